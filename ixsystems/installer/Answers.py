@@ -0,0 +1,275 @@
+"""
+Answer files, for unattended installations.
+
+An answer file is JSON, and replaces every question the installer
+would otherwise ask:
+
+	{
+	    "disks" : { "ssd" : true, "min_size" : "32G" },
+	    "mode" : "auto",
+	    "boot" : "auto",
+	    "password_hash" : "$6$...",
+	    "data_dir" : "/data",
+	    "summary" : "/tmp/install-summary.json"
+	}
+
+"disks" is a disk selection rule.  It can be "all" (every eligible
+disk), a list of disk names, or an object with any of these keys,
+all of which have to match:
+
+	names		A list of disk names; shell-style wildcards ("ada*") are allowed.
+	serials		A list of disk serial numbers (the geom ident).
+	min_size	Smallest disk to use, in bytes or with a k/m/g/t suffix.
+	max_size	Largest disk to use.
+	ssd		true for only SSDs, false for only spinning disks.
+	count		Use at most this many of the matching disks (in name order).
+
+Disks that belong to an importable pool (other than a boot pool) are
+never picked by "all", wildcards, or sizes:  they are only used when
+the rule names them exactly, by name or by serial number.
+
+"mode" is one of:
+
+	format		Format the disks, and do a fresh installation.
+	upgrade		Format the disks, and upgrade the existing installation,
+			keeping its configuration.
+	new-be		Upgrade the existing installation into a new boot
+			environment, without formatting anything.
+	auto		upgrade if an upgradable installation is found, otherwise format.
+			(This is the default.)
+
+For upgrade and new-be, the disks rule may be left out, and the
+existing boot pool's disks are used.  If formatting would leave part
+of an existing boot pool behind, the installation fails unless
+"destroy_pool" is true.
+
+"boot" is "efi", "bios", or "auto" (the way this system booted; the
+default).  "password_hash" is a crypt(3) hash for the root password,
+and is ignored for upgrades; if it's missing, root has no password.
+"data_dir" is the /data prototype directory (default /data).  If
+"summary" is given, the final summary is written there as well as
+to standard output.
+
+The installer exits with one of the EXIT_* codes below, and prints
+the summary -- a JSON object with the status, exit code, and what was
+done -- as the last line of its output.
+"""
+from __future__ import print_function
+import os, sys
+import json
+import fnmatch
+
+from . import Utils
+
+EXIT_OK = 0
+EXIT_FAILURE = 10	# Anything unexpected
+EXIT_BAD_ANSWERS = 11	# The answer file couldn't be read, or is invalid
+EXIT_SYSTEM = 12	# The system failed validation (e.g., too little memory)
+EXIT_MANIFEST = 13	# No manifest could be found
+EXIT_NO_DISKS = 14	# No disks matched the selection rule
+EXIT_CONFLICT = 15	# The answers don't fit the system (e.g., nothing to upgrade)
+EXIT_PACKAGES = 16	# The packages couldn't be fetched or verified
+EXIT_INSTALL = 17	# The installation itself failed
+
+MODES = ("auto", "format", "upgrade", "new-be")
+BOOT_METHODS = ("auto", "efi", "bios")
+
+class AnswerError(RuntimeError):
+    """
+    An unattended installation failed; code is the EXIT_* code
+    the installer should exit with.
+    """
+    def __init__(self, message, code=EXIT_BAD_ANSWERS):
+        super(AnswerError, self).__init__(message)
+        self._message = message
+        self._code = code
+    @property
+    def message(self):
+        return self._message
+    @property
+    def code(self):
+        return self._code
+
+def _Size(value, key):
+    if isinstance(value, bool):
+        raise AnswerError("{} must be a size, not {!r}".format(key, value))
+    if isinstance(value, int):
+        return value
+    value = str(value).strip()
+    size = Utils.ParseSize(value)
+    if size == 0 and value.rstrip("kKmMgGtT") not in ("0", ""):
+        raise AnswerError("{} has an invalid size {!r}".format(key, value))
+    return size
+
+def _StringList(value, key):
+    if isinstance(value, str):
+        return [value]
+    if not isinstance(value, list) or not all(isinstance(x, str) for x in value):
+        raise AnswerError("{} must be a list of strings".format(key))
+    return value
+
+class DiskRule(object):
+    """
+    A disk selection rule (see above).  select() is given the
+    DiskClassification objects from Menu.DiskInventory.eligible().
+    """
+    _keys = ("names", "serials", "min_size", "max_size", "ssd", "count")
+
+    def __init__(self, rule):
+        self.names = None
+        self.serials = None
+        self.min_size = None
+        self.max_size = None
+        self.ssd = None
+        self.count = None
+        if rule == "all":
+            rule = {}
+        elif isinstance(rule, (list, str)):
+            rule = { "names" : rule }
+        if not isinstance(rule, dict):
+            raise AnswerError("disks must be \"all\", a list of names, or an object")
+        for key in rule:
+            if key not in self._keys:
+                raise AnswerError("Unknown disk rule key {!r}".format(key))
+        if "names" in rule:
+            self.names = _StringList(rule["names"], "disks.names")
+        if "serials" in rule:
+            self.serials = _StringList(rule["serials"], "disks.serials")
+        if "min_size" in rule:
+            self.min_size = _Size(rule["min_size"], "disks.min_size")
+        if "max_size" in rule:
+            self.max_size = _Size(rule["max_size"], "disks.max_size")
+        if "ssd" in rule:
+            if not isinstance(rule["ssd"], bool):
+                raise AnswerError("disks.ssd must be true or false")
+            self.ssd = rule["ssd"]
+        if "count" in rule:
+            count = rule["count"]
+            if isinstance(count, bool) or not isinstance(count, int) or count < 1:
+                raise AnswerError("disks.count must be a positive integer")
+            self.count = count
+
+    def __repr__(self):
+        return "DiskRule({})".format(", ".join("{}={!r}".format(key, getattr(self, key))
+                                               for key in self._keys
+                                               if getattr(self, key) is not None))
+
+    def matches(self, entry):
+        """
+        Whether a Utils.DiskEntry matches the rule.
+        """
+        config = entry.config or {}
+        if self.names is not None:
+            if not any(fnmatch.fnmatchcase(entry.name, pattern) for pattern in self.names):
+                return False
+        if self.serials is not None:
+            if config.get("ident", None) not in self.serials:
+                return False
+        if self.min_size is not None and entry.size < self.min_size:
+            return False
+        if self.max_size is not None and entry.size > self.max_size:
+            return False
+        if self.ssd is not None:
+            try:
+                is_ssd = int(config.get("rotationrate", 0)) == 0
+            except (TypeError, ValueError):
+                is_ssd = False
+            if is_ssd != self.ssd:
+                return False
+        return True
+
+    def named(self, entry):
+        """
+        Whether the rule names a Utils.DiskEntry exactly (by a name
+        without wildcards, or by serial number), rather than just
+        matching it.
+        """
+        config = entry.config or {}
+        if self.names is not None and entry.name in self.names:
+            return True
+        if self.serials is not None and config.get("ident", None) in self.serials:
+            return True
+        return False
+
+    def select(self, candidates, pool_disks=()):
+        """
+        Return the names of the matching disks, in name order, and
+        limited to count.  The disks in pool_disks (the ones in some
+        other pool) are only selected if the rule names them.
+        """
+        names = sorted(x.name for x in candidates
+                       if x.entry and self.matches(x.entry) and
+                       (x.name not in pool_disks or self.named(x.entry)))
+        if self.count is not None:
+            names = names[:self.count]
+        return names
+
+class Answers(object):
+    """
+    A parsed, validated, answer file.
+    """
+    _keys = ("disks", "mode", "boot", "password_hash", "data_dir",
+             "destroy_pool", "summary")
+
+    def __init__(self, data, path=None):
+        if not isinstance(data, dict):
+            raise AnswerError("The answer file must contain a JSON object")
+        for key in data:
+            if key not in self._keys:
+                raise AnswerError("Unknown answer {!r}".format(key))
+        self.path = path
+        self.disk_rule = DiskRule(data["disks"]) if data.get("disks", None) is not None else None
+        self.mode = data.get("mode", "auto")
+        if self.mode not in MODES:
+            raise AnswerError("mode must be one of {}".format(", ".join(MODES)))
+        self.boot = data.get("boot", "auto")
+        if self.boot not in BOOT_METHODS:
+            raise AnswerError("boot must be one of {}".format(", ".join(BOOT_METHODS)))
+        self.password_hash = data.get("password_hash", None)
+        if self.password_hash is not None and not isinstance(self.password_hash, str):
+            raise AnswerError("password_hash must be a string")
+        self.data_dir = data.get("data_dir", None)
+        if self.data_dir is not None and not isinstance(self.data_dir, str):
+            raise AnswerError("data_dir must be a string")
+        self.destroy_pool = data.get("destroy_pool", False)
+        if not isinstance(self.destroy_pool, bool):
+            raise AnswerError("destroy_pool must be true or false")
+        self.summary_path = data.get("summary", None)
+        if self.summary_path is not None and not isinstance(self.summary_path, str):
+            raise AnswerError("summary must be a path")
+
+    def __repr__(self):
+        # Leave the password hash out of the logs
+        return "Answers(path={!r}, disks={!r}, mode={!r}, boot={!r}, password={}, data_dir={!r}, destroy_pool={!r})".format(
+            self.path, self.disk_rule, self.mode, self.boot,
+            "set" if self.password_hash else "none", self.data_dir, self.destroy_pool)
+
+def Load(path):
+    """
+    Read and validate an answer file.  Raises AnswerError.
+    """
+    try:
+        with open(path) as f:
+            data = json.load(f)
+    except (IOError, OSError) as e:
+        raise AnswerError("Could not read answer file {}: {}".format(path, str(e)))
+    except ValueError as e:
+        raise AnswerError("Answer file {} is not valid JSON: {}".format(path, str(e)))
+    return Answers(data, path=path)
+
+def WriteSummary(summary, path=None):
+    """
+    Print the summary as a single JSON line to standard output, and
+    write it to path if one is given.
+    """
+    text = json.dumps(summary, sort_keys=True)
+    if path:
+        try:
+            tmp_path = path + ".tmp"
+            with open(tmp_path, "w") as f:
+                print(text, file=f)
+            os.rename(tmp_path, path)
+        except (IOError, OSError) as e:
+            Utils.LogIt("Could not write summary to {}: {}".format(path, str(e)))
+    print(text)
+    sys.stdout.flush()
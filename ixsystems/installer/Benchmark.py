@@ -0,0 +1,593 @@
+"""
+Benchmarks for the installer.  Run as
+
+	python -m ixsystems.installer.Benchmark <benchmark> [options]
+
+Each benchmark prints its results as JSON.  The install benchmarks
+run on simulated hardware (see Simulator), so they work on any
+machine, and never touch its disks.
+"""
+from __future__ import print_function
+import os, sys
+import json
+import time
+import shutil
+import socket
+import hashlib
+import tempfile
+import argparse
+import resource
+import subprocess
+
+from . import Simulator
+
+def _MakeFiles(directory, count, size):
+    """
+    Create count files of random data, size bytes each, in directory.
+    Returns a list of paths.
+    """
+    paths = []
+    block = 1024 * 1024
+    for index in range(count):
+        path = os.path.join(directory, "package-{}.tgz".format(index))
+        with open(path, "wb") as f:
+            remaining = size
+            while remaining > 0:
+                chunk = min(block, remaining)
+                f.write(os.urandom(chunk))
+                remaining -= chunk
+        paths.append(path)
+    return paths
+
+def _SerialHash(path):
+    # This is how a package file gets checked without the Verify module
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
+def _EnsureModules():
+    """
+    The installer modules need bsd, libzfs, and freenasOS; if those
+    aren't available, use the simulated ones.
+    """
+    try:
+        import bsd.geom, libzfs, freenasOS.Manifest
+    except ImportError:
+        hardware = Simulator.Hardware(disks=0, packages=0)
+        hardware.install()
+        hardware.cleanup()
+
+def VerifyBenchmark(directory=None, count=100, size=10 * 1024 * 1024, workers=None):
+    """
+    Compare verifying a package set serially (read + sha256, one file
+    at a time), cold (Verify, no stamps), and warm (Verify, with the
+    stamps from the cold run).  If directory is None, a package set of
+    count files of size bytes is created, and removed afterwards.
+    Note that "cold" refers to the stamp cache, not the buffer cache.
+    """
+    from . import Verify
+    workers = workers or Verify.DEFAULT_WORKERS
+    cleanup = None
+    if directory is None:
+        cleanup = directory = tempfile.mkdtemp(prefix="verify-bench.")
+        paths = _MakeFiles(directory, count, size)
+    else:
+        paths = sorted(os.path.join(directory, x) for x in os.listdir(directory)
+                       if os.path.isfile(os.path.join(directory, x)))
+    try:
+        total_bytes = sum(os.path.getsize(x) for x in paths)
+        start = time.time()
+        checksums = { path : _SerialHash(path) for path in paths }
+        serial_time = time.time() - start
+
+        stamps = Verify.VerifiedStamps(path=None)
+        verifier = Verify.PackageVerifier(stamps=stamps, max_workers=workers)
+        start = time.time()
+        cold = verifier.verify(checksums.items())
+        cold_time = time.time() - start
+
+        start = time.time()
+        warm = verifier.verify(checksums.items())
+        warm_time = time.time() - start
+
+        return {
+            "benchmark" : "verify",
+            "files" : len(paths),
+            "bytes" : total_bytes,
+            "workers" : workers,
+            "serial_seconds" : serial_time,
+            "cold_seconds" : cold_time,
+            "warm_seconds" : warm_time,
+            "verified" : all(cold.values()) and all(warm.values()),
+            "stats" : verifier.stats(),
+        }
+    finally:
+        if cleanup:
+            shutil.rmtree(cleanup, ignore_errors=True)
+
+def _MakeTree(directory, small_files, small_size, large_files, large_size):
+    """
+    Fill directory with small_files files of small_size bytes (100 to
+    a subdirectory), and large_files sparse files of large_size bytes
+    (alternating 1Mbyte of data and 1Mbyte of hole, like a database
+    with free pages).
+    """
+    block = 1024 * 1024
+    data = os.urandom(max(small_size, block))
+    for index in range(small_files):
+        subdir = os.path.join(directory, "dir-{}".format(index // 100))
+        if index % 100 == 0:
+            os.makedirs(subdir)
+        with open(os.path.join(subdir, "file-{}".format(index)), "wb") as f:
+            f.write(data[:small_size])
+    for index in range(large_files):
+        fd = os.open(os.path.join(directory, "db-{}.db".format(index)),
+                     os.O_WRONLY | os.O_CREAT, 0o644)
+        try:
+            for offset in range(0, large_size, 2 * block):
+                os.pwrite(fd, data[:min(block, large_size - offset)], offset)
+            os.ftruncate(fd, large_size)
+        finally:
+            os.close(fd)
+
+def _TreeUsage(directory):
+    # (files, apparent bytes, allocated bytes)
+    files = size = allocated = 0
+    for (root, dirs, names) in os.walk(directory):
+        for name in names:
+            st = os.lstat(os.path.join(root, name))
+            files += 1
+            size += st.st_size
+            allocated += st.st_blocks * 512
+    return (files, size, allocated)
+
+def _BaselineCopy(src, dst):
+    """
+    The copy Install() used to do:  bsd.copy.copytree, logging every
+    file.  Where bsd isn't available, shutil.copytree stands in for it.
+    Returns the name of what was used.
+    """
+    from . import Logger
+    def Progress(s, d):
+        Logger.Info("installer", "Copying {} -> {}".format(s, d))
+    try:
+        from bsd.copy import copytree
+    except ImportError:
+        def Copy(s, d):
+            shutil.copy2(s, d)
+            Progress(s, d)
+        shutil.copytree(src, dst, symlinks=True, copy_function=Copy, dirs_exist_ok=True)
+        return "shutil.copytree"
+    copytree(src, dst, progress_callback=Progress)
+    return "bsd.copy.copytree"
+
+def CopyBenchmark(directory=None, small_files=20000, small_size=4096,
+                  large_files=4, large_size=256 * 1024 * 1024, workers=None, repeat=2):
+    """
+    Compare the old copytree with TreeCopy, on a tree of many small
+    files and on a tree of a few large sparse files, created in
+    directory (default a temporary directory), which should be on the
+    file system to be measured.  Each copy is done repeat times, and
+    the best time kept.
+    """
+    from . import TreeCopy, Logger
+    workers = workers or TreeCopy.DEFAULT_WORKERS
+    base = tempfile.mkdtemp(prefix="copy-bench.", dir=directory)
+    Logger.Init(os.path.join(base, "copy.log"))
+    try:
+        trees = [
+            ("small-files", small_files, small_size, 0, 0),
+            ("large-files", 0, 0, large_files, large_size),
+        ]
+        results = []
+        for (name, *shape) in trees:
+            src = os.path.join(base, name)
+            os.mkdir(src)
+            _MakeTree(src, *shape)
+            (files, size, allocated) = _TreeUsage(src)
+            result = {
+                "tree" : name,
+                "files" : files,
+                "bytes" : size,
+                "allocated_bytes" : allocated,
+            }
+            for copier in ["baseline", "treecopy"]:
+                best = None
+                for run in range(repeat):
+                    dst = os.path.join(base, "{}.{}.{}".format(name, copier, run))
+                    start = time.monotonic()
+                    if copier == "baseline":
+                        result["baseline"] = _BaselineCopy(src, dst)
+                    else:
+                        result["treecopy_stats"] = TreeCopy.CopyTree(src, dst, workers=workers)
+                    elapsed = time.monotonic() - start
+                    if best is None or elapsed < best:
+                        best = elapsed
+                    result["{}_allocated_bytes".format(copier)] = _TreeUsage(dst)[2]
+                    shutil.rmtree(dst)
+                result["{}_seconds".format(copier)] = best
+                result["{}_mbytes_per_second".format(copier)] = (size / best / (1024 * 1024)) if best else None
+            if result["treecopy_seconds"]:
+                result["speedup"] = result["baseline_seconds"] / result["treecopy_seconds"]
+            results.append(result)
+            shutil.rmtree(src)
+        return {
+            "benchmark" : "copy",
+            "directory" : base,
+            "workers" : workers,
+            "repeat" : repeat,
+            "results" : results,
+        }
+    finally:
+        Logger.Shutdown()
+        shutil.rmtree(base, ignore_errors=True)
+
+def _PeakRSS():
+    # ru_maxrss is in kbytes on Linux and FreeBSD (bytes on macOS)
+    usage = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return usage if sys.platform == "darwin" else usage * 1024
+
+def _SpanTotals(spans, parent):
+    """
+    Total time for each span name directly inside the (last) span named parent.
+    """
+    outer = [x for x in spans if x.name == parent]
+    if not outer:
+        return {}
+    outer = outer[-1]
+    totals = {}
+    for span in spans:
+        if (span.tid == outer.tid and span.depth == outer.depth + 1 and
+            span.start >= outer.start and span.end <= outer.end):
+            totals[span.name] = totals.get(span.name, 0) + span.duration
+    return totals
+
+def InstallBenchmark(disks=4, packages=50, package_size=256 * 1024, disk_size=16 * 1024 * 1024 * 1024,
+                     select=None, latency=Simulator.DEFAULT_LATENCY,
+                     throughput=Simulator.DEFAULT_THROUGHPUT,
+                     network_latency=Simulator.DEFAULT_NETWORK_LATENCY,
+                     network_throughput=Simulator.DEFAULT_NETWORK_THROUGHPUT,
+                     pipeline=True, efi=False):
+    """
+    On simulated hardware, time Menu.SelectDisks(), Install.FormatDisks()
+    (on the selected disks), and then a full non-interactive
+    Install.Install() (which formats them again).  This has to be run
+    in a fresh process; see InstallSweep().
+    """
+    hardware = Simulator.Hardware(disks=disks, disk_size=disk_size, packages=packages,
+                                  package_size=package_size, select=select,
+                                  latency=latency, throughput=throughput,
+                                  network_latency=network_latency,
+                                  network_throughput=network_throughput)
+    try:
+        hardware.install()
+        from . import Utils, Install, Menu, Trace, Verify, Logger
+        import freenasOS.Manifest as Manifest
+        import freenasOS.Configuration as Configuration
+
+        Utils.InitLog(os.path.join(hardware.root, "install.log"))
+        Verify.DEFAULT_STAMP_FILE = os.path.join(hardware.root, "verified.json")
+        Trace.Reset()
+        phases = {}
+        wall_start = time.monotonic()
+
+        start = time.monotonic()
+        selected = Menu.SelectDisks()
+        phases["SelectDisks"] = time.monotonic() - start
+        if not selected:
+            raise RuntimeError("SelectDisks did not select any disks")
+
+        boot_part = Utils.Partition(type="efi" if efi else "bios-boot", index=1,
+                                    size=(100 * 1024 * 1024) if efi else (512 * 1024))
+        os_part = Utils.Partition(type="freebsd-zfs", index=2, size=None, os=True)
+        start = time.monotonic()
+        pool = Install.FormatDisks(selected, [boot_part, os_part], False)
+        phases["FormatDisks"] = time.monotonic() - start
+        # Leave it for Install() to find and destroy, as on a re-install
+        Install.zfs.export_pool(pool)
+
+        manifest = Manifest.Manifest()
+        config = Configuration.SystemConfiguration()
+        start = time.monotonic()
+        if not pipeline:
+            Utils.GetPackages(manifest, config, hardware.package_dir, interactive=False)
+        Install.Install(interactive=False,
+                        disks=selected,
+                        efi=efi,
+                        manifest=manifest,
+                        config=config,
+                        package_directory=hardware.package_dir,
+                        data_dir=os.path.join(hardware.root, "no-data"),
+                        pipeline=pipeline)
+        phases["Install"] = time.monotonic() - start
+        wall = time.monotonic() - wall_start
+        Logger.Flush()
+
+        spans = Trace.GetTracer().spans()
+        return {
+            "benchmark" : "install",
+            "disks" : disks,
+            "selected" : len(selected),
+            "packages" : packages,
+            "package_size" : package_size,
+            "pipeline" : pipeline,
+            "efi" : efi,
+            "wall_seconds" : wall,
+            "peak_rss_bytes" : _PeakRSS(),
+            "phases" : phases,
+            "install_phases" : _SpanTotals(spans, "Install"),
+            "commands" : len(Utils.command_stats.records()),
+            "simulator" : hardware.stats(),
+        }
+    finally:
+        hardware.cleanup()
+
+def _UpgradeRun(packages, changed, package_size, pipeline, incremental):
+    """
+    Install on fresh simulated hardware, make a new release with changed
+    packages changed, and upgrade into a new boot environment.
+    Returns the upgrade's time and the simulator's counts for it.
+    """
+    hardware = Simulator.Hardware(disks=2, packages=packages, package_size=package_size)
+    try:
+        hardware.install()
+        from . import Utils, Install, Menu, Verify, Logger
+        import freenasOS.Manifest as Manifest
+        import freenasOS.Configuration as Configuration
+
+        Utils.InitLog(os.path.join(hardware.root, "install.log"))
+        Verify.DEFAULT_STAMP_FILE = os.path.join(hardware.root, "verified.json")
+        data_dir = os.path.join(hardware.root, "no-data")
+        Install.Install(interactive=False,
+                        disks=Menu.SelectDisks(),
+                        manifest=Manifest.Manifest(),
+                        config=Configuration.SystemConfiguration(),
+                        package_directory=hardware.package_dir,
+                        data_dir=data_dir,
+                        pipeline=pipeline)
+        hardware.release(changed=changed)
+        pool = list(Install.zfs.find_import(name="freenas-boot"))[0]
+        before = hardware.stats()
+        start = time.monotonic()
+        Install.Install(interactive=False,
+                        disks=None,
+                        upgrade_from=pool,
+                        upgrade=True,
+                        manifest=Manifest.Manifest(),
+                        config=Configuration.SystemConfiguration(),
+                        package_directory=hardware.package_dir,
+                        data_dir=data_dir,
+                        pipeline=pipeline,
+                        incremental=incremental)
+        elapsed = time.monotonic() - start
+        Logger.Flush()
+        after = hardware.stats()
+        return {
+            "seconds" : elapsed,
+            "simulator" : { key : after[key] - before.get(key, 0) for key in after },
+        }
+    finally:
+        hardware.cleanup()
+
+def UpgradeBenchmark(packages=50, changed=2, package_size=256 * 1024, pipeline=True):
+    """
+    Compare a full upgrade into a new boot environment with an
+    incremental one (clone the old BE, install only what changed),
+    for a release in which changed of the packages changed.
+    """
+    full = _UpgradeRun(packages, changed, package_size, pipeline, incremental=False)
+    incremental = _UpgradeRun(packages, changed, package_size, pipeline, incremental=True)
+    return {
+        "benchmark" : "upgrade",
+        "packages" : packages,
+        "changed" : changed,
+        "package_size" : package_size,
+        "pipeline" : pipeline,
+        "full_seconds" : full["seconds"],
+        "incremental_seconds" : incremental["seconds"],
+        "speedup" : full["seconds"] / incremental["seconds"] if incremental["seconds"] else None,
+        "full" : full["simulator"],
+        "incremental" : incremental["simulator"],
+    }
+
+def _GitCommit():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "HEAD"],
+                                       cwd=os.path.dirname(os.path.abspath(__file__)),
+                                       stderr=subprocess.DEVNULL).decode("utf-8").strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def _Compare(results, baseline):
+    """
+    Return lines comparing results with baseline (both lists of install
+    results), as new/old ratios for each phase.
+    """
+    old = { (x["disks"], x["packages"]) : x for x in baseline }
+    lines = []
+    for result in results:
+        key = (result["disks"], result["packages"])
+        if key not in old or "phases" not in old[key] or "phases" not in result:
+            continue
+        ratios = []
+        for name in sorted(result["phases"]):
+            if old[key]["phases"].get(name):
+                ratios.append("{} {:.2f}x".format(name, result["phases"][name] / old[key]["phases"][name]))
+        rss = old[key].get("peak_rss_bytes")
+        if rss:
+            ratios.append("RSS {:.2f}x".format(float(result["peak_rss_bytes"]) / rss))
+        lines.append("disks={} packages={}: {}".format(key[0], key[1], ", ".join(ratios)))
+    return lines
+
+def InstallSweep(disk_counts, package_counts, output=None, baseline=None, options=None):
+    """
+    Run InstallBenchmark() for each combination of disk and package
+    counts, each in its own process (so peak RSS means something).
+    If output is given, the results are written there; if baseline is
+    the path of an earlier output, a comparison is printed to stderr.
+    """
+    root = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    env = dict(os.environ)
+    env["PYTHONPATH"] = os.pathsep.join([root] + [x for x in env.get("PYTHONPATH", "").split(os.pathsep) if x])
+    results = []
+    for disks in disk_counts:
+        for packages in package_counts:
+            command = [sys.executable, "-m", "ixsystems.installer.Benchmark", "install-one",
+                       "--disks", str(disks), "--packages", str(packages)] + list(options or [])
+            print("Running {} disks, {} packages".format(disks, packages), file=sys.stderr)
+            child = subprocess.run(command, env=env, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+            if child.returncode == 0:
+                results.append(json.loads(child.stdout.decode("utf-8")))
+            else:
+                results.append({ "benchmark" : "install", "disks" : disks, "packages" : packages,
+                                 "error" : child.stderr.decode("utf-8", "replace").strip().split("\n")[-1] })
+    report = {
+        "benchmark" : "install-sweep",
+        "created" : time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "commit" : _GitCommit(),
+        "host" : socket.gethostname(),
+        "python" : sys.version.split()[0],
+        "results" : results,
+    }
+    if output:
+        with open(output, "w") as f:
+            json.dump(report, f, indent=2, sort_keys=True)
+    if baseline:
+        with open(baseline, "r") as f:
+            for line in _Compare(results, json.load(f).get("results", [])):
+                print(line, file=sys.stderr)
+    return report
+
+def _Counts(value):
+    return [int(x) for x in value.split(",") if x]
+
+def _SimulationArguments(parser):
+    parser.add_argument("--package-size", dest="package_size", default="256k",
+                        help="Size of each package")
+    parser.add_argument("--disk-size", dest="disk_size", default="16g",
+                        help="Size of each disk")
+    parser.add_argument("--select", dest="select", type=int, default=None,
+                        help="How many disks to select (default all)")
+    parser.add_argument("--latency", dest="latency", type=float, default=Simulator.DEFAULT_LATENCY,
+                        help="Disk latency, in seconds")
+    parser.add_argument("--throughput", dest="throughput", default="200m",
+                        help="Disk throughput, in bytes per second")
+    parser.add_argument("--network-latency", dest="network_latency", type=float,
+                        default=Simulator.DEFAULT_NETWORK_LATENCY,
+                        help="Network latency, in seconds")
+    parser.add_argument("--network-throughput", dest="network_throughput", default="100m",
+                        help="Network throughput, in bytes per second")
+    parser.add_argument("--no-pipeline", dest="pipeline", action="store_false", default=True,
+                        help="Download all packages before installing")
+    parser.add_argument("--efi", dest="efi", action="store_true", default=False,
+                        help="Partition for EFI instead of BIOS")
+
+def _SimulationOptions(args):
+    # The same options, as command-line arguments for a child process
+    options = ["--package-size", args.package_size, "--disk-size", args.disk_size,
+               "--latency", str(args.latency), "--throughput", args.throughput,
+               "--network-latency", str(args.network_latency),
+               "--network-throughput", args.network_throughput]
+    if args.select is not None:
+        options.extend(["--select", str(args.select)])
+    if not args.pipeline:
+        options.append("--no-pipeline")
+    if args.efi:
+        options.append("--efi")
+    return options
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Installer benchmarks", prog="Benchmark")
+    subparsers = parser.add_subparsers(dest="benchmark")
+
+    verify = subparsers.add_parser("verify", help="Package verification, cold and warm")
+    verify.add_argument("-d", "--directory", dest="directory",
+                        help="Directory of package files to verify (default: generate them)")
+    verify.add_argument("-n", "--packages", dest="count", type=int, default=100,
+                        help="Number of packages to generate")
+    verify.add_argument("-s", "--size", dest="size", default="10m",
+                        help="Size of each generated package")
+    verify.add_argument("-w", "--workers", dest="workers", type=int, default=None,
+                        help="Number of hashing threads")
+
+    copy = subparsers.add_parser("copy", help="The old copytree against TreeCopy, on small and large files")
+    copy.add_argument("-d", "--directory", dest="directory",
+                      help="Where to create the trees (default: a temporary directory)")
+    copy.add_argument("--small-files", dest="small_files", type=int, default=20000,
+                      help="Number of small files")
+    copy.add_argument("--small-size", dest="small_size", default="4k",
+                      help="Size of each small file")
+    copy.add_argument("--large-files", dest="large_files", type=int, default=4,
+                      help="Number of large (sparse) files")
+    copy.add_argument("--large-size", dest="large_size", default="256m",
+                      help="Size of each large file")
+    copy.add_argument("-w", "--workers", dest="workers", type=int, default=None,
+                      help="Number of copying threads")
+    copy.add_argument("-r", "--repeat", dest="repeat", type=int, default=2,
+                      help="Copies of each tree to time (the best is kept)")
+
+    install = subparsers.add_parser("install", help="SelectDisks, FormatDisks, and Install on simulated hardware")
+    install.add_argument("--disks", dest="disks", default="1,10,100,1000",
+                         help="Comma-separated disk counts")
+    install.add_argument("--packages", dest="packages", default="10,100,2000",
+                         help="Comma-separated package counts")
+    install.add_argument("-o", "--output", dest="output",
+                         help="Write the results to this file")
+    install.add_argument("-b", "--baseline", dest="baseline",
+                         help="Compare with the results in this file")
+    _SimulationArguments(install)
+
+    install_one = subparsers.add_parser("install-one", help="One run of the install benchmark (in this process)")
+    install_one.add_argument("--disks", dest="disks", type=int, default=4)
+    install_one.add_argument("--packages", dest="packages", type=int, default=50)
+    _SimulationArguments(install_one)
+
+    upgrade = subparsers.add_parser("upgrade", help="Full and incremental upgrades into a new boot environment")
+    upgrade.add_argument("--packages", dest="packages", type=int, default=50,
+                         help="Number of packages")
+    upgrade.add_argument("--changed", dest="changed", type=int, default=2,
+                         help="Number of packages changed in the new release")
+    upgrade.add_argument("--package-size", dest="package_size", default="256k",
+                         help="Size of each package")
+    upgrade.add_argument("--no-pipeline", dest="pipeline", action="store_false", default=True,
+                         help="Download all packages before installing")
+
+    args = parser.parse_args(argv)
+    if args.benchmark == "verify":
+        _EnsureModules()
+        from .Utils import ParseSize
+        result = VerifyBenchmark(directory=args.directory, count=args.count,
+                                 size=ParseSize(args.size), workers=args.workers)
+    elif args.benchmark == "copy":
+        result = CopyBenchmark(directory=args.directory, small_files=args.small_files,
+                               small_size=Simulator.ParseSize(args.small_size),
+                               large_files=args.large_files,
+                               large_size=Simulator.ParseSize(args.large_size),
+                               workers=args.workers, repeat=args.repeat)
+    elif args.benchmark == "upgrade":
+        result = UpgradeBenchmark(packages=args.packages, changed=args.changed,
+                                  package_size=Simulator.ParseSize(args.package_size),
+                                  pipeline=args.pipeline)
+    elif args.benchmark == "install":
+        result = InstallSweep(_Counts(args.disks), _Counts(args.packages),
+                              output=args.output, baseline=args.baseline,
+                              options=_SimulationOptions(args))
+    elif args.benchmark == "install-one":
+        result = InstallBenchmark(disks=args.disks, packages=args.packages,
+                                  package_size=Simulator.ParseSize(args.package_size),
+                                  disk_size=Simulator.ParseSize(args.disk_size),
+                                  select=args.select, latency=args.latency,
+                                  throughput=Simulator.ParseSize(args.throughput),
+                                  network_latency=args.network_latency,
+                                  network_throughput=Simulator.ParseSize(args.network_throughput),
+                                  pipeline=args.pipeline, efi=args.efi)
+    else:
+        parser.print_help()
+        return 1
+    print(json.dumps(result, indent=2, sort_keys=True))
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
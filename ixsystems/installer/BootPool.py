@@ -0,0 +1,219 @@
+from __future__ import print_function
+import os
+import tempfile
+import threading
+import bsd
+import libzfs
+
+from . import Trace
+from .Utils import LogIt, InstallationError
+
+zfs = libzfs.ZFS()
+
+BOOT_POOL = "freenas-boot"
+
+class BootPoolSession(object):
+    """
+    An existing boot pool, imported at most once, and exported at most
+    once, however many steps of an installation look at it.  Importing
+    (and exporting) a pool on slow USB devices can take seconds, and
+    an upgrade used to do it three times.
+
+    pools is the list of unimported boot pools from zfs.find_import (as
+    found by Discovery); if it is None, find_import is run the first time
+    it's needed.  If there is exactly one, it is the pool that imported()
+    imports; the others can only be destroyed.  The active BE is mounted
+    read-only by mount_bootfs(), and stays mounted until unmount_bootfs()
+    or close().  Methods raise libzfs.ZFSException or OSError as the
+    underlying calls do, and InstallationError if there's no active BE.
+
+    This can be used as a context manager, which closes it.
+    """
+    def __init__(self, pools=None, name=BOOT_POOL):
+        self.name = name
+        self._pools = None if pools is None else list(pools)
+        self._imported = None
+        self._bootfs = None
+        self._mount_point = None
+        self._version = None
+        self._closed = False
+        self._lock = threading.RLock()
+
+    def __repr__(self):
+        return "BootPoolSession({}, {} found, {})".format(
+            self.name, "?" if self._pools is None else len(self._pools),
+            "closed" if self._closed else "imported" if self._imported else "not imported")
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self.close()
+
+    @property
+    def pools(self):
+        """
+        The unimported boot pools, looked for only if they weren't given.
+        """
+        with self._lock:
+            if self._pools is None:
+                with Trace.Span("FindBootPools"):
+                    self._pools = list(zfs.find_import(name=self.name))
+            return self._pools
+
+    @property
+    def pool(self):
+        """
+        The one unimported boot pool, or None if there isn't exactly one.
+        """
+        pools = self.pools
+        return pools[0] if len(pools) == 1 else None
+
+    @property
+    def is_imported(self):
+        return self._imported is not None
+
+    def imported(self):
+        """
+        Return the imported pool, importing it the first time.
+        Raises InstallationError if there isn't exactly one boot pool.
+        """
+        with self._lock:
+            if self._closed:
+                raise InstallationError("Boot pool {} has already been exported".format(self.name))
+            if self._imported is None:
+                if len(self.pools) > 1:
+                    raise InstallationError("There are multiple unimported {} pools".format(self.name))
+                if not self.pools:
+                    raise InstallationError("There is no {} pool".format(self.name))
+                with Trace.Span("ImportBootPool"):
+                    pool = zfs.import_pool(self.pool, self.name, {})
+                    if pool is None:
+                        pool = zfs.get(self.name)
+                LogIt("Imported {}".format(self.name))
+                self._imported = pool
+            return self._imported
+
+    @property
+    def bootfs(self):
+        """
+        The active BE's dataset name, or None.
+        """
+        with self._lock:
+            if self._bootfs is None:
+                self._bootfs = self.imported().properties["bootfs"].value or None
+                LogIt("bootfs = {}".format(self._bootfs))
+            return self._bootfs
+
+    def mount_bootfs(self):
+        """
+        Mount the active BE read-only (the first time), and return the
+        mount point.
+        """
+        with self._lock:
+            if self._mount_point is None:
+                bootfs = self.bootfs
+                if not bootfs:
+                    raise InstallationError("No active boot environment for upgrade")
+                mount_point = tempfile.mkdtemp()
+                try:
+                    with Trace.Span("MountBootfs"):
+                        bsd.nmount(source=bootfs,
+                                   fspath=mount_point,
+                                   fstype="zfs",
+                                   flags=bsd.MountFlags.RDONLY,
+                        )
+                except BaseException:
+                    os.rmdir(mount_point)
+                    raise
+                LogIt("Mounted {} on {}".format(bootfs, mount_point))
+                self._mount_point = mount_point
+            return self._mount_point
+
+    def unmount_bootfs(self):
+        """
+        Unmount the active BE, if mount_bootfs() mounted it.
+        """
+        with self._lock:
+            if self._mount_point is None:
+                return
+            mount_point = self._mount_point
+            self._mount_point = None
+            LogIt("Unmounting {}".format(mount_point))
+            try:
+                bsd.unmount(mount_point)
+            finally:
+                try:
+                    os.rmdir(mount_point)
+                except OSError:
+                    pass
+
+    def version(self):
+        """
+        The contents of the active BE's etc/version.
+        """
+        with self._lock:
+            if self._version is None:
+                with open(os.path.join(self.mount_bootfs(), "etc/version")) as f:
+                    self._version = f.read().rstrip()
+            return self._version
+
+    def destroy(self):
+        """
+        Destroy the boot pools:  the imported one, and any others
+        (which have to be imported, one at a time, to be destroyed).
+        Errors are logged.  The session is closed afterwards.
+        """
+        with self._lock:
+            if self._closed:
+                return
+            with Trace.Span("DestroyOldPools"):
+                try:
+                    self.unmount_bootfs()
+                except OSError as e:
+                    LogIt("Could not unmount the old BE: {}".format(str(e)))
+                try:
+                    pools = self.pools
+                except libzfs.ZFSException as e:
+                    LogIt("Got ZFS error {} while looking for {} pools to destroy".format(str(e), self.name))
+                    pools = []
+                for pool in pools:
+                    try:
+                        if self._imported is None or pool is not self.pool:
+                            zfs.import_pool(pool, self.name, {})
+                        zfs.destroy(self.name)
+                        LogIt("Destroyed a {} pool".format(self.name))
+                    except libzfs.ZFSException as e:
+                        LogIt("Trying to destroy a {} pool got error {}".format(self.name, str(e)))
+            self._imported = None
+            self._closed = True
+
+    def adopt(self, pool):
+        """
+        Take over pool (a newly-created boot pool), so close() exports it.
+        """
+        with self._lock:
+            self._imported = pool
+            self._bootfs = None
+            self._version = None
+            self._closed = False
+
+    def close(self):
+        """
+        Unmount the active BE and export the pool, if it was imported.
+        Only the first call does anything.
+        """
+        with self._lock:
+            if self._closed:
+                return
+            self._closed = True
+            try:
+                self.unmount_bootfs()
+            except OSError as e:
+                LogIt("Could not unmount the old BE: {}".format(str(e)))
+            if self._imported is not None:
+                pool = self._imported
+                self._imported = None
+                LogIt("Exporting {}".format(self.name))
+                with Trace.Span("ExportPool"):
+                    zfs.export_pool(pool)
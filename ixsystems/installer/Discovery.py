@@ -0,0 +1,146 @@
+from __future__ import print_function
+import time
+import threading
+import collections
+
+from . import Trace
+from .Utils import LogIt
+
+# Close enough to when the installer started
+_launched = time.monotonic()
+
+class _Task(object):
+    def __init__(self, name, func, disks, once):
+        self.name = name
+        self.func = func
+        self.disks = disks
+        self.once = once
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+        self.disk_key = None
+        self.seconds = None
+        self.used = False
+
+class Discovery(object):
+    """
+    Find out about the system -- disks, boot pools, memory, and the
+    like -- on a background thread, while the operator is looking at
+    the menu.  Each task is a function; get() returns its result (or
+    raises its exception), waiting for it if it hasn't finished yet.
+    If discovery hasn't been started, get() just calls the function.
+
+    Tasks added with disks=True depend on which disks there are.
+    disk_key is a function returning something that changes when a
+    disk is added or removed (kern.disks); if it has changed since a
+    task ran, invalidate is called and the task is run again.  Tasks
+    added with once=True give their background result only once (e.g.,
+    the importable pools, which an installation changes).
+    """
+    def __init__(self, disk_key=None, invalidate=None):
+        self._tasks = collections.OrderedDict()
+        self._disk_key = disk_key
+        self._invalidate = invalidate
+        self._lock = threading.Lock()
+        self._thread = None
+        self._started = None
+
+    def add(self, name, func, disks=False, once=False):
+        self._tasks[name] = _Task(name, func, disks, once)
+
+    @property
+    def started(self):
+        return self._thread is not None
+
+    def _current_disk_key(self):
+        if self._disk_key is None:
+            return None
+        try:
+            return self._disk_key()
+        except BaseException as e:
+            LogIt("Discovery: unable to get the disk list: {}".format(str(e)))
+            return None
+
+    def start(self):
+        """
+        Start the background thread.  Only the first call does anything.
+        """
+        with self._lock:
+            if self._thread:
+                return
+            self._started = time.monotonic()
+            self._thread = threading.Thread(target=self._run, name="discovery")
+            self._thread.daemon = True
+            self._thread.start()
+
+    def _run(self):
+        with Trace.Span("Discovery"):
+            for task in self._tasks.values():
+                start = time.monotonic()
+                with Trace.Span("Discover", task=task.name):
+                    if task.disks:
+                        task.disk_key = self._current_disk_key()
+                    try:
+                        task.result = task.func()
+                    except BaseException as e:
+                        task.error = e
+                task.seconds = time.monotonic() - start
+                task.done.set()
+                LogIt("Discovery: {} took {:.3f} seconds{}".format(
+                    task.name, task.seconds,
+                    "" if task.error is None else ", and failed: {}".format(str(task.error))))
+        LogIt("Discovery: finished in {:.3f} seconds".format(time.monotonic() - self._started))
+
+    def disks_changed(self):
+        """
+        Whether the disks have changed since the disk tasks ran.  If
+        they have, invalidate is called (once per change).
+        """
+        if not self.started or self._disk_key is None:
+            return False
+        key = self._current_disk_key()
+        stale = [task for task in self._tasks.values()
+                 if task.disks and task.done.is_set() and task.disk_key != key]
+        changed = bool(stale)
+        if changed:
+            LogIt("Discovery: disks changed from {} to {}".format(stale[0].disk_key, key))
+            if self._invalidate:
+                self._invalidate()
+            for task in self._tasks.values():
+                if task.disks:
+                    task.disk_key = key
+                    task.used = True
+        return changed
+
+    def get(self, name):
+        """
+        The result of the named task:  the background one if it is
+        still good, otherwise the function's result now.
+        """
+        task = self._tasks[name]
+        if not self.started:
+            return task.func()
+        if not task.done.is_set():
+            LogIt("Discovery: waiting for {}".format(name))
+            with Trace.Span("WaitForDiscovery", task=name):
+                task.done.wait()
+        if task.disks:
+            self.disks_changed()
+        with self._lock:
+            stale = task.used
+            if task.once:
+                task.used = True
+        if stale:
+            return task.func()
+        if task.error is not None:
+            raise task.error
+        return task.result
+
+    def mark(self, event):
+        """
+        Log how long after the installer started event happened.
+        """
+        now = time.monotonic()
+        LogIt("Time to {}: {:.3f} seconds after launch{}".format(
+            event, now - _launched,
+            "" if self._started is None else ", {:.3f} after discovery started".format(now - self._started)))
@@ -0,0 +1,365 @@
+from __future__ import print_function
+import os
+import json
+import time
+import hashlib
+import threading
+import collections
+import http.client
+import urllib.parse
+
+import freenasOS.Exceptions as Exceptions
+
+from . import Trace
+from .Utils import LogIt, SmartSize
+
+DEFAULT_TIMEOUT = 30.0
+CHUNK_SIZE = 256 * 1024
+# Idle keep-alive connections kept for each server
+MAX_IDLE = 4
+# How often (in bytes) the progress of a download is recorded, for resuming
+CHECKPOINT_BYTES = 8 * 1024 * 1024
+MAX_REDIRECTS = 5
+# A download in progress is <path>.part, with its state in <path>.part.json
+PARTIAL_SUFFIX = ".part"
+STATE_SUFFIX = ".part.json"
+
+class DownloadError(RuntimeError):
+    """
+    Raised when a file could not be downloaded.  status is the HTTP
+    status, or None if the server couldn't be reached.
+    """
+    def __init__(self, url, status=None, message=""):
+        super(DownloadError, self).__init__(message)
+        self.url = url
+        self.status = status
+        self.message = message
+
+class DownloadCancelled(DownloadError):
+    """
+    Raised when a download is stopped because it was cancelled.
+    """
+    def __init__(self, url):
+        super(DownloadCancelled, self).__init__(url, message="Download of {} was cancelled".format(url))
+
+def PackageURL(conf, pkg):
+    """
+    Where the update server keeps pkg's full package file.
+    """
+    return "{}/Packages/{}".format(conf.UpdateServerURL().rstrip("/"), pkg.FileName())
+
+def _OpenConnection(scheme, host, port, timeout):
+    if scheme == "https":
+        return http.client.HTTPSConnection(host, port, timeout=timeout)
+    return http.client.HTTPConnection(host, port, timeout=timeout)
+
+# The simulator replaces this
+OpenConnection = _OpenConnection
+
+def _Preallocate(f, size):
+    """
+    Reserve size bytes for f, where the filesystem can (ZFS can't).
+    """
+    if not size or not hasattr(os, "posix_fallocate"):
+        return False
+    try:
+        os.posix_fallocate(f.fileno(), 0, size)
+        return True
+    except OSError:
+        return False
+
+class ConnectionPool(object):
+    """
+    Idle keep-alive connections, by (scheme, host, port).  get() hands
+    one out (opening a new one if there isn't one idle); put() returns
+    it once its response has been read completely.  A connection that
+    got an error should be closed instead.
+    """
+    def __init__(self, timeout=DEFAULT_TIMEOUT, max_idle=MAX_IDLE):
+        self._timeout = timeout
+        self._max_idle = max_idle
+        self._lock = threading.Lock()
+        self._idle = collections.defaultdict(list)
+        self._stats = { "opened" : 0, "reused" : 0 }
+
+    def get(self, key):
+        with self._lock:
+            if self._idle[key]:
+                self._stats["reused"] += 1
+                return self._idle[key].pop()
+            self._stats["opened"] += 1
+        return OpenConnection(key[0], key[1], key[2], self._timeout)
+
+    def put(self, key, conn):
+        with self._lock:
+            if len(self._idle[key]) < self._max_idle:
+                self._idle[key].append(conn)
+                return
+        conn.close()
+
+    def close(self):
+        with self._lock:
+            idle = [conn for conns in self._idle.values() for conn in conns]
+            self._idle.clear()
+        for conn in idle:
+            conn.close()
+
+    def stats(self):
+        with self._lock:
+            return dict(self._stats)
+
+class Downloader(object):
+    """
+    Download package files from the update server over keep-alive
+    connections (shared by all of the threads using this), instead of
+    going through freenasOS's FindPackageFile.
+
+    A download is written to <path>.part, and how far it got (with the
+    response's ETag or Last-Modified) to <path>.part.json, so a download
+    that's interrupted is resumed from there with a Range request, the
+    next time, as long as the file hasn't changed (If-Range).  The
+    checksum is computed as the bytes arrive, so the file doesn't have
+    to be read again to verify it; on a resume, only the part already
+    downloaded is read.
+    """
+    def __init__(self, timeout=DEFAULT_TIMEOUT, chunk_size=CHUNK_SIZE, max_idle=MAX_IDLE):
+        self._pool = ConnectionPool(timeout=timeout, max_idle=max_idle)
+        self._chunk_size = chunk_size
+        self._lock = threading.Lock()
+        self._stats = {
+            "downloads" : 0,
+            "resumed" : 0,
+            "restarted" : 0,
+            "bytes" : 0,
+            "resumed_bytes" : 0,
+            "seconds" : 0.0,
+        }
+
+    def __repr__(self):
+        return "<Downloader {}>".format(self.stats())
+
+    def close(self):
+        self._pool.close()
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._stats)
+        stats.update(self._pool.stats())
+        return stats
+
+    def log_stats(self):
+        stats = self.stats()
+        LogIt("Downloader: {} files, {}bytes at {}bytes/s, {} resumed (saving {}bytes), {} connections opened, {} reused".format(
+            stats["downloads"], SmartSize(stats["bytes"]),
+            SmartSize(int(stats["bytes"] / stats["seconds"]) if stats["seconds"] else 0),
+            stats["resumed"], SmartSize(stats["resumed_bytes"]),
+            stats["opened"], stats["reused"]))
+
+    def _count(self, **kwargs):
+        with self._lock:
+            for (key, value) in kwargs.items():
+                self._stats[key] += value
+
+    def _request(self, url, headers):
+        """
+        GET url, following redirects.  Returns (key, connection, response);
+        the caller has to read the response, and then return the connection
+        to the pool (or close it).  Raises DownloadError.
+        """
+        for redirect in range(MAX_REDIRECTS + 1):
+            parts = urllib.parse.urlsplit(url)
+            if parts.scheme not in ("http", "https"):
+                raise DownloadError(url, message="Unsupported URL {}".format(url))
+            key = (parts.scheme, parts.hostname, parts.port)
+            target = parts.path or "/"
+            if parts.query:
+                target += "?" + parts.query
+            # An idle connection may have been closed by the server; one retry, on a new one
+            for attempt in range(2):
+                conn = self._pool.get(key)
+                try:
+                    conn.request("GET", target, headers=headers)
+                    response = conn.getresponse()
+                    break
+                except (http.client.HTTPException, OSError) as e:
+                    conn.close()
+                    if attempt:
+                        raise DownloadError(url, message="Could not get {}: {}".format(url, str(e)))
+            if response.status in (301, 302, 303, 307, 308):
+                location = response.getheader("Location")
+                response.read()
+                self._pool.put(key, conn)
+                if not location:
+                    raise DownloadError(url, response.status, "Redirect from {} without a location".format(url))
+                url = urllib.parse.urljoin(url, location)
+                continue
+            return (key, conn, response)
+        raise DownloadError(url, message="Too many redirects for {}".format(url))
+
+    def _load_state(self, state_path, url):
+        try:
+            with open(state_path, "r") as f:
+                state = json.load(f)
+        except (OSError, IOError, ValueError):
+            return None
+        if state.get("url", None) != url or not state.get("validator", None):
+            return None
+        return state
+
+    def _save_state(self, state_path, state):
+        tmp_path = state_path + ".new"
+        with open(tmp_path, "w") as f:
+            json.dump(state, f)
+        os.rename(tmp_path, state_path)
+
+    def _discard(self, path):
+        for suffix in (PARTIAL_SUFFIX, STATE_SUFFIX):
+            try:
+                os.unlink(path + suffix)
+            except OSError:
+                pass
+
+    def fetch(self, url, path, size=None, checksum=None, handler=None, cancel=None):
+        """
+        Download url to path, resuming an earlier, interrupted download
+        of it if there is one.  size is the expected size, if known (the
+        server's is used otherwise); checksum, if given, is the file's
+        SHA256.  handler is called as freenasOS's download handlers are,
+        handler(path, url, size=, progress=, download_rate=), where
+        download_rate is the bytes per second actually received.
+        cancel, if given, is a threading.Event; once it is set, the
+        download stops at the next chunk (keeping what it has, to be
+        resumed) and raises DownloadCancelled.
+        Returns path.  Raises DownloadError, or ChecksumFailException
+        (after removing what was downloaded).
+        """
+        if cancel is not None and cancel.is_set():
+            raise DownloadCancelled(url)
+        partial = path + PARTIAL_SUFFIX
+        state_path = path + STATE_SUFFIX
+        state = self._load_state(state_path, url)
+        offset = 0
+        if state and os.path.exists(partial):
+            offset = min(int(state.get("done", 0)), os.path.getsize(partial))
+        headers = {}
+        if offset:
+            headers["Range"] = "bytes={}-".format(offset)
+            headers["If-Range"] = state["validator"]
+
+        with Trace.Span("Download", url=url, offset=offset):
+            (key, conn, response) = self._request(url, headers)
+            reusable = False
+            try:
+                resumed = False
+                if response.status == 206 and offset:
+                    content_range = response.getheader("Content-Range", "")
+                    try:
+                        (first, rest) = content_range.split(" ", 1)[1].split("-", 1)
+                        total = rest.split("/", 1)[1]
+                        total = None if total == "*" else int(total)
+                        resumed = int(first) == offset
+                    except (IndexError, ValueError):
+                        resumed = False
+                    if not resumed:
+                        # Resuming again would get the same answer
+                        self._discard(path)
+                        raise DownloadError(url, response.status,
+                                            "Bad Content-Range {} resuming {} at {}".format(content_range, url, offset))
+                elif response.status == 200:
+                    if offset:
+                        LogIt("{} has changed, so downloading it again".format(url))
+                        self._count(restarted=1)
+                    offset = 0
+                    length = response.getheader("Content-Length", None)
+                    total = int(length) if length else None
+                else:
+                    response.read()
+                    reusable = True
+                    if offset and response.status == 416:
+                        # E.g., all of it had been downloaded before a crash; the
+                        # next attempt starts over rather than asking for the same
+                        # range.  Anything else (a 503, say) may well pass, and the
+                        # partial download is kept for the next attempt.
+                        LogIt("Discarding the partial download of {}".format(url))
+                        self._discard(path)
+                    raise DownloadError(url, response.status, "Got HTTP {} {} for {}".format(
+                        response.status, response.reason, url))
+                total = total or size or None
+                validator = response.getheader("ETag", None) or response.getheader("Last-Modified", None)
+                if resumed:
+                    validator = state["validator"]
+                    LogIt("Resuming {} at {} of {}".format(url, offset, total))
+
+                digest = hashlib.sha256()
+                done = offset
+                received = 0
+                start = time.monotonic()
+                with open(partial, "r+b" if resumed else "w+b") as f:
+                    if resumed:
+                        # The part we already have, the one time it gets read
+                        while f.tell() < offset:
+                            data = f.read(min(self._chunk_size, offset - f.tell()))
+                            if not data:
+                                break
+                            digest.update(data)
+                        f.truncate(offset)
+                        f.seek(offset)
+                    _Preallocate(f, total)
+                    f.seek(offset)
+                    if validator:
+                        self._save_state(state_path, { "url" : url, "validator" : validator, "done" : done })
+                    checkpoint = done
+                    try:
+                        while True:
+                            if cancel is not None and cancel.is_set():
+                                raise DownloadCancelled(url)
+                            data = response.read(self._chunk_size)
+                            if not data:
+                                break
+                            f.write(data)
+                            digest.update(data)
+                            done += len(data)
+                            received += len(data)
+                            if validator and done - checkpoint >= CHECKPOINT_BYTES:
+                                f.flush()
+                                self._save_state(state_path, { "url" : url, "validator" : validator, "done" : done })
+                                checkpoint = done
+                            if handler:
+                                elapsed = max(time.monotonic() - start, 1e-6)
+                                handler(path, url, size=total or done,
+                                        progress=int(done * 100 / total) if total else 0,
+                                        download_rate=int(received / elapsed))
+                        if total and done != total:
+                            raise DownloadError(url, response.status, "Got {} of {} bytes of {}".format(done, total, url))
+                        reusable = True
+                    except BaseException:
+                        # Keep what we have, for next time
+                        if validator:
+                            try:
+                                f.flush()
+                                self._save_state(state_path, { "url" : url, "validator" : validator, "done" : done })
+                            except (OSError, IOError) as e:
+                                LogIt("Could not save the state of {}: {}".format(partial, str(e)))
+                        raise
+                    f.truncate(done)
+                elapsed = time.monotonic() - start
+            finally:
+                if reusable:
+                    self._pool.put(key, conn)
+                else:
+                    conn.close()
+
+        if checksum and digest.hexdigest() != checksum.lower():
+            self._discard(path)
+            raise Exceptions.ChecksumFailException("Checksum mismatch for {}".format(url))
+        os.rename(partial, path)
+        try:
+            os.unlink(state_path)
+        except OSError:
+            pass
+        self._count(downloads=1, bytes=received, seconds=elapsed,
+                    resumed=1 if resumed else 0, resumed_bytes=offset if resumed else 0)
+        LogIt("Downloaded {} ({}bytes{}) at {}bytes/s".format(
+            url, SmartSize(done), ", resumed at {}".format(offset) if resumed else "",
+            SmartSize(int(received / elapsed) if elapsed > 0 else 0)))
+        return path
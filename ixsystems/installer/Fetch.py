@@ -0,0 +1,433 @@
+from __future__ import print_function
+import os, sys
+import ctypes
+import threading
+import concurrent.futures
+
+import freenasOS.Exceptions as Exceptions
+from freenasOS.Update import PkgFileFullOnly
+
+from .Utils import LogIt
+from . import Verify
+from . import Trace
+from . import Download
+
+# How many packages to fetch at once, and how many times
+# to retry a package before giving up on it.
+DEFAULT_WORKERS = 4
+DEFAULT_RETRIES = 2
+# When pipelining, how many packages may be fetched ahead
+# of the one being installed.
+DEFAULT_WINDOW = 4
+# Background fetches use fewer workers, at this nice level (on Linux),
+# or in FreeBSD's idle scheduling class, at its lowest priority
+BACKGROUND_WORKERS = 2
+BACKGROUND_NICE = 19
+_RTP_SET = 1
+_RTP_PRIO_IDLE = 4
+_RTP_PRIO_MAX = 31
+# How long stopping a background fetch waits for downloads under way
+BACKGROUND_STOP_TIMEOUT = 5.0
+
+class _RTPrio(ctypes.Structure):
+    # FreeBSD's struct rtprio
+    _fields_ = [("type", ctypes.c_ushort), ("prio", ctypes.c_ushort)]
+
+def _LowerPriority():
+    """
+    Run the calling thread at the lowest CPU priority:  on FreeBSD, in
+    the idle class (rtprio_thread(2)), so it only gets time nothing else
+    wants; on Linux, which lets one thread be reniced, at nice 19.
+    Elsewhere that would renice the whole installer, so there the
+    background work is only limited by its worker count.
+    """
+    try:
+        if sys.platform.startswith("freebsd"):
+            libc = ctypes.CDLL(None, use_errno=True)
+            rtp = _RTPrio(_RTP_PRIO_IDLE, _RTP_PRIO_MAX)
+            # lwpid 0 is the calling thread
+            if libc.rtprio_thread(_RTP_SET, 0, ctypes.byref(rtp)) != 0:
+                error = ctypes.get_errno()
+                raise OSError(error, os.strerror(error))
+        elif sys.platform.startswith("linux") and hasattr(threading, "get_native_id"):
+            os.setpriority(os.PRIO_PROCESS, threading.get_native_id(), BACKGROUND_NICE)
+    except (AttributeError, OSError) as e:
+        LogIt("Could not lower the priority of {}: {}".format(threading.current_thread().name, str(e)))
+
+class FetchError(RuntimeError):
+    """
+    Raised by FetchScheduler when a package could not be fetched.
+    reason is one of "checksum", "missing", "cancelled", or "error".
+    """
+    def __init__(self, package, reason, message=""):
+        super(FetchError, self).__init__(message)
+        self.package = package
+        self.reason = reason
+        self.message = message
+
+def PackageSize(pkg, cache_dir=None):
+    """
+    Return the size, in bytes, of the package file.  The manifest
+    size is used if it has one; otherwise, if the file is already
+    in cache_dir, its size.  0 if it can't be determined.
+    """
+    try:
+        size = int(pkg.Size() or 0)
+    except:
+        size = 0
+    if not size and cache_dir:
+        try:
+            size = os.path.getsize(os.path.join(cache_dir, pkg.FileName()))
+        except OSError:
+            size = 0
+    return size
+
+def PackageChecksum(pkg):
+    """
+    Return the package file's checksum from the manifest, or None.
+    """
+    try:
+        return pkg.Checksum() or None
+    except:
+        return None
+
+class PackageFetch(object):
+    """
+    The state of one package in a FetchScheduler.
+    """
+    def __init__(self, pkg, size):
+        self.package = pkg
+        self.size = size
+        self.done_bytes = 0
+        self.attempts = 0
+        self.done = False
+        # Bytes per second, while it's being downloaded
+        self.rate = None
+
+    def __repr__(self):
+        return "<PackageFetch {}-{} size={} attempts={}>".format(self.package.Name(), self.package.Version(),
+                                                                self.size, self.attempts)
+
+class FetchScheduler(object):
+    """
+    Fetch and verify the packages for a manifest, with a bounded
+    number of packages in flight at once.  The largest packages are
+    started first, so the long downloads don't end up at the tail.
+    Each package is retried up to `retries` times; after that, the
+    first failure is raised as a FetchError from wait().
+
+    Progress is tracked in bytes across all of the packages; see progress().
+    This does not use any dialogs itself, so it is safe to poll from the
+    main thread while the workers run.
+
+    If ordered is True, the packages are kept in the given (manifest)
+    order instead; this is what pipeline() needs.
+
+    If store (a PackageCache.PackageStore) is given, it is checked for
+    a package before going to the update server, and packages that had
+    to be downloaded are added to it once they've been verified.
+
+    Package files that are already present are checked with verifier
+    (a Verify.PackageVerifier; one using the session's stamp file is
+    created if not given), so files verified by an earlier attempt
+    don't get hashed again.
+
+    If low_priority is True, the worker threads run at the lowest
+    priority the system allows for them (see BackgroundFetch).
+
+    If downloader (a Download.Downloader) is given, packages are
+    downloaded with it, rather than with the configuration's
+    FindPackageFile.
+    """
+    def __init__(self, conf, cache_dir, packages,
+                 max_workers=DEFAULT_WORKERS, retries=DEFAULT_RETRIES,
+                 ordered=False, store=None, verifier=None, low_priority=False,
+                 downloader=None):
+        self._conf = conf
+        self._cache_dir = cache_dir
+        self._store = store
+        self._downloader = downloader
+        if verifier is None:
+            verifier = Verify.PackageVerifier(max_workers=max_workers)
+        self._verifier = verifier
+        self._retries = retries
+        self._max_workers = max(1, max_workers)
+        self._initializer = _LowerPriority if low_priority else None
+        self._lock = threading.Lock()
+        self._cancelled = threading.Event()
+        self._executor = None
+        self._futures = {}
+        self._jobs = [PackageFetch(pkg, PackageSize(pkg, cache_dir)) for pkg in packages]
+        if not ordered:
+            self._jobs.sort(key=lambda job: job.size, reverse=True)
+
+    @property
+    def jobs(self):
+        return self._jobs
+
+    @property
+    def total_bytes(self):
+        return sum(job.size for job in self._jobs)
+
+    def progress(self):
+        """
+        Return (bytes done, bytes total, packages done, packages total).
+        """
+        with self._lock:
+            done_bytes = sum(job.done_bytes for job in self._jobs)
+            done_count = len([job for job in self._jobs if job.done])
+        return (done_bytes, self.total_bytes, done_count, len(self._jobs))
+
+    def percentage(self):
+        (done_bytes, total_bytes, done_count, total_count) = self.progress()
+        if total_bytes:
+            return int((done_bytes * 100) / total_bytes)
+        if total_count:
+            return int((done_count * 100) / total_count)
+        return 100
+
+    def download_rate(self):
+        """
+        The bytes per second being received, over the packages
+        being downloaded now.
+        """
+        with self._lock:
+            return sum(job.rate for job in self._jobs if job.rate and not job.done)
+
+    def _handler(self, job):
+        def DownloadHandler(path, url, size=0, progress=None, download_rate=None):
+            # The only way to stop FindPackageFile part way
+            if self._cancelled.is_set():
+                raise Download.DownloadCancelled(url)
+            if size and not job.size:
+                with self._lock:
+                    job.size = int(size)
+            if progress:
+                with self._lock:
+                    job.done_bytes = int((job.size * progress) / 100)
+            if download_rate is not None:
+                with self._lock:
+                    job.rate = download_rate
+        return DownloadHandler
+
+    def _download(self, job, path, checksum, from_store):
+        """
+        Get the package file with the downloader.  A file that came from
+        the store still has to be checked; a file that was already there
+        has been, and failed.
+        """
+        if from_store:
+            if self._verifier.check(path, checksum):
+                return
+            self._store.discard(checksum)
+        with Trace.Span("Download", package=job.package.Name(), attempt=job.attempts):
+            self._downloader.fetch(Download.PackageURL(self._conf, job.package), path,
+                                   size=job.size or None, checksum=checksum,
+                                   handler=self._handler(job), cancel=self._cancelled)
+
+    def _fetch(self, job):
+        pkg = job.package
+        path = os.path.join(self._cache_dir, pkg.FileName())
+        checksum = PackageChecksum(pkg)
+        while not self._cancelled.is_set():
+            job.attempts += 1
+            LogIt("Locating package file {}-{} (attempt {})".format(pkg.Name(), pkg.Version(), job.attempts))
+            existed = os.path.exists(path)
+            with Trace.Span("Verify", package=pkg.Name()):
+                verified = existed and self._verifier.check(path, checksum)
+            if verified:
+                LogIt("Package file {} is already verified".format(path))
+                with self._lock:
+                    job.done_bytes = job.size
+                    job.done = True
+                return job
+            from_store = False
+            if self._store and checksum and not existed:
+                from_store = self._store.fetch(checksum, path)
+            try:
+                if self._downloader:
+                    self._download(job, path, checksum, from_store)
+                    found = True
+                else:
+                    with Trace.Span("FindPackageFile", package=pkg.Name(), attempt=job.attempts):
+                        pkg_file = self._conf.FindPackageFile(pkg,
+                                                              pkg_type=PkgFileFullOnly,
+                                                              handler=self._handler(job),
+                                                              save_dir=self._cache_dir)
+                    found = pkg_file is not None
+                    if found:
+                        pkg_file.close()
+                if not found:
+                    failure = FetchError(pkg, "missing", "Unable to locate package {}".format(pkg.Name()))
+                else:
+                    self._verifier.record(path, checksum)
+                    if self._store and checksum and not existed and not from_store and os.path.exists(path):
+                        self._store.insert(checksum, path, name=pkg.FileName())
+                    with self._lock:
+                        job.done_bytes = job.size
+                        job.done = True
+                        job.rate = None
+                    return job
+            except Exceptions.ChecksumFailException as e:
+                failure = FetchError(pkg, "checksum", "Package {} has an invalid checksum".format(pkg.Name()))
+                self._verifier.stamps.forget(path)
+                if from_store:
+                    self._store.discard(checksum)
+                # Don't let the bad file get found again on the next attempt
+                try:
+                    os.unlink(path)
+                except OSError:
+                    pass
+            except Download.DownloadCancelled as e:
+                LogIt(e.message)
+                raise FetchError(pkg, "cancelled", "Fetch of package {} was cancelled".format(pkg.Name()))
+            except Download.DownloadError as e:
+                failure = FetchError(pkg, "missing" if e.status == 404 else "error", e.message)
+            except BaseException as e:
+                failure = FetchError(pkg, "error",
+                                     "Got exception {} while trying to download package {}".format(str(e), pkg.Name()))
+            LogIt(failure.message)
+            if job.attempts > self._retries:
+                raise failure
+            with self._lock:
+                job.done_bytes = 0
+        raise FetchError(pkg, "cancelled", "Fetch of package {} was cancelled".format(pkg.Name()))
+
+    def _finish(self):
+        self._verifier.stamps.save()
+        LogIt("Package verification: {}".format(self._verifier.stats()))
+        if self._store:
+            try:
+                self._store.flush()
+            except BaseException as e:
+                LogIt("Could not save package store index: {}".format(str(e)))
+            self._store.log_stats()
+        if self._downloader:
+            self._downloader.log_stats()
+
+    def start(self):
+        LogIt("Fetching {} packages ({} bytes) with {} workers".format(len(self._jobs),
+                                                                      self.total_bytes,
+                                                                      self._max_workers))
+        self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=self._max_workers,
+                                                               initializer=self._initializer)
+        self._futures = { self._executor.submit(self._fetch, job) : job for job in self._jobs }
+        return self
+
+    def cancel(self):
+        self._cancelled.set()
+        for future in self._futures:
+            future.cancel()
+
+    def wait(self, poll=None, interval=0.25):
+        """
+        Wait for all of the packages.  poll, if given, is called with
+        no arguments (on the calling thread) every interval seconds.
+        Raises the first FetchError; the remaining fetches are cancelled.
+        """
+        if self._executor is None:
+            self.start()
+        try:
+            pending = set(self._futures)
+            while pending:
+                (done, pending) = concurrent.futures.wait(pending, timeout=interval,
+                                                          return_when=concurrent.futures.FIRST_EXCEPTION)
+                for future in done:
+                    if not future.cancelled() and future.exception():
+                        self.cancel()
+                        raise future.exception()
+                if poll:
+                    poll()
+        finally:
+            self._executor.shutdown(wait=True)
+            self._finish()
+        return [job.package for job in self._jobs]
+
+    def pipeline(self, consumer, window=DEFAULT_WINDOW):
+        """
+        Fetch the packages in order, calling consumer(pkg, index) on the
+        calling thread for each one as soon as it has been fetched and
+        verified (index starts at 1).  Later packages keep downloading while
+        the consumer runs, but no more than window packages are fetched
+        ahead of the one being consumed, so the number of packages in
+        flight stays bounded.  Raises the first FetchError; exceptions from
+        the consumer are passed through.  Either way, the outstanding
+        fetches are cancelled.
+        """
+        window = max(1, window)
+        self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=min(self._max_workers, window))
+        LogIt("Pipelining {} packages ({} bytes), window {}".format(len(self._jobs),
+                                                                   self.total_bytes,
+                                                                   window))
+        futures = {}
+        next_submit = 0
+        try:
+            for (index, job) in enumerate(self._jobs):
+                while next_submit < len(self._jobs) and next_submit < index + window:
+                    future = self._executor.submit(self._fetch, self._jobs[next_submit])
+                    futures[next_submit] = future
+                    self._futures[future] = self._jobs[next_submit]
+                    next_submit += 1
+                futures.pop(index).result()
+                consumer(job.package, index + 1)
+        except BaseException:
+            self.cancel()
+            raise
+        finally:
+            self._executor.shutdown(wait=True)
+            self._finish()
+        return [job.package for job in self._jobs]
+
+class BackgroundFetch(object):
+    """
+    Fetch and verify packages in the background -- on a couple of
+    low-priority worker threads, without retries or any reporting --
+    so the cache directory (and the verified stamps) are warm by the
+    time the installation asks for them.  stop() has to be called
+    before anything else fetches into the same cache directory;
+    packages that weren't done by then are left for it.
+    """
+    def __init__(self, conf, cache_dir, packages, store=None,
+                 max_workers=BACKGROUND_WORKERS, downloader=None):
+        self._scheduler = FetchScheduler(conf, cache_dir, packages,
+                                         max_workers=max_workers, retries=0,
+                                         store=store, low_priority=True,
+                                         downloader=downloader)
+        self._thread = None
+
+    def _run(self):
+        try:
+            with Trace.Span("BackgroundFetch", packages=len(self._scheduler.jobs)):
+                self._scheduler.wait()
+        except FetchError as e:
+            LogIt("Background fetch stopped: {}".format(e.message))
+        except BaseException as e:
+            LogIt("Background fetch got exception {}".format(str(e)))
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name="prefetch")
+        self._thread.daemon = True
+        self._thread.start()
+        return self
+
+    def progress(self):
+        return self._scheduler.progress()
+
+    def stop(self, timeout=None):
+        """
+        Cancel the fetch:  what hasn't started won't, and the downloads
+        under way stop at their next chunk.  Waits (up to timeout seconds,
+        or for as long as it takes) for the workers to finish.  Returns
+        True if they have; until then, they may still write to the cache
+        directory.
+        """
+        if self._thread is None:
+            return True
+        self._scheduler.cancel()
+        self._thread.join(timeout)
+        (done_bytes, total_bytes, done_count, total_count) = self.progress()
+        finished = not self._thread.is_alive()
+        LogIt("Background fetch {}: {} of {} packages ({} of {} bytes) ready".format(
+            "stopped" if finished else "still stopping", done_count, total_count,
+            done_bytes, total_bytes))
+        return finished
@@ -3,13 +3,15 @@ import os, sys, errno
 import time
 import shutil
 import bsd
-from bsd.copy import copytree
 import bsd.sysctl as sysctl
 import bsd.dialog as Dialog
 import bsd.geom as geom
 import libzfs
 import tempfile
+import tarfile
 import argparse
+import collections
+import concurrent.futures
 
 import freenasOS.Manifest as Manifest
 import freenasOS.Package as Package
@@ -17,12 +19,22 @@ import freenasOS.Configuration as Configuration
 import freenasOS.Installer as Installer
 
 from . import Utils
+from . import Fetch
+from . import Trace
+from . import TreeCopy
+from . import PoolLayout
+from . import PartitionPlan
+from . import BootPool
 from .Utils import InitLog, LogIt, Project, Title, SetProject, IsTruenas
 from .Utils import SerialConsole, DiskInfo, SmartSize, RunCommand, RunCommandException
-from .Utils import Partition
+from .Utils import Partition, InstallationError
 
 zfs = libzfs.ZFS()
 
+# How hard to compress the configuration saved for an upgrade
+# when the boot pool is being reformatted.
+ARCHIVE_COMPRESSION = 1
+
 upgrade_paths = [
     "data",
     "conf/base/etc/hostid",
@@ -71,7 +83,31 @@ def SaveSerialSettings(mount_point):
     except:
         LogIt("Could not save serial port settings", exc_info=True)
         raise
+
+def SaveRootPasswordHash(mount_point, password_hash):
+    # Used by unattended installs, which are given a crypt(3) hash rather
+    # than the password itself, so netcli can't be used.  The same caveats
+    # about using sqlite3 directly apply as for SaveSerialSettings.
+    dbfile = "/data/freenas-v1.db"
+    import sqlite3
+
+    try:
+        db = sqlite3.connect(mount_point + dbfile)
+        try:
+            cursor = db.cursor()
+            cursor.execute("UPDATE account_bsdusers SET bsdusr_unixhash = ? WHERE bsdusr_username = ?",
+                           (password_hash, "root"))
+            if cursor.rowcount == 0:
+                raise InstallationError("No root user in {}".format(dbfile))
+            db.commit()
+            cursor.close()
+        finally:
+            db.close()
+    except sqlite3.Error as e:
+        LogIt("Could not save root password hash: {}".format(str(e)))
+        raise InstallationError("Unable to set root password")
         
+@Trace.Traced()
 def InstallGrub(chroot, disks, bename, efi=False):
     # Tell beadm to activate the dataset, and make the grub
     # configuration.
@@ -177,14 +213,68 @@ def InstallGrub(chroot, disks, bename, efi=False):
         except BaseException as e:
             LogIt("Got exception {} while trying to clean /etc/local fixup".format(str(e)))
             
-class InstallationError(RuntimeError):
-    def __init__(self, message=""):
-        super(InstallationError, self).__init__(message)
-        
-def FormatDisks(disks, partitions, interactive):
+@Trace.Traced()
+def PartitionDisk(disk, partitions, plan):
+    """
+    Partition (and, for efi, format the boot partition of) one disk,
+    as laid out by plan (a PartitionPlan.PartitionPlan).
+    This is run on a worker thread, one per disk, so it must not
+    use any dialogs.  Raises RunCommandException on failure.
+    """
+    # This could fail for a couple of reasons, but mostly we don't care.
+    try:
+        RunCommand("/sbin/gpart", "destroy", "-F", disk.name)
+    except:
+        pass
+    # One thing we have to worry about is gmirror, which won't
+    # let us repartition if it's in use.  So we need to find out
+    # if the disk is in use by a mirror, and if so, we need
+    # to remove the appropriate device, partition, or label from
+    # the mirror.  (Note that there may be more than one mapping,
+    # conceivably, so what we need is a pairing of object -> mirror name.
+    for (mname, pname) in Utils.FindMirrors(disk):
+        try:
+            RunCommand("/sbin/gmirror", "remove", mname, pname)
+        except:
+            LogIt("Unable to remove {} from mirror {}; this may cause a failure in a bit".format(pname, mname))
+
+    RunCommand("/sbin/gpart", "create", "-s", "GPT", "-f", "active", disk.name)
+    # For best purposes, the freebsd-boot partition-to-be
+    # should be the last one in the list.
+    for part in partitions:
+        args = plan.GpartArgs(disk, plan.partition(part.index))
+        RunCommand("/sbin/gpart", "add", *(args + [disk.name]))
+        if part.type == "efi":
+            RunCommand("/sbin/newfs_msdos",
+                       "-F", "16",
+                       "/dev/{}p{}".format(disk.name, part.index))
+
+def PartitionDisks(disks, partitions, plan):
+    """
+    Run PartitionDisk() for each of the disks concurrently, and wait
+    for all of them to finish.  Returns a list of (disk name, exception)
+    for the disks that failed; an empty list means they all succeeded.
+    """
+    failures = []
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max(1, len(disks))) as executor:
+        jobs = { executor.submit(PartitionDisk, disk, partitions, plan) : disk for disk in disks }
+        for job in concurrent.futures.as_completed(jobs):
+            disk = jobs[job]
+            try:
+                job.result()
+                LogIt("Finished partitioning {}".format(disk.name))
+            except BaseException as e:
+                failures.append((disk.name, e))
+    return sorted(failures, key=lambda x: x[0])
+
+@Trace.Traced()
+def FormatDisks(disks, partitions, interactive, layout=None, plan=None):
     """
     Format the given disks.  Either returns a handle for the pool,
-    or raises an exception.
+    or raises an exception.  layout is a PoolLayout.PoolLayout for the
+    boot pool; if not given, one is chosen from the disks alone.
+    plan is the PartitionPlan.PartitionPlan for the partitions; if not
+    given, one is made.
     """
     # We don't care if these commands fail
     if interactive:
@@ -206,45 +296,32 @@ def FormatDisks(disks, partitions, interactive):
                                           "Multiple partitions are claiming to be the OS partitions.  This must be due to a bug.  Aborting before any formatting is done",
                                           height=10, width=45).run()
                     raise InstallationError("Multiple OS partitions")
-    # This could fail for a couple of reasons, but mostly we don't care.
+    if plan is None:
+        try:
+            plan = PartitionPlan.Plan(disks, partitions)
+        except ValueError as e:
+            LogIt("Unable to lay out partitions: {}".format(str(e)))
+            raise InstallationError(str(e))
+        plan.log()
     try:
-        for disk in disks:
-            RunCommand("/sbin/gpart", "destroy", "-F", disk.name)
-    except:
-        pass
+        failures = PartitionDisks(disks, partitions, plan)
+        if failures:
+            details = []
+            for (disk_name, e) in failures:
+                LogIt("Partitioning {} failed: {}".format(disk_name, str(e)))
+                if isinstance(e, RunCommandException):
+                    details.append("{}: \"{}\" returned \"{}\"".format(disk_name, e.command, e.message))
+                else:
+                    details.append("{}: {}".format(disk_name, str(e)))
+            if interactive:
+                text = "The {} Installer was unable to partition {}:\n\n".format(Project(),
+                                                                                "disk" if len(failures) == 1 else "disks")
+                text += "\n".join(["\t" + x for x in details])
+                Dialog.MessageBox("Partitioning failure", text,
+                                  height=25, width=60).run()
+            raise InstallationError("Error during partitioning: {}".format("; ".join(details)))
 
-    try:
-        os_partition = None
-        for disk in disks:
-            # One thing we have to worry about is gmirror, which won't
-            # let us repartition if it's in use.  So we need to find out
-            # if the disk is in use by a mirror, and if so, we need
-            # to remove the appropriate device, partition, or label from
-            # the mirror.  (Note that there may be more than one mapping,
-            # conceivably, so what we need is a pairing of object -> mirror name.
-            for (mname, pname) in Utils.FindMirrors(disk):
-                try:
-                    RunCommand("/sbin/gmirror remove {} {}".format(mname, pname))
-                except:
-                    LogIt("Unable to remove {} from mirror {}; this may cause a failure in a bit".format(pname, mname))
-                    
-            RunCommand("/sbin/gpart", "create", "-s", "GPT", "-f", "active", disk.name)
-            # For best purposes, the freebsd-boot partition-to-be
-            # should be the last one in the list.
-            for part in partitions:
-                if part.os is True:
-                    os_partition = part.index
-                RunCommand("/sbin/gpart", "add",
-                           "-t", part.type,
-                           "-i", part.index,
-                           "-s", part.smart_size,
-                           disk.name)
-                if part.type == "efi":
-                    RunCommand("/sbin/newfs_msdos",
-                               "-F", "16",
-                               "/dev/{}p{}".format(disk.name, part.index))
-                    
-        geom.scan()
+        Utils.RescanTopology()
         if len(disks) > 1:
             vdev = libzfs.ZFSVdev(zfs, "mirror")
             components = []
@@ -257,8 +334,19 @@ def FormatDisks(disks, partitions, interactive):
             vdev = libzfs.ZFSVdev(zfs, "disk")
             vdev.path = "/dev/{}p{}".format(disks[0].name, os_partition)
                 
+        if layout is None:
+            layout = PoolLayout.Plan(disks)
+        layout.log()
         LogIt("Calling zfs.create, vdev = {}".format(vdev))
             
+        # Version 28 pools have no ashift property; new vdevs get
+        # at least vfs.zfs.min_auto_ashift.
+        old_ashift = None
+        try:
+            old_ashift = sysctl.sysctlbyname("vfs.zfs.min_auto_ashift")
+            sysctl.sysctlbyname("vfs.zfs.min_auto_ashift", old=False, new=layout.ashift)
+        except OSError as e:
+            LogIt("Unable to set vfs.zfs.min_auto_ashift to {}: {}".format(layout.ashift, str(e)))
         try:
             freenas_boot = zfs.create("freenas-boot",
                                       topology={"data": [vdev]},
@@ -273,14 +361,20 @@ def FormatDisks(disks, partitions, interactive):
         except:
             LogIt("Got exception while creating boot pool", exc_info=True)
             raise
+        finally:
+            if old_ashift is not None:
+                try:
+                    sysctl.sysctlbyname("vfs.zfs.min_auto_ashift", old=False, new=old_ashift)
+                except OSError:
+                    pass
         
         LogIt("Created freenas-boot")
         for feature in freenas_boot.features:
             if feature.name in ["async_destroy", "empty_bpobj", "lz4_compress"]:
                 feature.enable()
                 
-        LogIt("Setting compression to lz4")
-        freenas_boot.root_dataset.properties["compression"].value = "lz4"
+        LogIt("Setting compression to {}".format(layout.compression))
+        freenas_boot.root_dataset.properties["compression"].value = layout.compression
         LogIt("Creating grub dataset")
         freenas_boot.create("freenas-boot/grub", { "mountpoint" : "legacy" })
         LogIt("Creating ROOT dataset")
@@ -302,7 +396,7 @@ def FormatDisks(disks, partitions, interactive):
                                   "\t{}").format(Project(), e.command, e.message),
                               height=25, width=60).run()
         raise InstallationError("Error during partitioning: \"{}\" returned \"{}\"".format(e.command, e.message))
-    except Dialog.DialogEscape:
+    except (InstallationError, Dialog.DialogEscape):
         raise
     except BaseException as e:
         LogIt("Got exception {} while partitioning".format(str(e)))
@@ -314,6 +408,183 @@ def FormatDisks(disks, partitions, interactive):
 
     return freenas_boot
 
+@Trace.Traced()
+def PipelinedInstall(manifest, config, root, package_dir, trampoline=True,
+                     package_handler=None, progress_handler=None,
+                     window=Fetch.DEFAULT_WINDOW, store=None, packages=None,
+                     downloader=None):
+    """
+    Install the packages in the manifest (or just packages, a list of
+    packages from it) into root, in manifest order,
+    extracting each package as soon as it has been fetched and verified,
+    while the following packages are still downloading.  At most window
+    packages are fetched ahead of the one being installed.  The callers
+    in Menu fetch and verify every package (GetPackages) before any disk
+    is touched, so here the fetches only find (and re-check, through the
+    verified stamps) what's already in package_dir; a package that fails
+    here fails after the disks have been formatted.
+    package_handler and progress_handler are as for Install(); store is
+    an optional PackageCache.PackageStore, and downloader an optional
+    Download.Downloader.
+    Raises InstallationError.
+    """
+    if packages is None:
+        packages = manifest.Packages()
+    names = [pkg.Name() for pkg in packages]
+    scheduler = Fetch.FetchScheduler(config, package_dir, packages, ordered=True,
+                                     store=store, downloader=downloader)
+
+    def InstallOne(pkg, index):
+        def PackageStart(*args, **kwargs):
+            # The installer only knows about this one package
+            if package_handler:
+                package_handler(index, pkg.Name(), names)
+        with Trace.Span("InstallPackage", package=pkg.Name()):
+            installer = Installer.Installer(manifest=manifest,
+                                            root=root,
+                                            config=config)
+            if installer.GetPackages(pkgList=[pkg]) is not True:
+                LogIt("Installer.GetPackages({}) failed".format(pkg.Name()))
+                raise InstallationError("Unable to load package {}".format(pkg.Name()))
+            installer.trampoline = trampoline
+            installer.InstallPackages(progressFunc=progress_handler,
+                                      handler=PackageStart)
+    try:
+        scheduler.pipeline(InstallOne, window=window)
+    except Fetch.FetchError as e:
+        LogIt(e.message)
+        if e.reason == "checksum":
+            raise InstallationError("Invalid package checksum: {}".format(e.package.Name()))
+        elif e.reason == "missing":
+            raise InstallationError("Missing package {}".format(e.package.Name()))
+        raise InstallationError(e.message)
+    except InstallationError:
+        raise
+    except BaseException as e:
+        LogIt("PipelinedInstall got exception {}".format(str(e)))
+        raise InstallationError("Could not install packages")
+
+UpgradePlan = collections.namedtuple("UpgradePlan", ["bootfs", "changed", "removed"])
+
+def PackageChanges(old_manifest, new_manifest):
+    """
+    Compare two manifests.  Returns (changed, removed):  the packages in
+    new_manifest that aren't in old_manifest with the same version (and
+    checksum, if both have one), in new_manifest order, and the names of
+    the packages only in old_manifest.  Returns None if the manifests
+    can't be compared reliably:  they're for different trains, or a
+    package has no version, or appears twice.
+    """
+    if old_manifest.Train() != new_manifest.Train():
+        LogIt("Old manifest is for train {}, new one for {}".format(old_manifest.Train(),
+                                                                   new_manifest.Train()))
+        return None
+    def Index(manifest):
+        index = collections.OrderedDict()
+        for pkg in manifest.Packages():
+            if not pkg.Version() or pkg.Name() in index:
+                LogIt("Manifest {} has an unusable entry for package {}".format(manifest.Sequence(),
+                                                                                 pkg.Name()))
+                return None
+            index[pkg.Name()] = pkg
+        return index
+    old_packages = Index(old_manifest)
+    new_packages = Index(new_manifest)
+    if old_packages is None or new_packages is None:
+        return None
+    changed = []
+    for (name, pkg) in new_packages.items():
+        old = old_packages.get(name, None)
+        if (old is None or old.Version() != pkg.Version() or
+            (old.Checksum() and pkg.Checksum() and old.Checksum() != pkg.Checksum())):
+            changed.append(pkg)
+    removed = [name for name in old_packages if name not in new_packages]
+    return (changed, removed)
+
+@Trace.Traced()
+def PlanIncrementalUpgrade(session, manifest, config):
+    """
+    See whether the active BE of session's pool (see BootPool) can be
+    cloned and upgraded in place to manifest, by installing only the
+    packages that changed.  That needs the manifest saved in the BE, a
+    comparable manifest (see PackageChanges), and the BE's package
+    database to agree with its manifest.  Returns an UpgradePlan, or
+    None if a full installation is needed.
+    """
+    try:
+        bootfs = session.bootfs
+    except BaseException as e:
+        LogIt("Could not get bootfs: {}".format(str(e)))
+        return None
+    if not bootfs:
+        LogIt("No active boot environment, so no incremental upgrade")
+        return None
+    try:
+        old_root = session.mount_bootfs()
+    except OSError as e:
+        LogIt("Could not mount {}: {}".format(bootfs, str(e)))
+        return None
+    old_manifest = Manifest.Manifest(require_signature=False)
+    try:
+        old_manifest.LoadPath(os.path.join(old_root, "data", "manifest"))
+    except BaseException as e:
+        LogIt("Could not load the manifest from {}: {}".format(bootfs, str(e)))
+        return None
+    LogIt("Active BE {} has version {}".format(bootfs, old_manifest.Version()))
+    changes = PackageChanges(old_manifest, manifest)
+    if changes is None:
+        return None
+    # Make sure what's installed is what the manifest says
+    try:
+        pkgdb = config.PackageDB(old_root, create=False)
+        for pkg in old_manifest.Packages():
+            installed = pkgdb.FindPackage(pkg.Name())
+            if not installed or installed.get(pkg.Name(), None) != pkg.Version():
+                LogIt("Package {} is {} in {}, but {} in its manifest".format(
+                    pkg.Name(), installed.get(pkg.Name(), None) if installed else "not installed",
+                    bootfs, pkg.Version()))
+                return None
+    except BaseException as e:
+        LogIt("Could not check the package database in {}: {}".format(bootfs, str(e)))
+        return None
+    (changed, removed) = changes
+    LogIt("Incremental upgrade from {}:  {} of {} packages changed ({}), {} removed ({})".format(
+        bootfs, len(changed), len(manifest.Packages()), ", ".join(pkg.Name() for pkg in changed),
+        len(removed), ", ".join(removed)))
+    return UpgradePlan(bootfs, changed, removed)
+
+@Trace.Traced()
+def CloneBootEnvironment(pool, bootfs, bename):
+    """
+    Snapshot bootfs, and clone it as bename.  Returns the new dataset.
+    """
+    snapshot_name = "{}@{}".format(bootfs, bename.rsplit("/", 1)[-1])
+    LogIt("Cloning {} as {}".format(snapshot_name, bename))
+    zfs.get_dataset(bootfs).snapshot(snapshot_name)
+    try:
+        return zfs.get_snapshot(snapshot_name).clone(bename, {
+            "mountpoint" : "legacy",
+            "sync"       : "disabled",
+        })
+    except libzfs.ZFSException:
+        try:
+            zfs.get_snapshot(snapshot_name).delete()
+        except libzfs.ZFSException as e:
+            LogIt("Could not remove snapshot {}: {}".format(snapshot_name, str(e)))
+        raise
+
+@Trace.Traced()
+def RemovePackages(config, root, names):
+    """
+    Remove the named packages' files from root.
+    """
+    pkgdb = config.PackageDB(root)
+    for name in names:
+        LogIt("Removing package {}".format(name))
+        if pkgdb.RemovePackageContents(name) is False:
+            raise InstallationError("Unable to remove package {}".format(name))
+
+@Trace.Traced()
 def UnmountFilesystems(mountpoint):
     """
     This attempts to unmount all of the filesystems.
@@ -340,6 +611,7 @@ def UnmountFilesystems(mountpoint):
     except:
         raise InstallationError("Unable to unmount filesystems in new Boot Environment")
     
+@Trace.Traced()
 def MountFilesystems(bename, mountpoint, **kwargs):
     """
     Mount the necessary filesystems, and clean up on error.
@@ -357,7 +629,8 @@ def MountFilesystems(bename, mountpoint, **kwargs):
         
         grub_path = "{}/boot/grub".format(mountpoint)
         LogIt("Mounting grub on {}".format(grub_path))
-        os.makedirs(grub_path, 0o755)
+        # These already exist in a cloned BE
+        os.makedirs(grub_path, 0o755, exist_ok=True)
         bsd.nmount(source="freenas-boot/grub",
                    fspath=grub_path,
                    fstype="zfs")
@@ -365,7 +638,7 @@ def MountFilesystems(bename, mountpoint, **kwargs):
         
         dev_path = os.path.join(mountpoint, "dev")
         LogIt("Mounting dev on {}".format(dev_path))
-        os.makedirs(dev_path, 0o755)
+        os.makedirs(dev_path, 0o755, exist_ok=True)
         bsd.nmount(source="devfs",
                    fspath=dev_path,
                    fstype="devfs")
@@ -373,17 +646,37 @@ def MountFilesystems(bename, mountpoint, **kwargs):
         
     except os.error as e:
         LogIt("Got exception {} while mounting; have mounted {}".format(str(e), mounted))
-        for path in mounted:
+        for path in reversed(mounted):
             try:
                 bsd.unmount(path)
             except:
-                raise InstallationError("Unable to mount filesystems")
+                pass
+        raise InstallationError("Unable to mount filesystems")
     except BaseException as e:
         LogIt("Got base exception {}; have mounted {}".format(str(e), mounted))
         raise InstallationError("Error while mounting filesystems")
 
+def CopyProgress(name):
+    """
+    A progress callback for TreeCopy, logging how much of name has been copied.
+    """
+    def Report(done, total):
+        LogIt("Copying {}: {}bytes of {}bytes".format(name, SmartSize(done), SmartSize(total)))
+    return Report
+
+def _ArchiveFilter():
+    # The archive is one we made, so keep ownership, modes, and links as they were
+    if hasattr(tarfile, "fully_trusted_filter"):
+        return { "filter" : tarfile.fully_trusted_filter }
+    return {}
+
+@Trace.Traced()
 def RestoreConfiguration(**kwargs):
-    upgrade_dir = kwargs.get("save_path", None)
+    """
+    Unpack the archive made by SaveConfiguration() (save_path) into
+    the new BE (destination), and remove the archive.
+    """
+    upgrade_archive = kwargs.get("save_path", None)
     interactive = kwargs.get("interactive", False)
     dest_dir = kwargs.get("destination", None)
     
@@ -396,108 +689,147 @@ def RestoreConfiguration(**kwargs):
             status.run()
         except:
             pass
+    try:
+        LogIt("Restoring {} -> {}".format(upgrade_archive, dest_dir))
+        with tarfile.open(upgrade_archive, "r|gz") as archive:
+            archive.extractall(dest_dir, **_ArchiveFilter())
+    except BaseException as e:
+        LogIt("Exception {}".format(str(e)))
+        raise InstallationError("Unable to restore configuration files for upgrade")
+    finally:
         try:
-            for path in upgrade_paths:
-                src = os.path.join(upgrade_dir, path)
-                dst = os.path.join(dest_dir, path)
-                if os.path.exists(src):
-                    try:
-                        os.makedirs(os.path.dirname(dst))
-                    except:
-                        pass
-                    LogIt("Restoring {} -> {}".format(src, dst))
-                    try:
-                        copytree(src, dst,
-                                 progress_callback=lambda s, d: LogIt("\t{} -> {}".format(s, d)))
-                    except BaseException as e:
-                        LogIt("Exception {}".format(str(e)))
-                        raise InstallationError("Unable to restore configuration files for upgrade")
-        finally:
-            shutil.rmtree(upgrade_dir, ignore_errors=True)
+            os.remove(upgrade_archive)
+        except OSError:
+            pass
 
+@Trace.Traced()
+def MigrateConfiguration(**kwargs):
+    """
+    Copy the upgrade_paths directly from the active BE of the session's
+    pool (a BootPool.BootPoolSession) into the new BE (destination).  This
+    is used when the pool isn't being reformatted, so nothing needs to be
+    staged; the old BE is mounted read-only (if it isn't already) while
+    it's copied.
+    """
+    interactive = kwargs.get("interactive", False)
+    session = kwargs.get("session", None)
+    dest_dir = kwargs.get("destination", None)
+
+    bootfs = session.bootfs
+    if not bootfs:
+        if interactive:
+            try:
+                Dialog.MessageBox(Title(),
+                                  "No active boot environment for upgrade",
+                                  height=7, width=35).run()
+            except:
+                pass
+        raise InstallationError("No active boot environment for upgrade")
+    if interactive:
+        try:
+            status = Dialog.MessageBox(Title(),
+                                       "Copying configuration files to new Boot Environment",
+                                       height=7, width=60, wait=False)
+            status.clear()
+            status.run()
+        except:
+            pass
+
+    try:
+        old_root = session.mount_bootfs()
+    except OSError as e:
+        LogIt("Could not mount {}: {}".format(bootfs, str(e)))
+        raise InstallationError("Unable to mount the boot environment to upgrade")
+    try:
+        for path in upgrade_paths:
+            src = os.path.join(old_root, path)
+            dst = os.path.join(dest_dir, path)
+            if os.path.exists(src):
+                try:
+                    os.makedirs(os.path.dirname(dst))
+                except:
+                    pass
+                LogIt("Copying {} -> {}".format(src, dst))
+                TreeCopy.CopyTree(src, dst, progress=CopyProgress(path))
+    except BaseException as e:
+        LogIt("While copying, got exception {}".format(str(e)))
+        raise InstallationError("Unable to copy configuration files for upgrade")
+
+@Trace.Traced()
 def SaveConfiguration(**kwargs):
+    """
+    Save the upgrade_paths from the active BE of the boot pool, for when
+    the pool is going to be reformatted.  They're saved as a compressed
+    tar archive, written as the files are read (so memory use doesn't
+    depend on the size of /data), in a temporary file.  Returns the
+    archive's path, for RestoreConfiguration().
+
+    The pool is session's (a BootPool.BootPoolSession), which is left
+    imported with the BE mounted, for the caller to close; or, if there's
+    no session, pool (unimported), which is imported and exported again.
+    """
     interactive = kwargs.get("interactive", False)
-    upgrade_pool = kwargs.get("pool", None)
+    session = kwargs.get("session", None)
+    if session is None:
+        with BootPool.BootPoolSession([kwargs.get("pool", None)]) as session:
+            return SaveConfiguration(interactive=interactive, session=session)
+
     if interactive:
         status = Dialog.MessageBox(Title(),
                                    "Mounting boot pool for upgrade_pool",
                                    height=7, width=35, wait=False)
         status.clear()
         status.run()
-    upgrade_dir = tempfile.mkdtemp()
+    (fd, upgrade_archive) = tempfile.mkstemp(suffix=".tgz", prefix="upgrade-")
+    os.close(fd)
     try:
-        mount_point = tempfile.mkdtemp()
-        zfs.import_pool(upgrade_pool,
-                        "freenas-boot",
-                        {})
-        LogIt("Imported old freenas-boot")
-        freenas_boot = zfs.get("freenas-boot")
-        try:
-            LogIt("Looking for bootable dataset")
-            bootfs = freenas_boot.properties["bootfs"].value
-            if bootfs is None:
-                if interactive:
-                    try:
-                        Dialog.MessageBox(Title(),
-                                          "No active boot environment for upgrade",
-                                          height=7, width=35).run()
-                    except:
-                        pass
-                raise InstallerError("No active boot environment for upgrade")
-            
-            LogIt("Found dataset {}".format(bootfs))
-            bsd.nmount(source=bootfs,
-                       fspath=mount_point,
-                       fstype="zfs",
-                       flags=bsd.MountFlags.RDONLY,
-            )
-            LogIt("Mounted pool")
+        LogIt("Looking for bootable dataset")
+        bootfs = session.bootfs
+        if bootfs is None:
             if interactive:
-                status = Dialog.MessageBox(Title(),
-                                           "Copying configuration files for update",
-                                           height=7, width=36, wait=False)
-                status.clear()
-                status.run()
-            try:
-                # Copy files now.
+                try:
+                    Dialog.MessageBox(Title(),
+                                      "No active boot environment for upgrade",
+                                      height=7, width=35).run()
+                except:
+                    pass
+            raise InstallationError("No active boot environment for upgrade")
+
+        LogIt("Found dataset {}".format(bootfs))
+        mount_point = session.mount_bootfs()
+        if interactive:
+            status = Dialog.MessageBox(Title(),
+                                       "Copying configuration files for update",
+                                       height=7, width=36, wait=False)
+            status.clear()
+            status.run()
+        try:
+            # Copy files now.
+            with tarfile.open(upgrade_archive, "w:gz",
+                              compresslevel=ARCHIVE_COMPRESSION) as archive:
                 for path in upgrade_paths:
                     src = os.path.join(mount_point, path)
-                    dst = os.path.join(upgrade_dir, path)
-                    if os.path.exists(src):
-                        try:
-                            os.makedirs(os.path.dirname(dst))
-                        except:
-                            pass
-                        LogIt("Copying {} -> {}".format(src, dst))
-                        copytree(src, dst,
-                                 progress_callback=lambda s, d: LogIt("\t{} -> {}".format(s, d)))
-                return upgrade_dir
-            except BaseException as e:
-                LogIt("While copying, got exception {}".format(str(e)))
-                raise
-            finally:
-                LogIt("Unmounting pool")
-                bsd.unmount(mount_point)
-
+                    if os.path.lexists(src):
+                        LogIt("Saving {}".format(src))
+                        archive.add(src, arcname=path)
+            LogIt("Saved configuration in {} ({}bytes)".format(upgrade_archive,
+                                                               SmartSize(os.path.getsize(upgrade_archive))))
+            return upgrade_archive
         except BaseException as e:
-            LogIt("But got an excetion {}".format(str(e)))
-        finally:
-            LogIt("Exporting old freenas-boot pool")
-            zfs.export_pool(freenas_boot)
-    except InstallationError:
-        raise
+            LogIt("While copying, got exception {}".format(str(e)))
+            raise InstallationError("Unable to save configuration files for upgrade")
     except:
         if interactive:
             Dialog.MessageBox(Title(),
                               "Saving configuration files for upgrade_pool has failed",
                               height=10, width=45).run()
-        raise
-    finally:
         try:
-            os.rmdir(mount_point)
-        except:
+            os.remove(upgrade_archive)
+        except OSError:
             pass
-        
+        raise
+
+@Trace.Traced()
 def Install(**kwargs):
     """
     This does the grunt-work of actually doing the install.
@@ -512,6 +844,11 @@ def Install(**kwargs):
     - efi	Boolean indicating whether or not to use EFI (default is False).
     - upgrade_from	An unimported ZFSPool object to install to.  This must be set
     			when upgrading, and when creating a new BE on an existing pool.
+    - boot_session	A BootPool.BootPoolSession for the existing boot pool(s), which may
+    			already have imported upgrade_from and mounted its active BE (e.g.,
+    			to see whether it can be upgraded).  Install() uses that rather than
+    			importing the pool again, and closes it (exporting the pool) when it's
+    			done.  If not set, one is made from upgrade_from.
     - upgrade	Boolean indicating whether or not to upgrade.  Requires upgrade_from to
 		be valid.
     - data_dir	A string indicating the location of the /data.  Normally this will just
@@ -519,6 +856,8 @@ def Install(**kwargs):
 		be necessary to specify it.
     - password	A string indicating the root password.  Ignored for upgrades; may be None
     		(indicating no password, not recommended).
+    - password_hash	A crypt(3) hash to use for the root password, instead of password.
+    			Ignored for upgrades.
     - partitions	An array of Partition objects (see Utils).  Note that the OS
     			partition will always be installed last.
     - post_install	An array of callable objects, which will be called after installation,
@@ -535,24 +874,47 @@ def Install(**kwargs):
     			already be located in this directory.
     - trampoline	A boolean indicating whether the post-install scripts should be run
     			on reboot (True, default) or during the install (False).
+    - pipeline	A boolean indicating whether packages should be fetched and verified
+    		while earlier packages are being installed (see PipelinedInstall).  If
+    		set, the package files do not need to be in package_directory already.
+    - pipeline_window	How many packages may be fetched ahead of the one being installed.
+    - package_store	A PackageCache.PackageStore to use when fetching packages (pipeline only).
+    - downloader	A Download.Downloader to download packages with, instead of the
+    			configuration's FindPackageFile (pipeline only).
+    - ashift	The ashift for a new boot pool (see PoolLayout); chosen from the disks if not set.
+    - compression	The compression for a new boot pool; chosen by sampling the packages
+    			in package_directory if not set.
+    - incremental	When upgrading without formatting, clone the active BE and install only
+    			the packages that changed (default True).  A full installation is done
+    			if the active BE's manifest can't be used (see PlanIncrementalUpgrade).
     """
     LogIt("Install({})".format(kwargs))
     orig_kwargs = kwargs.copy()
+    command_mark = Utils.command_stats.mark()
 
     config = kwargs.get("config", Configuration.SystemConfiguration())
     interactive = kwargs.get("interactive", True)
     disks = kwargs.get("disks", [])
     efi = kwargs.get("efi", False)
     upgrade_pool = kwargs.get("upgrade_from", None)
+    session = kwargs.get("boot_session", None)
     upgrade = kwargs.get("upgrade", False)
     data_dir = kwargs.get("data_dir", "/data")
     password = kwargs.get("password", None)
+    password_hash = kwargs.get("password_hash", None)
     extra_partitions = kwargs.get("partitions", [])
     post_install = kwargs.get("post_install", [])
     package_notifier = kwargs.get("package_handler", None)
     progress_notifier = kwargs.get("progress_handler", None)
     manifest = kwargs.get("manifest", None)
     trampoline = kwargs.get("trampoline", True)
+    pipeline = kwargs.get("pipeline", False)
+    pipeline_window = kwargs.get("pipeline_window", Fetch.DEFAULT_WINDOW)
+    package_store = kwargs.get("package_store", None)
+    downloader = kwargs.get("downloader", None)
+    incremental = kwargs.get("incremental", True)
+    ashift = kwargs.get("ashift", None)
+    compression = kwargs.get("compression", None)
     # The default is based on ISO layout
     package_dir = kwargs.get("package_directory", "/.mount/{}/Packages".format(Project()))
 
@@ -601,16 +963,24 @@ def Install(**kwargs):
                 except RunCommandException as e:
                     LogIt("Could not create mirrored swap: {}".format(str(e)))
         post_install.append(make_tn_swap)
+    # The existing boot pool is imported (at most) once, by the session,
+    # and exported once, at the end.  If we weren't given the pools that
+    # were found, the session looks for them if it needs to.
+    if session is None:
+        session = BootPool.BootPoolSession([upgrade_pool] if upgrade_pool else None)
+
     # First step is to see if we're upgrading.
-    # If so, we want to copy files from the active BE to
-    # a location in /tmp, so we can copy them back later.
-    # This will import, and then export, the freenas-boot pool.
+    # If we're also reformatting, we want to save the files from the
+    # active BE in an archive in /tmp, so we can restore them later.
+    # If we're not reformatting, they're copied directly from the
+    # old BE to the new one, once it has been created.
     
-    if upgrade_pool and upgrade:
-        upgrade_dir = SaveConfiguration(interactive=interactive,
-                                        pool=upgrade_pool)
+    upgrade_plan = None
+    if upgrade_pool and upgrade and disks:
+        upgrade_archive = SaveConfiguration(interactive=interactive,
+                                            session=session)
     else:
-        upgrade_dir = None
+        upgrade_archive = None
 
     # Second step is to see if we're formatting drives.
     # If so, we first will destroy the freenas-boot pool;
@@ -658,10 +1028,7 @@ def Install(**kwargs):
             next_index += 1
 
         # At this point, used is the sum of the partitions, in bytes.
-        # This isn't really correct - we should be rounding the size up
-        # to the blocksize of the disk.  But partitioning behaves strangely
-        # sometimes with flash drives.  As a result, when we do the actual
-        # partitioning, we use the smart-size (e.g., 1G), which rounds down.
+        # PartitionPlan takes care of rounding and alignment.
         
         min_size = 0
         for disk in disks:
@@ -690,58 +1057,51 @@ def Install(**kwargs):
                                   height=15, weidth=60).run()
             raise InstallationError("Unable to find disk size")
         
-        # Round min_size down to a gbyte
-        part_size = int(min_size / gByte) * gByte
+        # The OS partition gets the rest of the smallest disk, aligned
         os_part = Partition(type="freebsd-zfs",
                             index=2,
-                            size=part_size,
+                            size=None,
                             os=True)
-        LogIt("OS partition {}".format(os_part))
         partitions.append(os_part)
+        try:
+            partition_plan = PartitionPlan.Plan(disks, partitions)
+        except ValueError as e:
+            LogIt("Unable to lay out partitions: {}".format(str(e)))
+            if interactive:
+                Dialog.MessageBox(Title(),
+                                  "The partitions do not fit on the selected disks:\n\n\t{}".format(str(e)),
+                                  height=15, width=60).run()
+            raise InstallationError(str(e))
+        partition_plan.log()
+        LogIt("OS partition {}".format(partition_plan.partition(os_part.index)))
                 
-        # We need to destroy any existing freenas-boot pool.
-        # To do that, we may first need to import the pool.
-        if upgrade_pool is None:
-            try:
-                old_pools = list(zfs.find_import(name="freenas-boot"))
-            except libzfs.ZFSException as e:
-                LogIt("Got ZFS error {} while trying to import freenas-boot for destruction".format(str(e)))
-                old_pools = []
-        else:
-            old_pools = [upgrade_pool]
-            # We'll be destroying it, so..
-            upgrade_pool = None
+        # We need to destroy any existing freenas-boot pool (the
+        # session imports it, if it hasn't already).
+        session.destroy()
+        # We'll be destroying it, so..
+        upgrade_pool = None
 
-        for pool in old_pools:
-            try:
-                dead_pool = zfs.import_pool(pool, "freenas-boot", {})
-                if dead_pool is None:
-                    dead_pool = zfs.get("freenas-boot")
-                zfs.destroy("freenas-boot")
-            except libzfs.ZFSException as e:
-                LogIt("Trying to destroy a freenas-boot pool got error {}".format(str(e)))
-            
         try:
-            freenas_boot = FormatDisks(disks, partitions, interactive)
+            layout = PoolLayout.Plan(disks, manifest=manifest, package_dir=package_dir,
+                                     ashift=ashift, compression=compression)
+        except ValueError as e:
+            raise InstallationError(str(e))
+        try:
+            freenas_boot = FormatDisks(disks, partitions, interactive, layout=layout, plan=partition_plan)
         except BaseException as e:
             LogIt("FormatDisks got exception {}".format(str(e)))
             raise
+        session.adopt(freenas_boot)
         
         bename = "freenas-boot/ROOT/default"
     else:
-        # We need to import the pool (we exported it above if upgrade_pool)
+        # We need the pool imported (the session may have done that already)
         try:
-            if upgrade_pool:
-                freenas_boot = zfs.import_pool(upgrade_pool, "freenas-boot", {})
+            if session.pools:
+                freenas_boot = session.imported()
             else:
-                freenas_boot = None
-                pools = list(zfs.find_import(name="freenas-boot"))
-                if len(pools) > 1:
-                    raise InstallationError("There are multiple unimported freenas-boot pools")
-                if len(pools) == 1:
-                    freenas_boot = zfs.import_pool(upgrade_pool, "freenas-boot", {})
-            if freenas_boot is None:
                 freenas_boot = zfs.get("freenas-boot")
+                session.adopt(freenas_boot)
         except libzfs.ZFSException as e:
             LogIt("Got ZFS error {} while trying to import pool".format(str(e)))
             if interactive:
@@ -751,71 +1111,112 @@ def Install(**kwargs):
             raise InstallationError("Unable to import boot pool")
 
         bename = time.strftime("freenas-boot/ROOT/default-%Y%m%d-%H%M%S")
+        if upgrade and upgrade_pool and incremental:
+            upgrade_plan = PlanIncrementalUpgrade(session, manifest, config)
         
     # Next, we create the dataset, and mount it, and then mount
     # the grub dataset.
     # We also mount a devfs and tmpfs in the new environment.
 
     LogIt("BE name is {}".format(bename))
-    try:
-        freenas_boot.create(bename, fsopts={
-            "mountpoint" : "legacy",
-            "sync"       : "disabled",
-        })
-    except libzfs.ZFSException as e:
-        LogIt("Could not create BE {}: {}".format(bename, str(e)))
-        if interactive:
-            Dialog.MessageBox(Title(),
-                              "An error occurred creatint the installation boot environment\n" +
-                              "\n\t{}".format(str(e)),
-                              height=25, width=60).run()
-        raise InstallationError("Could not create BE {}: {}".format(bename, str(e)))
+    if upgrade_plan:
+        # Done reading the old BE
+        try:
+            session.unmount_bootfs()
+        except OSError as e:
+            LogIt("Could not unmount {}: {}".format(upgrade_plan.bootfs, str(e)))
+        try:
+            CloneBootEnvironment(freenas_boot, upgrade_plan.bootfs, bename)
+        except libzfs.ZFSException as e:
+            LogIt("Could not clone {}, so doing a full installation: {}".format(upgrade_plan.bootfs, str(e)))
+            upgrade_plan = None
+    if not upgrade_plan:
+        with Trace.Span("CreateBE"):
+            try:
+                freenas_boot.create(bename, fsopts={
+                    "mountpoint" : "legacy",
+                    "sync"       : "disabled",
+                })
+            except libzfs.ZFSException as e:
+                LogIt("Could not create BE {}: {}".format(bename, str(e)))
+                if interactive:
+                    Dialog.MessageBox(Title(),
+                                      "An error occurred creatint the installation boot environment\n" +
+                                      "\n\t{}".format(str(e)),
+                                      height=25, width=60).run()
+                raise InstallationError("Could not create BE {}: {}".format(bename, str(e)))
     
     MountFilesystems(bename, mount_point)
     # After this, any exceptions need to have the filesystems unmounted
     try:
-        # If upgrading, copy the stashed files back
-        if upgrade_dir:
-            RestoreConfiguration(save_path=upgrade_dir,
-                                 interactive=interactive,
-                                 destination=mount_point)
-        else:
-            if os.path.exists(data_dir):
-                try:
-                    copytree(data_dir, "{}/data".format(mount_point),
-                             progress_callback=lambda src, dst: LogIt("Copying {} -> {}".format(src, dst)))
-                except:
-                    pass
-            # 
-            # We should also handle some FN9 stuff
-            # In this case, we want the newer database file, for migration purposes
-            # XXX -- this is a problem when installing from FreeBSD
-            for dbfile in ["freenas-v1.db", "factory-v1.db"]:
-                if os.path.exists("/data/{}".format(dbfile)):
-                    copytree("/data/{}".format(dbfile), "{}/data/{}".format(mount_point, dbfile))
+        # If upgrading, copy the saved files back, or copy them from the old BE
+        with Trace.Span("CopyConfiguration"):
+            if upgrade_archive:
+                RestoreConfiguration(save_path=upgrade_archive,
+                                     interactive=interactive,
+                                     destination=mount_point)
+            elif upgrade_plan:
+                # The clone already has everything
+                pass
+            elif upgrade and upgrade_pool:
+                MigrateConfiguration(session=session,
+                                     interactive=interactive,
+                                     destination=mount_point)
+            else:
+                if os.path.exists(data_dir):
+                    try:
+                        TreeCopy.CopyTree(data_dir, "{}/data".format(mount_point),
+                                          progress=CopyProgress(data_dir))
+                    except:
+                        pass
+                # 
+                # We should also handle some FN9 stuff
+                # In this case, we want the newer database file, for migration purposes
+                # XXX -- this is a problem when installing from FreeBSD
+                for dbfile in ["freenas-v1.db", "factory-v1.db"]:
+                    if os.path.exists("/data/{}".format(dbfile)):
+                        TreeCopy.CopyTree("/data/{}".format(dbfile), "{}/data/{}".format(mount_point, dbfile))
 
         # After that, we do the installlation.
         # This involves mounting the new BE,
         # and then running the install code on it.
 
-        installer = Installer.Installer(manifest=manifest,
-                                        root=mount_point,
-                                        config=config)
+        with Trace.Span("InstallPackages"):
+            if upgrade_plan:
+                # Only the changed packages, on top of the clone
+                RemovePackages(config, mount_point, upgrade_plan.removed)
+                packages = upgrade_plan.changed
+            else:
+                packages = None
+            if pipeline:
+                start_time = time.time()
+                PipelinedInstall(manifest, config, mount_point, package_dir,
+                                 trampoline=trampoline,
+                                 package_handler=package_notifier,
+                                 progress_handler=progress_notifier,
+                                 window=pipeline_window,
+                                 store=package_store,
+                                 downloader=downloader,
+                                 packages=packages)
+            else:
+                installer = Installer.Installer(manifest=manifest,
+                                                root=mount_point,
+                                                config=config)
 
-        if installer.GetPackages() is not True:
-            LogIt("Installer.GetPackages() failed")
-            raise InstallationError("Unable to load packages")
-        
-        # This should only be true for the ISO installer.
-        installer.trampoline = trampoline
-        
-        start_time = time.time()
-        try:
-            installer.InstallPackages(progressFunc=progress_notifier,
-                                      handler=package_notifier)
-        except BaseException as e:
-            LogIt("InstallPackaages got exception {}".format(str(e)))
-            raise InstallationError("Could not install packages")
+                if installer.GetPackages(pkgList=packages) is not True:
+                    LogIt("Installer.GetPackages() failed")
+                    raise InstallationError("Unable to load packages")
+
+                # This should only be true for the ISO installer.
+                installer.trampoline = trampoline
+
+                start_time = time.time()
+                try:
+                    installer.InstallPackages(progressFunc=progress_notifier,
+                                              handler=package_notifier)
+                except BaseException as e:
+                    LogIt("InstallPackaages got exception {}".format(str(e)))
+                    raise InstallationError("Could not install packages")
         # Packages installed!
         if interactive:
             try:
@@ -915,7 +1316,7 @@ def Install(**kwargs):
                 except:
                     pass
             # We've just repartitioned, so rescan geom
-            geom.scan()
+            Utils.RescanTopology()
             # Set the boot dataset
             freenas_boot.properties["bootfs"].value = bename
             LogIt("Set bootfs to {}".format(bename))
@@ -971,7 +1372,7 @@ def Install(**kwargs):
                 for sentinel in ["/data/cd-upgrade", "/data/need-update"]:
                     with open(mount_point + sentinel, "wb") as f:
                         pass
-            elif password is not None:
+            elif password is not None or password_hash is not None:
                 if interactive:
                     try:
                         status = Dialog.MessageBox(Title(), "\nSetting root password",
@@ -981,8 +1382,11 @@ def Install(**kwargs):
                     except:
                         pass
                 try:
-                    RunCommand("/etc/netcli", "reset_root_pw", password,
-                               chroot=mount_point)
+                    if password_hash is not None:
+                        SaveRootPasswordHash(mount_point, password_hash)
+                    else:
+                        RunCommand("/etc/netcli", "reset_root_pw", password,
+                                   chroot=mount_point)
                 except RunCommandException as e:
                     LogIt("Setting root password: {}".format(str(e)))
                     raise InstallationError("Unable to set root password")
@@ -1013,8 +1417,9 @@ def Install(**kwargs):
         manifest.Save(mount_point)
 
         # Okay!  Now if there are any post-install functions, we call them
-        for fp in post_install:
-            fp(mount_point=mount_point, **kwargs)
+        with Trace.Span("PostInstall"):
+            for fp in post_install:
+                fp(mount_point=mount_point, **kwargs)
 
         # And we're done!
         end_time = time.time()
@@ -1034,6 +1439,8 @@ def Install(**kwargs):
         LogIt("Outer block got base exception {}".format(str(e)))
         raise
     finally:
+        for line in Utils.command_stats.report(since=command_mark):
+            LogIt(line)
         if package_dir is None:
             LogIt("Removing downloaded packages directory {}".format(cache_dir))
             shutil.rmtree(cache_dir, ignore_errors=True)
@@ -1041,16 +1448,17 @@ def Install(**kwargs):
 
     LogIt("Exporting freenas-boot at end of installation")
     try:
-        zfs.export_pool(freenas_boot)
+        session.close()
     except libzfs.ZFSException as e:
         LogIt("Could not export freenas boot: {}".format(str(e)))
         raise
 
     if interactive:
         total_time = int(end_time - start_time)
-        Dialog.MessageBox(Title(),
-                          "The {} installer has finished the installation in {} seconds".format(Project(), total_time),
-                          height=8, width=40).run()
+        with Trace.Operator("Installation finished"):
+            Dialog.MessageBox(Title(),
+                              "The {} installer has finished the installation in {} seconds".format(Project(), total_time),
+                              height=8, width=40).run()
         
         
 
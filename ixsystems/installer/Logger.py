@@ -0,0 +1,335 @@
+"""
+A buffered, thread-safe logger for the installer.
+
+Messages go into a bounded ring buffer, and a background thread
+formats and writes them.  Formatting is lazy:
+
+	Logger.Debug("package", "Package {}:  {}", package, name)
+
+doesn't format anything unless debug is enabled for "package".
+Each line has a monotonic timestamp (seconds since the logger
+started), the level, the thread, and the subsystem; alternatively
+the log can be written as JSON lines.  The buffer is flushed at
+exit, when an uncaught exception happens, and whenever an error is
+logged.  If the buffer fills, callers wait for the writer rather
+than dropping messages.
+
+Levels can be set per subsystem, either with SetLevel() or with
+the IX_INSTALLER_LOG environment variable, e.g.
+
+	IX_INSTALLER_LOG="info,package=debug,fetch=warning,json"
+
+Utils.LogIt() is a compatible wrapper around this.  This module
+must not import anything else from the installer.
+"""
+from __future__ import print_function
+import os, sys
+import json
+import time
+import atexit
+import threading
+import traceback
+import collections
+
+DEBUG = 10
+INFO = 20
+WARNING = 30
+ERROR = 40
+
+_level_names = {
+    DEBUG : "DEBUG",
+    INFO : "INFO",
+    WARNING : "WARN",
+    ERROR : "ERROR",
+}
+_level_values = {
+    "debug" : DEBUG,
+    "info" : INFO,
+    "warn" : WARNING,
+    "warning" : WARNING,
+    "error" : ERROR,
+}
+
+DEFAULT_CAPACITY = 8192
+DEFAULT_FLUSH_INTERVAL = 0.5
+
+LogRecord = collections.namedtuple("LogRecord",
+                                   ["time", "level", "subsystem", "thread",
+                                    "message", "args", "kwargs", "exc_text"])
+
+def ParseLevel(value):
+    """
+    Turn a level name (or number) into a level.  Raises ValueError.
+    """
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        pass
+    return _level_values[str(value).strip().lower()]
+
+class Logger(object):
+    """
+    The logger itself.  output is a path (opened for append) or a
+    file object.
+    """
+    def __init__(self, output, level=INFO, json_lines=False,
+                 capacity=DEFAULT_CAPACITY, flush_interval=DEFAULT_FLUSH_INTERVAL):
+        if isinstance(output, str):
+            self._file = open(output, "a")
+            self._owns_file = True
+        else:
+            self._file = output
+            self._owns_file = False
+        self._level = level
+        self._levels = {}
+        self._json = json_lines
+        self._capacity = max(1, capacity)
+        self._flush_interval = flush_interval
+        self._epoch = time.monotonic()
+        self._wall_epoch = time.time()
+        self._buffer = collections.deque()
+        self._lock = threading.Lock()
+        self._wakeup = threading.Condition(self._lock)
+        self._drained = threading.Condition(self._lock)
+        self._write_lock = threading.Lock()
+        self._pending_flush = False
+        self._closed = False
+        self._writer = threading.Thread(target=self._run, name="LogWriter")
+        self._writer.daemon = True
+        self._writer.start()
+
+    @property
+    def file(self):
+        return self._file
+
+    @property
+    def json_lines(self):
+        return self._json
+
+    @json_lines.setter
+    def json_lines(self, value):
+        self._json = bool(value)
+
+    def set_level(self, level, subsystem=None):
+        if subsystem is None:
+            self._level = level
+        else:
+            self._levels[subsystem] = level
+
+    def enabled(self, level, subsystem=None):
+        return level >= self._levels.get(subsystem, self._level)
+
+    def log(self, level, subsystem, message, *args, **kwargs):
+        """
+        Queue a message.  message is formatted with args and kwargs
+        (str.format style) by the writer thread, and only if there are
+        any.  If exc_info=True is passed, the current exception's
+        traceback is captured now and written after the message.
+        """
+        exc_info = kwargs.pop("exc_info", False)
+        if not self.enabled(level, subsystem):
+            return
+        exc_text = None
+        if exc_info:
+            exc = sys.exc_info()
+            if exc[0] is not None:
+                exc_text = "".join(traceback.format_exception(*exc)).rstrip()
+        record = LogRecord(time.monotonic() - self._epoch, level, subsystem,
+                           threading.current_thread().name,
+                           message, args, kwargs, exc_text)
+        with self._lock:
+            if self._closed:
+                self._write([record])
+                return
+            while len(self._buffer) >= self._capacity:
+                # Full; make the writer catch up instead of losing messages
+                self._pending_flush = True
+                self._wakeup.notify()
+                self._drained.wait(1.0)
+            self._buffer.append(record)
+            if level >= ERROR or exc_text:
+                self._pending_flush = True
+                self._wakeup.notify()
+
+    def _format(self, record):
+        try:
+            if record.args or record.kwargs:
+                message = str(record.message).format(*record.args, **record.kwargs)
+            else:
+                message = str(record.message)
+        except BaseException as e:
+            message = "{!r} % {!r} (format failed: {})".format(record.message, record.args, str(e))
+        if self._json:
+            entry = {
+                "t" : round(record.time, 6),
+                "wall" : round(self._wall_epoch + record.time, 6),
+                "level" : _level_names.get(record.level, str(record.level)),
+                "subsystem" : record.subsystem,
+                "thread" : record.thread,
+                "msg" : message,
+            }
+            if record.exc_text:
+                entry["exc"] = record.exc_text
+            return json.dumps(entry)
+        line = "{:10.3f} {:5} [{}] {}: {}".format(record.time,
+                                                  _level_names.get(record.level, str(record.level)),
+                                                  record.thread, record.subsystem, message)
+        if record.exc_text:
+            line += "\n" + "\n".join("\t" + x for x in record.exc_text.split("\n"))
+        return line
+
+    def _write(self, records):
+        if not records:
+            return
+        with self._write_lock:
+            try:
+                for record in records:
+                    print(self._format(record), file=self._file)
+                self._file.flush()
+            except BaseException:
+                # Nowhere left to complain to
+                pass
+
+    def _take(self):
+        # Caller holds the lock
+        records = list(self._buffer)
+        self._buffer.clear()
+        self._pending_flush = False
+        self._drained.notify_all()
+        return records
+
+    def _run(self):
+        while True:
+            with self._lock:
+                if not self._buffer and not self._closed:
+                    self._wakeup.wait(self._flush_interval)
+                closed = self._closed
+                records = self._take()
+            self._write(records)
+            if closed:
+                return
+
+    def flush(self):
+        """
+        Write everything queued so far, on the calling thread.
+        """
+        with self._lock:
+            records = self._take()
+        self._write(records)
+
+    def close(self):
+        with self._lock:
+            if self._closed:
+                return
+            self._closed = True
+            self._wakeup.notify()
+        if self._writer is not threading.current_thread():
+            self._writer.join(5.0)
+        self.flush()
+        if self._owns_file:
+            try:
+                self._file.close()
+            except BaseException:
+                pass
+
+_logger = None
+_logger_lock = threading.Lock()
+_hooks_installed = False
+
+def _InstallHooks():
+    global _hooks_installed
+    if _hooks_installed:
+        return
+    _hooks_installed = True
+    atexit.register(Shutdown)
+    previous_hook = sys.excepthook
+    def ExceptHook(exc_type, exc_value, exc_traceback):
+        try:
+            if _logger:
+                text = "".join(traceback.format_exception(exc_type, exc_value, exc_traceback)).rstrip()
+                _logger.log(ERROR, "installer", "Uncaught exception:\n{}", text)
+                _logger.flush()
+        finally:
+            previous_hook(exc_type, exc_value, exc_traceback)
+    sys.excepthook = ExceptHook
+    if hasattr(threading, "excepthook"):
+        previous_thread_hook = threading.excepthook
+        def ThreadExceptHook(args):
+            try:
+                if _logger:
+                    text = "".join(traceback.format_exception(args.exc_type, args.exc_value,
+                                                              args.exc_traceback)).rstrip()
+                    _logger.log(ERROR, "installer", "Uncaught exception in thread {}:\n{}",
+                                getattr(args.thread, "name", None), text)
+                    _logger.flush()
+            finally:
+                previous_thread_hook(args)
+        threading.excepthook = ThreadExceptHook
+
+def Configure(logger, spec):
+    """
+    Apply a level specification (see IX_INSTALLER_LOG above) to logger.
+    """
+    for item in (spec or "").split(","):
+        item = item.strip()
+        if not item:
+            continue
+        try:
+            if item.lower() == "json":
+                logger.json_lines = True
+            elif "=" in item:
+                (subsystem, level) = item.split("=", 1)
+                logger.set_level(ParseLevel(level), subsystem.strip())
+            else:
+                logger.set_level(ParseLevel(item))
+        except (KeyError, ValueError):
+            logger.log(WARNING, "installer", "Ignoring unknown log setting {!r}", item)
+
+def Init(output, level=INFO, json_lines=False, **kwargs):
+    """
+    Start logging to output (a path or file object), replacing any
+    previous logger.  Returns the Logger.
+    """
+    global _logger
+    with _logger_lock:
+        old = _logger
+        _logger = Logger(output, level=level, json_lines=json_lines, **kwargs)
+        Configure(_logger, os.environ.get("IX_INSTALLER_LOG", None))
+        _InstallHooks()
+    if old:
+        old.close()
+    return _logger
+
+def GetLogger():
+    return _logger
+
+def Shutdown():
+    if _logger:
+        _logger.close()
+
+def Flush():
+    if _logger:
+        _logger.flush()
+
+def SetLevel(level, subsystem=None):
+    if _logger:
+        _logger.set_level(level, subsystem)
+
+def Enabled(level, subsystem=None):
+    return _logger is not None and _logger.enabled(level, subsystem)
+
+def Log(level, subsystem, message, *args, **kwargs):
+    if _logger:
+        _logger.log(level, subsystem, message, *args, **kwargs)
+
+def Debug(subsystem, message, *args, **kwargs):
+    Log(DEBUG, subsystem, message, *args, **kwargs)
+
+def Info(subsystem, message, *args, **kwargs):
+    Log(INFO, subsystem, message, *args, **kwargs)
+
+def Warning(subsystem, message, *args, **kwargs):
+    Log(WARNING, subsystem, message, *args, **kwargs)
+
+def Error(subsystem, message, *args, **kwargs):
+    Log(ERROR, subsystem, message, *args, **kwargs)
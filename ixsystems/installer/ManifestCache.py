@@ -0,0 +1,265 @@
+from __future__ import print_function
+import os
+import json
+import time
+import socket
+import hashlib
+import tempfile
+import threading
+import collections
+import urllib.error
+import urllib.request
+
+import freenasOS.Manifest as Manifest
+
+from . import Trace
+from .Fetch import PackageSize, PackageChecksum
+from .Utils import LogIt, SmartSize
+
+# /tmp is in memory when booted from the install media, so this lasts
+# for as long as the installer does, across restarts of the flow.
+DEFAULT_CACHE_DIR = os.path.join(tempfile.gettempdir(), "installer-manifests")
+INDEX_VERSION = 1
+# How long to wait for the update server before using the cached copy
+DEFAULT_TIMEOUT = 15.0
+# Where freenasOS's FindLatestManifest looks for a train's manifest
+LATEST_PATH = "{}/{}/LATEST"
+
+# One package in the manifest, as recorded in the cache
+PackageEntry = collections.namedtuple("PackageEntry",
+                                      ["name", "version", "filename", "size", "checksum"])
+
+class ManifestCacheError(Exception):
+    """
+    Raised when there is no manifest to be had:  the server couldn't
+    be reached (or sent something unusable), and nothing is cached.
+    """
+    def __init__(self, message):
+        super(ManifestCacheError, self).__init__(message)
+        self.message = message
+
+class CachedManifest(object):
+    """
+    What ManifestCache.get() returns:  the loaded manifest, the package
+    index (name -> PackageEntry, in manifest order), how it was obtained
+    ("fetched", "not-modified", or "stale" if the server couldn't be
+    reached), and when the copy was last fetched or revalidated.
+    """
+    def __init__(self, manifest, index, source, fetched):
+        self.manifest = manifest
+        self.index = index
+        self.source = source
+        self.fetched = fetched
+
+    def __repr__(self):
+        return "<CachedManifest {}, {} packages, {}>".format(self.manifest.Version(),
+                                                            len(self.index), self.source)
+
+    @property
+    def stale(self):
+        return self.source == "stale"
+
+    @property
+    def total_size(self):
+        return sum(entry.size for entry in self.index.values())
+
+def PackageIndex(manifest):
+    """
+    Build the package index for manifest.
+    """
+    index = collections.OrderedDict()
+    for pkg in manifest.Packages():
+        index[pkg.Name()] = PackageEntry(pkg.Name(), pkg.Version(), pkg.FileName(),
+                                         PackageSize(pkg), PackageChecksum(pkg))
+    return index
+
+class ManifestCache(object):
+    """
+    A cache of train manifests, keyed by update server URL and train.
+    Each lookup revalidates the cached copy with a conditional request
+    (If-None-Match and If-Modified-Since, from the last response), so a
+    restart of the installer costs a 304 rather than a download and a
+    fresh parse of the package list.  If the server can't be reached,
+    the last good copy is used, with a warning.  The layout is:
+
+    <root>/<key>.manifest	The manifest, as the server sent it
+    <root>/<key>.json		The URL, train, validators, fetch time, and package index
+
+    where key is a hash of the URL and train.  Both files are written to
+    temporary files and renamed into place, manifest first, so the
+    metadata never describes a partial manifest.
+    """
+    def __init__(self, root=DEFAULT_CACHE_DIR, timeout=DEFAULT_TIMEOUT):
+        self._root = root
+        self._timeout = timeout
+        self._lock = threading.Lock()
+        self._stats = {
+            "fetched" : 0,
+            "not_modified" : 0,
+            "stale" : 0,
+            "bytes_fetched" : 0,
+        }
+        try:
+            os.makedirs(self._root, 0o755)
+        except OSError:
+            if not os.path.isdir(self._root):
+                raise
+
+    def __repr__(self):
+        return "<ManifestCache {}>".format(self._root)
+
+    @property
+    def root(self):
+        return self._root
+
+    def stats(self):
+        with self._lock:
+            return dict(self._stats)
+
+    def _paths(self, url, train):
+        key = hashlib.sha256("{}\0{}".format(url, train).encode("utf-8")).hexdigest()[:32]
+        return (os.path.join(self._root, key + ".manifest"),
+                os.path.join(self._root, key + ".json"))
+
+    def _write(self, path, data):
+        (fd, tmp_path) = tempfile.mkstemp(dir=self._root, prefix=".tmp.")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                f.write(data)
+            os.rename(tmp_path, path)
+        except:
+            try:
+                os.unlink(tmp_path)
+            except OSError:
+                pass
+            raise
+
+    def _load_meta(self, meta_path, url, train):
+        try:
+            with open(meta_path, "r") as f:
+                meta = json.load(f)
+        except (OSError, IOError, ValueError):
+            return None
+        if (meta.get("version", None) != INDEX_VERSION or
+            meta.get("url", None) != url or meta.get("train", None) != train):
+            return None
+        return meta
+
+    def _load(self, manifest_path, config):
+        manifest = Manifest.Manifest(configuration=config, require_signature=False)
+        manifest.LoadPath(manifest_path)
+        return manifest
+
+    def _request(self, url, meta):
+        """
+        The conditional GET.  Returns (status, headers, body), with
+        a body only for a 200.  Raises urllib.error.URLError (including
+        HTTPError, for anything but 200 and 304), socket.timeout, or
+        IOError if the server can't be reached.
+        """
+        request = urllib.request.Request(url)
+        if meta:
+            if meta.get("etag", None):
+                request.add_header("If-None-Match", meta["etag"])
+            if meta.get("last_modified", None):
+                request.add_header("If-Modified-Since", meta["last_modified"])
+        try:
+            with urllib.request.urlopen(request, timeout=self._timeout) as response:
+                return (response.status, response.headers, response.read())
+        except urllib.error.HTTPError as e:
+            if e.code == 304:
+                return (304, e.headers, None)
+            raise
+
+    def get(self, url, train, config=None):
+        """
+        Return a CachedManifest for train's latest manifest on the update
+        server at url.  Raises ManifestCacheError if there's no manifest
+        to be had.
+        """
+        manifest_url = LATEST_PATH.format(url.rstrip("/"), train)
+        (manifest_path, meta_path) = self._paths(url, train)
+        meta = self._load_meta(meta_path, url, train)
+        if meta and not os.path.exists(manifest_path):
+            meta = None
+
+        with Trace.Span("FetchManifest", train=train):
+            try:
+                (status, headers, body) = self._request(manifest_url, meta)
+                error = None
+            except (urllib.error.URLError, socket.timeout, IOError, OSError) as e:
+                (status, headers, body) = (None, None, None)
+                error = e
+
+        if status == 304 and meta:
+            meta["fetched"] = time.time()
+            try:
+                manifest = self._load(manifest_path, config)
+                self._write(meta_path, json.dumps(meta, indent=1, sort_keys=True).encode("utf-8"))
+            except BaseException as e:
+                LogIt("Could not use the cached manifest for {}: {}".format(train, str(e)))
+            else:
+                with self._lock:
+                    self._stats["not_modified"] += 1
+                LogIt("Manifest for {} from {} has not changed".format(train, url))
+                return CachedManifest(manifest, self._index(meta), "not-modified", meta["fetched"])
+            # The cached copy is no good, so get the whole thing
+            try:
+                os.unlink(meta_path)
+            except OSError:
+                pass
+            return self.get(url, train, config=config)
+
+        if status == 200:
+            try:
+                self._write(manifest_path + ".new", body)
+                manifest = self._load(manifest_path + ".new", config)
+                index = PackageIndex(manifest)
+            except BaseException as e:
+                LogIt("Manifest for {} from {} could not be loaded: {}".format(train, manifest_url, str(e)))
+                error = e
+                try:
+                    os.unlink(manifest_path + ".new")
+                except OSError:
+                    pass
+            else:
+                os.rename(manifest_path + ".new", manifest_path)
+                meta = {
+                    "version" : INDEX_VERSION,
+                    "url" : url,
+                    "train" : train,
+                    "etag" : headers.get("ETag", None),
+                    "last_modified" : headers.get("Last-Modified", None),
+                    "fetched" : time.time(),
+                    "packages" : [list(entry) for entry in index.values()],
+                }
+                self._write(meta_path, json.dumps(meta, indent=1, sort_keys=True).encode("utf-8"))
+                with self._lock:
+                    self._stats["fetched"] += 1
+                    self._stats["bytes_fetched"] += len(body)
+                LogIt("Fetched manifest for {} from {} ({}bytes, {} packages)".format(
+                    train, url, SmartSize(len(body)), len(index)))
+                return CachedManifest(manifest, index, "fetched", meta["fetched"])
+        elif error is None:
+            error = "unexpected status {}".format(status)
+
+        # Fall back to the last good copy
+        if meta:
+            try:
+                manifest = self._load(manifest_path, config)
+            except BaseException as e:
+                LogIt("Could not load the cached manifest for {}: {}".format(train, str(e)))
+            else:
+                with self._lock:
+                    self._stats["stale"] += 1
+                LogIt("WARNING: Could not get the manifest for {} from {} ({}); using the copy fetched {}".format(
+                    train, url, str(error), time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(meta["fetched"]))))
+                return CachedManifest(manifest, self._index(meta), "stale", meta["fetched"])
+        raise ManifestCacheError("Could not get the manifest for {} from {}: {}".format(train, url, str(error)))
+
+    def _index(self, meta):
+        index = collections.OrderedDict()
+        for entry in meta.get("packages", []):
+            entry = PackageEntry(*entry)
+            index[entry.name] = entry
+        return index
@@ -4,20 +4,35 @@ import subprocess
 import time
 import argparse
 import tempfile
+import shutil
 import bsd
 import bsd.dialog as Dialog
 import bsd.geom as geom
 from bsd.sysctl import sysctlbyname
 import libzfs
 import enum
+import collections
+import threading
 
 import freenasOS.Manifest as Manifest
 import freenasOS.Configuration as Configuration
 
 from . import Install
+from . import Answers
+from . import PackageCache
+from . import ManifestCache
+from . import PoolLayout
+from . import Probe
+from . import Discovery
+from . import Fetch
+from . import Download
+from . import BootPool
 from .Install import InstallationError
 
 from . import Utils
+from . import Trace
+from . import Replay
+from . import Logger
 from .Utils import InitLog, LogIt, Title, Project, SetProject
 from .Utils import BootMethod, DiskRealName, SmartSize, RunCommand
 
@@ -30,6 +45,7 @@ class InstallationHandler(object):
     def __init__(self):
         self.package = None
         self.gauge = None
+        self.progress = None
         
     def __enter__(self):
         return self
@@ -37,6 +53,10 @@ class InstallationHandler(object):
     def __exit__(sef, type, value, traceback):
         pass
 
+    def _set_percentage(self, percentage):
+        if self.gauge:
+            self.gauge.percentage = percentage
+
     def start_package(self, index, name, packages):
         self.package = name
         total = len(packages)
@@ -46,6 +66,9 @@ class InstallationHandler(object):
                                   height=8, width=50)
         self.gauge.clear()
         self.gauge.run()
+        # Redrawing the gauge for every file is slow, especially on a
+        # serial console, so only redraw when there's something to show.
+        self.progress = Utils.ProgressCoalescer(self._set_percentage)
 
     def package_update(self, **kwargs):
         """
@@ -61,10 +84,15 @@ class InstallationHandler(object):
             # This causes the gauge to clean up
             self.gauge.result
             self.gauge = None
+            Logger.Debug("package", "Package {} progress updates: {}", self.package, self.progress.stats())
         else:
-            # This is going to be very verbose -- it's each FS object
-            LogIt("Package {}:  {}".format(self.package, name))
-            self.gauge.percentage = int((index * 100) / total)
+            # This is going to be very verbose -- it's each FS object,
+            # so only log a sample of them, and let the logger format
+            # them later (if at all).
+            if self.progress.should_log(index, total):
+                Logger.Info("package", "Package {}:  {} ({} of {})", self.package, name, index, total)
+            if total:
+                self.progress.update((index * 100) / total)
             
 # This is set by SelectDisks, even if the drives
 # aren't going to be re-used.
@@ -72,6 +100,19 @@ class InstallationHandler(object):
 # importable, the whole installation will exit, so
 # this will either be none, or an importable pool object.
 found_bootpool = None
+# And this is the session for the boot pools FindBootPool found, which
+# imports the pool once for UpgradePossible, Install, and so on.
+# CloseBootSession() exports it again.
+boot_session = None
+
+def CloseBootSession():
+    global boot_session
+    if boot_session:
+        try:
+            boot_session.close()
+        except BaseException as e:
+            LogIt("Could not close boot pool session: {}".format(str(e)))
+    boot_session = None
 
 class ValidationCode(enum.Enum):
     OK = 0
@@ -92,49 +133,137 @@ class ValidationError(RuntimeError):
     def message(self):
         return self._message
     
-def validate_disk(name):
+DiskClassification = collections.namedtuple("DiskClassification",
+                                            ["name", "code", "message", "entry"])
+
+class DiskInventory(object):
     """
-    Given the geom of a disk, let's see if it's appropriate.
-    Innappropriate disks are too small (4gbytes and less),
-    or are already mounted / in use by a pool.  (That latter
-    being somewhat harder to tell...)
-    XXX How inefficient is this?
+    Classify every disk in the system in a single pass.
+    Inappropriate disks are too small (4gbytes and less), or are
+    already mounted / in use by a pool.  The set of in-use disks is
+    computed once per refresh, and the results are kept until the
+    geom topology changes (or invalidate() is called).
     """
     min_disk_size = 4 * 1024 * 1024 * 1024
-    used_disks = []
-    # Start with zfs disks
-    pools = list(zfs.pools)
-    for pool in zfs.pools:
-        for disk in pool.disks:
-            # Remove the beginning "/dev/"
-            disk_name = disk[5:]
-            x = geom.geom_by_name("DEV", disk_name)
-            used_disks.append(DiskRealName(x))
-                
-    # Now let's go for the mounted disks
-    mounts = bsd.getmntinfo()
-    for mount in mounts:
-        if mount.fstype in ("tmpfs", "devfs"):
-            # It's not a real disk!
+
+    def __init__(self):
+        self._generation = None
+        self._results = {}
+        self._lock = threading.Lock()
+
+    def _used_disks(self):
+        used_disks = set()
+        # Start with zfs disks
+        for pool in zfs.pools:
+            for disk in pool.disks:
+                # Remove the beginning "/dev/"
+                used_disks.add(DiskRealName(disk[5:]))
+        # Now let's go for the mounted disks
+        for mount in bsd.getmntinfo():
+            if mount.fstype in ("tmpfs", "devfs"):
+                # It's not a real disk!
+                continue
+            if mount.source.startswith("/dev/"):
+                used_disks.add(DiskRealName(mount.source[5:]))
+        used_disks.discard(None)
+        return used_disks
+
+    def _classify(self, entry, used_disks):
+        if entry.name in used_disks:
+            return DiskClassification(entry.name, ValidationCode.DiskInUse,
+                                      "Disk {} is in use".format(entry.name), entry)
+        if not entry.size:
+            return DiskClassification(entry.name, ValidationCode.DiskNoInfo,
+                                      "No information available for disk {}".format(entry.name), entry)
+        if entry.size < self.min_disk_size:
+            return DiskClassification(entry.name, ValidationCode.DiskTooSmall,
+                                      "Disk {} is too small ({}, need 4G at least)".format(entry.name,
+                                                                                          SmartSize(entry.size)),
+                                      entry)
+        return DiskClassification(entry.name, ValidationCode.OK, "", entry)
+
+    def invalidate(self):
+        with self._lock:
+            self._generation = None
+
+    def refresh(self):
+        """
+        Re-classify all of the disks, unless the cached results are
+        still from the current topology.  Returns the results, as a
+        dictionary of name -> DiskClassification.
+        """
+        with self._lock:
+            topology = Utils.Topology()
+            if self._generation != topology.generation:
+                used_disks = self._used_disks()
+                LogIt("DiskInventory: disks in use are {}".format(sorted(used_disks)))
+                self._results = { entry.name : self._classify(entry, used_disks)
+                                  for entry in topology.disks() }
+                self._generation = topology.generation
+            return self._results
+
+    def classify(self, name):
+        """
+        Return the DiskClassification for the named disk.
+        """
+        result = self.refresh().get(name, None)
+        if result is None:
+            result = DiskClassification(name, ValidationCode.DiskNoInfo,
+                                        "No information available for disk {}".format(name), None)
+        return result
+
+    def eligible(self):
+        """
+        Return a list, sorted by name, of the DiskClassification objects
+        for disks that can be used for installation.
+        """
+        results = self.refresh()
+        return [results[name] for name in sorted(results) if results[name].code == ValidationCode.OK]
+
+disk_inventory = DiskInventory()
+
+def ImportablePoolDisks():
+    """
+    Return a dictionary of disk name -> pool name for the disks of
+    the pools that could be imported, other than boot pools.  These
+    are probably someone's data, so they're only used when asked for
+    by name.
+    """
+    pool_disks = {}
+    for pool in zfs.find_import():
+        if pool.name == "freenas-boot":
             continue
-        if mount.source.startswith("/dev/"):
-            disk_name = mount.source[5:]
-            x = geom.geom_by_name("DEV", disk_name)
-            used_disks.append(DiskRealName(x))
+        for disk in pool.disks:
+            name = DiskRealName(disk)
+            if name:
+                pool_disks[name] = pool.name
+    return pool_disks
 
-    if name in used_disks:
-        raise ValidationError(code=ValidationCode.DiskInUse, message="Disk {} is in use".format(name))
+def _InvalidateDisks():
+    Utils.RescanTopology()
+    disk_inventory.invalidate()
 
-    try:
-        disk = Utils.Disk(name)
-    except RuntimeError:
-        LogIt("Could not find information about disk {} in validate_disk".format(name))
-        raise ValidationError(code=ValidationCode.DiskNoInfo,
-                              message="No information available for disk {}".format(name))
-    if disk.size < min_disk_size:
-        LogIt("Disk {} is too small ({}, need 4G at least)".format(name, disk.smart_size))
-        raise ValidationError(code=ValidationCode.DiskTooSmall,
-                              message="Disk {} is too small ({}, need 4G at least)".format(name, disk.smart_size))
+# Started by main(), so this is mostly done by the time the operator
+# picks Install/Update.  The boot pools are looked up last, after the
+# disks, so the background thread is done with libzfs by the time
+# FindBootPool gets them.
+discovery = Discovery.Discovery(disk_key=lambda: sysctlbyname("kern.disks"),
+                                invalidate=_InvalidateDisks)
+discovery.add("physmem", lambda: sysctlbyname("hw.physmem"))
+discovery.add("boot_method", lambda: BootMethod())
+discovery.add("serial_console", lambda: Utils.ConsoleBaudRate())
+discovery.add("disks", lambda: disk_inventory.refresh(), disks=True)
+discovery.add("boot_pools", lambda: list(zfs.find_import(name="freenas-boot")), disks=True, once=True)
+
+def validate_disk(name):
+    """
+    Given the name of a disk, let's see if it's appropriate.
+    Raises ValidationError if it is not; see DiskInventory.
+    """
+    result = disk_inventory.classify(name)
+    if result.code != ValidationCode.OK:
+        LogIt("Could not validate disk {}: {}".format(name, result.message))
+        raise ValidationError(code=result.code, message=result.message)
     return
 
 def validate_system():
@@ -146,7 +275,7 @@ def validate_system():
     gByte = 1024 * 1024 * 1024
     min_memsize = 7 * gByte
     try:
-        sys_memsize = sysctlbyname("hw.physmem")
+        sys_memsize = discovery.get("physmem")
     except:
         LogIt("Could not determine system memory size")
         raise ValidationError(code=ValidationCode.MemoryTooSmall, message="Could not get memory size")
@@ -158,88 +287,63 @@ def validate_system():
     
     return
 
-def UpgradePossible():
+@Trace.Traced()
+def UpgradePossible(interactive=True):
     """
     An upgrade is possible if there is one (and only one) freenas-boot pool,
     and if that pool has an installation for the same project as us.  We'll
     determine the project by importing the pool, checking for a bootfs dataset,
     and mounting it to look at etc/version, which should startwith the same
     name as our project.  If any of those actions fail, return false.
+    The pool is left imported (and the dataset mounted) in boot_session,
+    for Install().
     """
-    global found_bootpool
-    if not found_bootpool:
+    if not found_bootpool or not boot_session:
         LogIt("Boot pool has not been found, so no upgrade is possible")
         return False
     
-    status = Dialog.MessageBox(Title(),
-                      "Checking for upgradable {} installation".format(Project()),
-                      width=45, height=10, wait=False)
-    status.clear()
-    status.run()
+    if interactive:
+        status = Dialog.MessageBox(Title(),
+                          "Checking for upgradable {} installation".format(Project()),
+                          width=45, height=10, wait=False)
+        status.clear()
+        status.run()
     try:
-        try:
-            zfs.import_pool(found_bootpool, "freenas-boot", {})
-        except:
-            LogIt("Could not import freenas-boot")
-            return False
-        boot_pool = None
-        try:
-            boot_pool = zfs.get("freenas-boot")
-            try:
-                bootfs = boot_pool.properties["bootfs"].value
-                LogIt("bootfs = {}".format(bootfs))
-                # Next we try to mount it
-                try:
-                    bsd.nmount(source=bootfs,
-                               fspath="/mnt",
-                               fstype="zfs",
-                               flags=bsd.MountFlags.RDONLY,
-                    )
-                except BaseException as e:
-                    LogIt("Couldn't mount, got exception {}".format(e))
-                    raise
-                try:
-                    with open("/mnt/etc/version") as f:
-                        version = f.read().rstrip()
-                    if version.startswith(Project()):
-                        return True
-                    LogIt("{} does not start with {}".format(version, Project()))
-                except:
-                    LogIt("Could not open version file")
-                    pass
-                finally:
-                    bsd.unmount("/mnt")
-            except:
-                    LogIt("Could not get bootfs property, or mount dataset")
-
-        except:
-            LogIt("Could not get freenas-boot pool")
-        finally:
-            if boot_pool:
-                zfs.export_pool(boot_pool)
-    except:
-        LogIt("Could not find unimported freenas-boot pool")
+        version = boot_session.version()
+    except BaseException as e:
+        LogIt("Could not get the version of the installation on freenas-boot: {}".format(str(e)))
+        return False
+    if version.startswith(Project()):
+        return True
+    LogIt("{} does not start with {}".format(version, Project()))
     LogIt("Returning false")
     return False
 
-def SelectDisks():
+@Trace.Traced()
+def FindBootPool(interactive=True):
     """
-    Select disks for installation.
-    If there is already a freenas-boot pool, then it will first offer to
-    reuse those disks.  Otherwise, it presents a menu of disks to select.
-    It excludes any disk that is less than 4Gbytes.
-
-    Returns either an array of Disk objects, or None.
+    Look for an existing, unimported, freenas-boot pool.  Returns
+    (pool, disks), where disks is a list of Disk objects for the pool's
+    disks; pool is None if there isn't one, or if some of its disks
+    are missing.  Raises InstallationError if a boot pool is already
+    imported, or if there is more than one.
     """
-    global found_bootpool
-    found_bootpool = None
-    # Look for an existing freenas-boot pool, and ask about just using that.
-    status = Dialog.MessageBox(Title(),
-                               "Scanning for existing boot pools",
-                               height=10, width=40, wait=False)
-    status.clear()
-    status.run()
+    if interactive:
+        status = Dialog.MessageBox(Title(),
+                                   "Scanning for existing boot pools",
+                                   height=10, width=40, wait=False)
+        status.clear()
+        status.run()
     
+    global boot_session
+    # Export the pool, if a previous attempt imported it
+    CloseBootSession()
+    # Get the importable pools first, so discovery is done with libzfs
+    try:
+        pools = discovery.get("boot_pools")
+    except:
+        pools = None
+
     # First see if there is an existing boot pool
     try:
         pool = zfs.get("freenas-boot")
@@ -247,77 +351,95 @@ def SelectDisks():
         pool = None
 
     if pool:
-        Dialog.MessageBox(Title(),
-                          "There is already an imported boot pool, and the {} installer cannot continue".format(Project()),
-                          height=15, width=45).run()
+        if interactive:
+            Dialog.MessageBox(Title(),
+                              "There is already an imported boot pool, and the {} installer cannot continue".format(Project()),
+                              height=15, width=45).run()
         raise InstallationError("Boot pool is already imported")
     
-    try:
-        pools = list(zfs.find_import(name="freenas-boot"))
-    except:
-        pools = None
-
+    # If discovery failed, the session looks for them itself
+    boot_session = BootPool.BootPoolSession(pools)
     if pools:
         if len(pools) > 1:
-            box = Dialog.MessageBox(Title(),
-                                    "There are {} unimported boot pools, this needs to be resolved.".format(len(pools)),
-                                    height=15, width=45)
-            box.run()
+            if interactive:
+                box = Dialog.MessageBox(Title(),
+                                        "There are {} unimported boot pools, this needs to be resolved.".format(len(pools)),
+                                        height=15, width=45)
+                box.run()
             raise InstallationError("Multiple unimported boot pools")
-        else:
-            pool_disks = [disk[5:] for disk in pools[0].disks]
-            complete = True
-            disks = []
-            for disk in pool_disks:
-                try:
-                    found = Utils.Disk(disk)
-                    disks.append(found)
-                except RuntimeError:
-                    complete = False
-
-            if complete:
-                found_bootpool = pools[0]
-                title = "An existing boot pool was found"
-                text = """The following disks are already in a boot pool.
+        pool_disks = [disk[5:] for disk in pools[0].disks]
+        disks = []
+        for disk in pool_disks:
+            try:
+                disks.append(Utils.Disk(disk))
+            except RuntimeError:
+                LogIt("Boot pool disk {} is missing".format(disk))
+                return (None, [])
+        return (pools[0], disks)
+    return (None, [])
+
+@Trace.Traced()
+def SelectDisks(probe_budget=None):
+    """
+    Select disks for installation.
+    If there is already a freenas-boot pool, then it will first offer to
+    reuse those disks.  Otherwise, it presents a menu of disks to select.
+    It excludes any disk that is less than 4Gbytes.
+    If probe_budget is set, the disks' read speeds are measured (see
+    Probe.ProbeDisks), taking at most that many seconds, and shown
+    in the menu, with slow disks flagged.
+
+    Returns either an array of Disk objects, or None.
+    """
+    global found_bootpool
+    found_bootpool = None
+    # Look for an existing freenas-boot pool, and ask about just using that.
+    (pool, disks) = FindBootPool()
+
+    if pool:
+        found_bootpool = pool
+        title = "An existing boot pool was found"
+        text = """The following disks are already in a boot pool.
 Do you want to use them for the installation?
 (Even if you want to re-format, but still use only these disks, select Yes.)\n\n"""
-                text += "* " + ", ".join([disk.name for disk in disks])
-                box = Dialog.YesNo(title, text, height=15, width=60, default=True)
-                box.yes_label = "Yes"
-                box.no_label = "No"
-                reuse = False
-                # Let an escape exception percolate up
-                reuse = box.result
-                LogIt("reuse = {}".format(reuse))
-                if reuse:
-                    return disks
-
-    disks = list(geom.class_by_name("DISK").geoms)
-    disks_menu = []
-    LogIt("Looking at system disks {}".format(disks))
-    for disk_geom in disks:
+        text += "* " + ", ".join([disk.name for disk in disks])
+        box = Dialog.YesNo(title, text, height=15, width=60, default=True)
+        box.yes_label = "Yes"
+        box.no_label = "No"
+        reuse = False
+        # Let an escape exception percolate up
+        with Trace.Operator("Reuse boot pool disks"):
+            reuse = box.result
+        LogIt("reuse = {}".format(reuse))
+        if reuse:
+            return disks
+
+    discovery.get("disks")
+    eligible = disk_inventory.eligible()
+    probes = {}
+    if probe_budget and eligible:
         try:
-            disk_real_name = disk_geom.name
+            status = Dialog.MessageBox(Title(),
+                                       "Measuring disk speeds",
+                                       height=7, width=40, wait=False)
+            status.clear()
+            status.run()
         except:
-            LogIt("Could not translate {} to a real disk name".format(disk_geom))
-            continue
-        disk = Utils.Disk(disk_real_name)
-        if disk is None:
-            LogIt("Could not translate name {} to a disk object".format(disk_real_name))
-            continue
-        diskSize = int(disk.size / (1024 * 1024 * 1024))
-        diskDescr = disk.description[:20]
-        if diskSize < 4:
-            # 4GBytes or less is just too small
-            continue
-        # Also want to see if the disk is currently mounted
-        try:
-            validate_disk(disk.name)
-        except ValidationError as e:
-            LogIt("Could not validate disk {}: {}".format(disk.name, e.message))
-            continue
-        
-        disks_menu.append(Dialog.ListItem(disk.name, "{} ({}GBytes)".format(diskDescr, diskSize)))
+            pass
+        with Trace.Span("ProbeDisks", disks=len(eligible), budget=probe_budget):
+            probes = Probe.ProbeDisks([(x.name, x.entry.size) for x in eligible],
+                                      budget=probe_budget)
+
+    disks_menu = []
+    for result in eligible:
+        diskSize = int(result.entry.size / (1024 * 1024 * 1024))
+        diskDescr = result.entry.description[:20]
+        text = "{} ({}GBytes)".format(diskDescr, diskSize)
+        if result.name in probes:
+            text += " {}".format(probes[result.name].summary())
+        disks_menu.append(Dialog.ListItem(result.name, text))
+    LogIt("Eligible system disks {}".format([x.label for x in disks_menu]))
+    discovery.mark("disk list")
     if len(disks_menu) == 0:
         try:
             box = Dialog.MessageBox("No suitable disks were found for installation", width=60)
@@ -326,73 +448,53 @@ Do you want to use them for the installation?
             pass
         return None
     
-    disk_selector = Dialog.CheckList("Installation Media", "Select installation device(s)",
-                                     height=20, width=60, list_items=disks_menu)
-    # Let an escape exception percolate up
-    selected_disks = disk_selector.result
+    while True:
+        disk_selector = Dialog.CheckList("Installation Media", "Select installation device(s)",
+                                         height=20, width=60, list_items=disks_menu)
+        # Let an escape exception percolate up
+        with Trace.Operator("Select disks"):
+            selected_disks = disk_selector.result
+        if not selected_disks:
+            return None
 
-    if selected_disks:
-        return [Utils.Disk(entry.label) for entry in selected_disks]
-    return None
+        slow = [entry.label for entry in selected_disks
+                if entry.label in probes and probes[entry.label].slow]
+        if not slow or len(selected_disks) == 1:
+            break
+        text = "A mirror is only as fast as its slowest disk, and these are much slower than the others:\n\n"
+        text += "\n".join("* {}: {}".format(name, probes[name].slow) for name in slow)
+        text += "\n\nUse them anyway?"
+        box = Dialog.YesNo("Slow disks selected", text, height=20, width=60, default=True)
+        box.yes_label = "Yes"
+        box.no_label = "No"
+        # Let an escape exception percolate up
+        with Trace.Operator("Use slow disks"):
+            if box.result:
+                break
+        # Ask again, with the other disks still selected
+        chosen = set(entry.label for entry in selected_disks) - set(slow)
+        for item in disks_menu:
+            item.selected = item.label in chosen
 
-def do_install():
+    return [Utils.Disk(entry.label) for entry in selected_disks]
+
+def LoadManifest(args, interactive=True):
     """
-    Do the UI for the install.
-    This will either return, or raise an exception.  DialogEscape means that
-    the installer should start over.
-    
-    If we have any command-line arguments, let's handle them now
+    Find the manifest, from the command-line arguments:  the -M file,
+    the one on the install media, or the latest one for the -T train
+    (from the -U server, if given).  Returns (conf, manifest, package_dir),
+    where package_dir is None if the packages will have to be downloaded.
+    Raises InstallationError if there is no manifest.
     """
-    arg_parser = argparse.ArgumentParser(description=Title(), prog="Installer")
-    arg_parser.register('type', 'bool', lambda x: x.lower() in ["yes", "y", "true", "t"])
-    arg_parser.add_argument('-p', '--project',
-                            dest='project',
-                            default=Project(),
-                            help="Specify project (default {})".format(Project()))
-    arg_parser.add_argument('-T', '--train',
-                            dest="train",
-                            help="Specify train name")
-    arg_parser.add_argument('-U', '--url',
-                            dest="url",
-                            help="URL to use when fetching files")
-    arg_parser.add_argument('-D', "--data",
-                            dest='data_dir',
-                            help='Path to /data prototype directory')
-    arg_parser.add_argument('-M', '--manifest',
-                            dest='manifest',
-                            help="Path to manifest file")
-    arg_parser.add_argument('-P', '--packages',
-                            dest='package_dir',
-                            help='Path to package files')
-    arg_parser.add_argument("-B", "--trampoline",
-                            dest='trampoline',
-                            default=True,
-                            type='bool',
-                            help="Run post-install scripts on reboot (default)")
-    args = arg_parser.parse_args()
-    if args:
-        LogIt("Command line args: {}".format(args))
-        
-    SetProject(args.project)
-    
-    
-    try:
-        validate_system()
-    except ValidationError as e:
-        LogIt("Could not validate system: {}".format(e.message))
-        Dialog.MessageBox(Title(),
-                           "\nSystem memory is too small.  Minimum memory size is 8Gbytes",
-                           height=10, width=45).run()
-        return
-    
     if args.manifest:
         if os.path.exists(args.manifest):
             manifest_path = args.manifest
         else:
-            Dialog.MessageBox(Title(),
-                              "A manifest file was specified on the command line, but does not exist.  The manifest file specified was\n\n\t{}".format(args.manifest),
-                              height=15, width=45).run()
-            raise InstallationError("Command-line manifest file {} does not exist".foramt(args.manifet))
+            if interactive:
+                Dialog.MessageBox(Title(),
+                                  "A manifest file was specified on the command line, but does not exist.  The manifest file specified was\n\n\t{}".format(args.manifest),
+                                  height=15, width=45).run()
+            raise InstallationError("Command-line manifest file {} does not exist".format(args.manifest))
     else:
         manifest_path = "/.mount/{}-MANIFEST".format(Project())
         if not os.path.exists(manifest_path):
@@ -407,10 +509,11 @@ def do_install():
     # if we don't have a train or manifest file, we're not okay.
     if (not manifest_path and not args.train):
         LogIt("Command-line URL {}, train {}, manifest {}".format(args.url, args.train, manifest_path))
-        box = Dialog.MessageBox(Title(), "",
-                                height=15, width=45)
-        box.text = "Neither a manifest file nor train were specified"
-        box.run()
+        if interactive:
+            box = Dialog.MessageBox(Title(), "",
+                                    height=15, width=45)
+            box.text = "Neither a manifest file nor train were specified"
+            box.run()
         raise InstallationError("Incorrect command-line arguments given")
         
     conf = Configuration.SystemConfiguration()
@@ -442,152 +545,354 @@ def do_install():
         manifest = None
         
     if args.train and not manifest:
-        try:
-            status = Dialog.MessageBox(Title(),
-                                       "Attempting to download manifest for train {}".format(args.train),
-                                       height=15, width=30, wait=False)
-            status.clear()
-            status.run()
-        except:
-            pass
-        try:
-            manifest = conf.FindLatestManifest(train=args.train,
-                                               require_signature=False)
-        except:
-            manifest = None
+        if interactive:
+            try:
+                status = Dialog.MessageBox(Title(),
+                                           "Attempting to download manifest for train {}".format(args.train),
+                                           height=15, width=30, wait=False)
+                status.clear()
+                status.run()
+            except:
+                pass
+        if args.manifest_cache:
+            # Revalidated, rather than downloaded again, when the flow restarts
+            try:
+                cached = ManifestCache.ManifestCache(args.manifest_cache).get(conf.UpdateServerURL(),
+                                                                              args.train,
+                                                                              config=conf)
+                manifest = cached.manifest
+                LogIt("Manifest for {}: {} ({} packages, {}bytes)".format(args.train, cached.source,
+                                                                         len(cached.index),
+                                                                         SmartSize(cached.total_size)))
+                if cached.stale and interactive:
+                    Dialog.MessageBox(Title(),
+                                      "The update server could not be reached, so the {} installer is using the manifest for {} it downloaded at {}.  It may not be the latest.".format(
+                                          Project(), args.train,
+                                          time.strftime("%H:%M:%S", time.localtime(cached.fetched))),
+                                      height=12, width=50).run()
+            except ManifestCache.ManifestCacheError as e:
+                LogIt(e.message)
+                manifest = None
+            except BaseException as e:
+                LogIt("Manifest cache {} got exception {}".format(args.manifest_cache, str(e)))
+                manifest = None
+        else:
+            try:
+                manifest = conf.FindLatestManifest(train=args.train,
+                                                   require_signature=False)
+            except:
+                manifest = None
             
     # At this point, if we don't have a manifest, we can't do anything
     if manifest is None:
         LogIt("Could not load a manifest")
-        text = "Despite valiant efforts, no manifest file could be located."
+        if interactive:
+            text = "Despite valiant efforts, no manifest file could be located."
 
-        Dialog.MessageBox(Title(),
-                          text,
-                          height=15, width=30).run()
+            Dialog.MessageBox(Title(),
+                              text,
+                              height=15, width=30).run()
         raise InstallationError("Unable to locate a manifest file")
+    return (conf, manifest, package_dir)
+
+def ArgumentParser():
+    """
+    The installer's command-line arguments.
+    """
+    arg_parser = argparse.ArgumentParser(description=Title(), prog="Installer")
+    arg_parser.register('type', 'bool', lambda x: x.lower() in ["yes", "y", "true", "t"])
+    arg_parser.add_argument('-p', '--project',
+                            dest='project',
+                            default=Project(),
+                            help="Specify project (default {})".format(Project()))
+    arg_parser.add_argument('-T', '--train',
+                            dest="train",
+                            help="Specify train name")
+    arg_parser.add_argument('-U', '--url',
+                            dest="url",
+                            help="URL to use when fetching files")
+    arg_parser.add_argument('-D', "--data",
+                            dest='data_dir',
+                            help='Path to /data prototype directory')
+    arg_parser.add_argument('-M', '--manifest',
+                            dest='manifest',
+                            help="Path to manifest file")
+    arg_parser.add_argument('-P', '--packages',
+                            dest='package_dir',
+                            help='Path to package files')
+    arg_parser.add_argument("-B", "--trampoline",
+                            dest='trampoline',
+                            default=True,
+                            type='bool',
+                            help="Run post-install scripts on reboot (default)")
+    arg_parser.add_argument("-S", "--pipeline",
+                            dest='pipeline',
+                            default=True,
+                            type='bool',
+                            help="Extract each package as soon as it has been checked again, while later ones are being checked (default)")
+    arg_parser.add_argument("-I", "--incremental",
+                            dest='incremental',
+                            default=True,
+                            type='bool',
+                            help="When upgrading into a new boot environment, clone the old one and install only the changed packages (default)")
+    arg_parser.add_argument("--ashift",
+                            dest='ashift',
+                            type=int,
+                            choices=range(PoolLayout.MIN_ASHIFT, PoolLayout.MAX_ASHIFT + 1),
+                            help="ashift for a new boot pool (default: chosen from the disks' sector and stripe sizes)")
+    arg_parser.add_argument("--compression",
+                            dest='compression',
+                            choices=PoolLayout.COMPRESSIONS,
+                            help="Compression for a new boot pool (default: chosen by sampling the packages)")
+    arg_parser.add_argument("--probe-disks",
+                            dest='probe_budget',
+                            type=float,
+                            nargs='?',
+                            const=Probe.DEFAULT_BUDGET,
+                            metavar="SECONDS",
+                            help="Measure each disk's read speed, taking at most SECONDS (default {}), and show it when selecting disks".format(Probe.DEFAULT_BUDGET))
+    arg_parser.add_argument("--prefetch",
+                            dest='prefetch',
+                            default=True,
+                            type='bool',
+                            help="Fetch and verify packages in the background while questions are being answered (default)")
+    arg_parser.add_argument("-C", "--package-cache",
+                            dest='package_cache',
+                            help="Path to a persistent package cache (e.g., on a USB stick)")
+    arg_parser.add_argument("--package-cache-size",
+                            dest='package_cache_size',
+                            default=Utils.SmartSize(PackageCache.DEFAULT_MAX_BYTES),
+                            help="Maximum size of the package cache (default {})".format(
+                                Utils.SmartSize(PackageCache.DEFAULT_MAX_BYTES)))
+    arg_parser.add_argument("--direct-download",
+                            dest='direct_download',
+                            default=True,
+                            type='bool',
+                            help="Download packages from the update server over keep-alive connections, resuming interrupted downloads (default)")
+    arg_parser.add_argument("--manifest-cache",
+                            dest='manifest_cache',
+                            default=ManifestCache.DEFAULT_CACHE_DIR,
+                            help="Directory to cache downloaded train manifests in, or '' for none (default {})".format(
+                                ManifestCache.DEFAULT_CACHE_DIR))
+    arg_parser.add_argument("-R", "--record",
+                            dest='record',
+                            help="Record all geom, ZFS, sysctl, mount, and command interactions to this file, for Replay")
+    arg_parser.add_argument("-A", "--answers",
+                            dest='answers',
+                            help="Install unattended, using this answer file (see Answers.py)")
+    return arg_parser
+
+def do_install():
+    """
+    Do the UI for the install, writing a trace file of the run.
+    See install_flow() for the rest.
+    """
+    Trace.Reset()
+    try:
+        with Trace.Span("do_install"):
+            return install_flow()
+    finally:
+        CloseBootSession()
+        try:
+            summary = Trace.Summary()
+            LogIt("Installer took {:.1f} seconds ({:.1f} machine, {:.1f} waiting on the operator)".format(
+                summary["wall_seconds"], summary["machine_seconds"], summary["operator_seconds"]))
+            LogIt("Wrote trace file {}".format(Trace.Save()))
+        except BaseException as e:
+            LogIt("Could not save trace file: {}".format(str(e)))
+        for path in Replay.Stop():
+            LogIt("Wrote replay trace {}".format(path))
+
+def install_flow():
+    """
+    Do the UI for the install.
+    This will either return, or raise an exception.  DialogEscape means that
+    the installer should start over.
+    
+    If we have any command-line arguments, let's handle them now
+    """
+    args = ArgumentParser().parse_args()
+    if args:
+        LogIt("Command line args: {}".format(args))
+    if args.record:
+        Replay.Record(args.record)
+        
+    SetProject(args.project)
     
+    
+    try:
+        validate_system()
+    except ValidationError as e:
+        LogIt("Could not validate system: {}".format(e.message))
+        Dialog.MessageBox(Title(),
+                           "\nSystem memory is too small.  Minimum memory size is 8Gbytes",
+                           height=10, width=45).run()
+        return
+    
+    (conf, manifest, package_dir) = LoadManifest(args)
+
     LogIt("Manifest:  Version {}, Train {}, Sequence {}".format(manifest.Version(),
                                                                 manifest.Train(),
                                                                 manifest.Sequence()))
-    do_upgrade = False
-    boot_method = None
-    disks = SelectDisks()
-    if not disks:
+    # I'm not sure if this should be done here, or in Install()
+
+    if package_dir is None:
+        cache_dir = tempfile.mkdtemp()
+    else:
+        cache_dir = package_dir
+
+    package_store = None
+    if args.package_cache:
         try:
-            Dialog.MessageBox(Title(),
-                              "No suitable disks were found for installation",
-                              height=15, width=60).run()
-        except:
-            pass
-        raise InstallationError("No disks selected for installation")
+            package_store = PackageCache.PackageStore(args.package_cache,
+                                                      max_bytes=Utils.ParseSize(args.package_cache_size))
+        except BaseException as e:
+            LogIt("Could not open package cache {}: {}".format(args.package_cache, str(e)))
+    downloader = Download.Downloader() if args.direct_download else None
+
+    # Start fetching and verifying the packages now, while the
+    # questions are being answered.
+    prefetch = None
+    if args.prefetch:
+        prefetch = Fetch.BackgroundFetch(conf, cache_dir, manifest.Packages(),
+                                         store=package_store,
+                                         downloader=downloader).start()
+    try:
+        do_upgrade = False
+        boot_method = None
+        disks = SelectDisks(probe_budget=args.probe_budget)
+        if not disks:
+            try:
+                Dialog.MessageBox(Title(),
+                                  "No suitable disks were found for installation",
+                                  height=15, width=60).run()
+            except:
+                pass
+            raise InstallationError("No disks selected for installation")
     
-    if found_bootpool:
-        if UpgradePossible():
-            text = """The {} installer can upgrade the existing {} installation.
+        if found_bootpool:
+            if UpgradePossible():
+                text = """The {} installer can upgrade the existing {} installation.
 Do you want to upgrade?""".format(Project(), Project())
-            yesno = Dialog.YesNo("Perform Upgrade", text, height=12, width=60,
-                                 yes_label="Upgrade", no_label="Do not Upgrade",
-                                 default=True)
-            do_upgrade = yesno.result
-        else:
-            Dialog.MessageBox("No upgrade possible", "").run()
-
-    format_disks = True
-    if found_bootpool:
-        # If the selected disks are not the same as the existing boot-pool
-        # disks, then we _will_ be formatting, and do not ask this question.
-        disk_set = set([x.name for x in disks])
-        pool_set = set([Utils.Disk(x).name for x in found_bootpool.disks])
-        LogIt("disk_set = {}, pool_set = {}".format(disk_set, pool_set))
-        if pool_set == disk_set:
-            yesno = Dialog.YesNo(Title(),
-                                 "The {} installer can reformat the disk{}, or create a new boot environment.\nReformatting will erase all of your data".format(Project(), "s" if len(disks) > 1 else ""),
-                                 height=10, width=60,
-                                 yes_label="Re-format",
-                                 no_label="Create New BE", default=True)
-            format_disks = yesno.result
-            yesno.clear()
+                yesno = Dialog.YesNo("Perform Upgrade", text, height=12, width=60,
+                                     yes_label="Upgrade", no_label="Do not Upgrade",
+                                     default=True)
+                with Trace.Operator("Perform upgrade"):
+                    do_upgrade = yesno.result
+            else:
+                Dialog.MessageBox("No upgrade possible", "").run()
 
-    if format_disks:
-        # If there is already a freenas-boot, and we're not using all of
-        # the disks in it, then this will cause problems.
-        # If we made it this far, there is only one freenas-boot pool.
+        format_disks = True
         if found_bootpool:
-            pool_disks = [Utils.Disk(x) for x in found_bootpool.disks]
-
+            # If the selected disks are not the same as the existing boot-pool
+            # disks, then we _will_ be formatting, and do not ask this question.
             disk_set = set([x.name for x in disks])
-            pool_set = set([x.name for x in pool_disks])
+            pool_set = set([Utils.Disk(x).name for x in found_bootpool.disks])
             LogIt("disk_set = {}, pool_set = {}".format(disk_set, pool_set))
-            if not pool_set <= disk_set:
-                # This means there would be two freenas-boot pools, which
-                # is too much of a problem.
+            if pool_set == disk_set:
                 yesno = Dialog.YesNo(Title(),
-                                        "The existing boot pool contains disks that are not in the selected set of disks, which would result in errors.  Select Start Over, or press Escape, otherwise the {} installer will destroy the existing pool".format(Project()),
-                                     width=60,
-                                     yes_label="Destroy Pool",
-                                     no_label="Start over",
-                                     default=False)
-                yesno.prompt += "\nSelected Disks: " + " ,".join(sorted([x.name for x in disks]))
-                yesno.prompt += "\nPool Disks:     " + " ,".join(sorted([x.name for x in pool_disks]))
-                if yesno.result is False:
-                    raise Dialog.DialogEscape
-
-        current_method = BootMethod()
-        yesno = Dialog.YesNo("Boot Method",
-                             "{} can boot via BIOS or (U)EFI.  Selecting the wrong method can result in a non-bootable system".format(Project()),
-                             height=10, width=60,
-                             yes_label="BIOS",
-                             no_label="(U)EFI",
-                             default=False if current_method == "efi" else True)
-        if yesno.result is True:
-            boot_method = "bios"
-        else:
-            boot_method = "efi"
-
-    if not do_upgrade:
-        # Ask for root password
-        while True:
-            password_fields = [
-                Dialog.FormItem(Dialog.FormLabel("Password:"),
-                                 Dialog.FormInput("", width=20, maximum_input=50, hidden=True)),
-                Dialog.FormItem(Dialog.FormLabel("Confirm Password:"),
-                                 Dialog.FormInput("", width=20, maximum_input=50, hidden=True)),
-            ]
-            try:
-                password_input = Dialog.Form("Root Password",
-                                             "Enter the root password.  (Escape to quit, or select No Password)",
-                                             width=60, height=15,
-                                             cancel_label="No Password",
-                                             form_height=10, form_items=password_fields)
-                results = password_input.result
-                if results and results[0].value.value != results[1].value.value:
-                    Dialog.MessageBox("Password Error",
-                                      "Passwords did not match",
-                                      width=35,
-                                      ok_label="Try again").run()
-                    continue
-                else:
-                    new_password = results[0].value.value if results else None
-                    break
-            except Dialog.DialogEscape:
+                                     "The {} installer can reformat the disk{}, or create a new boot environment.\nReformatting will erase all of your data".format(Project(), "s" if len(disks) > 1 else ""),
+                                     height=10, width=60,
+                                     yes_label="Re-format",
+                                     no_label="Create New BE", default=True)
+                with Trace.Operator("Re-format or new BE"):
+                    format_disks = yesno.result
+                yesno.clear()
+
+        if format_disks:
+            # If there is already a freenas-boot, and we're not using all of
+            # the disks in it, then this will cause problems.
+            # If we made it this far, there is only one freenas-boot pool.
+            if found_bootpool:
+                pool_disks = [Utils.Disk(x) for x in found_bootpool.disks]
+
+                disk_set = set([x.name for x in disks])
+                pool_set = set([x.name for x in pool_disks])
+                LogIt("disk_set = {}, pool_set = {}".format(disk_set, pool_set))
+                if not pool_set <= disk_set:
+                    # This means there would be two freenas-boot pools, which
+                    # is too much of a problem.
+                    yesno = Dialog.YesNo(Title(),
+                                            "The existing boot pool contains disks that are not in the selected set of disks, which would result in errors.  Select Start Over, or press Escape, otherwise the {} installer will destroy the existing pool".format(Project()),
+                                         width=60,
+                                         yes_label="Destroy Pool",
+                                         no_label="Start over",
+                                         default=False)
+                    yesno.prompt += "\nSelected Disks: " + " ,".join(sorted([x.name for x in disks]))
+                    yesno.prompt += "\nPool Disks:     " + " ,".join(sorted([x.name for x in pool_disks]))
+                    with Trace.Operator("Destroy pool"):
+                        destroy_pool = yesno.result
+                    if destroy_pool is False:
+                        raise Dialog.DialogEscape
+
+            current_method = discovery.get("boot_method")
+            yesno = Dialog.YesNo("Boot Method",
+                                 "{} can boot via BIOS or (U)EFI.  Selecting the wrong method can result in a non-bootable system".format(Project()),
+                                 height=10, width=60,
+                                 yes_label="BIOS",
+                                 no_label="(U)EFI",
+                                 default=False if current_method == "efi" else True)
+            with Trace.Operator("Boot method"):
+                use_bios = yesno.result
+            if use_bios is True:
+                boot_method = "bios"
+            else:
+                boot_method = "efi"
+
+        if not do_upgrade:
+            # Ask for root password
+            while True:
+                password_fields = [
+                    Dialog.FormItem(Dialog.FormLabel("Password:"),
+                                     Dialog.FormInput("", width=20, maximum_input=50, hidden=True)),
+                    Dialog.FormItem(Dialog.FormLabel("Confirm Password:"),
+                                     Dialog.FormInput("", width=20, maximum_input=50, hidden=True)),
+                ]
                 try:
-                    Diallog.MessageBox("No Password Selected",
-                                       "You have selected an empty password",
-                                       height=7, width=35).run()
-                except:
-                    pass
-                new_password = None
-                break
+                    password_input = Dialog.Form("Root Password",
+                                                 "Enter the root password.  (Escape to quit, or select No Password)",
+                                                 width=60, height=15,
+                                                 cancel_label="No Password",
+                                                 form_height=10, form_items=password_fields)
+                    with Trace.Operator("Root password"):
+                        results = password_input.result
+                    if results and results[0].value.value != results[1].value.value:
+                        Dialog.MessageBox("Password Error",
+                                          "Passwords did not match",
+                                          width=35,
+                                          ok_label="Try again").run()
+                        continue
+                    else:
+                        new_password = results[0].value.value if results else None
+                        break
+                except Dialog.DialogEscape:
+                    try:
+                        Diallog.MessageBox("No Password Selected",
+                                           "You have selected an empty password",
+                                           height=7, width=35).run()
+                    except:
+                        pass
+                    new_password = None
+                    break
                     
-    # I'm not sure if this should be done here, or in Install()
-
-    if package_dir is None:
-        cache_dir = tempfile.mkdtemp()
-    else:
-        cache_dir = package_dir
+    except BaseException:
+        # Including an escape to start over
+        stopped = prefetch.stop(timeout=Fetch.BACKGROUND_STOP_TIMEOUT) if prefetch else True
+        if package_dir is None:
+            if stopped:
+                shutil.rmtree(cache_dir, ignore_errors=True)
+            else:
+                LogIt("Leaving {} in place, the background fetch is still using it".format(cache_dir))
+        raise
+    if prefetch:
+        with Trace.Span("StopPrefetch"):
+            prefetch.stop()
 
+    # Every package is fetched and verified before anything is wiped, pipelined or not;
+    # the pipeline then only overlaps checking a package with extracting the one before.
     try:
-        Utils.GetPackages(manifest, conf, cache_dir, interactive=True)
+        Utils.GetPackages(manifest, conf, cache_dir, interactive=True,
+                          store=package_store, downloader=downloader)
     except BaseException as e:
         LogIt("GetPackages raised an exception {}".format(str(e)))
         if package_dir is None:
@@ -625,7 +930,9 @@ Do you want to upgrade?""".format(Project(), Project())
                          text,
                          height=min(15, height), width=60,
                          default=False)
-    if yesno.result == False:
+    with Trace.Operator("First confirmation"):
+        confirmed = yesno.result
+    if confirmed == False:
         LogIt("Installation aborted at first confirmation")
         raise Dialog.DialogEscape
     
@@ -637,7 +944,9 @@ Do you want to upgrade?""".format(Project(), Project())
                              yes_label="Continue",
                              no_label="Start Over",
                              default=False)
-        if yesno.result is False:
+        with Trace.Operator("Last chance"):
+            confirmed = yesno.result
+        if confirmed is False:
             LogIt("Installation aborted at second confirmation")
             raise Dialog.DialogEscape
         
@@ -659,17 +968,206 @@ Do you want to upgrade?""".format(Project(), Project())
                             disks=disks if format_disks else None,
                             efi=True if boot_method is "efi" else False,
                             upgrade_from=found_bootpool if found_bootpool else None,
+                            boot_session=boot_session,
                             upgrade=do_upgrade,
                             data_dir=args.data_dir if args.data_dir else "/data",
                             package_handler=handler.start_package,
                             progress_handler=handler.package_update,
                             password=None if do_upgrade else new_password,
-                            trampoline=args.trampoline)
+                            trampoline=args.trampoline,
+                            pipeline=args.pipeline,
+                            incremental=args.incremental,
+                            ashift=args.ashift,
+                            compression=args.compression,
+                            package_store=package_store,
+                            downloader=downloader)
         except BaseException as e:
             LogIt("Install got exception {}".format(str(e)))
             raise
     return
 
+def unattended_flow(args, answers, summary):
+    """
+    The unattended version of install_flow():  everything it would ask
+    comes from the answer file instead, and nothing is displayed.
+    What was decided is recorded in summary as we go.  Raises
+    Answers.AnswerError, with the appropriate exit code, on failure.
+    """
+    global found_bootpool
+    SetProject(args.project)
+    summary["project"] = Project()
+
+    try:
+        validate_system()
+    except ValidationError as e:
+        raise Answers.AnswerError(e.message, code=Answers.EXIT_SYSTEM)
+
+    try:
+        (conf, manifest, package_dir) = LoadManifest(args, interactive=False)
+    except InstallationError as e:
+        raise Answers.AnswerError(str(e), code=Answers.EXIT_MANIFEST)
+    LogIt("Manifest:  Version {}, Train {}, Sequence {}".format(manifest.Version(),
+                                                                manifest.Train(),
+                                                                manifest.Sequence()))
+    summary["version"] = manifest.Version()
+    summary["train"] = manifest.Train()
+    summary["sequence"] = manifest.Sequence()
+
+    try:
+        (found_bootpool, pool_disks) = FindBootPool(interactive=False)
+    except InstallationError as e:
+        raise Answers.AnswerError(str(e), code=Answers.EXIT_CONFLICT)
+    pool_set = set(x.name for x in pool_disks)
+    upgradable = bool(found_bootpool) and UpgradePossible(interactive=False)
+    summary["existing_pool"] = sorted(pool_set) if found_bootpool else None
+
+    mode = answers.mode
+    if mode == "auto":
+        mode = "upgrade" if upgradable else "format"
+    if mode in ("upgrade", "new-be") and not upgradable:
+        raise Answers.AnswerError("Mode {} needs an upgradable {} installation, and there isn't one".format(mode, Project()),
+                                  code=Answers.EXIT_CONFLICT)
+    do_upgrade = mode in ("upgrade", "new-be")
+    format_disks = mode != "new-be"
+    summary["mode"] = mode
+
+    if answers.disk_rule:
+        discovery.get("disks")
+        eligible = disk_inventory.eligible()
+        pool_disks = ImportablePoolDisks()
+        names = answers.disk_rule.select(eligible, pool_disks=pool_disks)
+        LogIt("Disk rule {} selected {} of {}".format(answers.disk_rule, names,
+                                                      [x.name for x in eligible]))
+        skipped = [x.name for x in eligible
+                   if x.name in pool_disks and x.entry and
+                   answers.disk_rule.matches(x.entry) and not answers.disk_rule.named(x.entry)]
+        if skipped:
+            LogIt("Left out disks in other pools:  {}".format(
+                ", ".join("{} ({})".format(name, pool_disks[name]) for name in skipped)))
+            summary["skipped_disks"] = skipped
+        discovery.mark("disk list")
+    elif do_upgrade:
+        names = sorted(pool_set)
+    else:
+        raise Answers.AnswerError("No disks were given, and there is no installation to upgrade")
+    if not names:
+        raise Answers.AnswerError("No disks matched {}".format(answers.disk_rule),
+                                  code=Answers.EXIT_NO_DISKS)
+    disks = [Utils.Disk(name) for name in names]
+    disk_set = set(names)
+    summary["disks"] = names
+
+    if not format_disks and disk_set != pool_set:
+        raise Answers.AnswerError("A new boot environment needs the boot pool's disks ({}), not {}".format(
+            ", ".join(sorted(pool_set)), ", ".join(names)), code=Answers.EXIT_CONFLICT)
+    if format_disks and found_bootpool and not pool_set <= disk_set:
+        # This would leave two freenas-boot pools
+        if not answers.destroy_pool:
+            raise Answers.AnswerError("The boot pool contains disks ({}) that were not selected; set destroy_pool to continue".format(
+                ", ".join(sorted(pool_set - disk_set))), code=Answers.EXIT_CONFLICT)
+        LogIt("Existing boot pool will be destroyed")
+
+    boot_method = None
+    if format_disks:
+        if answers.boot == "auto":
+            boot_method = "efi" if discovery.get("boot_method") == "efi" else "bios"
+        else:
+            boot_method = answers.boot
+    summary["boot"] = boot_method
+    data_dir = answers.data_dir or args.data_dir or "/data"
+    summary["data_dir"] = data_dir
+
+    if package_dir is None:
+        cache_dir = tempfile.mkdtemp()
+    else:
+        cache_dir = package_dir
+
+    package_store = None
+    if args.package_cache:
+        try:
+            package_store = PackageCache.PackageStore(args.package_cache,
+                                                      max_bytes=Utils.ParseSize(args.package_cache_size))
+        except BaseException as e:
+            LogIt("Could not open package cache {}: {}".format(args.package_cache, str(e)))
+    downloader = Download.Downloader() if args.direct_download else None
+
+    # All of them, before any disk is touched, even when pipelining
+    try:
+        Utils.GetPackages(manifest, conf, cache_dir, interactive=False,
+                          store=package_store, downloader=downloader)
+    except BaseException as e:
+        LogIt("GetPackages raised an exception {}".format(str(e)))
+        if package_dir is None:
+            shutil.rmtree(cache_dir, ignore_errors=True)
+        raise Answers.AnswerError("Could not get packages: {}".format(str(e)),
+                                  code=Answers.EXIT_PACKAGES)
+
+    try:
+        Install.Install(interactive=False,
+                        manifest=manifest,
+                        config=conf,
+                        package_directory=cache_dir,
+                        disks=disks if format_disks else None,
+                        efi=boot_method == "efi",
+                        upgrade_from=found_bootpool if found_bootpool else None,
+                        boot_session=boot_session,
+                        upgrade=do_upgrade,
+                        data_dir=data_dir,
+                        password_hash=None if do_upgrade else answers.password_hash,
+                        trampoline=args.trampoline,
+                        pipeline=args.pipeline,
+                        incremental=args.incremental,
+                        ashift=args.ashift,
+                        compression=args.compression,
+                        package_store=package_store,
+                        downloader=downloader)
+    except InstallationError as e:
+        raise Answers.AnswerError(str(e), code=Answers.EXIT_INSTALL)
+    return
+
+# The spans that wrap the whole of an unattended install; the phases
+# in its summary are the spans inside these.
+UNATTENDED_WRAPPERS = ("do_unattended", "Install")
+
+def do_unattended(args):
+    """
+    Install from the answer file named by --answers, with no dialogs.
+    Writes the JSON summary, and returns the exit code (Answers.EXIT_*).
+    """
+    Trace.Reset()
+    summary = { "answers" : args.answers }
+    answers = None
+    try:
+        with Trace.Span("do_unattended"):
+            answers = Answers.Load(args.answers)
+            LogIt("Unattended install: {}".format(answers))
+            unattended_flow(args, answers, summary)
+        code = Answers.EXIT_OK
+    except Answers.AnswerError as e:
+        LogIt("Unattended install failed: {}".format(e.message))
+        summary["error"] = e.message
+        code = e.code
+    except BaseException as e:
+        LogIt("Unattended install got exception {}".format(str(e)), exc_info=True)
+        summary["error"] = str(e) or type(e).__name__
+        code = Answers.EXIT_FAILURE
+    finally:
+        CloseBootSession()
+        for path in Replay.Stop():
+            LogIt("Wrote replay trace {}".format(path))
+
+    trace_summary = Trace.Summary(skip=UNATTENDED_WRAPPERS)
+    summary["status"] = "ok" if code == Answers.EXIT_OK else "failed"
+    summary["exit_code"] = code
+    summary["seconds"] = round(trace_summary["wall_seconds"], 3)
+    summary["phases"] = { name : round(seconds, 3) for (name, seconds) in trace_summary["phases"].items() }
+    try:
+        summary["trace"] = Trace.Save(skip=UNATTENDED_WRAPPERS)
+    except BaseException as e:
+        LogIt("Could not save trace file: {}".format(str(e)))
+    Answers.WriteSummary(summary, answers.summary_path if answers else None)
+    return code
+
 def do_shell():
     shell = os.environ["SHELL"] if "SHELL" in os.environ else "/bin/sh"
     try:
@@ -705,6 +1203,13 @@ def do_exit():
 def main():
     InitLog()
     
+    args = ArgumentParser().parse_args()
+    discovery.start()
+    if args.answers:
+        if args.record:
+            Replay.Record(args.record)
+        sys.exit(do_unattended(args))
+
     menu_actions = [
         ("Install/Update" , do_install),
         ("Shell" , do_shell),
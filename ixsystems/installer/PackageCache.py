@@ -0,0 +1,274 @@
+from __future__ import print_function
+import os
+import re
+import json
+import time
+import shutil
+import tempfile
+import threading
+
+from .Utils import LogIt, SmartSize
+
+# 4GBytes is enough for a few trains' worth of packages
+DEFAULT_MAX_BYTES = 4 * 1024 * 1024 * 1024
+INDEX_VERSION = 1
+
+_checksum_re = re.compile(r'^[0-9a-fA-F]{32,128}$')
+
+def _fsync_dir(path):
+    try:
+        fd = os.open(path, os.O_RDONLY)
+    except OSError:
+        return
+    try:
+        os.fsync(fd)
+    except OSError:
+        pass
+    finally:
+        os.close(fd)
+
+class PackageStore(object):
+    """
+    A persistent store of package files, keyed by their checksum,
+    meant to live somewhere that survives a restart of the installer
+    (a USB stick, a scratch disk).  The layout is:
+
+    <root>/index.json			The index (see below)
+    <root>/objects/<xx>/<checksum>	The package files
+    <root>/tmp/				Files being inserted
+
+    The index records the name, size, and last-used time for each
+    checksum; when the store is over max_bytes, the least recently
+    used entries are evicted.  Files are written to tmp/ first, and
+    renamed into place (and the index rewritten the same way), so a
+    crash can leave garbage in tmp/, but never a partial entry.
+
+    The store does not verify files itself:  insert() should only be
+    given files whose checksum has been verified, and a file handed out
+    by fetch() that then fails verification should be discard()ed.
+    """
+    def __init__(self, root, max_bytes=DEFAULT_MAX_BYTES):
+        self._root = root
+        self._max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self._entries = {}
+        self._stats = {
+            "hits" : 0,
+            "misses" : 0,
+            "inserts" : 0,
+            "evictions" : 0,
+            "bytes_served" : 0,
+        }
+        for directory in [self._root, self._object_dir, self._tmp_dir]:
+            try:
+                os.makedirs(directory, 0o755)
+            except OSError:
+                if not os.path.isdir(directory):
+                    raise
+        self._load()
+
+    def __repr__(self):
+        return "<PackageStore {}, {} entries, {}bytes of {}bytes>".format(self._root, len(self._entries),
+                                                                          SmartSize(self.size),
+                                                                          SmartSize(self._max_bytes))
+    @property
+    def root(self):
+        return self._root
+    @property
+    def max_bytes(self):
+        return self._max_bytes
+    @property
+    def size(self):
+        return sum(entry["size"] for entry in self._entries.values())
+    @property
+    def _object_dir(self):
+        return os.path.join(self._root, "objects")
+    @property
+    def _tmp_dir(self):
+        return os.path.join(self._root, "tmp")
+    @property
+    def _index_path(self):
+        return os.path.join(self._root, "index.json")
+
+    def _object_path(self, checksum):
+        return os.path.join(self._object_dir, checksum[:2], checksum)
+
+    def _load(self):
+        # Anything left in tmp is from an interrupted insert
+        for name in os.listdir(self._tmp_dir):
+            try:
+                os.unlink(os.path.join(self._tmp_dir, name))
+            except OSError:
+                pass
+        try:
+            with open(self._index_path, "r") as f:
+                index = json.load(f)
+            if index.get("version", None) != INDEX_VERSION:
+                LogIt("Package store {} has index version {}, ignoring it".format(self._root,
+                                                                                  index.get("version", None)))
+                index = {}
+        except (OSError, IOError, ValueError) as e:
+            LogIt("Could not load package store index {}: {}".format(self._index_path, str(e)))
+            index = {}
+        for (checksum, entry) in index.get("entries", {}).items():
+            path = self._object_path(checksum)
+            try:
+                if os.path.getsize(path) != entry["size"]:
+                    raise ValueError("size mismatch")
+            except (OSError, KeyError, ValueError) as e:
+                LogIt("Dropping package store entry {}: {}".format(checksum, str(e)))
+                continue
+            self._entries[checksum] = entry
+        LogIt("Loaded {}".format(self))
+
+    def _save(self):
+        (fd, tmp_path) = tempfile.mkstemp(dir=self._tmp_dir, prefix="index.")
+        try:
+            with os.fdopen(fd, "w") as f:
+                json.dump({ "version" : INDEX_VERSION, "entries" : self._entries }, f,
+                          indent=1, sort_keys=True)
+                f.flush()
+                os.fsync(f.fileno())
+            os.rename(tmp_path, self._index_path)
+            _fsync_dir(self._root)
+        except:
+            try:
+                os.unlink(tmp_path)
+            except OSError:
+                pass
+            raise
+
+    def _evict(self, keep=None):
+        # Caller holds the lock
+        evicted = False
+        total = self.size
+        for checksum in sorted(self._entries, key=lambda x: self._entries[x]["last_used"]):
+            if total <= self._max_bytes:
+                break
+            if checksum == keep:
+                continue
+            entry = self._entries.pop(checksum)
+            total -= entry["size"]
+            try:
+                os.unlink(self._object_path(checksum))
+            except OSError:
+                pass
+            self._stats["evictions"] += 1
+            evicted = True
+            LogIt("Evicted {} ({}) from package store".format(entry.get("name", None), checksum))
+        return evicted
+
+    def contains(self, checksum):
+        with self._lock:
+            return checksum in self._entries
+
+    def fetch(self, checksum, destination):
+        """
+        If the store has the file with the given checksum, put a copy of it
+        (a hard link, if possible) at destination and return True.
+        Otherwise return False.
+        """
+        with self._lock:
+            entry = self._entries.get(checksum, None)
+            if entry is None:
+                self._stats["misses"] += 1
+                return False
+            entry["last_used"] = time.time()
+            self._stats["hits"] += 1
+            self._stats["bytes_served"] += entry["size"]
+        source = self._object_path(checksum)
+        tmp_path = destination + ".store"
+        try:
+            try:
+                os.link(source, tmp_path)
+            except OSError:
+                shutil.copyfile(source, tmp_path)
+            os.rename(tmp_path, destination)
+        except (OSError, IOError) as e:
+            LogIt("Could not copy {} from package store: {}".format(checksum, str(e)))
+            try:
+                os.unlink(tmp_path)
+            except OSError:
+                pass
+            return False
+        LogIt("Package store hit for {} ({})".format(entry.get("name", None), checksum))
+        return True
+
+    def insert(self, checksum, path, name=None):
+        """
+        Add the (already verified) file at path to the store.
+        Returns True if it is in the store afterwards.
+        """
+        if not checksum or not _checksum_re.match(checksum):
+            LogIt("Not storing {}: unusable checksum {}".format(path, checksum))
+            return False
+        size = os.path.getsize(path)
+        if size > self._max_bytes:
+            LogIt("Not storing {}: {} bytes is larger than the store".format(path, size))
+            return False
+        with self._lock:
+            if checksum in self._entries:
+                self._entries[checksum]["last_used"] = time.time()
+                return True
+        (fd, tmp_path) = tempfile.mkstemp(dir=self._tmp_dir, prefix="object.")
+        try:
+            with os.fdopen(fd, "wb") as dst, open(path, "rb") as src:
+                shutil.copyfileobj(src, dst, 1024 * 1024)
+                dst.flush()
+                os.fsync(dst.fileno())
+            object_path = self._object_path(checksum)
+            try:
+                os.makedirs(os.path.dirname(object_path), 0o755)
+            except OSError:
+                pass
+            os.rename(tmp_path, object_path)
+            _fsync_dir(os.path.dirname(object_path))
+        except:
+            try:
+                os.unlink(tmp_path)
+            except OSError:
+                pass
+            LogIt("Could not add {} to package store".format(path), exc_info=True)
+            return False
+        with self._lock:
+            self._entries[checksum] = {
+                "name" : name,
+                "size" : size,
+                "last_used" : time.time(),
+            }
+            self._stats["inserts"] += 1
+            self._evict(keep=checksum)
+            self._save()
+        return True
+
+    def discard(self, checksum):
+        """
+        Remove an entry; used when a file from the store fails verification.
+        """
+        with self._lock:
+            entry = self._entries.pop(checksum, None)
+            if entry is None:
+                return
+            try:
+                os.unlink(self._object_path(checksum))
+            except OSError:
+                pass
+            self._save()
+        LogIt("Discarded {} ({}) from package store".format(entry.get("name", None), checksum))
+
+    def flush(self):
+        """
+        Write out the index (last-used times are only kept in memory otherwise).
+        """
+        with self._lock:
+            self._save()
+
+    def stats(self):
+        with self._lock:
+            return dict(self._stats, entries=len(self._entries), size=self.size)
+
+    def log_stats(self):
+        stats = self.stats()
+        LogIt("Package store {}: {} hits, {} misses, {} inserts, {} evictions, {}bytes served, {} entries ({}bytes)".format(
+            self._root, stats["hits"], stats["misses"], stats["inserts"], stats["evictions"],
+            SmartSize(stats["bytes_served"]), stats["entries"], SmartSize(stats["size"])))
@@ -0,0 +1,150 @@
+from __future__ import print_function
+import collections
+
+from .Utils import LogIt, SmartSize
+
+# Every partition starts on a 1MiB boundary, which is a multiple of
+# any sector size, 4k page, or flash erase block we're likely to see.
+ALIGNMENT = 1024 * 1024
+# Don't let a huge stripe size push the alignment past this
+MAX_ALIGNMENT = 16 * 1024 * 1024
+# A GPT has 128 entries of 128 bytes, after a protective MBR and a header
+# at the start of the disk; the backup is the entries and a header at the end.
+_GPT_ENTRY_BYTES = 128 * 128
+
+# A Utils.Partition, and where it goes:  start and size are in bytes.
+# start is always aligned; size is, unless the partition asked for less.
+PlannedPartition = collections.namedtuple("PlannedPartition",
+                                          ["partition", "start", "size"])
+
+def _RoundUp(value, unit):
+    return -(-value // unit) * unit
+
+def _RoundDown(value, unit):
+    return value // unit * unit
+
+def _GPTBytes(sectorsize):
+    """
+    The bytes a GPT takes at the start and at the end of a disk.
+    """
+    entries = _RoundUp(_GPT_ENTRY_BYTES, sectorsize)
+    return (2 * sectorsize + entries, sectorsize + entries)
+
+class PartitionPlan(object):
+    """
+    One partition layout for a set of disks (all of the members of a
+    mirror get the same one):  a list of PlannedPartitions, in the
+    order they're added, and the space the layout leaves unused.
+    """
+    def __init__(self, entries, alignment, lost, unused):
+        self.entries = entries
+        self.alignment = alignment
+        # Bytes lost to alignment on the smallest disk
+        self.lost = lost
+        # Bytes past the end of the layout, by disk name
+        self.unused = unused
+
+    def __repr__(self):
+        return "PartitionPlan({})".format(", ".join("{}@{}+{}".format(x.partition.index, x.start, x.size)
+                                                     for x in self.entries))
+
+    def partition(self, index):
+        """
+        Return the PlannedPartition with the given index, or None.
+        """
+        for entry in self.entries:
+            if str(entry.partition.index) == str(index):
+                return entry
+        return None
+
+    def GpartArgs(self, disk, entry):
+        """
+        The arguments to "gpart add" for entry on disk, which has
+        to have been one of the disks this plan was made for.
+        """
+        sectorsize = disk.sectorsize or 512
+        if entry.start % sectorsize or entry.size % sectorsize:
+            raise ValueError("Partition {} is not a multiple of {}'s sector size {}".format(
+                entry.partition.index, disk.name, sectorsize))
+        return ["-t", entry.partition.type,
+                "-i", entry.partition.index,
+                "-b", str(entry.start // sectorsize),
+                "-s", str(entry.size // sectorsize)]
+
+    def log(self):
+        LogIt("Partition plan, {} aligned:".format(SmartSize(self.alignment)))
+        for entry in self.entries:
+            LogIt("    p{} {}: start {}, size {} ({})".format(entry.partition.index, entry.partition.type,
+                                                         entry.start, entry.size, SmartSize(entry.size)))
+        LogIt("    {} bytes lost to alignment".format(self.lost))
+        for (name, unused) in sorted(self.unused.items()):
+            if unused >= self.alignment:
+                LogIt("    {} unused at the end of {}".format(SmartSize(unused), name))
+
+def Alignment(disks):
+    """
+    The alignment for partitions on disks:  1MiB, or a larger
+    stripe size (up to MAX_ALIGNMENT).
+    """
+    alignment = ALIGNMENT
+    for disk in disks:
+        stripe = disk.stripesize or 0
+        if alignment < stripe <= MAX_ALIGNMENT and not stripe & (stripe - 1):
+            alignment = stripe
+    return alignment
+
+def Plan(disks, partitions):
+    """
+    Lay out partitions (Utils.Partition objects, in the order they will
+    be added) on every one of disks.  Each partition starts on an aligned
+    boundary and gets its requested size, rounded up to the sector size;
+    the OS partition gets the rest of the smallest disk (but no more
+    than its size, if it has one), rounded down to the alignment.
+    Raises ValueError if the partitions don't fit.
+    """
+    if not disks:
+        raise ValueError("No disks to partition")
+    alignment = Alignment(disks)
+    sectorsize = max(disk.sectorsize or 512 for disk in disks)
+    ends = {}
+    start = 0
+    for disk in disks:
+        (head, tail) = _GPTBytes(disk.sectorsize or 512)
+        start = max(start, head)
+        ends[disk.name] = disk.size - tail
+    end = _RoundDown(min(ends.values()), alignment)
+
+    os_parts = [part for part in partitions if part.os]
+    if len(os_parts) > 1:
+        raise ValueError("Multiple OS partitions")
+    # The OS partition gets what the ones after it leave
+    after = 0
+    if os_parts:
+        position = partitions.index(os_parts[0])
+        after = sum(_RoundUp(_RoundUp(part.size, sectorsize), alignment) for part in partitions[position + 1:])
+
+    entries = []
+    lost = 0
+    filled = False
+    offset = start
+    for part in partitions:
+        aligned = _RoundUp(offset, alignment)
+        lost += aligned - offset
+        if part.os:
+            size = _RoundDown(end - aligned - after, alignment)
+            if part.size and part.size < size:
+                size = _RoundDown(part.size, alignment)
+            else:
+                filled = True
+        else:
+            size = _RoundUp(part.size, sectorsize)
+        if size <= 0 or aligned + size > end:
+            raise ValueError("Partition {} ({}) does not fit on {}".format(
+                part.index, SmartSize(part.size or 0), ", ".join(disk.name for disk in disks)))
+        entries.append(PlannedPartition(part, aligned, size))
+        offset = aligned + size
+    # If the OS partition was to fill the disk, what it couldn't is lost too
+    if filled:
+        lost += min(ends.values()) - offset
+    unused = { name : disk_end - offset for (name, disk_end) in ends.items() }
+    return PartitionPlan(entries, alignment, lost, unused)
@@ -0,0 +1,203 @@
+from __future__ import print_function
+import os
+import zlib
+import tarfile
+
+from .Utils import LogIt, SmartSize
+
+# The boot loader has to be able to read the pool, so ashift stays
+# between 512- and 4k-byte blocks, and compression is limited to
+# algorithms it can decompress.
+MIN_ASHIFT = 9
+MAX_ASHIFT = 12
+# Flash pages are (at least) 4k, even when the drive reports 512-byte sectors
+SSD_ASHIFT = 12
+COMPRESSIONS = ("off", "lz4", "gzip") + tuple("gzip-{}".format(x) for x in range(1, 10))
+DEFAULT_COMPRESSION = "lz4"
+
+# How many package files to sample, and how much of each
+SAMPLE_PACKAGES = 8
+SAMPLE_BYTES = 1024 * 1024
+# in this many pieces, so one large file doesn't stand for the package
+SAMPLE_PIECES = 16
+# Below this ratio, the payload isn't worth compressing
+INCOMPRESSIBLE = 1.05
+# If one boot environment would take more than this fraction of the
+# pool, space matters more than speed, and gzip is used if it does
+# noticeably better than lz4.
+TIGHT_SPACE = 0.25
+GZIP_ADVANTAGE = 1.15
+
+class PoolLayout(object):
+    """
+    The settings for a new boot pool, and the reasons for them
+    (a list of strings, for the log).
+    """
+    def __init__(self, ashift=MAX_ASHIFT, compression=DEFAULT_COMPRESSION, reasons=None):
+        self.ashift = ashift
+        self.compression = compression
+        self.reasons = reasons or []
+
+    def __repr__(self):
+        return "PoolLayout(ashift={}, compression={})".format(self.ashift, self.compression)
+
+    def log(self):
+        LogIt("Boot pool layout: {}".format(self))
+        for reason in self.reasons:
+            LogIt("    {}".format(reason))
+
+def _Log2(value):
+    try:
+        value = int(value)
+    except (TypeError, ValueError):
+        return None
+    if value <= 0 or value & (value - 1):
+        return None
+    return value.bit_length() - 1
+
+def ChooseAshift(disks):
+    """
+    Pick ashift for a pool on disks (Utils.Disk objects), from the largest
+    physical block size any of them has.  Returns (ashift, reasons).
+    """
+    reasons = []
+    ashift = MIN_ASHIFT
+    for disk in disks:
+        sector = _Log2(disk.sectorsize) or MIN_ASHIFT
+        # The stripe size is the physical sector size for 512e drives
+        stripe = _Log2(disk.stripesize)
+        wanted = max(sector, stripe or MIN_ASHIFT)
+        text = "{}: sectorsize {}, stripesize {}".format(disk.name, disk.sectorsize, disk.stripesize)
+        if disk.is_ssd and wanted < SSD_ASHIFT:
+            wanted = SSD_ASHIFT
+            text += ", SSD"
+        reasons.append("{} -> ashift {}".format(text, wanted))
+        ashift = max(ashift, wanted)
+    if ashift > MAX_ASHIFT:
+        reasons.append("ashift {} limited to {}, the largest the boot loader can read".format(ashift, MAX_ASHIFT))
+        ashift = MAX_ASHIFT
+    return (ashift, reasons)
+
+def _SampleFile(path, limit):
+    """
+    Read up to limit bytes of payload from a package file:  a piece of
+    each of its regular files if it's a tar archive, or else pieces
+    spread across its raw bytes.  Returns (sample, size of the payload
+    it was taken from, bytes of the package file holding that payload).
+    """
+    piece = max(1, limit // SAMPLE_PIECES)
+    chunks = []
+    total = 0
+    payload = 0
+    try:
+        with open(path, "rb") as f:
+            try:
+                with tarfile.open(fileobj=f, mode="r|*") as tf:
+                    for member in tf:
+                        if not member.isfile():
+                            continue
+                        data = tf.extractfile(member).read(min(piece, limit - total))
+                        chunks.append(data)
+                        total += len(data)
+                        payload += member.size
+                        if total >= limit:
+                            break
+                return (b"".join(chunks), payload, f.tell())
+            except tarfile.TarError:
+                size = os.fstat(f.fileno()).st_size
+                stride = max(piece, size // SAMPLE_PIECES)
+                for offset in range(0, size, stride):
+                    f.seek(offset)
+                    chunks.append(f.read(piece))
+                return (b"".join(chunks)[:limit], size, size)
+    except (IOError, OSError) as e:
+        LogIt("Could not sample {}: {}".format(path, str(e)))
+        return (b"", 0, 0)
+
+def SampleCompressibility(packages, package_dir, count=SAMPLE_PACKAGES, limit=SAMPLE_BYTES):
+    """
+    Compress a sample of the package payloads in package_dir, spread
+    across packages.  zlib level 1 stands in for lz4 (which does a little
+    worse), and level 6 for gzip.  Returns a dict with the bytes sampled,
+    their compressed sizes, and the size of the payload they came from
+    and of the package files holding it; or None if no package files
+    were available.
+    """
+    available = [pkg for pkg in packages
+                 if os.path.exists(os.path.join(package_dir, pkg.FileName()))]
+    if not available:
+        return None
+    step = max(1, len(available) // count)
+    result = { "packages" : 0, "raw" : 0, "payload" : 0, "file" : 0, "fast" : 0, "best" : 0 }
+    for pkg in available[::step][:count]:
+        (data, payload, file_bytes) = _SampleFile(os.path.join(package_dir, pkg.FileName()), limit)
+        if not data:
+            continue
+        result["packages"] += 1
+        result["raw"] += len(data)
+        result["payload"] += payload
+        result["file"] += file_bytes
+        result["fast"] += len(zlib.compress(data, 1))
+        result["best"] += len(zlib.compress(data, 6))
+    return result if result["raw"] else None
+
+def ChooseCompression(packages, package_dir, pool_size):
+    """
+    Pick the compression for a pool_size pool that will hold packages,
+    by sampling their payloads.  Returns (compression, reasons).
+    """
+    if not package_dir:
+        return (DEFAULT_COMPRESSION, ["No package directory to sample, so {}".format(DEFAULT_COMPRESSION)])
+    sample = SampleCompressibility(packages, package_dir)
+    if sample is None:
+        return (DEFAULT_COMPRESSION, ["No package files to sample, so {}".format(DEFAULT_COMPRESSION)])
+
+    fast = float(sample["raw"]) / sample["fast"]
+    best = float(sample["raw"]) / sample["best"]
+    reasons = ["Sampled {} of payload from {} packages: {:.2f}x with lz4, {:.2f}x with gzip".format(
+        SmartSize(sample["raw"]), sample["packages"], fast, best)]
+    if fast < INCOMPRESSIBLE:
+        reasons.append("Payload is incompressible (under {:.2f}x), so off".format(INCOMPRESSIBLE))
+        return ("off", reasons)
+
+    # Estimate the size of one installed boot environment
+    expansion = float(sample["payload"]) / max(1, sample["file"])
+    installed = sum(pkg.Size() or 0 for pkg in packages) * expansion / fast
+    reasons.append("One boot environment is about {} with lz4, on a {} pool".format(
+        SmartSize(int(installed)), SmartSize(pool_size)))
+    if pool_size and installed > pool_size * TIGHT_SPACE:
+        if best / fast >= GZIP_ADVANTAGE:
+            reasons.append("That's over {:.0f}% of the pool, and gzip saves {:.0f}% more, so gzip".format(
+                TIGHT_SPACE * 100, (1 - fast / best) * 100))
+            return ("gzip", reasons)
+        reasons.append("That's over {:.0f}% of the pool, but gzip doesn't save enough to be worth it".format(
+            TIGHT_SPACE * 100))
+    return ("lz4", reasons)
+
+def Plan(disks, manifest=None, package_dir=None, ashift=None, compression=None):
+    """
+    Choose the layout for a boot pool on disks, for the packages in
+    manifest (whose files, if they're already in package_dir, are
+    sampled).  ashift and compression override the choices.
+    Raises ValueError for an override the boot loader can't handle.
+    """
+    reasons = []
+    if ashift is not None:
+        if not MIN_ASHIFT <= ashift <= MAX_ASHIFT:
+            raise ValueError("ashift must be between {} and {}".format(MIN_ASHIFT, MAX_ASHIFT))
+        reasons.append("ashift {} was given".format(ashift))
+    else:
+        (ashift, why) = ChooseAshift(disks)
+        reasons.extend(why)
+
+    if compression is not None:
+        if compression not in COMPRESSIONS:
+            raise ValueError("compression must be one of {}".format(", ".join(COMPRESSIONS)))
+        reasons.append("compression {} was given".format(compression))
+    else:
+        packages = manifest.Packages() if manifest else []
+        pool_size = min(disk.size for disk in disks) if disks else 0
+        (compression, why) = ChooseCompression(packages, package_dir, pool_size)
+        reasons.extend(why)
+
+    return PoolLayout(ashift=ashift, compression=compression, reasons=reasons)
@@ -0,0 +1,187 @@
+from __future__ import print_function
+import os
+import time
+import random
+import threading
+import collections
+
+from .Utils import LogIt, SmartSize
+
+# The whole probe, for all of the disks at once, takes no longer than this
+DEFAULT_BUDGET = 3.0
+# Sequential reads are this large; random reads are ALIGN bytes
+SEQUENTIAL_BLOCK = 1024 * 1024
+SEQUENTIAL_BYTES = 64 * 1024 * 1024
+RANDOM_READS = 256
+ALIGN = 4096
+# Half of each disk's time goes to sequential reads, the rest to random reads
+SEQUENTIAL_SHARE = 0.5
+# A disk is slow if its throughput is under this fraction of the
+# fastest disk's, or its latency over this multiple of the quickest's.
+SLOW_FRACTION = 0.25
+SLOW_LATENCY = 4.0
+# How long past the deadline to wait for a read that's under way
+_GRACE = 0.1
+
+class DiskProbe(collections.namedtuple("DiskProbe",
+                                       ["name", "sequential", "iops", "latency",
+                                        "complete", "error", "slow"])):
+    """
+    The results of probing one disk:  sequential read throughput (bytes
+    per second), random reads per second, and the median random read
+    latency (seconds); None for anything not measured.  complete is False
+    if the time ran out first; slow is a reason string if the disk is a
+    slow outlier (see FlagOutliers), or None.
+    """
+    __slots__ = ()
+
+    def summary(self):
+        """
+        A short description, for the disk list.
+        """
+        if self.error:
+            return "probe failed"
+        parts = []
+        if self.sequential is not None:
+            parts.append("{}/s".format(SmartSize(int(self.sequential))))
+        if self.latency is not None:
+            parts.append("{:.1f}ms".format(self.latency * 1000))
+        if not parts:
+            return "not probed"
+        if self.slow:
+            parts.append("SLOW")
+        return " ".join(parts)
+
+class DiskReader(object):
+    """
+    A read-only handle on a disk device.
+    """
+    def __init__(self, name):
+        self._fd = os.open("/dev/{}".format(name), os.O_RDONLY)
+
+    def read(self, offset, length):
+        return os.pread(self._fd, length, offset)
+
+    def close(self):
+        if self._fd is not None:
+            os.close(self._fd)
+            self._fd = None
+
+# The simulator replaces this
+OpenDisk = DiskReader
+
+def _Median(values):
+    values = sorted(values)
+    if not values:
+        return None
+    return values[len(values) // 2]
+
+def ProbeDisk(name, size, deadline, rng=None):
+    """
+    Measure the disk:  sequential reads from the start, then random
+    reads across the whole disk, stopping at deadline (a time.monotonic()
+    value).  Only ever reads.  Returns a DiskProbe.
+    """
+    rng = rng or random.Random(name)
+    now = time.monotonic()
+    sequential_deadline = now + (deadline - now) * SEQUENTIAL_SHARE
+    sequential = None
+    latencies = []
+    random_time = 0.0
+    complete = False
+    try:
+        reader = OpenDisk(name)
+    except (IOError, OSError) as e:
+        return DiskProbe(name, None, None, None, False, str(e), None)
+    try:
+        done = 0
+        start = time.monotonic()
+        limit = min(SEQUENTIAL_BYTES, size - size % SEQUENTIAL_BLOCK)
+        while done < limit and time.monotonic() < sequential_deadline:
+            if not reader.read(done, SEQUENTIAL_BLOCK):
+                break
+            done += SEQUENTIAL_BLOCK
+        elapsed = time.monotonic() - start
+        if done and elapsed > 0:
+            sequential = done / elapsed
+
+        blocks = max(1, size // ALIGN)
+        while len(latencies) < RANDOM_READS and time.monotonic() < deadline:
+            offset = rng.randrange(blocks) * ALIGN
+            start = time.monotonic()
+            reader.read(offset, ALIGN)
+            latencies.append(time.monotonic() - start)
+        random_time = sum(latencies)
+        complete = done >= limit and len(latencies) >= RANDOM_READS
+    except (IOError, OSError) as e:
+        return DiskProbe(name, sequential, None, None, False, str(e), None)
+    finally:
+        reader.close()
+    return DiskProbe(name, sequential,
+                     len(latencies) / random_time if random_time > 0 else None,
+                     _Median(latencies), complete, None, None)
+
+def FlagOutliers(results):
+    """
+    Mark the disks that are much slower than the best of the others.
+    Takes and returns a dictionary of name -> DiskProbe.
+    """
+    rates = [x.sequential for x in results.values() if x.sequential]
+    latencies = [x.latency for x in results.values() if x.latency]
+    fastest = max(rates) if rates else None
+    quickest = min(latencies) if latencies else None
+    flagged = {}
+    for (name, result) in results.items():
+        reasons = []
+        if len(rates) > 1 and result.sequential and result.sequential < fastest * SLOW_FRACTION:
+            reasons.append("reads at {}/s, against {}/s for the fastest disk".format(
+                SmartSize(int(result.sequential)), SmartSize(int(fastest))))
+        if len(latencies) > 1 and result.latency and result.latency > quickest * SLOW_LATENCY:
+            reasons.append("takes {:.1f}ms per random read, against {:.1f}ms for the quickest disk".format(
+                result.latency * 1000, quickest * 1000))
+        flagged[name] = result._replace(slow="; ".join(reasons) or None)
+    return flagged
+
+def ProbeDisks(disks, budget=DEFAULT_BUDGET):
+    """
+    Probe the disks (a list of (name, size) pairs) in parallel,
+    returning within budget seconds.  Returns a dictionary of
+    name -> DiskProbe, with the slow outliers flagged; a disk that
+    hasn't answered in time gets an error.
+    """
+    results = {}
+    lock = threading.Lock()
+    deadline = time.monotonic() + budget
+
+    def Probe(name, size):
+        try:
+            result = ProbeDisk(name, size, deadline)
+        except BaseException as e:
+            result = DiskProbe(name, None, None, None, False, str(e), None)
+        with lock:
+            results[name] = result
+
+    # Daemon threads, since a dying disk might never return from a read
+    threads = []
+    for (name, size) in disks:
+        thread = threading.Thread(target=Probe, args=(name, size), name="probe-{}".format(name))
+        thread.daemon = True
+        thread.start()
+        threads.append(thread)
+    for thread in threads:
+        thread.join(max(0, deadline + _GRACE - time.monotonic()))
+
+    with lock:
+        finished = dict(results)
+    for (name, size) in disks:
+        if name not in finished:
+            finished[name] = DiskProbe(name, None, None, None, False, "timed out", None)
+    finished = FlagOutliers(finished)
+    for name in sorted(finished):
+        result = finished[name]
+        LogIt("Probe {}: {}{}{}".format(name, result.summary(),
+                                        "" if result.complete else " (incomplete)",
+                                        ", {}".format(result.error) if result.error else ""))
+        if result.slow:
+            LogIt("Disk {} is slow: {}".format(name, result.slow))
+    return finished
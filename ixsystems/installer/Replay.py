@@ -0,0 +1,587 @@
+"""
+Record and replay the installer's interactions with the system.
+
+The installer talks to the system through bsd.geom, libzfs, bsd.sysctl,
+bsd.nmount/unmount/getmntinfo, and RunCommand.  In record mode, each of
+those is replaced by a proxy which passes every call through, and
+writes down the arguments, the result (or exception), and how long it
+took:
+
+	recorder = Replay.Recorder()
+	Replay.Install(recorder)
+	Install.Install(...)
+	Replay.Uninstall()
+	recorder.save("/tmp/install-replay.json")
+
+In replay mode the proxies answer from such a trace instead, taking the
+recorded time (times scale) to do so.  The bsd and libzfs modules
+don't need to exist for that; Stubs() puts stand-ins for them into
+sys.modules, which has to happen before the installer modules are
+imported:
+
+	player = Replay.Player("/tmp/install-replay.json", scale=0.5)
+	Replay.Stubs(player)
+	from ixsystems.installer import Install
+	Replay.Install(player)
+
+Objects returned by the system (geoms, pools, datasets, vdevs) become
+proxies too, so their attributes and methods are recorded as well.
+Replay matches each call by the object, the operation, the name, and
+the arguments, and hands out the recorded results for that call in the
+order they were recorded; once they run out, the last one is repeated.
+So replay does not depend on the calls being made in exactly the same
+order (as they aren't, when disks are partitioned in parallel), only on
+the same calls being made.  Generators and other iterators are turned
+into lists.
+
+Only the interactions listed in TARGETS are covered.  Anything else
+the installer imports (bsd.dialog, bsd.copy, freenasOS) must still be
+importable when replaying.
+
+This module must not import anything else from the installer at load
+time, so that Stubs() can run first.
+"""
+from __future__ import print_function
+import os, sys, re
+import enum
+import json
+import time
+import types
+import atexit
+import importlib
+import threading
+import collections
+import collections.abc
+
+TRACE_VERSION = 1
+
+# (module, global, root):  the module globals that get replaced by a
+# proxy, and the name of the proxy in the trace.  The same root name
+# means the same object (or function).
+TARGETS = [
+    ("ixsystems.installer.Utils", "geom", "geom"),
+    ("ixsystems.installer.Install", "geom", "geom"),
+    ("ixsystems.installer.Menu", "geom", "geom"),
+    ("ixsystems.installer.Install", "libzfs", "libzfs"),
+    ("ixsystems.installer.Menu", "libzfs", "libzfs"),
+    ("ixsystems.installer.BootPool", "libzfs", "libzfs"),
+    ("ixsystems.installer.Install", "zfs", "Install.zfs"),
+    ("ixsystems.installer.Menu", "zfs", "Menu.zfs"),
+    ("ixsystems.installer.BootPool", "zfs", "BootPool.zfs"),
+    ("ixsystems.installer.Install", "bsd", "bsd"),
+    ("ixsystems.installer.Menu", "bsd", "bsd"),
+    ("ixsystems.installer.BootPool", "bsd", "bsd"),
+    ("ixsystems.installer.Install", "sysctl", "sysctl"),
+    ("ixsystems.installer.Menu", "sysctlbyname", "sysctlbyname"),
+    ("ixsystems.installer.Utils", "RunCommand", "RunCommand"),
+    ("ixsystems.installer.Install", "RunCommand", "RunCommand"),
+    ("ixsystems.installer.Menu", "RunCommand", "RunCommand"),
+]
+
+# Secrets are kept out of traces:  an argument that follows one of
+# these (the root password, in "/etc/netcli reset_root_pw <password>")
+# is recorded as REDACTED, and taken out of any error it causes.
+SECRET_AFTER = ("reset_root_pw",)
+REDACTED = "<redacted>"
+
+# Replay doesn't sleep for less than this at a time; shorter delays
+# are added up until they reach it.
+_MIN_SLEEP = 0.001
+
+_address_re = re.compile(r' at 0x[0-9a-fA-F]+')
+
+class ReplayMismatch(LookupError):
+    """
+    Raised during replay when the installer does something
+    the trace has no record of.
+    """
+    pass
+
+def _secrets(args):
+    """
+    The arguments in args that are secrets (see SECRET_AFTER).
+    """
+    return [str(args[index + 1]) for index in range(len(args) - 1)
+            if isinstance(args[index], str) and args[index] in SECRET_AFTER]
+
+def _redact(args):
+    """
+    args, with the secrets replaced by REDACTED.
+    """
+    return [REDACTED if index and isinstance(args[index - 1], str) and args[index - 1] in SECRET_AFTER
+            else arg for (index, arg) in enumerate(args)]
+
+def _scrub(value, secrets):
+    if isinstance(value, str):
+        for secret in secrets:
+            if secret:
+                value = value.replace(secret, REDACTED)
+    return value
+
+def _describe(oid, op, name, key):
+    return "#{} {} {} {}".format(oid, op, name or "", key or "").rstrip()
+
+def _class_name(cls):
+    return "{}:{}".format(cls.__module__, getattr(cls, "__qualname__", cls.__name__))
+
+class _Proxy(types.ModuleType):
+    """
+    Stands in for one object (or module, or function).  All of the
+    work is done by the backend; attribute names starting with
+    _replay_ belong to the proxy itself.
+    """
+    def __init__(self, backend, oid):
+        super(_Proxy, self).__init__("<replay {}>".format(oid))
+        types.ModuleType.__setattr__(self, "_replay_backend", backend)
+        types.ModuleType.__setattr__(self, "_replay_oid", oid)
+
+    def __getattr__(self, name):
+        if name.startswith("__") and name.endswith("__"):
+            raise AttributeError(name)
+        return self._replay_backend.operate(self, "get", name)
+
+    def __setattr__(self, name, value):
+        if name.startswith("_replay_") or name == "__path__":
+            types.ModuleType.__setattr__(self, name, value)
+        else:
+            self._replay_backend.operate(self, "set", name, (value,))
+
+    def __call__(self, *args, **kwargs):
+        return self._replay_backend.operate(self, "call", None, args, kwargs)
+
+    def __getitem__(self, key):
+        return self._replay_backend.operate(self, "getitem", None, (key,))
+
+    def __contains__(self, item):
+        return self._replay_backend.operate(self, "contains", None, (item,))
+
+    def __iter__(self):
+        return iter(self._replay_backend.operate(self, "iter"))
+
+    def __len__(self):
+        return self._replay_backend.operate(self, "len")
+
+    def __bool__(self):
+        return self._replay_backend.operate(self, "bool")
+    __nonzero__ = __bool__
+
+    def __str__(self):
+        return self._replay_backend.operate(self, "str")
+
+    def __repr__(self):
+        return self._replay_backend.operate(self, "repr")
+
+    def __hash__(self):
+        return id(self)
+
+    def __eq__(self, other):
+        return self is other
+
+    def __ne__(self, other):
+        return self is not other
+
+class _Backend(object):
+    """
+    What the recorder and the player have in common:  the proxies,
+    and turning values into their JSON form.
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._proxies = {}
+
+    def proxy(self, oid):
+        with self._lock:
+            proxy = self._proxies.get(oid, None)
+            if proxy is None:
+                proxy = self._proxies[oid] = _Proxy(self, oid)
+            return proxy
+
+    def _key(self, args, kwargs):
+        return json.dumps([self._encode_arg(x) for x in _redact(args or ())] +
+                          [{ k : self._encode_arg(v) for (k, v) in (kwargs or {}).items() }],
+                          sort_keys=True)
+
+    def _encode_arg(self, value):
+        if isinstance(value, _Proxy):
+            return { "$ref" : value._replay_oid }
+        if value is None or isinstance(value, (bool, int, float, str)):
+            return value
+        if isinstance(value, (list, tuple, set, frozenset)):
+            return [self._encode_arg(x) for x in value]
+        if isinstance(value, dict):
+            return { str(k) : self._encode_arg(v) for (k, v) in value.items() }
+        if isinstance(value, enum.Enum):
+            return { "$enum" : "{}.{}".format(_class_name(type(value)), value.name) }
+        return { "$repr" : _address_re.sub("", repr(value)) }
+
+class Recorder(_Backend):
+    """
+    Passes everything through to the real objects, and keeps a
+    record of it.  save() writes the trace.
+    """
+    def __init__(self):
+        super(Recorder, self).__init__()
+        self._epoch = time.monotonic()
+        self._events = []
+        self._real = {}		# oid -> real object
+        self._oids = {}		# id(real object) -> oid
+        self._next_oid = 1
+
+    def root(self, name, real):
+        with self._lock:
+            self._real[name] = real
+            self._oids.setdefault(id(real), name)
+        return self.proxy(name)
+
+    def _oid_for(self, real):
+        with self._lock:
+            oid = self._oids.get(id(real), None)
+            if oid is None:
+                oid = self._oids[id(real)] = self._next_oid
+                self._next_oid += 1
+                self._real[oid] = real
+            return oid
+
+    def _unwrap(self, value):
+        if isinstance(value, _Proxy):
+            return self._real[value._replay_oid]
+        if isinstance(value, list):
+            return [self._unwrap(x) for x in value]
+        if isinstance(value, tuple):
+            return tuple(self._unwrap(x) for x in value)
+        if isinstance(value, dict):
+            return { k : self._unwrap(v) for (k, v) in value.items() }
+        return value
+
+    def _wrap(self, value):
+        """
+        Return the JSON form of value, and what to hand back to the caller.
+        """
+        if value is None or isinstance(value, (bool, int, float, str)):
+            return (value, value)
+        if isinstance(value, bytes):
+            return ({ "$bytes" : value.decode("latin-1") }, value)
+        if isinstance(value, enum.Enum):
+            return ({ "$enum" : "{}.{}".format(_class_name(type(value)), value.name) }, value)
+        if isinstance(value, type) and issubclass(value, BaseException):
+            # These have to be the real thing, for except clauses
+            return ({ "$class" : _class_name(value) }, value)
+        if isinstance(value, dict):
+            encoded = {}
+            wrapped = {}
+            for (k, v) in value.items():
+                (encoded[str(k)], wrapped[k]) = self._wrap(v)
+            return ({ "$dict" : encoded }, wrapped)
+        if isinstance(value, (list, tuple, set, frozenset, types.GeneratorType,
+                              collections.abc.Iterator)):
+            pairs = [self._wrap(x) for x in value]
+            wrapped = [x[1] for x in pairs]
+            return ({ "$list" : [x[0] for x in pairs], "tuple" : isinstance(value, tuple) },
+                    tuple(wrapped) if isinstance(value, tuple) else wrapped)
+        oid = self._oid_for(value)
+        return ({ "$ref" : oid }, self.proxy(oid))
+
+    def _encode_exception(self, exc, secrets=()):
+        attrs = {}
+        for (k, v) in getattr(exc, "__dict__", {}).items():
+            if v is None or isinstance(v, (bool, int, float, str)):
+                attrs[k] = _scrub(v, secrets)
+        return {
+            "class" : _class_name(type(exc)),
+            "args" : [_scrub(x if x is None or isinstance(x, (bool, int, float, str)) else repr(x), secrets)
+                      for x in exc.args],
+            "attrs" : attrs,
+        }
+
+    def operate(self, proxy, op, name=None, args=(), kwargs=None):
+        oid = proxy._replay_oid
+        real = self._real[oid]
+        key = self._key(args, kwargs)
+        event = {
+            "oid" : oid,
+            "op" : op,
+            "name" : name,
+            "key" : key,
+            "thread" : threading.current_thread().name,
+        }
+        start = time.monotonic()
+        try:
+            if op == "get":
+                result = getattr(real, name)
+            elif op == "set":
+                result = setattr(real, name, self._unwrap(args[0]))
+            elif op == "call":
+                result = real(*self._unwrap(args), **self._unwrap(kwargs or {}))
+            elif op == "getitem":
+                result = real[self._unwrap(args[0])]
+            elif op == "contains":
+                result = self._unwrap(args[0]) in real
+            elif op == "iter":
+                result = list(real)
+            elif op == "len":
+                result = len(real)
+            elif op == "bool":
+                result = bool(real)
+            elif op == "str":
+                result = str(real)
+            elif op == "repr":
+                result = repr(real)
+            else:
+                raise ValueError("Unknown operation {}".format(op))
+            (event["result"], wrapped) = self._wrap(result)
+        except BaseException as e:
+            event["error"] = self._encode_exception(e, _secrets(args or ()))
+            event["start"] = start - self._epoch
+            event["seconds"] = time.monotonic() - start
+            self._append(event)
+            raise
+        event["start"] = start - self._epoch
+        event["seconds"] = time.monotonic() - start
+        self._append(event)
+        return wrapped
+
+    def _append(self, event):
+        with self._lock:
+            event["seq"] = len(self._events)
+            self._events.append(event)
+
+    def events(self):
+        with self._lock:
+            return list(self._events)
+
+    def save(self, path):
+        data = {
+            "version" : TRACE_VERSION,
+            "created" : time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "events" : self.events(),
+        }
+        tmp_path = path + ".tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(data, f)
+        os.rename(tmp_path, path)
+        return path
+
+class Player(_Backend):
+    """
+    Answers from a trace written by Recorder.save().  Each answer
+    takes as long as it did when recorded, times scale (so 0 means
+    as fast as possible).
+    """
+    def __init__(self, path, scale=1.0):
+        super(Player, self).__init__()
+        self._scale = scale
+        self._classes = {}
+        self._local = threading.local()
+        with open(path, "r") as f:
+            data = json.load(f)
+        if data.get("version", None) != TRACE_VERSION:
+            raise ValueError("{} is trace version {}, not {}".format(path, data.get("version", None),
+                                                                     TRACE_VERSION))
+        self._answers = {}
+        self._served = {}
+        for event in sorted(data["events"], key=lambda x: x["seq"]):
+            self._answers.setdefault(self._event_key(event["oid"], event["op"], event["name"], event["key"]),
+                                     []).append(event)
+        self._stats = {
+            "events" : len(data["events"]),
+            "served" : 0,
+            "delay_seconds" : 0.0,
+        }
+
+    @property
+    def scale(self):
+        return self._scale
+
+    def _event_key(self, oid, op, name, key):
+        return json.dumps([oid, op, name, key])
+
+    def root(self, name, real=None):
+        return self.proxy(name)
+
+    def lookup_class(self, name, base=Exception):
+        """
+        Return the class recorded as name ("module:qualname"):  the real
+        one if it can be imported, otherwise a stand-in, the same one
+        every time.
+        """
+        with self._lock:
+            cls = self._classes.get(name, None)
+            if cls is not None:
+                return cls
+        (module_name, qualname) = name.split(":", 1)
+        try:
+            cls = importlib.import_module(module_name)
+            for part in qualname.split("."):
+                cls = getattr(cls, part)
+        except (ImportError, AttributeError, ReplayMismatch):
+            cls = type(str(qualname.split(".")[-1]), (base,), { "__module__" : module_name })
+        with self._lock:
+            return self._classes.setdefault(name, cls)
+
+    def _decode(self, value):
+        if isinstance(value, list):
+            return [self._decode(x) for x in value]
+        if not isinstance(value, dict):
+            return value
+        if "$ref" in value:
+            return self.proxy(value["$ref"])
+        if "$list" in value:
+            items = [self._decode(x) for x in value["$list"]]
+            return tuple(items) if value.get("tuple", False) else items
+        if "$dict" in value:
+            return { k : self._decode(v) for (k, v) in value["$dict"].items() }
+        if "$bytes" in value:
+            return value["$bytes"].encode("latin-1")
+        if "$class" in value:
+            return self.lookup_class(value["$class"])
+        if "$enum" in value:
+            (cls_name, member) = value["$enum"].rsplit(".", 1)
+            cls = self.lookup_class(cls_name, base=object)
+            return getattr(cls, member, member)
+        return value
+
+    def _raise(self, error):
+        cls = self.lookup_class(error["class"])
+        exc = cls.__new__(cls)
+        exc.args = tuple(error["args"])
+        try:
+            exc.__dict__.update(error["attrs"])
+        except AttributeError:
+            pass
+        raise exc
+
+    def _delay(self, seconds):
+        owed = getattr(self._local, "owed", 0.0) + seconds * self._scale
+        if owed >= _MIN_SLEEP:
+            time.sleep(owed)
+            owed = 0.0
+        self._local.owed = owed
+
+    def operate(self, proxy, op, name=None, args=(), kwargs=None):
+        oid = proxy._replay_oid
+        key = self._key(args, kwargs)
+        event_key = self._event_key(oid, op, name, key)
+        with self._lock:
+            answers = self._answers.get(event_key, None)
+            if not answers:
+                event = None
+            else:
+                index = self._served.get(event_key, 0)
+                event = answers[min(index, len(answers) - 1)]
+                self._served[event_key] = index + 1
+                self._stats["served"] += 1
+                self._stats["delay_seconds"] += event["seconds"] * self._scale
+        if event is None:
+            if op == "repr" or op == "str":
+                return "<replay #{}>".format(oid)
+            if op == "get":
+                # Exception classes are only looked up when something is
+                # raised, and that may not have happened while recording.
+                for cls_name in list(self._classes):
+                    if cls_name.endswith(":" + name):
+                        return self._classes[cls_name]
+            raise ReplayMismatch("No recorded answer for {}".format(_describe(oid, op, name, key)))
+        self._delay(event["seconds"])
+        if "error" in event:
+            self._raise(event["error"])
+        return self._decode(event["result"])
+
+    def stats(self):
+        with self._lock:
+            return dict(self._stats, unused=sum(1 for k in self._answers if k not in self._served))
+
+class _Placeholder(object):
+    """
+    Returned by the stand-in libzfs.ZFS(); Install() replaces it.
+    """
+    def __getattr__(self, name):
+        raise ReplayMismatch("libzfs.ZFS().{} used before Replay.Install()".format(name))
+
+def Stubs(player):
+    """
+    Put stand-ins for the bsd, bsd.geom, bsd.sysctl, and libzfs modules
+    into sys.modules, unless the real ones can be imported.  This has to
+    be done before the installer modules are imported.  Returns the
+    names of the modules replaced.
+    """
+    stubbed = []
+    def stub(module_name, root):
+        try:
+            importlib.import_module(module_name)
+            return sys.modules[module_name]
+        except ImportError:
+            pass
+        module = player.root(root)
+        module.__path__ = []
+        sys.modules[module_name] = module
+        stubbed.append(module_name)
+        return module
+
+    # These are all plain attributes of the stand-ins, so that neither
+    # importing them nor "from x import y" needs anything from the trace.
+    bsd = stub("bsd", "bsd")
+    for (submodule, root) in [("geom", "geom"), ("sysctl", "sysctl")]:
+        module = stub("bsd." + submodule, root)
+        if "bsd" in stubbed:
+            types.ModuleType.__setattr__(bsd, submodule, module)
+    if "bsd.sysctl" in stubbed:
+        types.ModuleType.__setattr__(sys.modules["bsd.sysctl"], "sysctlbyname", player.root("sysctlbyname"))
+    libzfs = stub("libzfs", "libzfs")
+    if "libzfs" in stubbed:
+        types.ModuleType.__setattr__(libzfs, "ZFS", _Placeholder)
+        types.ModuleType.__setattr__(libzfs, "ZFSException", player.lookup_class("libzfs:ZFSException"))
+    return stubbed
+
+_installed = []
+_recorders = []
+
+def Install(backend):
+    """
+    Replace the installer's system interfaces (see TARGETS) with
+    proxies using backend (a Recorder or a Player).  Only modules
+    already imported are changed.
+    """
+    Uninstall()
+    for (module_name, attr, root) in TARGETS:
+        module = sys.modules.get(module_name, None)
+        if module is None or not hasattr(module, attr):
+            continue
+        original = getattr(module, attr)
+        setattr(module, attr, backend.root(root, original))
+        _installed.append((module, attr, original))
+    if isinstance(backend, Recorder):
+        _recorders.append(backend)
+
+def Uninstall():
+    """
+    Put back what Install() replaced.
+    """
+    while _installed:
+        (module, attr, original) = _installed.pop()
+        setattr(module, attr, original)
+
+def Record(path):
+    """
+    Start recording into a new Recorder, which is saved to path
+    by Stop(), or at exit.  Returns the Recorder.
+    """
+    recorder = Recorder()
+    recorder.path = path
+    Install(recorder)
+    return recorder
+
+def Stop():
+    """
+    Uninstall, and save any recordings started with Record().
+    Returns the paths saved.
+    """
+    Uninstall()
+    paths = []
+    while _recorders:
+        recorder = _recorders.pop()
+        path = getattr(recorder, "path", None)
+        if path:
+            paths.append(recorder.save(path))
+    return paths
+
+atexit.register(Stop)
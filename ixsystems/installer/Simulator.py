@@ -0,0 +1,1327 @@
+"""
+Simulated hardware, so the installer can be run (and benchmarked)
+on a machine without FreeBSD, ZFS, or disks to spare -- e.g., a
+plain Linux box.
+
+	hardware = Simulator.Hardware(disks=8, disk_size="16g", packages=200)
+	hardware.install()
+	from ixsystems.installer import Install, Menu
+	...
+	hardware.cleanup()
+
+install() puts stand-ins for bsd (geom, sysctl, dialog, copy), libzfs,
+and freenasOS into sys.modules, so it has to be called before the
+installer modules are imported; it then replaces RunCommand in the
+installer modules.  Each disk is a sparse file; partition tables,
+labels, and the like are really written to it, and every I/O is
+charged the device's latency plus its size over the device's
+throughput (by sleeping).  Datasets are directories, and mounting one
+moves its directory onto the mount point.  Packages are generated on
+demand, "downloaded" at the network's latency and throughput, and
+"extracted" at the boot pool's.
+
+Dialogs answer on their own:  a YesNo gives its default, a CheckList
+selects the first select items (all of them by default), a Form
+returns its items as they are, and a Menu escapes.
+
+disk_size, sectorsize, stripesize, latency, and throughput may be lists, giving a value for each disk in
+turn (repeating the list if there are more disks than values).
+"""
+from __future__ import print_function
+import os, sys, re, errno
+import json
+import time
+import types
+import random
+import shutil
+import hashlib
+import tempfile
+import threading
+import collections
+
+from . import Trace
+
+DEFAULT_DISKS = 4
+DEFAULT_DISK_SIZE = 16 * 1024 * 1024 * 1024
+DEFAULT_LATENCY = 0.0005
+DEFAULT_THROUGHPUT = 200 * 1024 * 1024
+DEFAULT_PACKAGES = 50
+DEFAULT_PACKAGE_SIZE = 256 * 1024
+DEFAULT_NETWORK_LATENCY = 0.01
+DEFAULT_NETWORK_THROUGHPUT = 100 * 1024 * 1024
+# Each package extracts to this many files
+FILES_PER_PACKAGE = 4
+# The first 34 sectors (and the last 33) are the GPT
+_GPT_BYTES = 34 * 512
+# What newfs_msdos and grub-install write, more or less
+_NEWFS_BYTES = 1024 * 1024
+_GRUB_BYTES = 1024 * 1024
+# Each of the four vdev labels
+_ZFS_LABEL_BYTES = 256 * 1024
+
+_hardware = None
+
+def Current():
+    """
+    Return the Hardware currently installed.
+    """
+    if _hardware is None:
+        raise RuntimeError("No simulated hardware has been installed")
+    return _hardware
+
+def _Sleep(seconds):
+    if seconds > 0:
+        time.sleep(seconds)
+
+def _PerDevice(value, index):
+    if isinstance(value, (list, tuple)):
+        return value[index % len(value)]
+    return value
+
+def ParseSize(value):
+    """
+    Like Utils.ParseSize (which can't be imported until install()).
+    """
+    if isinstance(value, str):
+        scale = { "k" : 1024, "m" : 1024 ** 2, "g" : 1024 ** 3, "t" : 1024 ** 4 }
+        if value[-1].lower() in scale:
+            return int(float(value[:-1]) * scale[value[-1].lower()])
+    return int(value)
+
+#
+# Disks, and the geom view of them.
+#
+
+class Device(object):
+    """
+    One simulated disk, backed by a sparse file.
+    """
+    def __init__(self, name, path, size, sectorsize=512, stripesize=4096,
+                 latency=DEFAULT_LATENCY, throughput=DEFAULT_THROUGHPUT, description=None):
+        self.name = name
+        self.path = path
+        self.size = size
+        self.sectorsize = sectorsize
+        self.stripesize = stripesize
+        self.latency = latency
+        self.throughput = throughput
+        self.description = description or "Simulated disk {}".format(name)
+        self.partitions = None		# None: no partition table; else index -> dict
+        self.mirror = None
+        self._lock = threading.Lock()
+        self._stats = { "reads" : 0, "writes" : 0, "bytes_read" : 0, "bytes_written" : 0 }
+        with open(path, "wb") as f:
+            f.truncate(size)
+
+    def charge(self, nbytes):
+        _Sleep(self.latency + float(nbytes) / self.throughput)
+
+    def write(self, offset, nbytes):
+        """
+        Write nbytes at offset (only the first megabyte is really written).
+        """
+        with self._lock:
+            with open(self.path, "r+b") as f:
+                f.seek(max(0, min(offset, self.size - 1)))
+                f.write(b"\xa5" * min(nbytes, 1024 * 1024, max(0, self.size - offset)))
+            self.charge(nbytes)
+            self._stats["writes"] += 1
+            self._stats["bytes_written"] += nbytes
+
+    def read(self, offset, nbytes):
+        with self._lock:
+            with open(self.path, "rb") as f:
+                f.seek(max(0, min(offset, self.size - 1)))
+                f.read(min(nbytes, 1024 * 1024))
+            self.charge(nbytes)
+            self._stats["reads"] += 1
+            self._stats["bytes_read"] += nbytes
+
+    def stats(self):
+        with self._lock:
+            return dict(self._stats)
+
+class DiskReader(object):
+    """
+    A read-only handle on a Device, as Probe.OpenDisk returns.
+    """
+    def __init__(self, device):
+        self._device = device
+
+    def read(self, offset, length):
+        length = max(0, min(length, self._device.size - offset))
+        if length:
+            self._device.read(offset, length)
+        return b"\0" * length
+
+    def close(self):
+        pass
+
+class HTTPResponse(object):
+    """
+    The part of http.client.HTTPResponse that Download uses.
+    """
+    def __init__(self, status, reason, headers, body):
+        self.status = status
+        self.reason = reason
+        self._headers = headers
+        self._body = body
+        self._offset = 0
+
+    def getheader(self, name, default=None):
+        for (key, value) in self._headers.items():
+            if key.lower() == name.lower():
+                return value
+        return default
+
+    def read(self, amt=None):
+        end = len(self._body) if amt is None else min(len(self._body), self._offset + amt)
+        data = self._body[self._offset:end]
+        self._offset = end
+        return data
+
+class HTTPConnection(object):
+    """
+    A keep-alive connection to the simulated update server, as
+    Download.OpenConnection returns.  It serves the package files
+    (as <anything>/Packages/<file>), honoring Range and If-Range,
+    and charges the network for each response.
+    """
+    def __init__(self, hardware, host):
+        self._hardware = hardware
+        self._host = host
+        self._request = None
+        hardware.count("connections")
+
+    def request(self, method, target, headers=None):
+        self._request = (method, target, dict(headers or {}))
+
+    def getresponse(self):
+        (method, target, headers) = self._request
+        self._request = None
+        hardware = self._hardware
+        name = target.rsplit("/", 1)[-1]
+        with hardware.lock:
+            packages = [pkg for pkg in hardware.packages if pkg.FileName() == name]
+        if method != "GET" or "/Packages/" not in target or not packages:
+            _Sleep(hardware.network_latency)
+            return HTTPResponse(404, "Not Found", {}, b"")
+        data = hardware.package_data(packages[0].Name(), packages[0].Version())
+        etag = '"{}"'.format(packages[0].Checksum()[:16])
+        status = 200
+        reason = "OK"
+        response_headers = { "ETag" : etag, "Content-Length" : str(len(data)) }
+        match = re.match(r'^bytes=(\d+)-$', headers.get("Range", ""))
+        if match and headers.get("If-Range", None) == etag and int(match.group(1)) < len(data):
+            start = int(match.group(1))
+            response_headers["Content-Range"] = "bytes {}-{}/{}".format(start, len(data) - 1, len(data))
+            response_headers["Content-Length"] = str(len(data) - start)
+            data = data[start:]
+            status = 206
+            reason = "Partial Content"
+        hardware.download(len(data), url="https://{}{}".format(self._host, target))
+        return HTTPResponse(status, reason, response_headers, data)
+
+    def close(self):
+        pass
+
+class _Object(object):
+    def __init__(self, **kwargs):
+        self.__dict__.update(kwargs)
+    def __repr__(self):
+        return "<{} {}>".format(type(self).__name__, getattr(self, "name", ""))
+
+class GeomClass(_Object): pass
+
+class Geom(_Object):
+    @property
+    def provider(self):
+        return self.providers[0] if self.providers else None
+    @property
+    def consumer(self):
+        return self.consumers[0] if self.consumers else None
+
+class Provider(_Object): pass
+class Consumer(_Object): pass
+
+def _BuildGeoms(devices):
+    disk_geoms = []
+    part_geoms = []
+    dev_geoms = []
+    for device in devices:
+        disk = Geom(name=device.name, providers=[], consumers=[], config={})
+        provider = Provider(name=device.name, mediasize=device.size,
+                            sectorsize=device.sectorsize, stripesize=device.stripesize,
+                            description=device.description, geom=disk,
+                            config={ "rotationrate" : "0", "descr" : device.description,
+                                     "ident" : "SIM-{}".format(device.name) })
+        disk.providers.append(provider)
+        disk_geoms.append(disk)
+        dev_geoms.append(Geom(name=device.name, providers=[],
+                              consumers=[Consumer(provider=provider)], config={}))
+        if device.partitions is not None:
+            part = Geom(name=device.name, providers=[],
+                        consumers=[Consumer(provider=provider)], config={ "scheme" : "GPT" })
+            for index in sorted(device.partitions):
+                entry = device.partitions[index]
+                pname = "{}p{}".format(device.name, index)
+                part_provider = Provider(name=pname, mediasize=entry["length"],
+                                         sectorsize=device.sectorsize, stripesize=device.stripesize,
+                                         description=None, geom=part,
+                                         config={ "type" : entry["type"],
+                                                  "index" : str(index),
+                                                  "length" : str(entry["length"]),
+                                                  "offset" : str(entry["offset"]),
+                                                  "start" : str(entry["offset"] // device.sectorsize),
+                                                  "end" : str((entry["offset"] + entry["length"]) // device.sectorsize - 1),
+                                                  "label" : entry.get("label", None) })
+                part.providers.append(part_provider)
+                dev_geoms.append(Geom(name=pname, providers=[],
+                                      consumers=[Consumer(provider=part_provider)], config={}))
+            part_geoms.append(part)
+    return {
+        "DISK" : GeomClass(name="DISK", geoms=disk_geoms),
+        "PART" : GeomClass(name="PART", geoms=part_geoms),
+        "DEV" : GeomClass(name="DEV", geoms=dev_geoms),
+        "MIRROR" : GeomClass(name="MIRROR", geoms=[]),
+    }
+
+def _geom_scan():
+    hardware = Current()
+    _Sleep(hardware.latency_for_scan())
+    with hardware.lock:
+        hardware.geom_classes = _BuildGeoms(hardware.devices)
+
+def _geom_class_by_name(name):
+    hardware = Current()
+    with hardware.lock:
+        if hardware.geom_classes is None:
+            hardware.geom_classes = _BuildGeoms(hardware.devices)
+        return hardware.geom_classes.get(name, None)
+
+def _geom_geom_by_name(class_name, name):
+    geom_class = _geom_class_by_name(class_name)
+    for entry in (geom_class.geoms if geom_class else []):
+        if entry.name == name:
+            return entry
+    return None
+
+#
+# ZFS
+#
+
+class ZFSException(Exception):
+    def __init__(self, code=errno.EINVAL, message=""):
+        super(ZFSException, self).__init__(message)
+        self.code = code
+
+class ZFSVdev(object):
+    def __init__(self, zfs, type):
+        self.zfs = zfs
+        self.type = type
+        self.path = None
+        self.children = []
+
+    def __str__(self):
+        if self.children:
+            return "<ZFSVdev {} [{}]>".format(self.type, ", ".join(str(x) for x in self.children))
+        return "<ZFSVdev {} {}>".format(self.type, self.path)
+
+class ZFSProperty(object):
+    def __init__(self, name, value=None):
+        self.name = name
+        self.value = value
+        self.source = "DEFAULT"
+
+    def inherit(self):
+        self.value = None
+        self.source = "INHERITED"
+
+class _Properties(dict):
+    def __missing__(self, key):
+        value = self[key] = ZFSProperty(key)
+        return value
+
+class ZFSFeature(object):
+    def __init__(self, name):
+        self.name = name
+        self.state = "DISABLED"
+    def enable(self):
+        self.state = "ENABLED"
+
+class ZFSDataset(object):
+    def __init__(self, pool, name, properties=None):
+        self.pool = pool
+        self.name = name
+        self.properties = _Properties()
+        for (k, v) in (properties or {}).items():
+            self.properties[k] = ZFSProperty(k, v)
+        self.path = os.path.join(Current().dataset_dir, name.replace("/", "%"))
+        os.makedirs(self.path)
+
+    def __repr__(self):
+        return "<ZFSDataset {}>".format(self.name)
+
+    def _contents(self):
+        # Where the dataset's files are now (it may be mounted)
+        return Current().mounted_datasets.get(self.path, self.path)
+
+    def snapshot(self, name, fsopts=None, recursive=False):
+        (dataset_name, _, snapshot_name) = name.partition("@")
+        if dataset_name != self.name or not snapshot_name:
+            raise ZFSException(errno.EINVAL, "invalid snapshot name {}".format(name))
+        with Current().lock:
+            if name in self.pool.snapshots:
+                raise ZFSException(errno.EEXIST, "snapshot {} already exists".format(name))
+            snapshot = self.pool.snapshots[name] = ZFSSnapshot(self, name)
+        shutil.copytree(self._contents(), snapshot.path, symlinks=True)
+        self.pool.write(128 * 1024)
+        return snapshot
+
+    def delete(self):
+        hardware = Current()
+        with hardware.lock:
+            if self.path in hardware.mounted_datasets:
+                raise ZFSException(errno.EBUSY, "{} is mounted".format(self.name))
+            if any(x.dataset is self for x in self.pool.snapshots.values()):
+                raise ZFSException(errno.EBUSY, "{} has snapshots".format(self.name))
+            del self.pool.datasets[self.name]
+        shutil.rmtree(self.path, ignore_errors=True)
+
+class ZFSSnapshot(object):
+    def __init__(self, dataset, name):
+        self.dataset = dataset
+        self.name = name
+        self.properties = _Properties()
+        self.path = os.path.join(Current().dataset_dir, name.replace("/", "%"))
+
+    def __repr__(self):
+        return "<ZFSSnapshot {}>".format(self.name)
+
+    def clone(self, name, opts=None):
+        # Clones are free in ZFS, so nothing is charged for the copy
+        clone = self.dataset.pool._add_dataset(name, opts or {})
+        os.rmdir(clone.path)
+        shutil.copytree(self.path, clone.path, symlinks=True)
+        clone.properties["origin"] = ZFSProperty("origin", self.name)
+        return clone
+
+    def delete(self):
+        with Current().lock:
+            self.dataset.pool.snapshots.pop(self.name, None)
+        shutil.rmtree(self.path, ignore_errors=True)
+
+class ZFSPool(object):
+    def __init__(self, name, devices, paths, properties=None):
+        self.name = name
+        self.devices = devices
+        self.disks = paths
+        self.imported = True
+        self.properties = _Properties()
+        for (k, v) in (properties or {}).items():
+            self.properties[k] = ZFSProperty(k, v)
+        self.properties["bootfs"] = ZFSProperty("bootfs", None)
+        self.features = [ZFSFeature(x) for x in ["async_destroy", "empty_bpobj", "lz4_compress"]]
+        self.datasets = collections.OrderedDict()
+        self.snapshots = collections.OrderedDict()
+        self.root_dataset = self._add_dataset(name, {})
+
+    def __repr__(self):
+        return "<ZFSPool {}>".format(self.name)
+
+    def _add_dataset(self, name, properties):
+        if name in self.datasets:
+            raise ZFSException(errno.EEXIST, "dataset {} already exists".format(name))
+        self.write(128 * 1024)
+        dataset = self.datasets[name] = ZFSDataset(self, name, properties)
+        return dataset
+
+    def create(self, name, fsopts=None, fstype=None, sparse_vol=None):
+        if not name.startswith(self.name + "/"):
+            raise ZFSException(errno.EINVAL, "{} is not in pool {}".format(name, self.name))
+        parent = name.rsplit("/", 1)[0]
+        if parent not in self.datasets:
+            raise ZFSException(errno.ENOENT, "parent of {} does not exist".format(name))
+        return self._add_dataset(name, fsopts or {})
+
+    def write(self, nbytes):
+        """
+        Charge a write of nbytes to every device in the pool, concurrently.
+        """
+        if self.devices:
+            _Sleep(max(device.latency + float(nbytes) / device.throughput for device in self.devices))
+
+class ZFS(object):
+    """
+    Stands in for libzfs.ZFS; all of the instances share the pools
+    of the current Hardware.
+    """
+    @property
+    def pools(self):
+        hardware = Current()
+        _Sleep(hardware.zfs_latency)
+        with hardware.lock:
+            return [pool for pool in hardware.pools if pool.imported]
+
+    def find_import(self, name=None, **kwargs):
+        hardware = Current()
+        # Tasting every disk
+        _Sleep(hardware.zfs_latency + sum(device.latency for device in hardware.devices))
+        with hardware.lock:
+            found = [pool for pool in hardware.pools
+                     if not pool.imported and (name is None or pool.name == name)]
+        for pool in found:
+            yield pool
+
+    def _find(self, name):
+        for pool in Current().pools:
+            if pool.imported and (pool.name == name or name.startswith(pool.name + "/")):
+                return pool
+        return None
+
+    def get(self, name):
+        hardware = Current()
+        _Sleep(hardware.zfs_latency)
+        with hardware.lock:
+            pool = self._find(name)
+        if pool is None or pool.name != name:
+            raise ZFSException(errno.ENOENT, "pool {} not found".format(name))
+        return pool
+
+    def get_dataset(self, name):
+        hardware = Current()
+        _Sleep(hardware.zfs_latency)
+        with hardware.lock:
+            pool = self._find(name)
+            dataset = pool.datasets.get(name, None) if pool else None
+        if dataset is None:
+            raise ZFSException(errno.ENOENT, "dataset {} not found".format(name))
+        return dataset
+
+    def get_snapshot(self, name):
+        hardware = Current()
+        _Sleep(hardware.zfs_latency)
+        with hardware.lock:
+            pool = self._find(name)
+            snapshot = pool.snapshots.get(name, None) if pool else None
+        if snapshot is None:
+            raise ZFSException(errno.ENOENT, "snapshot {} not found".format(name))
+        return snapshot
+
+    def import_pool(self, pool, name, opts, **kwargs):
+        hardware = Current()
+        with hardware.lock:
+            if self._find(name):
+                raise ZFSException(errno.EEXIST, "a pool named {} is already imported".format(name))
+            if pool not in hardware.pools:
+                raise ZFSException(errno.ENOENT, "no such pool")
+            pool.imported = True
+            pool.name = name
+        for device in pool.devices:
+            device.read(0, 4 * _ZFS_LABEL_BYTES)
+        return pool
+
+    def export_pool(self, pool):
+        hardware = Current()
+        pool.write(4 * _ZFS_LABEL_BYTES)
+        with hardware.lock:
+            pool.imported = False
+
+    def destroy(self, name):
+        hardware = Current()
+        with hardware.lock:
+            pool = self._find(name)
+            if pool is None or pool.name != name:
+                raise ZFSException(errno.ENOENT, "pool {} not found".format(name))
+            hardware.pools.remove(pool)
+        for dataset in list(pool.datasets.values()) + list(pool.snapshots.values()):
+            shutil.rmtree(dataset.path, ignore_errors=True)
+        pool.write(4 * _ZFS_LABEL_BYTES)
+
+    def create(self, name, topology, opts=None, fsopts=None, enable_all_feat=True):
+        hardware = Current()
+        members = []
+        for vdev in topology.get("data", []):
+            members.extend(vdev.children or [vdev])
+        devices = []
+        for vdev in members:
+            device = hardware.device_for_path(vdev.path)
+            if device is None:
+                raise ZFSException(errno.ENOENT, "cannot open {}".format(vdev.path))
+            devices.append(device)
+        with hardware.lock:
+            if self._find(name):
+                raise ZFSException(errno.EEXIST, "pool {} already exists".format(name))
+        for device in devices:
+            device.write(0, 4 * _ZFS_LABEL_BYTES)
+        pool = ZFSPool(name, devices, [vdev.path for vdev in members], opts)
+        # As on FreeBSD:  the vdevs get the larger of the devices' sector
+        # size and vfs.zfs.min_auto_ashift.
+        with hardware.lock:
+            min_ashift = int(hardware.sysctls.get("vfs.zfs.min_auto_ashift", 9))
+        ashift = max([min_ashift] + [device.sectorsize.bit_length() - 1 for device in devices])
+        pool.properties["ashift"] = ZFSProperty("ashift", str(ashift))
+        for (k, v) in (fsopts or {}).items():
+            pool.root_dataset.properties[k] = ZFSProperty(k, v)
+        with hardware.lock:
+            hardware.pools.append(pool)
+        return pool
+
+#
+# bsd:  mounts, sysctl, copy
+#
+
+MountEntry = collections.namedtuple("MountEntry", ["source", "dest", "fstype", "flags"])
+
+class MountFlags(object):
+    RDONLY = 0x1
+    NOEXEC = 0x4
+    NOSUID = 0x8
+    NOATIME = 0x10000000
+
+def _nmount(source=None, fspath=None, fstype=None, flags=0, **kwargs):
+    hardware = Current()
+    _Sleep(hardware.zfs_latency)
+    fspath = os.path.realpath(fspath)
+    if not os.path.isdir(fspath):
+        raise OSError(errno.ENOENT, "{} does not exist".format(fspath))
+    with hardware.lock:
+        if fspath in hardware.mounts:
+            raise OSError(errno.EBUSY, "{} is already mounted".format(fspath))
+        if fstype == "zfs":
+            dataset = ZFS().get_dataset(source) if source else None
+            if dataset is None or dataset.path in hardware.mounted_datasets:
+                raise OSError(errno.EBUSY, "{} is already mounted".format(source))
+            # The dataset's contents move onto the mount point
+            if os.listdir(fspath):
+                raise OSError(errno.ENOTEMPTY, "{} is not empty".format(fspath))
+            os.rmdir(fspath)
+            os.rename(dataset.path, fspath)
+            hardware.mounted_datasets[dataset.path] = fspath
+            hardware.mounts[fspath] = (MountEntry(source, fspath, fstype, flags), dataset.path)
+        else:
+            hardware.mounts[fspath] = (MountEntry(source, fspath, fstype, flags), None)
+
+def _unmount(fspath, flags=0):
+    hardware = Current()
+    _Sleep(hardware.zfs_latency)
+    fspath = os.path.realpath(fspath)
+    with hardware.lock:
+        if fspath not in hardware.mounts:
+            raise OSError(errno.EINVAL, "{} is not mounted".format(fspath))
+        if any(x.startswith(fspath + "/") for x in hardware.mounts):
+            raise OSError(errno.EBUSY, "{} is busy".format(fspath))
+        (entry, dataset_path) = hardware.mounts.pop(fspath)
+        if dataset_path:
+            os.rename(fspath, dataset_path)
+            del hardware.mounted_datasets[dataset_path]
+        else:
+            # tmpfs, msdosfs, devfs:  nothing to keep
+            shutil.rmtree(fspath, ignore_errors=True)
+        os.mkdir(fspath)
+
+def _getmntinfo():
+    hardware = Current()
+    with hardware.lock:
+        return [entry for (entry, _) in hardware.mounts.values()]
+
+def _sysctlbyname(name, old=True, new=None):
+    hardware = Current()
+    with hardware.lock:
+        value = hardware.sysctls.get(name, None)
+        if new is not None:
+            hardware.sysctls[name] = new
+    if name == "kern.disks":
+        return " ".join(device.name for device in reversed(hardware.devices))
+    if value is None and new is None:
+        raise OSError(errno.ENOENT, "unknown sysctl {}".format(name))
+    return value if old else None
+
+def _copytree(src, dst, progress_callback=None, **kwargs):
+    if os.path.isdir(src) and not os.path.islink(src):
+        def Copy(s, d):
+            shutil.copy2(s, d)
+            if progress_callback:
+                progress_callback(s, d)
+        shutil.copytree(src, dst, symlinks=True, copy_function=Copy, dirs_exist_ok=True)
+    else:
+        shutil.copy2(src, dst, follow_symlinks=False)
+        if progress_callback:
+            progress_callback(src, dst)
+
+#
+# bsd.dialog
+#
+
+class DialogEscape(Exception):
+    pass
+
+class _Dialog(object):
+    def __init__(self, title="", prompt="", **kwargs):
+        self.title = title
+        self.prompt = prompt
+        self.kwargs = kwargs
+        self.percentage = 0
+        self.__dict__.update((k, v) for (k, v) in kwargs.items() if k.endswith("_label"))
+        try:
+            Current().count("dialogs")
+        except RuntimeError:
+            pass
+
+    def run(self):
+        pass
+
+    def clear(self):
+        pass
+
+    @property
+    def result(self):
+        return True
+
+class MessageBox(_Dialog): pass
+class Gauge(_Dialog): pass
+
+class YesNo(_Dialog):
+    @property
+    def result(self):
+        return self.kwargs.get("default", True)
+
+class CheckList(_Dialog):
+    @property
+    def result(self):
+        items = self.kwargs.get("list_items", [])
+        select = Current().select
+        return list(items) if select is None else list(items)[:select]
+
+class Form(_Dialog):
+    @property
+    def result(self):
+        return self.kwargs.get("form_items", [])
+
+class Menu(_Dialog):
+    @property
+    def result(self):
+        raise DialogEscape
+
+class ListItem(object):
+    def __init__(self, label, text="", selected=False):
+        self.label = label
+        self.text = text
+        self.selected = selected
+
+class FormLabel(object):
+    def __init__(self, label, **kwargs):
+        self.label = label
+        self.value = label
+
+class FormInput(object):
+    def __init__(self, value="", **kwargs):
+        self.value = value
+
+class FormItem(object):
+    def __init__(self, label, value):
+        self.label = label
+        self.value = value
+
+#
+# freenasOS
+#
+
+class UpdateException(Exception): pass
+class ChecksumFailException(UpdateException): pass
+class UpdateInvalidUpdateException(UpdateException): pass
+class UpdatePackageNotFound(UpdateException): pass
+
+class Package(object):
+    def __init__(self, name, version, size, checksum):
+        self._name = name
+        self._version = version
+        self._size = size
+        self._checksum = checksum
+
+    def Name(self):
+        return self._name
+    def Version(self):
+        return self._version
+    def Size(self):
+        return self._size
+    def Checksum(self):
+        return self._checksum
+    def FileName(self):
+        return "{}-{}.tgz".format(self._name, self._version)
+    def dict(self):
+        return { "Name" : self._name, "Version" : self._version,
+                 "Size" : self._size, "Checksum" : self._checksum }
+
+class Manifest(object):
+    def __init__(self, configuration=None, require_signature=False):
+        hardware = Current()
+        self._train = hardware.train
+        self._sequence = hardware.sequence
+        self._packages = list(hardware.packages)
+
+    def Packages(self):
+        return list(self._packages)
+    def Train(self):
+        return self._train
+    def Sequence(self):
+        return self._sequence
+    def Version(self):
+        return "{}-{}".format(self._train, self._sequence)
+    def RunValidationProgram(self, cache_dir, kind=None):
+        return True
+    def dict(self):
+        return { "Train" : self._train, "Sequence" : self._sequence,
+                 "Packages" : [pkg.dict() for pkg in self._packages] }
+    def LoadPath(self, path):
+        with open(path, "r") as f:
+            data = json.load(f)
+        self._train = data["Train"]
+        self._sequence = data["Sequence"]
+        self._packages = [Package(x["Name"], x["Version"], x["Size"], x["Checksum"])
+                          for x in data["Packages"]]
+    def Save(self, root):
+        path = os.path.join(root or "/", "data", "manifest")
+        with open(path, "w") as f:
+            json.dump(self.dict(), f, indent=1)
+
+class SystemConfiguration(object):
+    def __init__(self, *args, **kwargs):
+        self._package_dir = None
+        self._servers = []
+
+    def SetPackageDir(self, path):
+        self._package_dir = path
+    def SystemManifest(self):
+        return None
+    def AddUpdateServer(self, server):
+        self._servers.append(server)
+    def SetUpdateServer(self, name, save=False):
+        pass
+    def UpdateServerURL(self):
+        return "https://update.example.com/simulated"
+    def PackageDB(self, root=None, create=True):
+        return PackageDB(root, create)
+    def FindLatestManifest(self, train=None, require_signature=False):
+        return Manifest()
+
+    def FindPackageFile(self, package, upgrade_from=None, handler=None, save_dir=None,
+                        pkg_type=None, **kwargs):
+        """
+        "Download" package to save_dir, and return it open.
+        """
+        hardware = Current()
+        save_dir = save_dir or self._package_dir
+        path = os.path.join(save_dir, package.FileName())
+        if os.path.exists(path):
+            digest = hashlib.sha256()
+            with open(path, "rb") as f:
+                digest.update(f.read())
+            if digest.hexdigest() == package.Checksum():
+                return open(path, "rb")
+        data = hardware.package_data(package.Name(), package.Version())
+        url = "{}/Packages/{}".format(self.UpdateServerURL(), package.FileName())
+        hardware.download(len(data), handler=handler, path=path, url=url)
+        tmp_path = path + ".part"
+        with open(tmp_path, "wb") as f:
+            f.write(data)
+        os.rename(tmp_path, path)
+        if hashlib.sha256(data).hexdigest() != package.Checksum():
+            raise ChecksumFailException("Checksum mismatch for {}".format(package.Name()))
+        return open(path, "rb")
+
+class PackageDB(object):
+    """
+    The installed packages in a root, as name -> version (in JSON,
+    rather than freenasOS's sqlite database).
+    """
+    def __init__(self, root, create=True):
+        self._path = os.path.join(root or "/", "data", "pkgdb", "simulated.json")
+        self._root = root or "/"
+
+    def _load(self):
+        try:
+            with open(self._path, "r") as f:
+                return json.load(f)
+        except (IOError, OSError, ValueError):
+            return {}
+
+    def _save(self, packages):
+        os.makedirs(os.path.dirname(self._path), exist_ok=True)
+        with open(self._path, "w") as f:
+            json.dump(packages, f)
+
+    def FindPackage(self, name):
+        packages = self._load()
+        if name in packages:
+            return { name : packages[name] }
+        return None
+
+    def AddPackage(self, name, version):
+        packages = self._load()
+        packages[name] = version
+        self._save(packages)
+
+    def RemovePackageContents(self, name, failDirectoryRemoval=False):
+        packages = self._load()
+        if name not in packages:
+            return False
+        shutil.rmtree(os.path.join(self._root, "usr", "local", "share", name), ignore_errors=True)
+        del packages[name]
+        self._save(packages)
+        return True
+
+class UpdateServer(object):
+    def __init__(self, name, url, signing=False):
+        self.name = name
+        self.url = url
+        self.signature_required = signing
+
+class Installer(object):
+    def __init__(self, manifest=None, root=None, config=None):
+        self._manifest = manifest
+        self._root = root
+        self._config = config
+        self._packages = []
+        self.trampoline = True
+
+    def GetPackages(self, pkgList=None):
+        packages = pkgList if pkgList is not None else self._manifest.Packages()
+        package_dir = self._config._package_dir
+        for pkg in packages:
+            if not os.path.exists(os.path.join(package_dir, pkg.FileName())):
+                return False
+        self._packages = list(packages)
+        return True
+
+    def InstallPackages(self, progressFunc=None, handler=None):
+        hardware = Current()
+        names = [pkg.Name() for pkg in self._packages]
+        pool = hardware.boot_pool()
+        for (index, pkg) in enumerate(self._packages):
+            if handler:
+                handler(index + 1, pkg.Name(), names)
+            with open(os.path.join(self._config._package_dir, pkg.FileName()), "rb") as f:
+                data = f.read()
+            if pkg.Name() == "base-os" or not os.path.exists(os.path.join(self._root, "etc", "version")):
+                hardware.populate_base(self._root)
+            directory = os.path.join(self._root, "usr", "local", "share", pkg.Name())
+            # An upgrade replaces the old version's files
+            shutil.rmtree(directory, ignore_errors=True)
+            os.makedirs(directory)
+            chunk = max(1, (len(data) + FILES_PER_PACKAGE - 1) // FILES_PER_PACKAGE)
+            for count in range(FILES_PER_PACKAGE):
+                path = os.path.join(directory, "file{}".format(count))
+                piece = data[count * chunk:(count + 1) * chunk]
+                with open(path, "wb") as f:
+                    f.write(piece)
+                if pool:
+                    pool.write(len(piece))
+                if progressFunc:
+                    progressFunc(total=FILES_PER_PACKAGE, index=count + 1, name=path)
+            PackageDB(self._root).AddPackage(pkg.Name(), pkg.Version())
+            if progressFunc:
+                progressFunc(done=True)
+        return True
+
+#
+# The hardware itself
+#
+
+class Hardware(object):
+    """
+    The simulated machine:  disks, pools, mounts, sysctls, packages,
+    and the network.
+    """
+    def __init__(self, disks=DEFAULT_DISKS, disk_size=DEFAULT_DISK_SIZE,
+                 sectorsize=512, stripesize=4096,
+                 latency=DEFAULT_LATENCY, throughput=DEFAULT_THROUGHPUT,
+                 packages=DEFAULT_PACKAGES, package_size=DEFAULT_PACKAGE_SIZE,
+                 network_latency=DEFAULT_NETWORK_LATENCY,
+                 network_throughput=DEFAULT_NETWORK_THROUGHPUT,
+                 command_latency=0.002, zfs_latency=0.001,
+                 memory=16 * 1024 * 1024 * 1024,
+                 select=None, directory=None, seed=0):
+        self.lock = threading.RLock()
+        self.root = tempfile.mkdtemp(prefix="installer-sim.", dir=directory)
+        self.dataset_dir = os.path.join(self.root, "datasets")
+        self.package_dir = os.path.join(self.root, "packages")
+        for directory in [self.dataset_dir, self.package_dir, os.path.join(self.root, "disks")]:
+            os.makedirs(directory)
+        self.command_latency = command_latency
+        self.zfs_latency = zfs_latency
+        self.network_latency = network_latency
+        self.network_throughput = network_throughput
+        self.select = select
+        self.train = "FreeNAS-Simulated"
+        self.sequence = "1"
+        self.geom_classes = None
+        self.pools = []
+        self.mounts = {}
+        self.mounted_datasets = {}
+        self.sysctls = {
+            "hw.physmem" : memory,
+            "debug.boothowto" : 0,
+            "kern.geom.debugflags" : 0,
+            "kern.geom.label.disk_ident.enable" : 1,
+            "vfs.zfs.min_auto_ashift" : 9,
+        }
+        self._counters = collections.Counter()
+        self._network_lock = threading.Lock()
+        self.devices = []
+        for index in range(disks):
+            name = "ada{}".format(index)
+            self.devices.append(Device(name, os.path.join(self.root, "disks", name),
+                                       ParseSize(_PerDevice(disk_size, index)),
+                                       sectorsize=_PerDevice(sectorsize, index),
+                                       stripesize=_PerDevice(stripesize, index),
+                                       latency=_PerDevice(latency, index),
+                                       throughput=ParseSize(_PerDevice(throughput, index))))
+        self._seed = seed
+        self._package_size = ParseSize(package_size)
+        self.packages = []
+        for index in range(packages):
+            name = "base-os" if index == 0 else "package-{:04d}".format(index)
+            data = self.package_data(name)
+            self.packages.append(Package(name, "1.0", len(data), hashlib.sha256(data).hexdigest()))
+
+    def __repr__(self):
+        return "<Hardware {} disks, {} packages in {}>".format(len(self.devices), len(self.packages), self.root)
+
+    def count(self, name, amount=1):
+        with self.lock:
+            self._counters[name] += amount
+
+    def latency_for_scan(self):
+        # geom tastes every disk
+        return sum(device.latency for device in self.devices)
+
+    def package_data(self, name, version="1.0"):
+        """
+        The contents of a package:  half random (incompressible),
+        half text (compressible), the same every time.
+        """
+        size = self._package_size
+        if version == "1.0":
+            rng = random.Random("{}:{}".format(self._seed, name))
+        else:
+            rng = random.Random("{}:{}:{}".format(self._seed, name, version))
+        half = size // 2
+        text = ("{} ".format(name) * (1 + (size - half) // (len(name) + 1))).encode("ascii")
+        return rng.getrandbits(8 * half).to_bytes(half, "little") + text[:size - half]
+
+    def release(self, changed=1, added=0, removed=0):
+        """
+        Make a new release of the train (a new sequence), with new
+        versions of the last changed packages, added new packages, and
+        removed packages dropped (from the end).  Manifests created
+        after this are for the new release.  Returns the names of the
+        packages that changed or were added.
+        """
+        with self.lock:
+            self.sequence = str(int(self.sequence) + 1)
+            packages = list(self.packages)
+            if removed:
+                packages = packages[:max(1, len(packages) - removed)]
+            names = []
+            for index in range(max(0, len(packages) - changed), len(packages)):
+                pkg = packages[index]
+                version = "1.{}".format(self.sequence)
+                data = self.package_data(pkg.Name(), version)
+                packages[index] = Package(pkg.Name(), version, len(data), hashlib.sha256(data).hexdigest())
+                names.append(pkg.Name())
+            for index in range(added):
+                name = "package-{}-{:04d}".format(self.sequence, index)
+                version = "1.{}".format(self.sequence)
+                data = self.package_data(name, version)
+                packages.append(Package(name, version, len(data), hashlib.sha256(data).hexdigest()))
+                names.append(name)
+            self.packages = packages
+        return names
+
+    def download(self, nbytes, handler=None, path=None, url=None):
+        """
+        Charge the network for nbytes, calling handler as freenasOS would.
+        """
+        _Sleep(self.network_latency)
+        chunk = max(1, nbytes // 4)
+        done = 0
+        start = time.monotonic()
+        while done < nbytes:
+            step = min(chunk, nbytes - done)
+            _Sleep(float(step) / self.network_throughput)
+            done += step
+            if handler:
+                elapsed = max(time.monotonic() - start, 1e-6)
+                handler(path, url, size=nbytes, progress=int(done * 100 / nbytes),
+                        download_rate=int(done / elapsed))
+        self.count("downloads")
+        self.count("bytes_downloaded", nbytes)
+
+    def device(self, name):
+        for device in self.devices:
+            if device.name == name:
+                return device
+        return None
+
+    def device_for_path(self, path):
+        """
+        Return the Device for a path like /dev/ada0p2, if the partition exists.
+        """
+        match = re.match(r'^(?:/dev/)?(.+?)p(\d+)$', path or "")
+        if match:
+            device = self.device(match.group(1))
+            if device and device.partitions and int(match.group(2)) in device.partitions:
+                return device
+            return None
+        return self.device((path or "")[5:] if (path or "").startswith("/dev/") else path)
+
+    def boot_pool(self):
+        with self.lock:
+            for pool in self.pools:
+                if pool.imported:
+                    return pool
+        return None
+
+    def populate_base(self, root):
+        """
+        The files the installer expects the base-os package to provide.
+        """
+        files = {
+            "usr/local/sbin/beadm" : "#!/bin/sh\nROOTFS=freenas-boot/ROOT/default\n",
+            "conf/base/etc/local/grub.d/10_ktrueos" : "#!/bin/sh\nROOTFS=freenas-boot/ROOT/default\n",
+            "conf/base/etc/local/default/grub" : "GRUB_TERMINAL_OUTPUT=console\n",
+            "boot/loader.conf" : 'kernel="kernel"\nmodule_path="/boot/kernel"\n',
+            "etc/mtree/BSD.var.dist" : "/set type=dir\n.\n..\n",
+            "conf/default/etc/fstab" : "",
+            "conf/base/etc/fstab" : "",
+            "etc/version" : "{}-{}\n".format(self.train, self.sequence),
+        }
+        for directory in ["data", "var", "etc", "dev", "boot/grub", "conf/base/etc"]:
+            os.makedirs(os.path.join(root, directory), exist_ok=True)
+        for (path, contents) in files.items():
+            full_path = os.path.join(root, path)
+            os.makedirs(os.path.dirname(full_path), exist_ok=True)
+            with open(full_path, "w") as f:
+                f.write(contents)
+
+    #
+    # Commands
+    #
+
+    def _partition(self, args):
+        device = self.device(args[-1]) if args else None
+        if device is None:
+            raise self._command_error(1, "gpart: No such geom: {}".format(args[-1] if args else ""))
+        return device
+
+    def _command_error(self, code, message):
+        from .Utils import RunCommandException
+        return RunCommandException(code=code, command="", message=message)
+
+    def _cmd_gpart(self, args, chroot):
+        verb = args[0] if args else ""
+        options = {}
+        rest = args[1:]
+        index = 0
+        while index < len(rest) - 1:
+            if rest[index].startswith("-"):
+                options[rest[index]] = rest[index + 1]
+                index += 2
+            else:
+                index += 1
+        if verb == "destroy":
+            device = self._partition(args)
+            if device.partitions is None:
+                raise self._command_error(1, "gpart: arg0 '{}': Invalid argument".format(device.name))
+            device.write(0, _GPT_BYTES)
+            device.partitions = None
+        elif verb == "create":
+            device = self._partition(args)
+            if device.partitions is not None:
+                raise self._command_error(1, "gpart: geom '{}': File exists".format(device.name))
+            device.write(0, _GPT_BYTES)
+            device.write(device.size - _GPT_BYTES, _GPT_BYTES)
+            device.partitions = {}
+        elif verb == "add":
+            device = self._partition(args)
+            if device.partitions is None:
+                raise self._command_error(1, "gpart: No such geom: {}".format(device.name))
+            from .Utils import ParseSize
+            part_index = int(options.get("-i", len(device.partitions) + 1))
+            if part_index in device.partitions:
+                raise self._command_error(1, "gpart: index '{}': File exists".format(part_index))
+            if "-b" in options:
+                offset = int(options["-b"]) * device.sectorsize
+            else:
+                offset = _GPT_BYTES + 6 * 512
+                for entry in device.partitions.values():
+                    offset = max(offset, entry["offset"] + entry["length"])
+            if "-s" in options:
+                length = ParseSize(options["-s"])
+                if options["-s"][-1].isdigit():
+                    length *= device.sectorsize
+            else:
+                length = device.size - _GPT_BYTES - offset
+            if offset + length > device.size - _GPT_BYTES:
+                raise self._command_error(1, "gpart: autofill: No space left on device")
+            device.write(0, _GPT_BYTES)
+            device.partitions[part_index] = { "type" : options.get("-t", "freebsd"),
+                                              "offset" : offset, "length" : length,
+                                              "label" : options.get("-l", None) }
+            return "{}p{} added".format(device.name, part_index)
+        return ""
+
+    def _cmd_newfs_msdos(self, args, chroot):
+        device = self.device_for_path(args[-1])
+        if device is None:
+            raise self._command_error(1, "newfs_msdos: {}: No such file or directory".format(args[-1]))
+        device.write(0, _NEWFS_BYTES)
+        return ""
+
+    def _cmd_grub_install(self, args, chroot):
+        device = self.device_for_path(args[-1])
+        if device is None:
+            raise self._command_error(1, "grub-install: error: cannot find {}".format(args[-1]))
+        device.write(0, _GRUB_BYTES)
+        return "Installation finished. No error reported."
+
+    def _cmd_grub_mkconfig(self, args, chroot):
+        pool = self.boot_pool()
+        if pool:
+            pool.write(64 * 1024)
+        return ""
+
+    def _cmd_dmidecode(self, args, chroot):
+        return "Simulated"
+
+    def open_disk(self, name):
+        """
+        Stands in for Probe.OpenDisk.
+        """
+        device = self.device(name)
+        if device is None:
+            raise OSError(errno.ENOENT, "No such device /dev/{}".format(name))
+        return DiskReader(device)
+
+    def open_connection(self, scheme, host, port, timeout):
+        """
+        Stands in for Download.OpenConnection.
+        """
+        return HTTPConnection(self, host)
+
+    def run_command(self, *args, **kwargs):
+        """
+        Stands in for Utils.RunCommand:  the same logging, tracing,
+        and statistics, but the commands are simulated.
+        """
+        from . import Utils
+        argv = [str(x) for x in args]
+        command_line = " ".join(argv)
+        program = os.path.basename(argv[0])
+        chroot = kwargs.get("chroot", None)
+        Utils.LogIt("RunCommand(\"{}\")".format(command_line))
+        handler = getattr(self, "_cmd_" + program.replace("-", "_"), None)
+        code = 0
+        output = ""
+        with Trace.Span(program, chroot=chroot):
+            start = time.monotonic()
+            try:
+                _Sleep(self.command_latency)
+                if handler:
+                    output = handler(argv[1:], chroot) or ""
+            except Utils.RunCommandException as e:
+                e.command = command_line
+                code = e.code
+                raise
+            finally:
+                elapsed = time.monotonic() - start
+                Utils.command_stats.record(Utils.CommandRecord(command_line, elapsed, code,
+                                                               len(output), 0, False))
+                self.count("commands")
+        return output
+
+    #
+    # Installing it
+    #
+
+    def modules(self):
+        """
+        Return a dictionary of module name -> module, for the stand-ins.
+        """
+        def Module(name, **attrs):
+            module = types.ModuleType(name)
+            module.__dict__.update(attrs)
+            return module
+        geom = Module("bsd.geom", scan=_geom_scan, class_by_name=_geom_class_by_name,
+                      geom_by_name=_geom_geom_by_name)
+        sysctl = Module("bsd.sysctl", sysctlbyname=_sysctlbyname)
+        dialog = Module("bsd.dialog", DialogEscape=DialogEscape, MessageBox=MessageBox,
+                        Gauge=Gauge, YesNo=YesNo, CheckList=CheckList, Form=Form, Menu=Menu,
+                        ListItem=ListItem, FormLabel=FormLabel, FormInput=FormInput,
+                        FormItem=FormItem)
+        copy = Module("bsd.copy", copytree=_copytree)
+        bsd = Module("bsd", nmount=_nmount, unmount=_unmount, getmntinfo=_getmntinfo,
+                     MountFlags=MountFlags, geom=geom, sysctl=sysctl, dialog=dialog, copy=copy)
+        bsd.__path__ = []
+        libzfs = Module("libzfs", ZFS=ZFS, ZFSVdev=ZFSVdev, ZFSException=ZFSException,
+                        ZFSPool=ZFSPool, ZFSDataset=ZFSDataset, ZFSProperty=ZFSProperty)
+        exceptions = Module("freenasOS.Exceptions", UpdateException=UpdateException,
+                            ChecksumFailException=ChecksumFailException,
+                            UpdateInvalidUpdateException=UpdateInvalidUpdateException,
+                            UpdatePackageNotFound=UpdatePackageNotFound)
+        update = Module("freenasOS.Update", PkgFileAny=0, PkgFileFullOnly=1, PkgFileDeltaOnly=2)
+        package = Module("freenasOS.Package", Package=Package)
+        manifest = Module("freenasOS.Manifest", Manifest=Manifest, VALIDATE_INSTALL="install",
+                          VALIDATE_UPDATE="update")
+        configuration = Module("freenasOS.Configuration", SystemConfiguration=SystemConfiguration,
+                               UpdateServer=UpdateServer)
+        installer = Module("freenasOS.Installer", Installer=Installer)
+        freenasOS = Module("freenasOS", Exceptions=exceptions, Update=update, Package=package,
+                           Manifest=manifest, Configuration=configuration, Installer=installer)
+        freenasOS.__path__ = []
+        return {
+            "bsd" : bsd, "bsd.geom" : geom, "bsd.sysctl" : sysctl, "bsd.dialog" : dialog,
+            "bsd.copy" : copy, "libzfs" : libzfs, "freenasOS" : freenasOS,
+            "freenasOS.Exceptions" : exceptions, "freenasOS.Update" : update,
+            "freenasOS.Package" : package, "freenasOS.Manifest" : manifest,
+            "freenasOS.Configuration" : configuration, "freenasOS.Installer" : installer,
+        }
+
+    def install(self):
+        """
+        Make this the current hardware, put the stand-in modules in
+        sys.modules (the first time), import the installer modules,
+        and replace their RunCommand (and Probe's OpenDisk, and
+        Download's OpenConnection).
+        """
+        global _hardware
+        _hardware = self
+        if not getattr(sys.modules.get("libzfs", None), "_simulated", False):
+            if "ixsystems.installer.Utils" in sys.modules:
+                raise RuntimeError("Simulator must be installed before the installer modules are imported")
+            for (name, module) in self.modules().items():
+                module._simulated = True
+                sys.modules[name] = module
+        from . import Utils, Install, Menu, Probe, Download
+        for module in (Utils, Install, Menu):
+            module.RunCommand = self.run_command
+        Probe.OpenDisk = self.open_disk
+        Download.OpenConnection = self.open_connection
+        Utils.RescanTopology()
+        Menu.disk_inventory.invalidate()
+        return self
+
+    def stats(self):
+        with self.lock:
+            counters = dict(self._counters)
+        devices = [device.stats() for device in self.devices]
+        for key in ["reads", "writes", "bytes_read", "bytes_written"]:
+            counters["disk_" + key] = sum(x[key] for x in devices)
+        return counters
+
+    def cleanup(self):
+        global _hardware
+        shutil.rmtree(self.root, ignore_errors=True)
+        if _hardware is self:
+            _hardware = None
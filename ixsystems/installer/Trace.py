@@ -0,0 +1,245 @@
+"""
+A lightweight span tracer for the installer.
+
+	with Trace.Span("FormatDisks", disks=2):
+	    ...
+	with Trace.Operator("Boot method"):
+	    answer = yesno.result
+
+Spans nest, use the monotonic clock, and record the thread they ran
+on.  Operator spans (time spent waiting on a person in a dialog) are
+kept in their own category, so they can be separated from machine
+time.  Save() writes the spans in the Chrome trace event format,
+which chrome://tracing, Perfetto, and speedscope can load.
+
+This module must not import anything else from the installer, since
+Utils uses it.
+"""
+from __future__ import print_function
+import os
+import json
+import time
+import functools
+import threading
+
+MACHINE = "machine"
+OPERATOR = "operator"
+
+class TraceSpan(object):
+    """
+    One timed region; use it as a context manager.
+    """
+    __slots__ = ("_tracer", "name", "category", "args", "start", "end", "tid", "depth")
+
+    def __init__(self, tracer, name, category=MACHINE, args=None):
+        self._tracer = tracer
+        self.name = name
+        self.category = category
+        self.args = args or {}
+        self.start = None
+        self.end = None
+        self.tid = None
+        self.depth = 0
+
+    def __enter__(self):
+        self._tracer._push(self)
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is not None:
+            self.args["error"] = "{}: {}".format(exc_type.__name__, str(exc_value))
+        self._tracer._pop(self)
+        return False
+
+    @property
+    def duration(self):
+        if self.start is None or self.end is None:
+            return None
+        return self.end - self.start
+
+class Tracer(object):
+    """
+    Collects spans.  There is normally just the one, used by the
+    module-level functions.
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self._epoch = time.monotonic()
+            self._wall_epoch = time.time()
+            self._spans = []
+            self._threads = {}
+
+    def _stack(self):
+        stack = getattr(self._local, "stack", None)
+        if stack is None:
+            stack = self._local.stack = []
+        return stack
+
+    def _push(self, span):
+        stack = self._stack()
+        span.depth = len(stack)
+        span.tid = threading.current_thread().ident
+        stack.append(span)
+        span.start = time.monotonic()
+
+    def _pop(self, span):
+        span.end = time.monotonic()
+        stack = self._stack()
+        if span in stack:
+            # Anything opened inside this span and not closed ends with it
+            while stack and stack.pop() is not span:
+                pass
+        with self._lock:
+            self._spans.append(span)
+            if span.tid not in self._threads:
+                self._threads[span.tid] = threading.current_thread().name
+
+    def span(self, name, category=MACHINE, **args):
+        return TraceSpan(self, name, category, args)
+
+    def spans(self):
+        with self._lock:
+            return list(self._spans)
+
+    def _parents(self, spans):
+        # Map each span (by id) to the span it's directly inside, on
+        # its own thread, or None.
+        parents = {}
+        by_thread = {}
+        for span in spans:
+            by_thread.setdefault(span.tid, []).append(span)
+        for thread_spans in by_thread.values():
+            stack = []
+            for span in sorted(thread_spans, key=lambda x: (x.start, x.depth)):
+                while stack and stack[-1].depth >= span.depth:
+                    stack.pop()
+                parents[id(span)] = stack[-1] if stack else None
+                stack.append(span)
+        return parents
+
+    def summary(self, skip=()):
+        """
+        Return a dictionary with the total wall time, operator time, and
+        machine time (wall time less operator time) in seconds, and the
+        total time for each top-level (depth 0) machine span name.  If
+        skip (span names) is given, those spans are wrappers rather than
+        phases:  the phases are then the machine spans directly inside
+        them, or inside wrappers nested in them, on the wrappers' thread.
+        """
+        spans = self.spans()
+        now = time.monotonic()
+        operator = sum(x.duration for x in spans if x.category == OPERATOR)
+        if skip:
+            parents = self._parents(spans)
+            def IsPhase(span):
+                parent = parents[id(span)]
+                if span.name in skip or parent is None:
+                    return False
+                while parent is not None:
+                    if parent.name not in skip:
+                        return False
+                    parent = parents[id(parent)]
+                return True
+        else:
+            def IsPhase(span):
+                return span.depth == 0
+        phases = {}
+        for span in spans:
+            if span.category == MACHINE and IsPhase(span):
+                phases[span.name] = phases.get(span.name, 0) + span.duration
+        return {
+            "wall_seconds" : now - self._epoch,
+            "operator_seconds" : operator,
+            "machine_seconds" : (now - self._epoch) - operator,
+            "phases" : phases,
+        }
+
+    def events(self):
+        """
+        Return the spans as a list of Chrome trace events.
+        """
+        pid = os.getpid()
+        events = []
+        with self._lock:
+            threads = dict(self._threads)
+        for (tid, name) in threads.items():
+            events.append({ "ph" : "M", "name" : "thread_name", "pid" : pid, "tid" : tid,
+                            "args" : { "name" : name } })
+        for span in sorted(self.spans(), key=lambda x: (x.start, -x.end)):
+            events.append({
+                "ph" : "X",
+                "name" : span.name,
+                "cat" : span.category,
+                "pid" : pid,
+                "tid" : span.tid,
+                "ts" : int((span.start - self._epoch) * 1000000),
+                "dur" : int((span.end - span.start) * 1000000),
+                "args" : { k : str(v) for (k, v) in span.args.items() },
+            })
+        return events
+
+    def save(self, path, skip=()):
+        data = {
+            "traceEvents" : self.events(),
+            "displayTimeUnit" : "ms",
+            "otherData" : {
+                "started" : time.strftime("%Y-%m-%dT%H:%M:%S", time.localtime(self._wall_epoch)),
+                "summary" : self.summary(skip),
+            },
+        }
+        tmp_path = path + ".tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(data, f)
+        os.rename(tmp_path, path)
+        return path
+
+_tracer = Tracer()
+
+def GetTracer():
+    return _tracer
+
+def Span(name, **args):
+    """
+    Return a context manager timing a machine-time span.
+    """
+    return _tracer.span(name, MACHINE, **args)
+
+def Operator(name, **args):
+    """
+    Return a context manager timing a span spent waiting on the operator.
+    """
+    return _tracer.span(name, OPERATOR, **args)
+
+def Traced(name=None, category=MACHINE):
+    """
+    Decorator to run a function inside a span (named after the function
+    unless name is given).
+    """
+    def decorator(func):
+        span_name = name or func.__name__
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with _tracer.span(span_name, category):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+def Reset():
+    _tracer.reset()
+
+def Summary(skip=()):
+    return _tracer.summary(skip)
+
+def Save(path=None, skip=()):
+    """
+    Write the trace file, by default /tmp/install-trace-<time>.json,
+    with its summary (skip is passed to Summary()).  Returns the path.
+    """
+    if path is None:
+        path = time.strftime("/tmp/install-trace-%Y%m%d-%H%M%S.json")
+    return _tracer.save(path, skip)
@@ -0,0 +1,461 @@
+"""
+A parallel tree copier, used for the /data prototype and for
+migrating configuration on upgrades.
+
+	stats = TreeCopy.CopyTree(src, dst, progress=Report)
+
+All of the directories are created first, in one pass on the calling
+thread; then the files are copied by a pool of workers, largest
+first.  Each file is copied in the kernel when possible
+(copy_file_range(2), then sendfile(2), then plain reads and writes),
+and only its data regions are copied (found with SEEK_DATA and
+SEEK_HOLE), so sparse files -- such as sqlite databases -- stay
+sparse.  Ownership (when running as root), modes, times, and file
+flags are preserved, as are symbolic links and hard links within the
+tree.  Directory modes and times are set last, so the copying doesn't
+change them.
+
+progress, if given, is called as progress(done_bytes, total_bytes)
+at most once per interval, and once at the end.
+
+Like Trace and Logger, this must not import anything else from the
+installer.
+"""
+from __future__ import print_function
+import os
+import stat
+import time
+import errno
+import threading
+import concurrent.futures
+
+from . import Logger
+from . import Trace
+
+DEFAULT_WORKERS = 4
+DEFAULT_INTERVAL = 1.0
+# Largest single read/write (or in-kernel copy) request
+CHUNK_SIZE = 8 * 1024 * 1024
+# Files smaller than this aren't checked for holes, and are handed
+# to the workers in batches of up to BATCH_FILES files or BATCH_BYTES bytes.
+SMALL_FILE = 128 * 1024
+BATCH_FILES = 128
+BATCH_BYTES = 8 * 1024 * 1024
+
+# errnos meaning "this copy method can't be used here; try the next one"
+_FALLBACK_ERRNOS = set(getattr(errno, name) for name in ["ENOSYS", "EXDEV", "EINVAL", "ENOTSOCK",
+                                                        "EOPNOTSUPP", "ENOTSUP", "EBADF"]
+                       if hasattr(errno, name))
+
+# Copy methods that have failed with ENOSYS are not tried again
+_unavailable = set()
+
+class CopyError(RuntimeError):
+    """
+    Raised when part of a tree couldn't be copied.  path is the
+    source path; errors is the list of (path, exception) for every
+    failure.
+    """
+    def __init__(self, path, message, errors=None):
+        super(CopyError, self).__init__(message)
+        self.path = path
+        self.message = message
+        self.errors = errors or []
+
+def _CopyFileRange(src_fd, dst_fd, offset, length):
+    copied = 0
+    while copied < length:
+        count = os.copy_file_range(src_fd, dst_fd, min(CHUNK_SIZE, length - copied),
+                                   offset + copied, offset + copied)
+        if count == 0:
+            break
+        copied += count
+    return copied
+
+def _SendFile(src_fd, dst_fd, offset, length):
+    # sendfile() writes at the destination's file offset
+    os.lseek(dst_fd, offset, os.SEEK_SET)
+    copied = 0
+    while copied < length:
+        count = os.sendfile(dst_fd, src_fd, offset + copied, min(CHUNK_SIZE, length - copied))
+        if count == 0:
+            break
+        copied += count
+    return copied
+
+def _ReadWrite(src_fd, dst_fd, offset, length):
+    copied = 0
+    while copied < length:
+        data = os.pread(src_fd, min(CHUNK_SIZE, length - copied), offset + copied)
+        if not data:
+            break
+        view = memoryview(data)
+        while view:
+            count = os.pwrite(dst_fd, view, offset + copied)
+            view = view[count:]
+            copied += count
+    return copied
+
+_methods = [(name, func) for (name, func, needs) in [
+    ("copy_file_range", _CopyFileRange, "copy_file_range"),
+    ("sendfile", _SendFile, "sendfile"),
+    ("read", _ReadWrite, "pread"),
+] if hasattr(os, needs)]
+
+def CopyRange(src_fd, dst_fd, offset, length):
+    """
+    Copy length bytes at offset from src_fd to the same offset in
+    dst_fd, using the best method that works.  Returns (bytes, method).
+    """
+    done = 0
+    method = None
+    for (name, func) in _methods:
+        if name in _unavailable:
+            continue
+        try:
+            done += func(src_fd, dst_fd, offset + done, length - done)
+            method = name
+        except OSError as e:
+            if e.errno not in _FALLBACK_ERRNOS:
+                raise
+            if e.errno == errno.ENOSYS:
+                _unavailable.add(name)
+            continue
+        if done >= length:
+            break
+    return (done, method)
+
+def DataSegments(fd, size):
+    """
+    Yield (offset, length) for each region of the file that holds data.
+    If the file system can't say, the whole file is one region.
+    """
+    if size == 0:
+        return
+    if not hasattr(os, "SEEK_DATA"):
+        yield (0, size)
+        return
+    offset = 0
+    while offset < size:
+        try:
+            start = os.lseek(fd, offset, os.SEEK_DATA)
+        except OSError as e:
+            if e.errno == errno.ENXIO:
+                # Nothing but a hole from here on
+                return
+            if offset == 0:
+                yield (0, size)
+                return
+            raise
+        if start >= size:
+            return
+        end = os.lseek(fd, start, os.SEEK_HOLE)
+        end = min(end, size)
+        yield (start, end - start)
+        offset = end
+
+def _CopyFileMetadata(fd, path, st):
+    # The same as _CopyMetadata, but using the open file
+    if os.geteuid() == 0:
+        try:
+            os.fchown(fd, st.st_uid, st.st_gid)
+        except OSError as e:
+            Logger.Warning("copy", "Could not set owner of {}: {}", path, str(e))
+    os.fchmod(fd, stat.S_IMODE(st.st_mode))
+    os.utime(fd, ns=(st.st_atime_ns, st.st_mtime_ns))
+    flags = getattr(st, "st_flags", 0)
+    if flags and hasattr(os, "chflags"):
+        try:
+            os.chflags(path, flags)
+        except OSError as e:
+            Logger.Warning("copy", "Could not set flags on {}: {}", path, str(e))
+
+def _CopyMetadata(path, st, is_link=False):
+    if os.geteuid() == 0:
+        try:
+            if is_link:
+                os.lchown(path, st.st_uid, st.st_gid)
+            else:
+                os.chown(path, st.st_uid, st.st_gid)
+        except OSError as e:
+            Logger.Warning("copy", "Could not set owner of {}: {}", path, str(e))
+    if is_link:
+        # Most systems can't set a link's mode or times; lchmod is FreeBSD-only
+        if hasattr(os, "lchmod"):
+            os.lchmod(path, stat.S_IMODE(st.st_mode))
+        if os.utime in os.supports_follow_symlinks:
+            os.utime(path, ns=(st.st_atime_ns, st.st_mtime_ns), follow_symlinks=False)
+    else:
+        os.chmod(path, stat.S_IMODE(st.st_mode))
+        os.utime(path, ns=(st.st_atime_ns, st.st_mtime_ns))
+    flags = getattr(st, "st_flags", 0)
+    if flags and hasattr(os, "chflags"):
+        try:
+            os.chflags(path, flags, follow_symlinks=not is_link)
+        except OSError as e:
+            Logger.Warning("copy", "Could not set flags on {}: {}", path, str(e))
+
+class CopyProgress(object):
+    """
+    Thread-safe byte count, passed on to a callback no more
+    often than once per interval.
+    """
+    def __init__(self, callback=None, total=0, interval=DEFAULT_INTERVAL):
+        self._callback = callback
+        self._lock = threading.Lock()
+        self._interval = interval
+        self._last = time.monotonic()
+        self.total = total
+        self.done = 0
+
+    def add(self, count):
+        report = False
+        with self._lock:
+            self.done += count
+            now = time.monotonic()
+            if self._callback and now - self._last >= self._interval:
+                self._last = now
+                report = True
+            done = self.done
+        if report:
+            self._callback(done, self.total)
+
+    def finish(self):
+        if self._callback:
+            self._callback(self.done, self.total)
+
+class TreeCopier(object):
+    """
+    Copies a file, or a directory tree, from src to dst, merging with
+    (and overwriting files in) anything already at dst.
+    """
+    def __init__(self, workers=DEFAULT_WORKERS, progress=None, interval=DEFAULT_INTERVAL):
+        self._workers = max(1, workers)
+        self._progress_callback = progress
+        self._interval = interval
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self._stats = {
+                "files" : 0,
+                "directories" : 0,
+                "symlinks" : 0,
+                "hardlinks" : 0,
+                "bytes" : 0,
+                "hole_bytes" : 0,
+                "seconds" : 0.0,
+                "methods" : {},
+            }
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._stats)
+            stats["methods"] = dict(self._stats["methods"])
+            return stats
+
+    def _count(self, key, value=1):
+        with self._lock:
+            self._stats[key] += value
+
+    def _scan(self, src, dst):
+        """
+        Walk src, returning (directories, files, symlinks, hardlinks), each
+        a list of (src, dst, stat); hardlinks are (dst of the first link, dst).
+        Directories are in pre-order, so parents come before children.
+        """
+        directories = []
+        files = []
+        symlinks = []
+        hardlinks = []
+        inodes = {}
+        pending = [(src, dst)]
+        while pending:
+            (src_dir, dst_dir) = pending.pop()
+            directories.append((src_dir, dst_dir, os.stat(src_dir)))
+            subdirs = []
+            with os.scandir(src_dir) as entries:
+                for entry in entries:
+                    src_path = entry.path
+                    dst_path = os.path.join(dst_dir, entry.name)
+                    st = entry.stat(follow_symlinks=False)
+                    if stat.S_ISDIR(st.st_mode):
+                        subdirs.append((src_path, dst_path))
+                    elif stat.S_ISLNK(st.st_mode):
+                        symlinks.append((src_path, dst_path, st))
+                    elif stat.S_ISREG(st.st_mode):
+                        if st.st_nlink > 1:
+                            key = (st.st_dev, st.st_ino)
+                            if key in inodes:
+                                hardlinks.append((inodes[key], dst_path))
+                                continue
+                            inodes[key] = dst_path
+                        files.append((src_path, dst_path, st))
+                    else:
+                        Logger.Warning("copy", "Skipping special file {}", src_path)
+            # Reversed, so they come off the stack in name order
+            pending.extend(reversed(sorted(subdirs)))
+        return (directories, files, symlinks, hardlinks)
+
+    def _copy_file(self, src, dst, st, progress):
+        src_fd = os.open(src, os.O_RDONLY)
+        try:
+            try:
+                dst_fd = os.open(dst, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+            except FileExistsError:
+                # Replace it, rather than writing through any other links to it
+                os.unlink(dst)
+                dst_fd = os.open(dst, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+            try:
+                copied = 0
+                methods = {}
+                if st.st_size < SMALL_FILE:
+                    segments = [(0, st.st_size)] if st.st_size else []
+                else:
+                    segments = DataSegments(src_fd, st.st_size)
+                for (offset, length) in segments:
+                    (count, method) = CopyRange(src_fd, dst_fd, offset, length)
+                    if count < length:
+                        raise CopyError(src, "{} changed size while being copied".format(src))
+                    copied += count
+                    methods[method] = methods.get(method, 0) + count
+                if copied < st.st_size:
+                    # Leaves any trailing hole as a hole
+                    os.ftruncate(dst_fd, st.st_size)
+                _CopyFileMetadata(dst_fd, dst, st)
+            finally:
+                os.close(dst_fd)
+        finally:
+            os.close(src_fd)
+        with self._lock:
+            self._stats["files"] += 1
+            self._stats["bytes"] += copied
+            self._stats["hole_bytes"] += st.st_size - copied
+            for (method, count) in methods.items():
+                self._stats["methods"][method] = self._stats["methods"].get(method, 0) + count
+        progress.add(st.st_size)
+
+    def _copy_batch(self, batch, progress):
+        # Returns a list of (path, exception) for the files that failed
+        errors = []
+        for (src, dst, st) in batch:
+            try:
+                self._copy_file(src, dst, st, progress)
+            except (OSError, CopyError) as e:
+                errors.append((src, e))
+        return errors
+
+    def _batches(self, files):
+        """
+        Yield lists of files for the workers:  each large file on
+        its own (biggest first, so one large file doesn't finish on its
+        own at the end), then the small files in batches.
+        """
+        files = sorted(files, key=lambda x: x[2].st_size, reverse=True)
+        batch = []
+        batch_bytes = 0
+        for entry in files:
+            size = entry[2].st_size
+            if size >= SMALL_FILE:
+                yield [entry]
+                continue
+            batch.append(entry)
+            batch_bytes += size
+            if len(batch) >= BATCH_FILES or batch_bytes >= BATCH_BYTES:
+                yield batch
+                batch = []
+                batch_bytes = 0
+        if batch:
+            yield batch
+
+    def _copy_link(self, src, dst, st):
+        try:
+            os.unlink(dst)
+        except FileNotFoundError:
+            pass
+        os.symlink(os.readlink(src), dst)
+        _CopyMetadata(dst, st, is_link=True)
+        self._count("symlinks")
+
+    def copy(self, src, dst):
+        """
+        Copy src to dst.  Raises CopyError if anything couldn't be copied
+        (after copying everything else it could).  Returns the stats.
+        """
+        start = time.monotonic()
+        with Trace.Span("CopyTree", src=src, dst=dst):
+            st = os.lstat(src)
+            if stat.S_ISLNK(st.st_mode):
+                self._copy_link(src, dst, st)
+            elif not stat.S_ISDIR(st.st_mode):
+                progress = CopyProgress(self._progress_callback, st.st_size, self._interval)
+                try:
+                    self._copy_file(src, dst, st, progress)
+                except OSError as e:
+                    raise CopyError(src, "Could not copy {}: {}".format(src, str(e)), errors=[(src, e)])
+                progress.finish()
+            else:
+                self._copy_tree(src, dst)
+        self._count("seconds", time.monotonic() - start)
+        stats = self.stats()
+        Logger.Info("copy", "Copied {} -> {}: {} files, {} directories, {} bytes ({} in holes) in {:.2f}s",
+                    src, dst, stats["files"], stats["directories"], stats["bytes"],
+                    stats["hole_bytes"], stats["seconds"])
+        return stats
+
+    def _copy_tree(self, src, dst):
+        (directories, files, symlinks, hardlinks) = self._scan(src, dst)
+        for (_, dst_dir, _) in directories:
+            try:
+                os.mkdir(dst_dir, 0o700)
+            except FileExistsError:
+                if not os.path.isdir(dst_dir):
+                    raise CopyError(dst_dir, "{} exists and is not a directory".format(dst_dir))
+        self._count("directories", len(directories))
+
+        errors = []
+        progress = CopyProgress(self._progress_callback,
+                                sum(x[2].st_size for x in files), self._interval)
+        with concurrent.futures.ThreadPoolExecutor(max_workers=self._workers,
+                                                   thread_name_prefix="TreeCopy") as executor:
+            futures = [executor.submit(self._copy_batch, batch, progress)
+                       for batch in self._batches(files)]
+            for (src_path, dst_path, st) in symlinks:
+                try:
+                    self._copy_link(src_path, dst_path, st)
+                except OSError as e:
+                    errors.append((src_path, e))
+            for future in concurrent.futures.as_completed(futures):
+                errors.extend(future.result())
+        for (first, dst_path) in hardlinks:
+            try:
+                try:
+                    os.unlink(dst_path)
+                except FileNotFoundError:
+                    pass
+                os.link(first, dst_path)
+                self._count("hardlinks")
+            except OSError as e:
+                errors.append((dst_path, e))
+        progress.finish()
+
+        # Deepest first, so setting a directory's times isn't undone by its children
+        for (src_dir, dst_dir, st) in reversed(directories):
+            try:
+                _CopyMetadata(dst_dir, st)
+            except OSError as e:
+                errors.append((src_dir, e))
+
+        if errors:
+            for (path, e) in errors:
+                Logger.Error("copy", "Could not copy {}: {}", path, str(e))
+            raise CopyError(errors[0][0], "Could not copy {} of the files in {}".format(len(errors), src),
+                            errors=errors)
+
+def CopyTree(src, dst, progress=None, workers=DEFAULT_WORKERS, interval=DEFAULT_INTERVAL):
+    """
+    Copy src (a file or a directory tree) to dst; see TreeCopier.
+    Returns the stats.
+    """
+    return TreeCopier(workers=workers, progress=progress, interval=interval).copy(src, dst)
@@ -1,11 +1,19 @@
 from __future__ import print_function
-import os, sys, re
+import os, sys, re, errno
+import signal
+import collections
 import subprocess
 import tempfile
+import threading
+import time
 import bsd.geom as geom
 import bsd.dialog as Dialog
 
+from . import Trace
+from . import Logger
+
 import freenasOS.Exceptions as Exceptions
+import freenasOS.Manifest as Manifest
 from freenasOS.Update import PkgFileFullOnly
 
 _avatar = None
@@ -39,9 +47,13 @@ class RunCommandException(RuntimeError):
 
     def __str__(self):
         return "Command '{}' returned {} due to '{}'".format(self.command, self.code, self.message)
-    def __repr__(sefl):
+    def __repr__(self):
         return self.__str__()
 
+class InstallationError(RuntimeError):
+    def __init__(self, message=""):
+        super(InstallationError, self).__init__(message)
+
 class Partition(object):
     """
     Simple wrapper for partitions.
@@ -90,17 +102,13 @@ class Partition(object):
 def FindMirrors(disk):
     """
     gmirror is stubborn, and we want to find any mirrors that use the given disk.
-    disk is the name, e.g. ada0, not a path or partition.
+    disk is the name, e.g. ada0, not a path or partition (a Disk object is
+    also accepted).  Yields (mirror name, provider name) pairs.
     XXX: Other classes are probably just as stubborn!
     """
-    mirrors = geom.class_by_name("MIRROR")
-    if not mirrors:
-        return
-    for mirror in mirrors.geoms:
-        for geom_entry in mirror.consumers:
-            rn = DiskRealName(geom_entry.provider.geom)
-            if rn == disk:
-                yield (mirror.name, geom_entry.provider.name)
+    name = getattr(disk, "name", disk)
+    for entry in Topology().mirrors(name):
+        yield entry
             
 def SetProject(project="FreeNAS"):
     if _avatar is None:
@@ -118,25 +126,23 @@ def Title():
     return Project() + " Installer"
 
 logfile = None
-def InitLog(output="/tmp/install.log"):
+def InitLog(output="/tmp/install.log", **kwargs):
+    """
+    Start logging to output (a path, appended to, or a file object).
+    Any other arguments are passed to Logger.Init().
+    """
     global logfile
-    if output.__class__ == str:
-        logfile = open(output, "a")
-    else:
-        logfile = output
+    logfile = Logger.Init(output, **kwargs).file
         
-def LogIt(msg, exc_info=False):
-    import traceback
-    if logfile is None:
+def LogIt(msg, exc_info=False, subsystem="installer", level=Logger.INFO):
+    """
+    Log a (pre-formatted) message.  This is a compatible wrapper
+    around the Logger module; new code that logs a lot should use
+    Logger directly, so the formatting is done only if needed.
+    """
+    if Logger.GetLogger() is None:
         InitLog()
-    print(msg, file=logfile)
-    if exc_info:
-        exc = sys.exc_info()
-        if exc:
-            print("Exception {}:".format(str(exc)), file=logfile)
-            for stack in traceback.extract_tb(exc[2]):
-                print("\t{}".format(stack), file=logfile)
-                
+    Logger.Log(level, subsystem, msg, exc_info=exc_info)
 
 def BootPartitionType(diskname):
     """
@@ -162,33 +168,122 @@ def SerialConsole():
     # Either value may be None.  Returns (None, None) if it can't determine
     # the values.
     try:
-        uart = subprocess.check_output(["/bin/kenv", "hw.uart.console"]).rstrip()
+        uart = subprocess.check_output(["/bin/kenv", "hw.uart.console"]).decode('utf-8').rstrip()
     except:
         return (None, None)
-    port_result = re.match(r'io:([0-9a-fx]+)', uart)
+    port_result = re.search(r'io:([0-9a-fx]+)', uart)
     if port_result:
         port = port_result.group(1)
     else:
         port = None
         
-    baud_result = re.match(r'br:([0-9]+)', uart)
+    baud_result = re.search(r'br:([0-9]+)', uart)
     if baud_result:
         br = baud_result.group(1)
     else:
         br = None
     return (port, br)
 
+_console_baud = None
+def ConsoleBaudRate():
+    """
+    Return the serial console's baud rate as an int, or 0 if
+    we aren't on a serial console (or can't tell).  The kenv
+    lookup is only done once.
+    """
+    global _console_baud
+    if _console_baud is None:
+        (port, br) = SerialConsole()
+        try:
+            _console_baud = int(br) if br else 0
+        except ValueError:
+            _console_baud = 0
+    return _console_baud
+
+# Roughly how many bytes of output a dialog gauge redraw takes,
+# and the most of the console's time we want redraws to take.
+_GAUGE_REDRAW_BYTES = 200
+_REDRAW_DUTY = 0.25
+_MIN_QUANTUM = 0.05
+# Log one of every this many per-object progress updates
+DEFAULT_LOG_SAMPLE = 100
+
+def ProgressQuantum(baud=None):
+    """
+    Return the minimum time, in seconds, between progress redraws on a
+    console at the given baud rate (0 or None for a non-serial console).
+    At 9600 baud a gauge redraw takes about 0.2 seconds, so updates are
+    spaced out to keep redraws to a fraction of the console's time.
+    """
+    if not baud:
+        return _MIN_QUANTUM * 2
+    # 10 bits per byte on the wire (start + 8 data + stop)
+    redraw_time = (_GAUGE_REDRAW_BYTES * 10.0) / baud
+    return max(_MIN_QUANTUM, redraw_time / _REDRAW_DUTY)
+
+class ProgressCoalescer(object):
+    """
+    Coalesce progress updates, so a gauge is only redrawn when the
+    integer percentage has changed, and no more often than once per
+    quantum (which by default depends on the console's baud rate).
+    callback is called with the percentage when an update goes out.
+    should_log() can be used to log per-item details at a sampled rate.
+    """
+    def __init__(self, callback, quantum=None, sample=DEFAULT_LOG_SAMPLE):
+        self._callback = callback
+        self._quantum = ProgressQuantum(ConsoleBaudRate()) if quantum is None else quantum
+        self._sample = max(1, sample)
+        self._last_percentage = None
+        self._last_time = 0
+        self._emitted = 0
+        self._suppressed = 0
+
+    @property
+    def quantum(self):
+        return self._quantum
+
+    def update(self, percentage, force=False):
+        """
+        Offer a new percentage.  Returns True if the callback was called.
+        """
+        percentage = int(percentage)
+        now = time.monotonic()
+        if not force:
+            if percentage == self._last_percentage:
+                self._suppressed += 1
+                return False
+            if percentage < 100 and (now - self._last_time) < self._quantum:
+                self._suppressed += 1
+                return False
+        self._last_percentage = percentage
+        self._last_time = now
+        self._emitted += 1
+        self._callback(percentage)
+        return True
+
+    def finish(self):
+        self.update(100, force=True)
+
+    def should_log(self, index, total=None):
+        """
+        Whether the index'th item (of total) should be logged.
+        """
+        return index <= 1 or index == total or (index % self._sample) == 0
+
+    def stats(self):
+        return { "emitted" : self._emitted, "suppressed" : self._suppressed }
+
 def BootMethod():
     try:
-        platform = subprocess.check_output(["/bin/kenv", "grub.platform"]).rstrip()
+        platform = subprocess.check_output(["/bin/kenv", "grub.platform"]).decode("utf-8").rstrip()
         return platform
     except:
         return "pc"
 
-def DiskRealName(x):
+def _GeomRealName(x):
     """
-    Given a geom, attempt to find out it's real name.
-    (E.g., "da4p1" is "da4", "gptid/blach" is "ada18", etc.)
+    Walk the consumer chain of a geom to find the disk underneath it.
+    This is the slow path; it is only used when building a TopologySnapshot.
     """
     try:
         if x.consumer.provider.geom.consumer:
@@ -198,6 +293,141 @@ def DiskRealName(x):
     except:
         return None
 
+def DiskRealName(x):
+    """
+    Given a device name or a geom, attempt to find out it's real name.
+    (E.g., "da4p1" is "da4", "gptid/blach" is "ada18", etc.)
+    Names are looked up in the current topology snapshot.
+    """
+    if x.__class__ == str:
+        if x.startswith("/dev/"):
+            x = x[5:]
+        return Topology().real_name(x)
+    return _GeomRealName(x)
+
+DiskEntry = collections.namedtuple("DiskEntry",
+                                   ["name", "size", "description",
+                                    "sectorsize", "stripesize", "config", "geom"])
+PartitionEntry = collections.namedtuple("PartitionEntry",
+                                        ["name", "type", "index", "size", "label"])
+
+class TopologySnapshot(object):
+    """
+    An immutable index of the geom tree, built once per geom.scan().
+    It maps device names to their real disk names, and disk names to
+    their DISK geom information, their partitions, and any mirrors
+    using them.  Everything here is a lookup; nothing walks geom.
+    """
+    __slots__ = ("_generation", "_disks", "_parts", "_real_names", "_mirrors")
+
+    def __init__(self, generation):
+        disks = {}
+        parts = {}
+        real_names = {}
+        mirrors = {}
+
+        disk_class = geom.class_by_name("DISK")
+        for disk in (disk_class.geoms if disk_class else []):
+            provider = disk.provider
+            disks[disk.name] = DiskEntry(name=disk.name,
+                                         size=provider.mediasize,
+                                         description=provider.description,
+                                         sectorsize=getattr(provider, "sectorsize", 512),
+                                         stripesize=getattr(provider, "stripesize", 0),
+                                         config=dict(provider.config or {}),
+                                         geom=disk)
+
+        part_class = geom.class_by_name("PART")
+        for part_geom in (part_class.geoms if part_class else []):
+            entries = []
+            for part in (part_geom.providers or []):
+                entries.append(PartitionEntry(name=part.name,
+                                              type=part.config["type"],
+                                              index=int(part.config["index"]),
+                                              size=int(part.config["length"]),
+                                              label=part.config.get("label", None)))
+            parts[part_geom.name] = tuple(sorted(entries, key=lambda p: p.index))
+
+        dev_class = geom.class_by_name("DEV")
+        for dev in (dev_class.geoms if dev_class else []):
+            real_names[dev.name] = _GeomRealName(dev)
+
+        mirror_class = geom.class_by_name("MIRROR")
+        for mirror in (mirror_class.geoms if mirror_class else []):
+            for geom_entry in mirror.consumers:
+                rn = _GeomRealName(geom_entry.provider.geom)
+                mirrors.setdefault(rn, []).append((mirror.name, geom_entry.provider.name))
+
+        self._generation = generation
+        self._disks = disks
+        self._parts = parts
+        self._real_names = real_names
+        self._mirrors = { k : tuple(v) for k, v in mirrors.items() }
+
+    def __repr__(self):
+        return "<TopologySnapshot generation={}, disks={}>".format(self.generation, len(self._disks))
+
+    @property
+    def generation(self):
+        return self._generation
+
+    def real_name(self, name):
+        """
+        Return the disk name for a device (e.g., "ada0p2" -> "ada0"), or None
+        """
+        return self._real_names.get(name, None)
+
+    def disk(self, name):
+        """
+        Return the DiskEntry for the disk with this name, or None
+        """
+        return self._disks.get(name, None)
+
+    def disks(self):
+        """
+        Return all of the DiskEntry objects, sorted by name
+        """
+        return [self._disks[name] for name in sorted(self._disks)]
+
+    def partitions(self, name):
+        """
+        Return a tuple of PartitionEntry objects for the disk, sorted by index
+        """
+        return self._parts.get(name, ())
+
+    def mirrors(self, name):
+        """
+        Return a tuple of (mirror name, provider name) for the disk
+        """
+        return self._mirrors.get(name, ())
+
+_topology = None
+_topology_generation = 0
+_topology_lock = threading.Lock()
+
+def Topology():
+    """
+    Return the current TopologySnapshot, building it if necessary.
+    """
+    global _topology
+    with _topology_lock:
+        if _topology is None:
+            _topology = TopologySnapshot(_topology_generation)
+        return _topology
+
+def RescanTopology():
+    """
+    Have geom rescan the system, and rebuild the topology snapshot.
+    This should be used in place of calling geom.scan() directly, so that
+    the generation counter goes up and cached lookups get invalidated.
+    """
+    global _topology, _topology_generation
+    with _topology_lock:
+        geom.scan()
+        _topology_generation += 1
+        _topology = TopologySnapshot(_topology_generation)
+        LogIt("Rescanned geom topology, generation {}".format(_topology_generation))
+        return _topology
 
 def SmartSize(x):
     """
@@ -240,16 +470,14 @@ def DiskInfo(name):
     Return a dictionary with name, size, and description values
     """
     if name.startswith("/dev/"):
-        LogIt("Tryiing geom_by_name(DEV, {})".format(name[5:]))
-        name = DiskRealName(geom.geom_by_name("DEV", name[5:]))
-    LogIt("Trying geom_by_name(DISK, {})".format(name))
-    disk = geom.geom_by_name("DISK", name)
+        name = DiskRealName(name)
+    disk = Topology().disk(name)
     if disk:
         return {
             "name" : name,
-            "size" : disk.provider.mediasize,
-            "description" : disk.provider.description,
-            "geom" : disk,
+            "size" : disk.size,
+            "description" : disk.description,
+            "geom" : disk.geom,
             }
     else:
         return {}
@@ -261,27 +489,31 @@ class Disk(object):
     They may also have partitions.
     """
     def __init__(self, iname):
+        self._load(Topology(), iname)
+
+    def _load(self, topology, iname):
         if iname.startswith("/dev/"):
             iname = iname[5:]
-        name = DiskRealName(geom.geom_by_name("DEV", iname))
+        name = topology.real_name(iname)
         if name is None:
             raise RuntimeError("Unable to find real name for disk {}".format(iname))
-        disk = geom.geom_by_name("DISK", name)
+        disk = topology.disk(name)
         if disk:
-            self._geom = disk
+            self._geom = disk.geom
             self._name = name
-            self._size = disk.provider.mediasize
-            self._description = disk.provider.description
-            part_geom = geom.geom_by_name("PART", disk.name)
+            self._size = disk.size
+            self._description = disk.description
+            self._sectorsize = disk.sectorsize
+            self._stripesize = disk.stripesize
+            self._generation = topology.generation
             self._parts = []
-            if part_geom and part_geom.providers:
-                for part in part_geom.providers:
-                    part_obj = Partition(type=part.config["type"],
-                                         index=int(part.config["index"]),
-                                         size=int(part.config["length"]),
-                                         label=part.config["label"],
-                                         disk=self)
-                    self._parts.append(part_obj)
+            for part in topology.partitions(name):
+                part_obj = Partition(type=part.type,
+                                     index=part.index,
+                                     size=part.size,
+                                     label=part.label,
+                                     disk=self)
+                self._parts.append(part_obj)
         else:
             raise RuntimeError("Unable to find disk {}".format(name))
     def __str__(self):
@@ -316,6 +548,15 @@ class Disk(object):
     def description(self):
         return self._description
     @property
+    def sectorsize(self):
+        return self._sectorsize
+    @property
+    def stripesize(self):
+        return self._stripesize
+    @property
+    def generation(self):
+        return self._generation
+    @property
     def partitions(self):
         return self._parts
 
@@ -329,14 +570,12 @@ class Disk(object):
         return None
 
     def rescan(self):
-        geom.scan()
-        self.__init__(self._name)
+        self._load(RescanTopology(), self._name)
         
-def GetPackages(manifest, conf, cache_dir, interactive=False):
+def ValidatePackages(manifest, conf, cache_dir, interactive=False):
     """
-    Make sure that the packages exist.  If they don't, then
-    attempt to download them.  If interactive, use lots of
-    dialog messages.
+    Run the manifest's validation program, if it has one.
+    Raises InstallationError if the installation is not valid.
     """
     conf.SetPackageDir(cache_dir)
     try:
@@ -353,66 +592,60 @@ def GetPackages(manifest, conf, cache_dir, interactive=False):
         else:
             LogIt("Trying to run validation program, got exception {}".format(str(e)))
             raise
+
+@Trace.Traced()
+def GetPackages(manifest, conf, cache_dir, interactive=False,
+                max_workers=4, retries=2, store=None, downloader=None):
+    """
+    Make sure that the packages exist.  If they don't, then
+    attempt to download them.  If interactive, use lots of
+    dialog messages.  Up to max_workers packages are fetched
+    at once, and each package is tried 1 + retries times.
+    If store (a PackageCache.PackageStore) is given, it is
+    used before going to the update server.  If downloader (a
+    Download.Downloader) is given, it does the downloading.
+    """
+    ValidatePackages(manifest, conf, cache_dir, interactive=interactive)
     # Okay, now let's ensure all the packages are downloaded
+    from . import Fetch
     LogIt("Using cache directory {}".format(cache_dir))
     try:
-        count = 0
-        total = len(manifest.Packages())
-        for pkg in manifest.Packages():
-            count += 1
-            LogIt("Locating package file {}-{}".format(pkg.Name(), pkg.Version()))
+        scheduler = Fetch.FetchScheduler(conf, cache_dir, manifest.Packages(),
+                                         max_workers=max_workers, retries=retries,
+                                         store=store, downloader=downloader)
+        status = None
+        if interactive:
+            status = Dialog.Gauge(Title(), "", height=8, width=60)
+            status.prompt = "Downloading and verifying {} packages ({}bytes)".format(len(scheduler.jobs),
+                                                                                    SmartSize(scheduler.total_bytes))
+            status.clear()
+            status.run()
+            LogIt("Started gauge")
+
+        progress = None
+        if status:
+            progress = ProgressCoalescer(lambda percentage: setattr(status, "percentage", percentage))
+        def UpdateGauge():
+            if progress:
+                progress.update(scheduler.percentage())
+        try:
+            scheduler.wait(poll=UpdateGauge)
+        except Fetch.FetchError as e:
             if interactive:
-                if os.path.exists(os.path.join(cache_dir, pkg.FileName())):
-                    status = Dialog.MessageBox(Title(), "", height=8, width=60, wait=False)
-                    text = "Verifying"
-                else:
-                    text = "Downloading and verifying"
-                    status = Dialog.Gauge(Title(), "", height=8, width=60)
-
-                status.prompt = "{} package {} ({} of {})".format(text, pkg.Name(), count, total)
-                status.clear()
-                status.run()
-                LogIt("Started gauge")
-
-            def DownloadHandler(path, url, size=0, progress=None, download_rate=None):
-                if progress:
-                    if status.__class__ == Dialog.Gauge:
-                        status.percentage = progress
-                LogIt("DownloadHandler({}, {}, {}, {}, {})".format(path, url, size, progress, download_rate))
-            try:
-                pkg_file = conf.FindPackageFile(pkg,
-                                                pkg_type=PkgFileFullOnly,
-                                                handler=DownloadHandler if interactive else None,
-                                                save_dir=cache_dir)
-            except Exceptions.ChecksumFailException as e:
-                if interactive:
-                    try:
-                        Dialog.MessageBox(Title(),
-                                          "Package {} has an invalid checksum".format(pkg.Name()),
-                                          height=5, width=50).run()
-                    except:
-                        pass
-                raise InstallationError("Invalid package checksum")
-            except BaseException as e:
-                LogIt("Got exception {} while trying to download package".format(str(e)))
-                raise
-            finally:
-                if interactive:
-                    if status.__class__ == Dialog.Gauge:
-                        status.percentage = 100
-                        dc = status.result
-                
-                if pkg_file is None:
-                    if interactive:
-                        try:
-                            Dialog.MessageBox(Title(),
-                                              "Unable to locate package {}".format(pkg.Name()),
-                                              height=15, width=30).run()
-                        except:
-                            pass
-                    raise InstallationError("Missing package {}".format(pkg.Name()))
-                else:
-                    pkg_file.close()
+                try:
+                    Dialog.MessageBox(Title(), e.message,
+                                      height=7, width=50).run()
+                except:
+                    pass
+            if e.reason == "checksum":
+                raise InstallationError("Invalid package checksum: {}".format(e.package.Name()))
+            elif e.reason == "missing":
+                raise InstallationError("Missing package {}".format(e.package.Name()))
+            raise InstallationError(e.message)
+        finally:
+            if status:
+                status.percentage = 100
+                dc = status.result
         try:
             # I have no idea why I need this.
             # Without this, the next YesNo dialog won't be able to use arrow keys.
@@ -427,14 +660,148 @@ def GetPackages(manifest, conf, cache_dir, interactive=False):
         LogIt("Got exception {} while trying to load packages".format(str(e)))
         raise InstallationError(str(e))
 
+# Commands that run longer than this (in seconds) are killed,
+# unless RunCommand is given a different timeout.  0 means no limit.
+DEFAULT_COMMAND_TIMEOUT = 15 * 60
+# How much of a command's stdout and stderr (each) is kept.
+DEFAULT_OUTPUT_CAP = 4 * 1024 * 1024
+# How long a command gets to exit after SIGTERM, before SIGKILL.
+_KILL_GRACE = 5
+# Longest line logged at once; longer ones are logged in pieces.
+_LINE_LIMIT = 4096
+
+class RunCommandTimeout(RunCommandException):
+    """
+    Raised by RunCommand when the command did not finish in time.
+    """
+    pass
+
+CommandRecord = collections.namedtuple("CommandRecord",
+                                       ["command", "seconds", "code",
+                                        "stdout_bytes", "stderr_bytes", "timed_out"])
+
+class CommandStats(object):
+    """
+    A record of every command RunCommand has run:  how long it took,
+    its exit code, and how much output it produced.
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._records = []
+
+    def record(self, entry):
+        with self._lock:
+            self._records.append(entry)
+
+    def mark(self):
+        """
+        Return a marker that can be passed as since=, to only
+        look at commands run after this point.
+        """
+        with self._lock:
+            return len(self._records)
+
+    def records(self, since=0):
+        with self._lock:
+            return self._records[since:]
+
+    def slowest(self, count=10, since=0):
+        return sorted(self.records(since), key=lambda x: x.seconds, reverse=True)[:count]
+
+    def report(self, count=10, since=0):
+        """
+        Return a list of lines with a table of the slowest commands.
+        """
+        records = self.records(since)
+        if not records:
+            return []
+        lines = ["Slowest commands ({} of {}, {:.1f} seconds total):".format(min(count, len(records)),
+                                                                             len(records),
+                                                                             sum(x.seconds for x in records)),
+                 "{:>9}  {:>5}  {:>7}  {}".format("seconds", "exit", "output", "command")]
+        for entry in self.slowest(count, since):
+            lines.append("{:9.3f}  {:>5}  {:>7}  {}".format(entry.seconds,
+                                                           "T/O" if entry.timed_out else entry.code,
+                                                           SmartSize(entry.stdout_bytes + entry.stderr_bytes),
+                                                           entry.command))
+        return lines
+
+command_stats = CommandStats()
+
+def _ReadStream(stream, name, program, cap, results):
+    # Runs on its own thread:  log each line as it arrives, and
+    # keep up to cap bytes of it.
+    captured = []
+    kept = 0
+    total = 0
+    try:
+        for line in iter(lambda: stream.readline(_LINE_LIMIT), b""):
+            total += len(line)
+            if kept < cap:
+                piece = line[:cap - kept]
+                captured.append(piece)
+                kept += len(piece)
+            Logger.Info("command", "\t{} {}: {}", program, name,
+                        line.decode('utf-8', 'replace').rstrip())
+    finally:
+        stream.close()
+        if total > kept:
+            Logger.Info("command", "\t{} {}: {} bytes, only kept {}", program, name, total, kept)
+        results[name] = (b"".join(captured), total)
+
+def _KillProcessGroup(proc):
+    for sig in (signal.SIGTERM, signal.SIGKILL):
+        try:
+            os.killpg(proc.pid, sig)
+        except OSError:
+            return
+        try:
+            proc.wait(timeout=_KILL_GRACE)
+            return
+        except subprocess.TimeoutExpired:
+            pass
+
+def _KillStragglers(proc):
+    # Kill whatever the command left running in its process group
+    # (a child that outlived it, still holding its stdout or stderr
+    # open).  Returns True if there was anything to kill.
+    try:
+        os.killpg(proc.pid, signal.SIGKILL)
+        return True
+    except OSError:
+        return False
+
+def _JoinReaders(readers):
+    # Give the output readers _KILL_GRACE seconds to reach the end of
+    # the output.  Returns the names of the streams they didn't finish.
+    deadline = time.monotonic() + _KILL_GRACE
+    for reader in readers:
+        reader.join(max(0, deadline - time.monotonic()))
+    return [name for (name, reader) in zip(("stdout", "stderr"), readers) if reader.is_alive()]
+
 def RunCommand(*args, **kwargs):
     # Run the given command as a sub process.
     # Either returns the output (which may be empty),
     # or raises an exception.
-    error_output = tempfile.TemporaryFile()
+    # Optional keyword arguments:
+    #	chroot		Directory to chroot into first
+    #	timeout		Seconds before the command (and its process group)
+    #			is killed; default DEFAULT_COMMAND_TIMEOUT, 0 for none.
+    #			Raises RunCommandTimeout.
+    #	output_cap	Maximum bytes of stdout (and of stderr) to keep.
+    # Output is logged line by line as the command runs.  If its output
+    # doesn't end soon after it exits, whatever it left running in its
+    # process group is killed (daemons it started that let go of the
+    # output are left alone); if the output still doesn't end (something
+    # outside the group has it open), RunCommandException is raised.
     temp_array = [str(x) for x in args]
     command_line = " ".join(temp_array)
+    program = os.path.basename(temp_array[0])
     chroot = kwargs.pop("chroot", None)
+    timeout = kwargs.pop("timeout", None)
+    output_cap = kwargs.pop("output_cap", DEFAULT_OUTPUT_CAP)
+    if timeout is None:
+        timeout = DEFAULT_COMMAND_TIMEOUT
     
     def PreFunc():
         os.environ.pop('PYTHONPATH', None)
@@ -443,8 +810,6 @@ def RunCommand(*args, **kwargs):
         os.chroot(chroot)
         os.chdir("/")
         
-    prexec_fn = None
-    
     LogIt("RunCommand(\"{}\")".format(command_line))
     if chroot:
         LogIt("\tchrooted into {}".format(chroot))
@@ -452,24 +817,72 @@ def RunCommand(*args, **kwargs):
             raise RunCommandException(code=errno.EPERM,
                                       command=command_line,
                                       message="Must be root to chroot")
-    try:
-        retval = ""
-        retval = subprocess.check_output(temp_array,
-                                         preexec_fn=PreFunc if chroot else None,
-                                         stderr=error_output).decode('utf-8').rstrip()
-    except subprocess.CalledProcessError as e:
-        error_output.seek(0)
-        error_message = error_output.read().decode('utf-8').rstrip()
-        raise RunCommandException(code=e.returncode,
-                                  command=command_line,
-                                  message=error_message)
-    finally:
-        LogIt("\t{}".format(retval))
-        error_output.seek(0)
-        LogIt("\tStdErr: {}".format(error_output.read().decode('utf-8').rstrip()))
-        error_output.close()
+    with Trace.Span(program, chroot=chroot):
+        start_time = time.monotonic()
+        try:
+            # A new session, so that on a timeout we can kill
+            # everything the command started, too.
+            proc = subprocess.Popen(temp_array,
+                                    stdin=subprocess.DEVNULL,
+                                    stdout=subprocess.PIPE,
+                                    stderr=subprocess.PIPE,
+                                    preexec_fn=PreFunc if chroot else None,
+                                    start_new_session=True)
+        except OSError as e:
+            command_stats.record(CommandRecord(command_line, time.monotonic() - start_time,
+                                               e.errno, 0, 0, False))
+            raise RunCommandException(code=e.errno,
+                                      command=command_line,
+                                      message=str(e))
+        results = {}
+        readers = []
+        for (name, stream) in (("stdout", proc.stdout), ("stderr", proc.stderr)):
+            reader = threading.Thread(target=_ReadStream,
+                                      args=(stream, name, program, output_cap, results),
+                                      name="{}-{}".format(program, name))
+            reader.daemon = True
+            reader.start()
+            readers.append(reader)
+        timed_out = False
+        try:
+            code = proc.wait(timeout=timeout or None)
+        except subprocess.TimeoutExpired:
+            LogIt("\t{} did not finish in {} seconds, killing it".format(program, timeout))
+            timed_out = True
+            _KillProcessGroup(proc)
+            try:
+                code = proc.wait(timeout=_KILL_GRACE)
+            except subprocess.TimeoutExpired:
+                LogIt("\t{} could not be killed".format(program))
+                code = None
+        if timed_out and _KillStragglers(proc):
+            LogIt("\tKilled processes {} left running".format(program))
+        # The output isn't complete until the readers have seen the end of it
+        unfinished = _JoinReaders(readers)
+        if unfinished and not timed_out and _KillStragglers(proc):
+            LogIt("\tKilled processes {} left running with its {} open".format(program, " and ".join(unfinished)))
+            unfinished = _JoinReaders(readers)
+        elapsed = time.monotonic() - start_time
+        (stdout, stdout_bytes) = results.get("stdout", (b"", 0))
+        (stderr, stderr_bytes) = results.get("stderr", (b"", 0))
+        command_stats.record(CommandRecord(command_line, elapsed, code,
+                                           stdout_bytes, stderr_bytes, timed_out))
+        LogIt("\t{} exited with {} after {:.3f} seconds".format(program, code, elapsed))
 
-    return retval
+    if timed_out:
+        raise RunCommandTimeout(code=errno.ETIMEDOUT,
+                                command=command_line,
+                                message="Timed out after {} seconds".format(timeout))
+    if unfinished:
+        LogIt("\t{} {} still open after it exited".format(program, " and ".join(unfinished)))
+        raise RunCommandException(code=errno.EIO,
+                                  command=command_line,
+                                  message="Could not read all of its {}".format(" and ".join(unfinished)))
+    if code != 0:
+        raise RunCommandException(code=code,
+                                  command=command_line,
+                                  message=stderr.decode('utf-8', 'replace').rstrip())
+    return stdout.decode('utf-8', 'replace').rstrip()
 
 def IsTruenas():
     """
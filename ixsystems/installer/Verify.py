@@ -0,0 +1,191 @@
+from __future__ import print_function
+import os
+import json
+import mmap
+import hashlib
+import tempfile
+import threading
+import concurrent.futures
+
+from .Utils import LogIt
+
+# This lives in /tmp, so it lasts as long as the installer session
+# (including "Start Over" and re-running the installer), and no longer.
+DEFAULT_STAMP_FILE = "/tmp/.installer-verified.json"
+DEFAULT_WORKERS = 4
+# Hash this much of the mapping at a time; hashlib drops the GIL
+# for large updates, so the worker threads really run in parallel.
+HASH_CHUNK = 4 * 1024 * 1024
+
+def HashFile(path, algorithm="sha256"):
+    """
+    Return the hex digest of the file at path, reading it
+    through a memory mapping.
+    """
+    h = hashlib.new(algorithm)
+    with open(path, "rb") as f:
+        size = os.fstat(f.fileno()).st_size
+        if size == 0:
+            return h.hexdigest()
+        m = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            view = memoryview(m)
+            try:
+                for offset in range(0, size, HASH_CHUNK):
+                    h.update(view[offset:offset + HASH_CHUNK])
+            finally:
+                view.release()
+        finally:
+            m.close()
+    return h.hexdigest()
+
+def _stamp_of(st):
+    return [st.st_size, st.st_mtime_ns, st.st_ino, st.st_dev]
+
+class VerifiedStamps(object):
+    """
+    A record of files whose digest has been computed (or verified by
+    freenasOS), keyed by path, with the size, mtime, inode, and device
+    the file had at that time.  If a file still has the same stamp,
+    its digest is taken from here instead of being recomputed.
+    """
+    def __init__(self, path=DEFAULT_STAMP_FILE):
+        self._path = path
+        self._lock = threading.Lock()
+        self._stamps = {}
+        self._dirty = False
+        if path:
+            try:
+                with open(path, "r") as f:
+                    self._stamps = json.load(f)
+            except (OSError, IOError, ValueError):
+                self._stamps = {}
+
+    def __len__(self):
+        return len(self._stamps)
+
+    def lookup(self, path):
+        """
+        Return the recorded digest for path, or None if there isn't one,
+        or the file has changed since it was recorded.
+        """
+        path = os.path.realpath(path)
+        try:
+            st = os.stat(path)
+        except OSError:
+            return None
+        with self._lock:
+            entry = self._stamps.get(path, None)
+        if entry and entry["stamp"] == _stamp_of(st):
+            return entry["digest"]
+        return None
+
+    def record(self, path, digest, st=None):
+        path = os.path.realpath(path)
+        try:
+            st = st or os.stat(path)
+        except OSError:
+            return
+        with self._lock:
+            self._stamps[path] = { "stamp" : _stamp_of(st), "digest" : digest.lower() }
+            self._dirty = True
+
+    def forget(self, path):
+        with self._lock:
+            if self._stamps.pop(os.path.realpath(path), None):
+                self._dirty = True
+
+    def clear(self):
+        with self._lock:
+            self._stamps = {}
+            self._dirty = True
+
+    def save(self):
+        if not self._path:
+            return
+        with self._lock:
+            if not self._dirty:
+                return
+            data = dict(self._stamps)
+            self._dirty = False
+        try:
+            (fd, tmp_path) = tempfile.mkstemp(dir=os.path.dirname(self._path) or ".",
+                                              prefix=".verified.")
+            with os.fdopen(fd, "w") as f:
+                json.dump(data, f)
+            os.rename(tmp_path, self._path)
+        except (OSError, IOError) as e:
+            LogIt("Could not save verification stamps to {}: {}".format(self._path, str(e)))
+
+class PackageVerifier(object):
+    """
+    Verify package files against their expected checksums, hashing
+    them on worker threads, and skipping files whose stamp shows they
+    have already been verified and not changed since.
+    """
+    def __init__(self, stamps=None, max_workers=DEFAULT_WORKERS, algorithm="sha256"):
+        self._stamps = VerifiedStamps(DEFAULT_STAMP_FILE) if stamps is None else stamps
+        self._max_workers = max(1, max_workers)
+        self._algorithm = algorithm
+        self._lock = threading.Lock()
+        self._hashed = 0
+        self._skipped = 0
+
+    @property
+    def stamps(self):
+        return self._stamps
+
+    def digest(self, path):
+        """
+        Return the digest of path, from the stamp cache if possible.
+        """
+        digest = self._stamps.lookup(path)
+        if digest is not None:
+            with self._lock:
+                self._skipped += 1
+            return digest
+        st = os.stat(path)
+        digest = HashFile(path, self._algorithm)
+        # Only trust the result if the file didn't change while hashing it
+        if _stamp_of(os.stat(path)) == _stamp_of(st):
+            self._stamps.record(path, digest, st=st)
+        with self._lock:
+            self._hashed += 1
+        return digest
+
+    def check(self, path, checksum):
+        """
+        Return True if the file at path exists and matches checksum.
+        """
+        if not checksum:
+            return False
+        try:
+            return self.digest(path) == checksum.lower()
+        except (OSError, IOError, ValueError) as e:
+            LogIt("Could not verify {}: {}".format(path, str(e)))
+            return False
+
+    def record(self, path, checksum):
+        """
+        Note that path has been verified (by someone else) to match checksum.
+        """
+        if checksum:
+            self._stamps.record(path, checksum)
+
+    def verify(self, items):
+        """
+        Given an iterable of (path, checksum), check all of them in parallel.
+        Returns a dictionary of path -> True/False.
+        """
+        items = list(items)
+        results = {}
+        with concurrent.futures.ThreadPoolExecutor(max_workers=self._max_workers) as executor:
+            jobs = { executor.submit(self.check, path, checksum) : path for (path, checksum) in items }
+            for job in concurrent.futures.as_completed(jobs):
+                results[jobs[job]] = job.result()
+        self._stamps.save()
+        return results
+
+    def stats(self):
+        with self._lock:
+            return { "hashed" : self._hashed, "skipped" : self._skipped }
@@ -0,0 +1,188 @@
+"""
+Pieces shared by the tests:  simulated hardware (whose stand-ins for
+bsd, libzfs, and freenasOS let the installer modules be imported on
+any machine), generated packages, and a local HTTP stand-in for the
+update server.
+
+The installer modules have to be imported after Hardware() has been
+called, so the tests import them in setUp().
+"""
+from __future__ import print_function
+import json
+import time
+import random
+import hashlib
+import threading
+import http.server
+
+from ixsystems.installer import Simulator
+
+TRAIN = "FreeNAS-Test"
+
+def Hardware(**kwargs):
+    """
+    Create simulated hardware (with no disks, unless asked for) and
+    install it.  The network is left alone, so downloads go to a real
+    (local) server, rather than the simulator's.  The caller has to
+    call cleanup() on it.
+    """
+    kwargs.setdefault("disks", 0)
+    kwargs.setdefault("packages", 0)
+    hardware = Simulator.Hardware(**kwargs).install()
+    from ixsystems.installer import Download
+    Download.OpenConnection = Download._OpenConnection
+    return hardware
+
+def MakePackages(sizes, seed=0):
+    """
+    Generate a package of each of the given sizes.  Returns (packages,
+    contents), where contents is package file name -> bytes.
+    """
+    import freenasOS.Package as Package
+    rng = random.Random(seed)
+    packages = []
+    contents = {}
+    for (index, size) in enumerate(sizes):
+        data = rng.getrandbits(8 * size).to_bytes(size, "little")
+        pkg = Package.Package("package-{:02d}".format(index), "1.0", size,
+                              hashlib.sha256(data).hexdigest())
+        packages.append(pkg)
+        contents[pkg.FileName()] = data
+    return (packages, contents)
+
+def Configuration(url):
+    """
+    A system configuration whose update server is url.
+    """
+    import freenasOS.Configuration as Configuration
+    conf = Configuration.SystemConfiguration()
+    conf.UpdateServerURL = lambda: url
+    return conf
+
+class UpdateServer(object):
+    """
+    An update server on a local port, on its own thread.
+
+    <url>/<train>/LATEST	The manifest (etag and last_modified, if set,
+    			are sent with it, and honored in conditional requests)
+    <url>/Packages/<file>	The package files (Range and If-Range are honored)
+
+    failures maps a path to a list of statuses to answer the next
+    requests for it with, instead.  Every request is recorded in
+    requests, as (path, headers).  If delay is set, package files are
+    sent in CHUNK_SIZE pieces, delay seconds apart.
+    """
+    CHUNK_SIZE = 16 * 1024
+
+    def __init__(self, train=TRAIN):
+        self.train = train
+        self.manifest = None
+        self.etag = None
+        self.last_modified = None
+        self.files = {}
+        self.failures = {}
+        self.requests = []
+        self.delay = 0
+        self.lock = threading.Lock()
+        server = self
+
+        class Handler(http.server.BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def log_message(self, format, *args):
+                pass
+
+            def do_GET(self):
+                server._get(self)
+
+        self._httpd = http.server.ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self._httpd.daemon_threads = True
+        self._thread = threading.Thread(target=self._httpd.serve_forever, name="update-server")
+        self._thread.daemon = True
+        self._thread.start()
+
+    @property
+    def url(self):
+        return "http://127.0.0.1:{}".format(self._httpd.server_port)
+
+    def publish(self, manifest, contents, etag=None, last_modified=None):
+        """
+        Serve manifest (a simulator Manifest) and the package files in contents.
+        """
+        with self.lock:
+            self.manifest = json.dumps(manifest.dict()).encode("utf-8")
+            self.files = dict(contents)
+            self.etag = etag
+            self.last_modified = last_modified
+
+    def requested(self, path):
+        """
+        The headers of each request for path, in order.
+        """
+        with self.lock:
+            return [headers for (request_path, headers) in self.requests if request_path == path]
+
+    def stop(self):
+        self._httpd.shutdown()
+        self._httpd.server_close()
+        self._thread.join()
+
+    def _send(self, request, status, headers, body=b"", delay=0):
+        request.send_response(status)
+        for (name, value) in headers.items():
+            if value is not None:
+                request.send_header(name, value)
+        request.send_header("Content-Length", str(len(body)))
+        request.end_headers()
+        if not delay:
+            request.wfile.write(body)
+            return
+        try:
+            for offset in range(0, len(body), self.CHUNK_SIZE):
+                request.wfile.write(body[offset:offset + self.CHUNK_SIZE])
+                request.wfile.flush()
+                time.sleep(delay)
+        except OSError:
+            # The client went away
+            request.close_connection = True
+
+    def _get(self, request):
+        path = request.path
+        headers = dict(request.headers.items())
+        with self.lock:
+            self.requests.append((path, headers))
+            failures = self.failures.get(path, None)
+            status = failures.pop(0) if failures else None
+            manifest = self.manifest
+            delay = self.delay
+            etag = self.etag
+            last_modified = self.last_modified
+            data = self.files.get(path[len("/Packages/"):], None) if path.startswith("/Packages/") else None
+        if status:
+            self._send(request, status, {}, "Failure {}".format(status).encode("utf-8"))
+        elif path == "/{}/LATEST".format(self.train) and manifest is not None:
+            validators = { "ETag" : etag, "Last-Modified" : last_modified }
+            if etag and request.headers.get("If-None-Match", None) == etag:
+                self._send(request, 304, validators)
+            elif (last_modified and not request.headers.get("If-None-Match", None) and
+                  request.headers.get("If-Modified-Since", None) == last_modified):
+                self._send(request, 304, validators)
+            else:
+                self._send(request, 200, validators, manifest)
+        elif data is not None:
+            etag = '"{}"'.format(hashlib.sha256(data).hexdigest()[:16])
+            start = None
+            byte_range = request.headers.get("Range", "")
+            if (byte_range.startswith("bytes=") and byte_range.endswith("-") and
+                request.headers.get("If-Range", None) == etag):
+                start = int(byte_range[len("bytes="):-1])
+            if start is None:
+                self._send(request, 200, { "ETag" : etag }, data, delay)
+            elif start >= len(data):
+                self._send(request, 416, { "Content-Range" : "bytes */{}".format(len(data)) })
+            else:
+                self._send(request, 206, { "ETag" : etag,
+                                           "Content-Range" : "bytes {}-{}/{}".format(start, len(data) - 1, len(data)) },
+                           data[start:], delay)
+        else:
+            self._send(request, 404, {}, b"Not found")
@@ -0,0 +1,276 @@
+"""
+Answer files:  validation, disk selection rules, and how the
+unattended installer resolves the mode and the disks against what
+is on the (simulated) system.
+"""
+from __future__ import print_function
+import io
+import os
+import json
+import contextlib
+import unittest
+
+from . import Support
+
+GiB = 1024 * 1024 * 1024
+
+class AnswersTest(unittest.TestCase):
+    def setUp(self):
+        self.hardware = Support.Hardware()
+        from ixsystems.installer import Answers
+        self.Answers = Answers
+
+    def tearDown(self):
+        self.hardware.cleanup()
+
+    def assertInvalid(self, data):
+        with self.assertRaises(self.Answers.AnswerError) as context:
+            self.Answers.Answers(data)
+        self.assertEqual(context.exception.code, self.Answers.EXIT_BAD_ANSWERS)
+
+    def test_defaults(self):
+        answers = self.Answers.Answers({})
+        self.assertIsNone(answers.disk_rule)
+        self.assertEqual(answers.mode, "auto")
+        self.assertEqual(answers.boot, "auto")
+        self.assertIsNone(answers.password_hash)
+        self.assertFalse(answers.destroy_pool)
+        self.assertIsNone(answers.summary_path)
+
+    def test_valid(self):
+        answers = self.Answers.Answers({ "disks" : { "names" : ["ada*"], "min_size" : "8G", "count" : 2 },
+                                         "mode" : "new-be", "boot" : "efi",
+                                         "password_hash" : "$6$salt$hash", "data_dir" : "/data",
+                                         "destroy_pool" : True, "summary" : "/tmp/summary.json" })
+        self.assertEqual(answers.disk_rule.names, ["ada*"])
+        self.assertEqual(answers.disk_rule.min_size, 8 * GiB)
+        self.assertEqual(answers.disk_rule.count, 2)
+        self.assertEqual(answers.mode, "new-be")
+        self.assertEqual(answers.boot, "efi")
+        self.assertTrue(answers.destroy_pool)
+        self.assertNotIn("$6$", repr(answers))
+
+    def test_invalid(self):
+        for data in [[], "all", { "disk" : "all" }, { "mode" : "reinstall" }, { "boot" : "uefi" },
+                     { "password_hash" : 1 }, { "data_dir" : ["/data"] }, { "destroy_pool" : "yes" },
+                     { "summary" : False }, { "disks" : 3 }, { "disks" : { "name" : "ada0" } },
+                     { "disks" : { "names" : [1] } }, { "disks" : { "serials" : {} } },
+                     { "disks" : { "min_size" : "big" } }, { "disks" : { "max_size" : True } },
+                     { "disks" : { "ssd" : "yes" } }, { "disks" : { "count" : 0 } },
+                     { "disks" : { "count" : True } }]:
+            self.assertInvalid(data)
+
+    def test_disk_forms(self):
+        self.assertEqual(self.Answers.DiskRule("all").names, None)
+        self.assertEqual(self.Answers.DiskRule("ada0").names, ["ada0"])
+        self.assertEqual(self.Answers.DiskRule(["ada0", "da*"]).names, ["ada0", "da*"])
+        self.assertEqual(self.Answers.DiskRule({ "serials" : "S1" }).serials, ["S1"])
+        self.assertEqual(self.Answers.DiskRule({ "max_size" : 1000 }).max_size, 1000)
+
+    def test_load(self):
+        path = os.path.join(self.hardware.root, "answers.json")
+        with open(path, "w") as f:
+            json.dump({ "disks" : "all", "mode" : "format" }, f)
+        answers = self.Answers.Load(path)
+        self.assertEqual(answers.mode, "format")
+        self.assertEqual(answers.path, path)
+        with open(path, "w") as f:
+            f.write("{ disks")
+        for bad_path in [path, os.path.join(self.hardware.root, "missing.json")]:
+            with self.assertRaises(self.Answers.AnswerError) as context:
+                self.Answers.Load(bad_path)
+            self.assertEqual(context.exception.code, self.Answers.EXIT_BAD_ANSWERS)
+
+class DiskRuleTest(unittest.TestCase):
+    def setUp(self):
+        self.hardware = Support.Hardware()
+        from ixsystems.installer import Answers, Menu, Utils
+        self.Answers = Answers
+        self.Menu = Menu
+        self.Utils = Utils
+        self.disks = [self.disk("ada0", 16 * GiB, "0", "S0"),
+                      self.disk("ada1", 500 * GiB, "7200", "S1"),
+                      self.disk("da0", 32 * GiB, "0", "S2"),
+                      self.disk("da1", 64 * GiB, None, "S3")]
+
+    def tearDown(self):
+        self.hardware.cleanup()
+
+    def disk(self, name, size, rotationrate, ident):
+        config = { "ident" : ident }
+        if rotationrate is not None:
+            config["rotationrate"] = rotationrate
+        entry = self.Utils.DiskEntry(name, size, "Disk {}".format(name), 512, 4096, config, None)
+        return self.Menu.DiskClassification(name, self.Menu.ValidationCode.OK, "", entry)
+
+    def select(self, rule, **kwargs):
+        return self.Answers.DiskRule(rule).select(self.disks, **kwargs)
+
+    def test_matches(self):
+        rule = self.Answers.DiskRule({ "names" : ["ada*"], "max_size" : "100G" })
+        self.assertEqual([x.name for x in self.disks if rule.matches(x.entry)], ["ada0"])
+
+    def test_all(self):
+        self.assertEqual(self.select("all"), ["ada0", "ada1", "da0", "da1"])
+
+    def test_names(self):
+        self.assertEqual(self.select(["da*", "ada1"]), ["ada1", "da0", "da1"])
+        self.assertEqual(self.select("ada2"), [])
+
+    def test_serials(self):
+        self.assertEqual(self.select({ "serials" : ["S3", "S0", "S9"] }), ["ada0", "da1"])
+
+    def test_sizes(self):
+        self.assertEqual(self.select({ "min_size" : "32G" }), ["ada1", "da0", "da1"])
+        self.assertEqual(self.select({ "min_size" : 32 * GiB, "max_size" : "64g" }), ["da0", "da1"])
+
+    def test_ssd(self):
+        # A disk with no rotation rate counts as an SSD
+        self.assertEqual(self.select({ "ssd" : True }), ["ada0", "da0", "da1"])
+        self.assertEqual(self.select({ "ssd" : False }), ["ada1"])
+
+    def test_count(self):
+        self.assertEqual(self.select({ "ssd" : True, "count" : 2 }), ["ada0", "da0"])
+
+    def test_no_entry(self):
+        self.disks.append(self.Menu.DiskClassification("ada9", self.Menu.ValidationCode.OK, "", None))
+        self.assertEqual(self.select("all"), ["ada0", "ada1", "da0", "da1"])
+
+    def test_pool_disks(self):
+        pool_disks = { "ada1" : "tank", "da0" : "tank" }
+        self.assertEqual(self.select("all", pool_disks=pool_disks), ["ada0", "da1"])
+        self.assertEqual(self.select(["*"], pool_disks=pool_disks), ["ada0", "da1"])
+        self.assertEqual(self.select({ "min_size" : "32G" }, pool_disks=pool_disks), ["da1"])
+        self.assertEqual(self.select(["ada1", "da*"], pool_disks=pool_disks), ["ada1", "da1"])
+        self.assertEqual(self.select({ "serials" : ["S2"] }, pool_disks=pool_disks), ["da0"])
+
+class UnattendedTest(unittest.TestCase):
+    """
+    Unattended installations on a simulated system with three disks.
+    """
+    def setUp(self):
+        # The packages come from the simulated network
+        from ixsystems.installer import Simulator
+        self.hardware = Simulator.Hardware(disks=3, packages=4, package_size=64 * 1024).install()
+        from ixsystems.installer import Answers, Menu, Utils, Verify
+        self.Answers = Answers
+        self.Menu = Menu
+        Verify.DEFAULT_STAMP_FILE = os.path.join(self.hardware.root, "verified.json")
+        Utils.InitLog(os.path.join(self.hardware.root, "log"))
+        Utils.RescanTopology()
+        Menu.disk_inventory.invalidate()
+        self.data_dir = os.path.join(self.hardware.root, "data")
+        os.makedirs(self.data_dir)
+        self.manifest_path = os.path.join(self.hardware.root, "MANIFEST")
+        import freenasOS.Manifest as Manifest
+        with open(self.manifest_path, "w") as f:
+            json.dump(Manifest.Manifest().dict(), f)
+
+    def tearDown(self):
+        self.hardware.cleanup()
+
+    def install(self, **answers):
+        """
+        Run an unattended installation with the given answers.
+        Returns the summary (the last line of its output).
+        """
+        path = os.path.join(self.hardware.root, "answers.json")
+        answers.setdefault("data_dir", self.data_dir)
+        with open(path, "w") as f:
+            json.dump(answers, f)
+        args = self.Menu.ArgumentParser().parse_args(["-M", self.manifest_path,
+                                                      "-P", self.hardware.package_dir,
+                                                      "-A", path])
+        output = io.StringIO()
+        with contextlib.redirect_stdout(output):
+            code = self.Menu.do_unattended(args)
+        summary = json.loads(output.getvalue().splitlines()[-1])
+        self.assertEqual(summary["exit_code"], code)
+        if summary.get("trace", None):
+            os.remove(summary["trace"])
+        return summary
+
+    def data_pool(self, name, disk):
+        from ixsystems.installer import Simulator
+        pool = Simulator.ZFSPool(name, [self.hardware.device(disk)], ["/dev/" + disk])
+        pool.imported = False
+        self.hardware.pools.append(pool)
+
+    def boot_pool(self):
+        return [pool for pool in self.hardware.pools if pool.name == "freenas-boot"]
+
+    def test_format(self):
+        summary_path = os.path.join(self.hardware.root, "summary.json")
+        summary = self.install(disks="all", summary=summary_path)
+        self.assertEqual(summary["exit_code"], self.Answers.EXIT_OK, summary)
+        with open(summary_path) as f:
+            self.assertEqual(json.load(f), summary)
+        self.assertEqual(summary["mode"], "format")
+        self.assertEqual(summary["disks"], ["ada0", "ada1", "ada2"])
+        self.assertEqual(len(self.boot_pool()), 1)
+
+    def test_no_disks(self):
+        summary = self.install(disks=["da*"])
+        self.assertEqual(summary["exit_code"], self.Answers.EXIT_NO_DISKS)
+        self.assertEqual(self.boot_pool(), [])
+
+    def test_no_rule(self):
+        summary = self.install(mode="format")
+        self.assertEqual(summary["exit_code"], self.Answers.EXIT_BAD_ANSWERS)
+
+    def test_bad_answers(self):
+        summary = self.install(disks="all", mode="reinstall")
+        self.assertEqual(summary["exit_code"], self.Answers.EXIT_BAD_ANSWERS)
+
+    def test_nothing_to_upgrade(self):
+        for mode in ("upgrade", "new-be"):
+            summary = self.install(disks="all", mode=mode)
+            self.assertEqual(summary["exit_code"], self.Answers.EXIT_CONFLICT)
+        self.assertEqual(self.boot_pool(), [])
+
+    def test_data_pool_left_out(self):
+        self.data_pool("tank", "ada1")
+        summary = self.install(disks="all")
+        self.assertEqual(summary["exit_code"], self.Answers.EXIT_OK, summary)
+        self.assertEqual(summary["disks"], ["ada0", "ada2"])
+        self.assertEqual(summary["skipped_disks"], ["ada1"])
+        self.assertIn("tank", [pool.name for pool in self.hardware.pools])
+
+    def test_data_pool_only(self):
+        self.data_pool("tank", "ada0")
+        summary = self.install(disks={ "names" : ["ada*"], "count" : 1 })
+        self.assertEqual(summary["exit_code"], self.Answers.EXIT_OK, summary)
+        self.assertEqual(summary["disks"], ["ada1"])
+        self.data_pool("backup", "ada2")
+        summary = self.install(disks={ "names" : ["ada2"] }, destroy_pool=True)
+        self.assertEqual(summary["exit_code"], self.Answers.EXIT_OK, summary)
+        self.assertEqual(summary["disks"], ["ada2"])
+
+    def test_existing(self):
+        summary = self.install(disks=["ada0"], mode="format")
+        self.assertEqual(summary["exit_code"], self.Answers.EXIT_OK, summary)
+
+        # Formatting other disks would leave part of the boot pool behind
+        summary = self.install(disks=["ada1"], mode="format")
+        self.assertEqual(summary["exit_code"], self.Answers.EXIT_CONFLICT)
+        # A new boot environment can't move to other disks
+        summary = self.install(disks=["ada1"], mode="new-be")
+        self.assertEqual(summary["exit_code"], self.Answers.EXIT_CONFLICT)
+
+        # With no rule, an upgrade uses the boot pool's disks
+        summary = self.install()
+        self.assertEqual(summary["exit_code"], self.Answers.EXIT_OK, summary)
+        self.assertEqual(summary["mode"], "upgrade")
+        self.assertEqual(summary["disks"], ["ada0"])
+        summary = self.install(mode="new-be")
+        self.assertEqual(summary["exit_code"], self.Answers.EXIT_OK, summary)
+        self.assertEqual(summary["mode"], "new-be")
+
+        summary = self.install(disks=["ada1", "ada2"], mode="format", destroy_pool=True)
+        self.assertEqual(summary["exit_code"], self.Answers.EXIT_OK, summary)
+        self.assertEqual(summary["existing_pool"], ["ada0"])
+        self.assertEqual(len(self.boot_pool()), 1)
+        self.assertEqual(sorted(self.boot_pool()[0].disks), ["/dev/ada1p2", "/dev/ada2p2"])
+
+if __name__ == "__main__":
+    unittest.main()
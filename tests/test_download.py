@@ -0,0 +1,137 @@
+"""
+Downloader, against a local update server.
+"""
+from __future__ import print_function
+import os
+import json
+import shutil
+import hashlib
+import tempfile
+import threading
+import unittest
+
+from . import Support
+
+class DownloaderTest(unittest.TestCase):
+    def setUp(self):
+        self.hardware = Support.Hardware()
+        from ixsystems.installer import Download, Utils
+        import freenasOS.Manifest as Manifest
+        self.root = tempfile.mkdtemp()
+        Utils.InitLog(os.path.join(self.root, "log"))
+        (self.packages, self.contents) = Support.MakePackages([300000])
+        self.hardware.packages = self.packages
+        self.server = Support.UpdateServer()
+        self.server.publish(Manifest.Manifest(), self.contents)
+        self.name = self.packages[0].FileName()
+        self.data = self.contents[self.name]
+        self.url = "{}/Packages/{}".format(self.server.url, self.name)
+        self.path = os.path.join(self.root, self.name)
+        self.etag = '"{}"'.format(hashlib.sha256(self.data).hexdigest()[:16])
+        self.downloader = Download.Downloader(timeout=10, chunk_size=4096)
+
+    def tearDown(self):
+        self.downloader.close()
+        self.server.stop()
+        self.hardware.cleanup()
+        shutil.rmtree(self.root)
+
+    def fetch(self, **kwargs):
+        return self.downloader.fetch(self.url, self.path, size=len(self.data),
+                                     checksum=self.packages[0].Checksum(), **kwargs)
+
+    def partial(self, done, validator=None, data=None):
+        from ixsystems.installer import Download
+        with open(self.path + Download.PARTIAL_SUFFIX, "wb") as f:
+            f.write((data or self.data)[:done])
+        with open(self.path + Download.STATE_SUFFIX, "w") as f:
+            json.dump({ "url" : self.url, "validator" : validator or self.etag, "done" : done }, f)
+
+    def assertDownloaded(self):
+        from ixsystems.installer import Download
+        with open(self.path, "rb") as f:
+            self.assertEqual(f.read(), self.data)
+        self.assertEqual(sorted(os.listdir(self.root)), ["log", self.name])
+
+    def test_fetch(self):
+        self.assertEqual(self.fetch(), self.path)
+        self.assertDownloaded()
+        self.assertNotIn("Range", self.server.requested("/Packages/" + self.name)[0])
+
+    def test_resume(self):
+        self.partial(100000)
+        self.fetch()
+        self.assertDownloaded()
+        request = self.server.requested("/Packages/" + self.name)[0]
+        self.assertEqual(request["Range"], "bytes=100000-")
+        self.assertEqual(request["If-Range"], self.etag)
+        self.assertEqual(self.downloader.stats()["resumed_bytes"], 100000)
+
+    def test_changed(self):
+        # A different validator gets the whole file, which replaces what was there
+        self.partial(100000, validator='"old"', data=b"x" * 100000)
+        self.fetch()
+        self.assertDownloaded()
+        self.assertEqual(self.downloader.stats()["restarted"], 1)
+
+    def test_complete_partial(self):
+        # All of it was downloaded before a crash:  the server answers 416,
+        # and the next attempt has to start over rather than ask again
+        from ixsystems.installer import Download
+        self.partial(len(self.data))
+        with self.assertRaises(Download.DownloadError) as context:
+            self.fetch()
+        self.assertEqual(context.exception.status, 416)
+        self.assertEqual(os.listdir(self.root), ["log"])
+        self.fetch()
+        self.assertDownloaded()
+        self.assertNotIn("Range", self.server.requested("/Packages/" + self.name)[1])
+
+    def test_error_resuming(self):
+        from ixsystems.installer import Download
+        self.partial(100000)
+        self.server.failures["/Packages/" + self.name] = [500]
+        with self.assertRaises(Download.DownloadError):
+            self.fetch()
+        self.fetch()
+        self.assertDownloaded()
+        # The server error doesn't cost the part already downloaded
+        self.assertEqual(self.server.requested("/Packages/" + self.name)[1]["Range"], "bytes=100000-")
+
+    def test_checksum(self):
+        import freenasOS.Exceptions as Exceptions
+        with self.assertRaises(Exceptions.ChecksumFailException):
+            self.downloader.fetch(self.url, self.path, checksum="0" * 64)
+        self.assertEqual(os.listdir(self.root), ["log"])
+
+    def test_not_found(self):
+        from ixsystems.installer import Download
+        with self.assertRaises(Download.DownloadError) as context:
+            self.downloader.fetch(self.url + ".missing", self.path)
+        self.assertEqual(context.exception.status, 404)
+
+    def test_cancel(self):
+        from ixsystems.installer import Download
+        cancel = threading.Event()
+        def Handler(path, url, size=0, progress=None, download_rate=None):
+            if progress >= 50:
+                cancel.set()
+        with self.assertRaises(Download.DownloadCancelled):
+            self.fetch(handler=Handler, cancel=cancel)
+        with open(self.path + Download.STATE_SUFFIX) as f:
+            done = json.load(f)["done"]
+        self.assertGreaterEqual(done, len(self.data) // 2)
+        self.assertLess(done, len(self.data))
+        self.fetch()
+        self.assertDownloaded()
+        self.assertEqual(self.downloader.stats()["resumed_bytes"], done)
+
+    def test_reuse(self):
+        for index in range(3):
+            self.fetch()
+            os.unlink(self.path)
+        self.assertEqual(self.downloader.stats()["opened"], 1)
+        self.assertEqual(self.downloader.stats()["reused"], 2)
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,175 @@
+"""
+FetchScheduler (and GetPackages), downloading a manifest's worth of
+packages from a local update server.
+"""
+from __future__ import print_function
+import os
+import time
+import shutil
+import tempfile
+import unittest
+
+from . import Support
+
+SIZES = [40000, 300000, 5000, 120000, 1, 70000]
+
+class PackageServerTest(unittest.TestCase):
+    """
+    A manifest's worth of packages, on a local update server.
+    """
+    def setUp(self):
+        self.hardware = Support.Hardware()
+        from ixsystems.installer import Utils, Verify, Download
+        import freenasOS.Manifest as Manifest
+        self.root = tempfile.mkdtemp()
+        Utils.InitLog(os.path.join(self.root, "log"))
+        self.stamp_file = Verify.DEFAULT_STAMP_FILE
+        Verify.DEFAULT_STAMP_FILE = os.path.join(self.root, "verified.json")
+        self.cache_dir = os.path.join(self.root, "cache")
+        os.makedirs(self.cache_dir)
+        (self.packages, self.contents) = Support.MakePackages(SIZES)
+        self.hardware.packages = self.packages
+        self.server = Support.UpdateServer()
+        self.server.publish(Manifest.Manifest(), self.contents)
+        self.conf = Support.Configuration(self.server.url)
+        self.downloader = Download.Downloader(timeout=10)
+
+    def tearDown(self):
+        from ixsystems.installer import Verify
+        self.downloader.close()
+        self.server.stop()
+        Verify.DEFAULT_STAMP_FILE = self.stamp_file
+        self.hardware.cleanup()
+        shutil.rmtree(self.root)
+
+    def scheduler(self, **kwargs):
+        from ixsystems.installer import Fetch
+        return Fetch.FetchScheduler(self.conf, self.cache_dir, self.packages,
+                                    downloader=self.downloader, **kwargs)
+
+    def package_requests(self):
+        return [path for (path, headers) in self.server.requests if path.startswith("/Packages/")]
+
+    def assertFetched(self):
+        for (name, data) in self.contents.items():
+            with open(os.path.join(self.cache_dir, name), "rb") as f:
+                self.assertEqual(f.read(), data)
+
+class FetchSchedulerTest(PackageServerTest):
+    def test_largest_first(self):
+        scheduler = self.scheduler(max_workers=1)
+        self.assertEqual([job.size for job in scheduler.jobs], sorted(SIZES, reverse=True))
+        scheduler.wait()
+        by_size = sorted(self.packages, key=lambda pkg: pkg.Size(), reverse=True)
+        self.assertEqual(self.package_requests(), ["/Packages/" + pkg.FileName() for pkg in by_size])
+        self.assertFetched()
+
+    def test_ordered(self):
+        scheduler = self.scheduler(max_workers=1, ordered=True)
+        self.assertEqual([job.package for job in scheduler.jobs], self.packages)
+        scheduler.wait()
+        self.assertEqual(self.package_requests(), ["/Packages/" + pkg.FileName() for pkg in self.packages])
+
+    def test_progress(self):
+        scheduler = self.scheduler(max_workers=2)
+        self.assertEqual(scheduler.total_bytes, sum(SIZES))
+        self.assertEqual(scheduler.progress(), (0, sum(SIZES), 0, len(SIZES)))
+        seen = []
+        scheduler.wait(poll=lambda: seen.append(scheduler.progress()), interval=0.001)
+        seen.append(scheduler.progress())
+        for (done_bytes, total_bytes, done_count, total_count) in seen:
+            self.assertEqual(total_bytes, sum(SIZES))
+            self.assertEqual(total_count, len(SIZES))
+            self.assertLessEqual(done_bytes, total_bytes)
+        self.assertEqual([x[0] for x in seen], sorted(x[0] for x in seen))
+        self.assertEqual([x[2] for x in seen], sorted(x[2] for x in seen))
+        self.assertEqual(seen[-1], (sum(SIZES), sum(SIZES), len(SIZES), len(SIZES)))
+        self.assertEqual(scheduler.percentage(), 100)
+        self.assertFetched()
+
+    def test_already_fetched(self):
+        self.scheduler().wait()
+        count = len(self.package_requests())
+        scheduler = self.scheduler()
+        scheduler.wait()
+        self.assertEqual(len(self.package_requests()), count)
+        self.assertEqual(scheduler.progress(), (sum(SIZES), sum(SIZES), len(SIZES), len(SIZES)))
+
+    def test_retry(self):
+        path = "/Packages/" + self.packages[0].FileName()
+        self.server.failures[path] = [500, 503]
+        scheduler = self.scheduler(max_workers=1, retries=2)
+        scheduler.wait()
+        self.assertEqual(len(self.server.requested(path)), 3)
+        self.assertEqual([job.attempts for job in scheduler.jobs if job.package is self.packages[0]], [3])
+        self.assertFetched()
+
+    def test_retries_exhausted(self):
+        from ixsystems.installer import Fetch
+        path = "/Packages/" + self.packages[3].FileName()
+        self.server.failures[path] = [500] * 10
+        scheduler = self.scheduler(max_workers=1, retries=2)
+        with self.assertRaises(Fetch.FetchError) as context:
+            scheduler.wait()
+        self.assertIs(context.exception.package, self.packages[3])
+        self.assertEqual(context.exception.reason, "error")
+        self.assertEqual(len(self.server.requested(path)), 3)
+        self.assertFalse(os.path.exists(os.path.join(self.cache_dir, self.packages[3].FileName())))
+
+    def test_missing(self):
+        from ixsystems.installer import Utils
+        import freenasOS.Manifest as Manifest
+        del self.server.files[self.packages[2].FileName()]
+        with self.assertRaises(Utils.InstallationError) as context:
+            Utils.GetPackages(Manifest.Manifest(), self.conf, self.cache_dir,
+                              retries=1, downloader=self.downloader)
+        self.assertEqual(str(context.exception), "Missing package {}".format(self.packages[2].Name()))
+
+    def test_checksum_failure(self):
+        from ixsystems.installer import Utils
+        import freenasOS.Manifest as Manifest
+        import freenasOS.Package as Package
+        bad = self.packages[1]
+        self.hardware.packages = [Package.Package(pkg.Name(), pkg.Version(), pkg.Size(), "0" * 64)
+                                  if pkg is bad else pkg for pkg in self.packages]
+        with self.assertRaises(Utils.InstallationError) as context:
+            Utils.GetPackages(Manifest.Manifest(), self.conf, self.cache_dir,
+                              retries=1, downloader=self.downloader)
+        self.assertEqual(str(context.exception), "Invalid package checksum: {}".format(bad.Name()))
+        self.assertEqual(len(self.server.requested("/Packages/" + bad.FileName())), 2)
+        self.assertEqual([name for name in os.listdir(self.cache_dir) if name.startswith(bad.Name())], [])
+
+    def test_get_packages(self):
+        from ixsystems.installer import Utils
+        import freenasOS.Manifest as Manifest
+        Utils.GetPackages(Manifest.Manifest(), self.conf, self.cache_dir, downloader=self.downloader)
+        self.assertFetched()
+        self.assertEqual(self.downloader.stats()["downloads"], len(SIZES))
+
+class BackgroundFetchTest(PackageServerTest):
+    def test_stop(self):
+        from ixsystems.installer import Fetch, Download
+        # About 20 seconds a package, if it were left to finish
+        self.server.delay = 1.0
+        self.downloader = Download.Downloader(timeout=10, chunk_size=4096)
+        prefetch = Fetch.BackgroundFetch(self.conf, self.cache_dir, self.packages,
+                                         downloader=self.downloader).start()
+        while len(self.package_requests()) < Fetch.BACKGROUND_WORKERS:
+            time.sleep(0.01)
+        start = time.monotonic()
+        self.assertTrue(prefetch.stop(timeout=5))
+        self.assertLess(time.monotonic() - start, 3)
+        (done_bytes, total_bytes, done_count, total_count) = prefetch.progress()
+        self.assertEqual(done_count, 0)
+        self.assertEqual(len(self.package_requests()), Fetch.BACKGROUND_WORKERS)
+        # What was downloaded is kept, and the rest is resumed
+        names = os.listdir(self.cache_dir)
+        self.assertEqual(len([name for name in names if name.endswith(Download.STATE_SUFFIX)]),
+                         Fetch.BACKGROUND_WORKERS)
+        self.server.delay = 0
+        self.scheduler().wait()
+        self.assertFetched()
+        self.assertEqual(self.downloader.stats()["resumed"], Fetch.BACKGROUND_WORKERS)
+
+if __name__ == "__main__":
+    unittest.main()
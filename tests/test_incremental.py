@@ -0,0 +1,211 @@
+"""
+Incremental upgrades:  comparing manifests (PackageChanges), deciding
+whether the active boot environment can be cloned and upgraded in
+place (PlanIncrementalUpgrade), and falling back to a full installation.
+"""
+from __future__ import print_function
+import os
+import json
+import unittest
+
+from . import Support
+
+def Packages(*packages):
+    """
+    (name, version[, checksum]) tuples, as manifest entries.
+    """
+    return [{ "Name" : x[0], "Version" : x[1], "Size" : 1024,
+              "Checksum" : x[2] if len(x) > 2 else None } for x in packages]
+
+class Session(object):
+    """
+    Stands in for a BootPool.BootPoolSession, with root as the active
+    boot environment.
+    """
+    def __init__(self, root, bootfs="freenas-boot/ROOT/default"):
+        self.root = root
+        self._bootfs = bootfs
+
+    @property
+    def bootfs(self):
+        if isinstance(self._bootfs, BaseException):
+            raise self._bootfs
+        return self._bootfs
+
+    def mount_bootfs(self):
+        return self.root
+
+class PlanTest(unittest.TestCase):
+    def setUp(self):
+        self.hardware = Support.Hardware()
+        from ixsystems.installer import Install
+        import freenasOS.Configuration as Configuration
+        self.Install = Install
+        self.config = Configuration.SystemConfiguration()
+        self.root = os.path.join(self.hardware.root, "be")
+        os.makedirs(os.path.join(self.root, "data"))
+        self.old = self.manifest(Packages(("base-os", "1.0", "a"), ("kernel", "1.0", "b"), ("samba", "4.1", "c")))
+
+    def tearDown(self):
+        self.hardware.cleanup()
+
+    def manifest(self, packages, train=Support.TRAIN, sequence="1"):
+        import freenasOS.Manifest as Manifest
+        path = os.path.join(self.hardware.root, "manifest-{}.json".format(sequence))
+        with open(path, "w") as f:
+            json.dump({ "Train" : train, "Sequence" : sequence, "Packages" : packages }, f)
+        manifest = Manifest.Manifest()
+        manifest.LoadPath(path)
+        return manifest
+
+    def installed(self, manifest, **versions):
+        """
+        Make the boot environment the installation of manifest, with
+        the package database saying versions instead, where given.
+        """
+        manifest.Save(self.root)
+        pkgdb = self.config.PackageDB(self.root)
+        for pkg in manifest.Packages():
+            version = versions.get(pkg.Name(), pkg.Version())
+            if version is not None:
+                pkgdb.AddPackage(pkg.Name(), version)
+
+    def changes(self, new):
+        result = self.Install.PackageChanges(self.old, new)
+        if result is None:
+            return None
+        (changed, removed) = result
+        return ([pkg.Name() for pkg in changed], removed)
+
+    def test_same(self):
+        self.assertEqual(self.changes(self.old), ([], []))
+
+    def test_changed(self):
+        new = self.manifest(Packages(("base-os", "1.0", "a"), ("kernel", "1.1", "d"), ("samba", "4.1", "c"),
+                                     ("netatalk", "3.0", "e")), sequence="2")
+        self.assertEqual(self.changes(new), (["kernel", "netatalk"], []))
+
+    def test_checksum_only(self):
+        # The same version, rebuilt
+        new = self.manifest(Packages(("base-os", "1.0", "a"), ("kernel", "1.0", "f"), ("samba", "4.1", "c")),
+                            sequence="2")
+        self.assertEqual(self.changes(new), (["kernel"], []))
+        # Without a checksum on one side, the version has to do
+        new = self.manifest(Packages(("base-os", "1.0"), ("kernel", "1.0", "f"), ("samba", "4.1", "c")),
+                            sequence="3")
+        self.assertEqual(self.changes(new), (["kernel"], []))
+
+    def test_removed(self):
+        new = self.manifest(Packages(("kernel", "1.1", "d"), ("base-os", "1.0", "a")), sequence="2")
+        self.assertEqual(self.changes(new), (["kernel"], ["samba"]))
+
+    def test_other_train(self):
+        new = self.manifest(Packages(("base-os", "1.0", "a"), ("kernel", "1.0", "b"), ("samba", "4.1", "c")),
+                            train="FreeNAS-Other", sequence="2")
+        self.assertIsNone(self.changes(new))
+
+    def test_unusable_entries(self):
+        for packages in [Packages(("base-os", "1.0", "a"), ("kernel", "1.1", "d"), ("kernel", "1.2", "e")),
+                         Packages(("base-os", "1.0", "a"), ("kernel", "", "d")),
+                         Packages(("base-os", "1.0", "a"), ("kernel", None, "d"))]:
+            self.assertIsNone(self.changes(self.manifest(packages, sequence="2")))
+            # On either side
+            self.assertIsNone(self.Install.PackageChanges(self.manifest(packages, sequence="3"), self.old))
+
+    def plan(self, new, session=None):
+        return self.Install.PlanIncrementalUpgrade(session or Session(self.root), new, self.config)
+
+    def test_plan(self):
+        self.installed(self.old)
+        new = self.manifest(Packages(("base-os", "1.0", "a"), ("kernel", "1.1", "d")), sequence="2")
+        plan = self.plan(new)
+        self.assertEqual(plan.bootfs, "freenas-boot/ROOT/default")
+        self.assertEqual([pkg.Name() for pkg in plan.changed], ["kernel"])
+        self.assertEqual(plan.removed, ["samba"])
+
+    def test_plan_not_comparable(self):
+        self.installed(self.old)
+        new = self.manifest(Packages(("base-os", "1.0", "a"), ("kernel", "1.1", "d")),
+                            train="FreeNAS-Other", sequence="2")
+        self.assertIsNone(self.plan(new))
+
+    def test_package_db_disagrees(self):
+        new = self.manifest(Packages(("base-os", "1.0", "a"), ("kernel", "1.1", "d"), ("samba", "4.1", "c")),
+                            sequence="2")
+        # A package upgraded (or removed) behind the manifest's back
+        for versions in [{ "samba" : "4.2" }, { "samba" : None }]:
+            self.installed(self.old, **versions)
+            self.assertIsNone(self.plan(new))
+            os.unlink(os.path.join(self.root, "data", "pkgdb", "simulated.json"))
+
+    def test_no_manifest(self):
+        self.assertIsNone(self.plan(self.old))
+
+    def test_no_bootfs(self):
+        self.installed(self.old)
+        self.assertIsNone(self.plan(self.old, Session(self.root, bootfs=None)))
+        self.assertIsNone(self.plan(self.old, Session(self.root, bootfs=RuntimeError("no pool"))))
+
+class UpgradeTest(unittest.TestCase):
+    """
+    Upgrading a simulated installation into a new boot environment.
+    """
+    def setUp(self):
+        # The packages come from the simulated network
+        from ixsystems.installer import Simulator
+        self.hardware = Simulator.Hardware(disks=1, packages=4, package_size=64 * 1024).install()
+        self.Simulator = Simulator
+        from ixsystems.installer import Install, Utils, Verify
+        self.Install = Install
+        Verify.DEFAULT_STAMP_FILE = os.path.join(self.hardware.root, "verified.json")
+        Utils.InitLog(os.path.join(self.hardware.root, "log"))
+        Utils.RescanTopology()
+        self.installed = []
+        self.install(disks=[Utils.Disk("ada0")])
+        self.hardware.release(changed=1)
+        self.installed = []
+
+    def tearDown(self):
+        self.hardware.cleanup()
+
+    def install(self, **kwargs):
+        import freenasOS.Manifest as Manifest
+        import freenasOS.Configuration as Configuration
+        self.Install.Install(interactive=False, manifest=Manifest.Manifest(),
+                             config=Configuration.SystemConfiguration(),
+                             package_directory=self.hardware.package_dir,
+                             data_dir=os.path.join(self.hardware.root, "no-data"),
+                             pipeline=True,
+                             package_handler=lambda index, name, names: self.installed.append(name),
+                             **kwargs)
+
+    def upgrade(self):
+        pool = list(self.Install.zfs.find_import(name="freenas-boot"))[0]
+        self.install(upgrade_from=pool, upgrade=True)
+        pool = self.hardware.pools[0]
+        bootfs = pool.datasets[pool.properties["bootfs"].value]
+        pkgdb = self.Simulator.PackageDB(bootfs.path)
+        for pkg in self.hardware.packages:
+            self.assertEqual(pkgdb.FindPackage(pkg.Name()), { pkg.Name() : pkg.Version() })
+        return (pool, bootfs)
+
+    def test_incremental(self):
+        (pool, bootfs) = self.upgrade()
+        self.assertEqual(self.installed, [self.hardware.packages[-1].Name()])
+        self.assertIn("origin", bootfs.properties)
+
+    def test_clone_fails(self):
+        def Clone(snapshot, name, opts=None):
+            raise self.Simulator.ZFSException(28, "out of space")
+        self.Simulator.ZFSSnapshot.clone, clone = Clone, self.Simulator.ZFSSnapshot.clone
+        try:
+            (pool, bootfs) = self.upgrade()
+        finally:
+            self.Simulator.ZFSSnapshot.clone = clone
+        # Every package, into a new boot environment, and no snapshot left behind
+        self.assertEqual(sorted(self.installed), sorted(pkg.Name() for pkg in self.hardware.packages))
+        self.assertNotIn("origin", bootfs.properties)
+        self.assertEqual(list(pool.snapshots), [])
+
+if __name__ == "__main__":
+    unittest.main()
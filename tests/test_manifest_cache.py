@@ -0,0 +1,138 @@
+"""
+ManifestCache, against a local update server.
+"""
+from __future__ import print_function
+import os
+import shutil
+import tempfile
+import unittest
+
+from . import Support
+
+LAST_MODIFIED = "Tue, 01 Sep 2026 00:00:00 GMT"
+
+class ManifestCacheTest(unittest.TestCase):
+    def setUp(self):
+        self.hardware = Support.Hardware()
+        from ixsystems.installer import ManifestCache, Utils
+        import freenasOS.Manifest as Manifest
+        self.root = tempfile.mkdtemp()
+        self.log = os.path.join(self.root, "log")
+        Utils.InitLog(self.log)
+        (self.hardware.packages, contents) = Support.MakePackages([1000, 3000, 2000])
+        self.server = Support.UpdateServer()
+        self.server.publish(Manifest.Manifest(), contents, etag='"v1"', last_modified=LAST_MODIFIED)
+        self.url = self.server.url
+        self.cache = ManifestCache.ManifestCache(os.path.join(self.root, "cache"), timeout=5)
+        self.stopped = False
+
+    def tearDown(self):
+        if not self.stopped:
+            self.server.stop()
+        self.hardware.cleanup()
+        shutil.rmtree(self.root)
+
+    def stop_server(self):
+        self.server.stop()
+        self.stopped = True
+
+    def manifest_requests(self):
+        return self.server.requested("/{}/LATEST".format(Support.TRAIN))
+
+    def logged(self):
+        from ixsystems.installer import Logger
+        Logger.Flush()
+        with open(self.log) as f:
+            return f.read()
+
+    def get(self):
+        return self.cache.get(self.url, Support.TRAIN)
+
+    def assertManifest(self, cached, source):
+        self.assertEqual(cached.source, source)
+        self.assertEqual(cached.stale, source == "stale")
+        self.assertEqual([pkg.Name() for pkg in cached.manifest.Packages()],
+                         [pkg.Name() for pkg in self.hardware.packages])
+        self.assertEqual([(entry.name, entry.filename, entry.size, entry.checksum) for entry in cached.index.values()],
+                         [(pkg.Name(), pkg.FileName(), pkg.Size(), pkg.Checksum()) for pkg in self.hardware.packages])
+        self.assertEqual(cached.total_size, 6000)
+
+    def test_revalidate_etag(self):
+        self.assertManifest(self.get(), "fetched")
+        self.assertManifest(self.get(), "not-modified")
+        requests = self.manifest_requests()
+        self.assertEqual(len(requests), 2)
+        self.assertNotIn("If-None-Match", requests[0])
+        self.assertEqual(requests[1]["If-None-Match"], '"v1"')
+        self.assertEqual(requests[1]["If-Modified-Since"], LAST_MODIFIED)
+        self.assertEqual(self.cache.stats()["fetched"], 1)
+        self.assertEqual(self.cache.stats()["not_modified"], 1)
+
+    def test_revalidate_last_modified(self):
+        self.server.etag = None
+        self.assertManifest(self.get(), "fetched")
+        self.assertManifest(self.get(), "not-modified")
+        requests = self.manifest_requests()
+        self.assertNotIn("If-None-Match", requests[1])
+        self.assertEqual(requests[1]["If-Modified-Since"], LAST_MODIFIED)
+
+    def test_changed(self):
+        import freenasOS.Manifest as Manifest
+        self.get()
+        (self.hardware.packages, contents) = Support.MakePackages([1000, 3000, 2000], seed=1)
+        self.server.publish(Manifest.Manifest(), contents, etag='"v2"')
+        self.assertManifest(self.get(), "fetched")
+        self.assertManifest(self.get(), "not-modified")
+        self.assertEqual(self.manifest_requests()[2]["If-None-Match"], '"v2"')
+
+    def test_unreachable(self):
+        fetched = self.get()
+        self.stop_server()
+        cached = self.get()
+        self.assertManifest(cached, "stale")
+        self.assertEqual(cached.fetched, fetched.fetched)
+        self.assertEqual(self.cache.stats()["stale"], 1)
+        self.assertIn("WARNING: Could not get the manifest for {}".format(Support.TRAIN), self.logged())
+
+    def test_server_error(self):
+        self.get()
+        self.server.failures["/{}/LATEST".format(Support.TRAIN)] = [500]
+        self.assertManifest(self.get(), "stale")
+        self.assertManifest(self.get(), "not-modified")
+
+    def test_corrupt_cache(self):
+        self.get()
+        for name in os.listdir(self.cache.root):
+            if name.endswith(".manifest"):
+                with open(os.path.join(self.cache.root, name), "w") as f:
+                    f.write("not a manifest")
+        self.assertManifest(self.get(), "fetched")
+        requests = self.manifest_requests()
+        self.assertEqual(len(requests), 3)
+        # The cached copy was no good, so the second try isn't conditional
+        self.assertEqual(requests[1]["If-None-Match"], '"v1"')
+        self.assertNotIn("If-None-Match", requests[2])
+        self.assertNotIn("If-Modified-Since", requests[2])
+        self.assertManifest(self.get(), "not-modified")
+
+    def test_bad_manifest(self):
+        from ixsystems.installer import ManifestCache
+        self.server.manifest = b"garbage"
+        with self.assertRaises(ManifestCache.ManifestCacheError):
+            self.get()
+        self.assertEqual([name for name in os.listdir(self.cache.root) if not name.startswith(".")], [])
+
+    def test_nothing_cached(self):
+        from ixsystems.installer import ManifestCache
+        self.stop_server()
+        with self.assertRaises(ManifestCache.ManifestCacheError) as context:
+            self.get()
+        self.assertIn("Could not get the manifest for {}".format(Support.TRAIN), context.exception.message)
+
+    def test_not_found(self):
+        from ixsystems.installer import ManifestCache
+        with self.assertRaises(ManifestCache.ManifestCacheError):
+            self.cache.get(self.url, "Some-Other-Train")
+
+if __name__ == "__main__":
+    unittest.main()
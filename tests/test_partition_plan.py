@@ -0,0 +1,131 @@
+"""
+Properties of PartitionPlan.Plan, over random disks and partition lists.
+"""
+from __future__ import print_function
+import random
+import collections
+import unittest
+
+from . import Support
+
+MiB = 1024 * 1024
+GiB = 1024 * MiB
+RUNS = 2000
+
+Disk = collections.namedtuple("Disk", ["name", "size", "sectorsize", "stripesize"])
+
+class PlanPropertiesTest(unittest.TestCase):
+    def setUp(self):
+        self.hardware = Support.Hardware()
+
+    def tearDown(self):
+        self.hardware.cleanup()
+
+    def random_disks(self, rng):
+        disks = []
+        for index in range(rng.randint(1, 4)):
+            sectorsize = rng.choice([512, 4096])
+            stripesize = rng.choice([0, 0, sectorsize, 4096, 8192, 128 * 1024, MiB,
+                                     2 * MiB, 4 * MiB, 32 * MiB, 3000, 3 * MiB])
+            size = rng.choice([rng.randint(16 * MiB, 2 * GiB), rng.randint(2 * GiB, 2048 * GiB)])
+            disks.append(Disk("ada{}".format(index), size // sectorsize * sectorsize, sectorsize, stripesize))
+        return disks
+
+    def random_partitions(self, rng):
+        from ixsystems.installer import Utils
+        sizes = [rng.choice([512 * 1024, MiB, 260 * MiB, rng.randint(1, 600 * MiB)])
+                 for index in range(rng.randint(0, 3))]
+        os_size = rng.choice([0, 0, rng.randint(1, 64 * GiB)])
+        after = [rng.choice([rng.randint(1, 2 * GiB), 16 * GiB]) for index in range(rng.randint(0, 1))]
+        partitions = [Utils.Partition("efi" if index == 0 else "bios-boot", str(index + 1), size)
+                      for (index, size) in enumerate(sizes)]
+        partitions.append(Utils.Partition("freebsd-zfs", str(len(partitions) + 1), os_size, os=True))
+        for size in after:
+            partitions.append(Utils.Partition("swap", str(len(partitions) + 1), size))
+        if rng.random() < 0.1:
+            partitions = [part for part in partitions if not part.os]
+        return partitions
+
+    def check(self, disks, partitions, plan):
+        from ixsystems.installer import PartitionPlan
+        alignment = plan.alignment
+        self.assertEqual(alignment, PartitionPlan.Alignment(disks))
+        self.assertEqual(alignment % max(disk.sectorsize for disk in disks), 0)
+        self.assertEqual([entry.partition for entry in plan.entries], partitions)
+        heads = max(PartitionPlan._GPTBytes(disk.sectorsize)[0] for disk in disks)
+        ends = { disk.name : disk.size - PartitionPlan._GPTBytes(disk.sectorsize)[1] for disk in disks }
+
+        gaps = 0
+        previous = heads
+        for entry in plan.entries:
+            self.assertEqual(entry.start % alignment, 0)
+            self.assertGreater(entry.size, 0)
+            self.assertGreaterEqual(entry.start, previous)
+            gaps += entry.start - previous
+            previous = entry.start + entry.size
+            if entry.partition.os:
+                self.assertEqual(entry.size % alignment, 0)
+                if entry.partition.size:
+                    self.assertLessEqual(entry.size, entry.partition.size)
+            else:
+                self.assertGreaterEqual(entry.size, entry.partition.size)
+                self.assertLess(entry.size - entry.partition.size, max(disk.sectorsize for disk in disks))
+        self.assertLessEqual(previous, min(ends.values()))
+        self.assertEqual(plan.unused, { name : end - previous for (name, end) in ends.items() })
+
+        # Every disk gets the same layout, in whole sectors
+        layouts = []
+        for disk in disks:
+            layout = []
+            for entry in plan.entries:
+                self.assertEqual(entry.size % disk.sectorsize, 0)
+                args = plan.GpartArgs(disk, entry)
+                layout.append((int(args[5]) * disk.sectorsize, int(args[7]) * disk.sectorsize))
+            layouts.append(layout)
+        self.assertEqual(layouts, [[(entry.start, entry.size) for entry in plan.entries]] * len(disks))
+
+        # What's lost is the gaps, and the end of the smallest disk if the OS partition was to fill it
+        os_parts = [entry for entry in plan.entries if entry.partition.os]
+        if not os_parts:
+            self.assertEqual(plan.lost, gaps)
+        elif (not os_parts[0].partition.size or
+              os_parts[0].size < _RoundDownTo(os_parts[0].partition.size, alignment)):
+            self.assertEqual(plan.lost, gaps + min(plan.unused.values()))
+        else:
+            # It got the size it asked for, which may or may not have been all there was
+            self.assertIn(plan.lost, (gaps, gaps + min(plan.unused.values())))
+
+    def test_properties(self):
+        from ixsystems.installer import PartitionPlan
+        rng = random.Random(20)
+        planned = 0
+        for run in range(RUNS):
+            disks = self.random_disks(rng)
+            partitions = self.random_partitions(rng)
+            try:
+                plan = PartitionPlan.Plan(disks, partitions)
+            except ValueError:
+                # Only when it really doesn't fit:  with room for the GPT, a
+                # minimal OS partition, and rounding, it would have
+                alignment = PartitionPlan.Alignment(disks)
+                needed = sum(_RoundUpTo(part.size, alignment) for part in partitions if not part.os)
+                self.assertGreater(needed + 4 * alignment, min(disk.size for disk in disks))
+                continue
+            with self.subTest(run=run, disks=disks, partitions=partitions):
+                self.check(disks, partitions, plan)
+            planned += 1
+        self.assertGreater(planned, RUNS // 2)
+
+    def test_no_disks(self):
+        from ixsystems.installer import PartitionPlan, Utils
+        with self.assertRaises(ValueError):
+            PartitionPlan.Plan([], [Utils.Partition("freebsd-zfs", "1", 0, os=True)])
+
+def _RoundDownTo(value, unit):
+    return value // unit * unit
+
+def _RoundUpTo(value, unit):
+    return -(-value // unit) * unit
+
+if __name__ == "__main__":
+    unittest.main()
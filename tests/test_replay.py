@@ -0,0 +1,56 @@
+"""
+Replay traces:  recording and replaying calls, and keeping the root
+password out of them.
+"""
+from __future__ import print_function
+import os
+import shutil
+import tempfile
+import unittest
+
+from ixsystems.installer import Replay
+
+PASSWORD = "correct horse battery staple"
+
+class CommandFailed(RuntimeError):
+    def __init__(self, command):
+        super(CommandFailed, self).__init__("{} failed".format(command))
+        self.command = command
+
+def RunCommand(*args, **kwargs):
+    if kwargs.get("fail", False):
+        raise CommandFailed(" ".join(args))
+    return "ran {}".format(args[0])
+
+class RedactionTest(unittest.TestCase):
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.path = os.path.join(self.root, "trace.json")
+
+    def tearDown(self):
+        shutil.rmtree(self.root)
+
+    def test_password(self):
+        recorder = Replay.Recorder()
+        command = recorder.root("RunCommand", RunCommand)
+        self.assertEqual(command("/etc/netcli", "reset_root_pw", PASSWORD), "ran /etc/netcli")
+        with self.assertRaises(CommandFailed) as context:
+            command("/etc/netcli", "reset_root_pw", PASSWORD, fail=True)
+        # The caller still gets the real thing
+        self.assertIn(PASSWORD, context.exception.command)
+        self.assertEqual(command("/sbin/zpool", "status"), "ran /sbin/zpool")
+        recorder.save(self.path)
+        with open(self.path) as f:
+            trace = f.read()
+        self.assertNotIn(PASSWORD, trace)
+        self.assertIn(Replay.REDACTED, trace)
+
+        player = Replay.Player(self.path, scale=0)
+        command = player.root("RunCommand")
+        self.assertEqual(command("/etc/netcli", "reset_root_pw", "any password"), "ran /etc/netcli")
+        self.assertEqual(command("/sbin/zpool", "status"), "ran /sbin/zpool")
+        with self.assertRaises(Replay.ReplayMismatch):
+            command("/sbin/zpool", "list")
+
+if __name__ == "__main__":
+    unittest.main()
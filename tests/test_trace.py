@@ -0,0 +1,47 @@
+"""
+Trace's summary of the phases of a run.
+"""
+from __future__ import print_function
+import threading
+import unittest
+
+from ixsystems.installer import Trace
+
+class SummaryTest(unittest.TestCase):
+    def run_install(self, tracer):
+        def Worker():
+            with tracer.span("Download"):
+                pass
+        with tracer.span("do_unattended"):
+            with tracer.span("FindBootPool"):
+                with tracer.span("WaitForDiscovery"):
+                    pass
+            with tracer.span("Install"):
+                with tracer.span("FormatDisks"):
+                    with tracer.span("gpart"):
+                        pass
+                with tracer.span("InstallPackages"):
+                    worker = threading.Thread(target=Worker)
+                    worker.start()
+                    worker.join()
+                with tracer.span("Answer", category=Trace.OPERATOR):
+                    pass
+                with tracer.span("FormatDisks"):
+                    pass
+
+    def test_top_level(self):
+        tracer = Trace.Tracer()
+        self.run_install(tracer)
+        self.assertEqual(sorted(tracer.summary()["phases"]), ["Download", "do_unattended"])
+
+    def test_skip(self):
+        tracer = Trace.Tracer()
+        self.run_install(tracer)
+        summary = tracer.summary(skip=("do_unattended", "Install"))
+        self.assertEqual(sorted(summary["phases"]), ["FindBootPool", "FormatDisks", "InstallPackages"])
+        spans = [x for x in tracer.spans() if x.name == "FormatDisks"]
+        self.assertEqual(summary["phases"]["FormatDisks"], sum(x.duration for x in spans))
+        self.assertEqual(sorted(tracer.summary(skip=("do_unattended",))["phases"]), ["FindBootPool", "Install"])
+
+if __name__ == "__main__":
+    unittest.main()